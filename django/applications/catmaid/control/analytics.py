@@ -47,6 +47,124 @@ def list_broken_section_nodes(request, project_id=None):
 
     return JsonResponse(broken_section_nodes, safe=False)
 
+BrokenSectionRange = namedtuple('BrokenSectionRange', ['stack_id',
+        'stack_title', 'orientation', 'section', 'start', 'end'])
+
+BrokenSectionInterval = namedtuple('BrokenSectionInterval', ['start', 'end',
+        'ranges'])
+
+# The node coordinate that is tested for each stack orientation (XY, XZ, ZY)
+ORIENTATION_COLUMN = {
+    0: 'location_z',
+    1: 'location_y',
+    2: 'location_x',
+}
+
+def get_broken_section_intervals(project_id, cursor=None):
+    """Get the project space ranges of all broken sections of all stacks
+    linked to the passed in project. Returns a dictionary that maps each
+    orientation to a sorted list of disjoint BrokenSectionInterval tuples.
+    Each interval covers the half-open [start, end) ranges of one or more
+    overlapping or adjacent broken sections, which are available as list of
+    BrokenSectionRange tuples.
+    """
+    cursor = cursor or connection.cursor()
+    cursor.execute("""
+        SELECT s.id, s.title, ps.orientation, bs.index,
+            CASE WHEN ps.orientation = 0 THEN (ps.translation).z + bs.index * (s.resolution).z
+                 WHEN ps.orientation = 1 THEN (ps.translation).y + bs.index * (s.resolution).y
+                 WHEN ps.orientation = 2 THEN (ps.translation).x + bs.index * (s.resolution).x
+            END AS broken_z,
+            CASE WHEN ps.orientation = 0 THEN (ps.translation).z + (bs.index + 1) * (s.resolution).z
+                 WHEN ps.orientation = 1 THEN (ps.translation).y + (bs.index + 1) * (s.resolution).y
+                 WHEN ps.orientation = 2 THEN (ps.translation).x + (bs.index + 1) * (s.resolution).x
+            END AS next_z
+        FROM project_stack ps
+        JOIN stack s
+            ON s.id = ps.stack_id
+        JOIN broken_slice bs
+            ON bs.stack_id = s.id
+        WHERE ps.project_id = %(project_id)s
+    """, {
+        'project_id': project_id
+    })
+
+    ranges = defaultdict(list)
+    for row in cursor.fetchall():
+        broken_range = BrokenSectionRange(*row)
+        if broken_range.start is not None:
+            ranges[broken_range.orientation].append(broken_range)
+
+    intervals = {}
+    for orientation, orientation_ranges in six.iteritems(ranges):
+        orientation_ranges.sort(key=lambda r: r.start)
+        merged = []
+        for r in orientation_ranges:
+            if merged and r.start <= merged[-1].end:
+                last = merged[-1]
+                merged[-1] = BrokenSectionInterval(last.start,
+                        max(last.end, r.end), last.ranges + [r])
+            else:
+                merged.append(BrokenSectionInterval(r.start, r.end, [r]))
+        intervals[orientation] = merged
+
+    return intervals
+
+def iter_broken_section_nodes(project_id, skeleton_ids=None, intervals=None,
+        cursor=None):
+    """Yield all treenodes that are located in a broken section of any stack
+    linked to the given project ID. If there are skeleton IDs passed in, the
+    test will only be performed on these skeletons. Precomputed intervals from
+    get_broken_section_intervals() can be passed in when testing the same
+    project repeatedly.
+
+    Each broken section interval is looked up separately using the location
+    index of the treenode table, and results are streamed from the database
+    using a server side cursor, unless a cursor is passed in.
+
+    Yields tuples of the form (treenode_id, stack_id, stack_title, orientation,
+    section, z).
+    """
+    if intervals is None:
+        intervals = get_broken_section_intervals(project_id, cursor)
+
+    params = {
+        'project_id': project_id,
+        'skeleton_ids': skeleton_ids,
+    }
+    if skeleton_ids:
+        skid_constraint = 'AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])'
+    else:
+        skid_constraint = ''
+
+    for orientation, orientation_intervals in six.iteritems(intervals):
+        column = ORIENTATION_COLUMN[orientation]
+        params['starts'] = [i.start for i in orientation_intervals]
+        params['ends'] = [i.end for i in orientation_intervals]
+
+        node_cursor = cursor or connection.chunked_cursor()
+        try:
+            node_cursor.execute("""
+                SELECT t.id, t.{column}, broken_interval.index
+                FROM UNNEST(%(starts)s::float8[], %(ends)s::float8[])
+                    WITH ORDINALITY AS broken_interval(start, next, index)
+                JOIN treenode t
+                    ON t.project_id = %(project_id)s
+                    AND t.{column} >= broken_interval.start
+                    AND t.{column} < broken_interval.next
+                {skid_constraint}
+            """.format(column=column, skid_constraint=skid_constraint), params)
+
+            # Find the broken sections of all stacks the node is located in
+            for node_id, location, index in node_cursor:
+                for r in orientation_intervals[index - 1].ranges:
+                    if r.start <= location < r.end:
+                        yield (node_id, r.stack_id, r.stack_title,
+                                orientation, r.section, r.start)
+        finally:
+            if node_cursor is not cursor:
+                node_cursor.close()
+
 def check_broken_section(project_id, skeleton_ids=None, cursor=None):
     """Test if there are treenodes in a broken section of any stack linked to
     the given project ID. If there are skeleton IDs passed in, the test will
@@ -54,64 +172,8 @@ def check_broken_section(project_id, skeleton_ids=None, cursor=None):
 
     Returns tuples of the form (treenode_id, stack_id, stack_title, orientation, section, z)
     """
-    params = [project_id]
-    if skeleton_ids:
-        params = params + skeleton_ids
-        skid_constraint = 'AND t.skeleton_id IN ({})'.format(
-            ','.join('%s' for _ in skeleton_ids))
-    else:
-        skid_constraint = ''
-
-    cursor = cursor or connection.cursor()
-    cursor.execute("""
-        WITH broken_project_slice AS (
-            SELECT p.id AS project_id,
-                s.id AS stack_id,
-                s.title AS stack_title,
-                ps.orientation AS orientation,
-                bs.index as broken_section,
-                CASE WHEN ps.orientation = 0 THEN (ps.translation).z + bs.index * (s.resolution).z
-                     WHEN ps.orientation = 1 THEN (ps.translation).y + bs.index * (s.resolution).y
-                     WHEN ps.orientation = 2 THEN (ps.translation).x + bs.index * (s.resolution).x
-                END AS broken_z,
-                CASE WHEN ps.orientation = 0 THEN (ps.translation).z + (bs.index + 1) * (s.resolution).z
-                     WHEN ps.orientation = 1 THEN (ps.translation).y + (bs.index + 1) * (s.resolution).y
-                     WHEN ps.orientation = 2 THEN (ps.translation).x + (bs.index + 1) * (s.resolution).x
-                END AS next_z
-            FROM project p
-            JOIN project_stack ps
-                ON ps.project_id = p.id
-            JOIN stack s
-                ON s.id = ps.stack_id
-            JOIN broken_slice bs
-                ON bs.stack_id = s.id
-        )
-        SELECT t.id, bps.stack_id, bps.stack_title, bps.orientation,
-            bps.broken_section, bps.broken_z
-        FROM treenode t
-        JOIN broken_project_slice bps
-            ON t.project_id = bps.project_id
-        WHERE t.project_id = %s
-            AND ((
-                -- XY orientation: check if node Z is in broken section, i.e. same
-                bps.orientation = 0
-                AND t.location_z >= bps.broken_z
-                AND t.location_z < bps.next_z
-            ) OR (
-                -- XZ orientation: check if node Y is in broken section, i.e. same
-                bps.orientation = 1
-                AND t.location_y >= bps.broken_z
-                AND t.location_y < bps.next_z
-            ) OR(
-                -- ZY orientation: check if node X is in broken section, i.e. same
-                bps.orientation = 2
-                AND t.location_x >= bps.broken_z
-                AND t.location_x < bps.next_z
-            ))
-            {}
-    """.format(skid_constraint), params)
-
-    return cursor.fetchall()
+    return list(iter_broken_section_nodes(project_id, skeleton_ids,
+            cursor=cursor))
 
 @requires_user_role(UserRole.Browse)
 def analyze_skeletons(request, project_id=None):
@@ -169,8 +231,12 @@ def analyze_skeletons(request, project_id=None):
       AND r.relation_name = 'model_of'
     ''' % ",".join(map(str, skids)))
 
+    # Broken sections are the same for all skeletons
+    broken_section_intervals = get_broken_section_intervals(project_id, cursor)
+
     blob = {
-        'issues': tuple((skid, _analyze_skeleton(project_id, skid, adjacents)) for skid in skids),
+        'issues': tuple((skid, _analyze_skeleton(project_id, skid, adjacents,
+                broken_section_intervals)) for skid in skids),
         'names': dict(cursor.fetchall()),
         0: "Autapse",
         1: "Two or more times postsynaptic to the same connector",
@@ -185,10 +251,12 @@ def analyze_skeletons(request, project_id=None):
 
     return JsonResponse(blob)
 
-def _analyze_skeleton(project_id, skeleton_id, adjacents):
+def _analyze_skeleton(project_id, skeleton_id, adjacents,
+        broken_section_intervals=None):
     """ Takes a skeleton and returns a list of potentially problematic issues,
     as a list of tuples of two values: issue type and treenode ID.
     adjacents: the number of nodes in the paths starting at a node when checking for duplicated connectors.
+    broken_section_intervals: optional precomputed broken section intervals of the project.
     """
     project_id = int(project_id)
     skeleton_id = int(skeleton_id)
@@ -382,7 +450,8 @@ def _analyze_skeleton(project_id, skeleton_id, adjacents):
             issues.append((6, node_id))
 
     # Type 8: node in broken section of project
-    for r in check_broken_section(project_id, cursor=cursor):
+    for r in iter_broken_section_nodes(project_id, [skeleton_id],
+            broken_section_intervals, cursor):
         issues.append((8, r[0], {
             'stack': r[1],
             'stack_title': r[2],
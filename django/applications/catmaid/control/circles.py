@@ -1,47 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import json
 import six
-import networkx as nx
-
-from itertools import combinations, chain
-from collections import defaultdict
-from functools import partial
-import math
 
 from django.db import connection
 from django.http import JsonResponse
 
 from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.connectome import get_connectome_graph
 from catmaid.control.skeleton import _neuronnames
 
-def _next_circle(skeleton_set, relations, cursor):
-    """ Return a dictionary of skeleton IDs in the skeleton_set vs a dictionary of connected skeletons vs how many connections."""
-    pre = relations['presynaptic_to']
-    post = relations['postsynaptic_to']
-    cursor.execute('''
-    SELECT tc1.skeleton_id, tc1.relation_id, tc2.skeleton_id
-    FROM treenode_connector tc1,
-         treenode_connector tc2
-    WHERE tc1.skeleton_id in (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.skeleton_id != tc2.skeleton_id
-      AND tc1.relation_id != tc2.relation_id
-      AND (tc1.relation_id = %s OR tc1.relation_id = %s)
-      AND (tc2.relation_id = %s OR tc2.relation_id = %s)
-    ''' % (','.join(map(str, skeleton_set)), pre, post, pre, post))
-    connections = defaultdict(partial(defaultdict, partial(defaultdict, int)))
-    for row in cursor.fetchall():
-        connections[row[0]][row[1]][row[2]] += 1
-    return connections
-
-def _relations(cursor, project_id):
-    cursor.execute("SELECT relation_name, id FROM relation WHERE project_id = %s AND (relation_name = 'presynaptic_to' OR relation_name = 'postsynaptic_to')" % int(project_id))
-    return dict(cursor.fetchall())
-
-def _clean_mins(request, cursor, project_id):
+def _clean_mins(request):
     min_pre  = int(request.POST.get('min_pre',  -1))
     min_post = int(request.POST.get('min_post', -1))
 
@@ -52,11 +22,7 @@ def _clean_mins(request, cursor, project_id):
     if -1 == min_post:
         min_post = float('inf')
 
-    relations = _relations(cursor, project_id)
-    mins = {}
-    mins[relations['presynaptic_to']]  = min_post # inverted: all postsynaptic to the set
-    mins[relations['postsynaptic_to']] = min_pre # inverted: all presynaptic to the set
-    return mins, relations
+    return min_pre, min_post
 
 @requires_user_role(UserRole.Browse)
 def circles_of_hell(request, project_id=None):
@@ -73,22 +39,12 @@ def circles_of_hell(request, project_id=None):
     if not first_circle:
         raise Exception("No skeletons were provided.")
 
-    cursor = connection.cursor()
-    mins, relations = _clean_mins(request, cursor, int(project_id))
-
-    current_circle = first_circle
-    all_circles = first_circle
+    min_pre, min_post = _clean_mins(request)
 
-    while n_circles > 0 and current_circle:
-        n_circles -= 1
-        connections = _next_circle(current_circle, relations, cursor)
-        next_circle = set(skID for c in six.itervalues(connections) \
-                          for relationID, cs in six.iteritems(c) \
-                          for skID, count in six.iteritems(cs) if count >= mins[relationID])
-        current_circle = next_circle - all_circles
-        all_circles = all_circles.union(next_circle)
-
-    skeleton_ids = tuple(all_circles - first_circle)
+    cursor = connection.cursor()
+    graph = get_connectome_graph(project_id, cursor)
+    skeleton_ids = graph.get_circles(first_circle, n_circles, min_pre,
+            min_post).tolist()
     return JsonResponse([skeleton_ids, _neuronnames(skeleton_ids, project_id)], safe=False)
 
 
@@ -102,73 +58,41 @@ def find_directed_paths(request, project_id=None):
         raise Exception('Need at least 1 skeleton IDs for both sources and targets to find directed paths!')
 
     path_length = int(request.POST.get('path_length', 2))
-    cursor = connection.cursor()
     min = int(request.POST.get('min_synapses', -1))
     if -1 == min:
         min = float('inf')
 
-    relations = _relations(cursor, project_id)
-
-    def next_level(skids, rel1, rel2):
-        cursor.execute('''
-        SELECT tc1.skeleton_id, tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2
-        WHERE tc1.skeleton_id in (%s)
-          AND tc1.connector_id = tc2.connector_id
-          AND tc1.skeleton_id != tc2.skeleton_id
-          AND tc1.relation_id = %s
-          AND tc2.relation_id = %s
-        GROUP BY tc1.skeleton_id, tc2.skeleton_id
-        HAVING count(*) >= %s
-        ''' % (','.join(str(skid) for skid in skids),
-               rel1,
-               rel2,
-               min))
-        return cursor.fetchall()
-
-
-    # bidirectional search
-    i = 0
-    middle = path_length / 2
-    s1 = sources
-    t1 = targets
-    graph = nx.DiGraph()
-    pre = relations['presynaptic_to']
-    post = relations['postsynaptic_to']
-
-    while i <= middle:
-        if 0 == len(s1):
-            break
-        s2 = set()
-        for pre_skid, post_skid in next_level(s1, pre, post):
-            graph.add_edge(pre_skid, post_skid)
-            if not post_skid in s1:
-                s2.add(post_skid)
-        s1 = s2
-        i += 1
-        if i < middle and len(t1) > 0:
-            t2 = set()
-            for post_skid, pre_skid in next_level(t1, post, pre):
-                graph.add_edge(pre_skid, post_skid)
-                if not pre_skid in t1:
-                    t2.add(pre_skid)
-            t1 = t2
-
-    # Nodes will not be in the graph if they didn't have further connections,
-    # like for example will happen for placeholder skeletons e.g. at unmerged postsynaptic sites.
-    all_paths = []
-    for source in sources:
-        if graph.has_node(source):
-            for target in targets:
-                if graph.has_node(target):
-                    # The cutoff is the maximum number of hops, not the number of vertices in the path, hence -1:
-                    for path in nx.all_simple_paths(graph, source, target, cutoff=(path_length -1)):
-                        all_paths.append(path)
+    cursor = connection.cursor()
+    graph = get_connectome_graph(project_id, cursor)
+    # The maximum number of hops is the number of vertices in the path - 1. Skeletons
+    # without connections, like for example placeholder skeletons at unmerged
+    # postsynaptic sites, are not part of the graph.
+    all_paths = graph.get_directed_paths(sources, targets, path_length - 1, min)
 
     return JsonResponse(all_paths, safe=False)
 
 
+@requires_user_role(UserRole.Browse)
+def find_shortest_directed_paths(request, project_id=None):
+    """ Given a set of one or more source and target skeleton IDs, find for each
+    pair of source and target skeleton one of the shortest directed paths of
+    connected neurons between them. Only connections with at least min_synapses
+    synapses are followed. Pairs without such a path are not included. """
+
+    sources = set(int(v) for k,v in six.iteritems(request.POST) if k.startswith('sources['))
+    targets = set(int(v) for k,v in six.iteritems(request.POST) if k.startswith('targets['))
+    if len(sources) < 1 or len(targets) < 1:
+        raise Exception('Need at least 1 skeleton IDs for both sources and targets to find shortest paths!')
+
+    min_synapses = int(request.POST.get('min_synapses', 1))
+
+    cursor = connection.cursor()
+    graph = get_connectome_graph(project_id, cursor)
+    paths = graph.get_shortest_paths(sources, targets, min_synapses)
+
+    return JsonResponse(paths, safe=False)
+
+
 @requires_user_role(UserRole.Browse)
 def find_directed_path_skeletons(request, project_id=None):
     """ Given a set of two or more skeleton Ids, find directed paths of connected neurons between them, for a maximum inner path length as given (i.e. origin and destination not counted), and return the nodes of those paths, including the provided source and target nodes.
@@ -186,49 +110,11 @@ def find_directed_path_skeletons(request, project_id=None):
         min_synapses = float('inf')
 
     cursor = connection.cursor()
-    relations = _relations(cursor, project_id)
-
-    def fetch_adjacent(cursor, skids, relation1, relation2, min_synapses):
-        """ Return the list of skids one hop away from the given skids. """
-        cursor.execute("""
-        SELECT tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2
-        WHERE tc1.project_id = %s
-          AND tc1.skeleton_id in (%s)
-          AND tc1.connector_id = tc2.connector_id
-          AND tc1.skeleton_id != tc2.skeleton_id
-          AND tc1.relation_id = %s
-          AND tc2.relation_id = %s
-        GROUP BY tc1.skeleton_id, tc2.skeleton_id
-        HAVING count(*) >= %s
-        """ % (int(project_id),
-              ','.join(str(int(skid)) for skid in skids),
-              int(relation1),
-              int(relation2),
-              float(min_synapses)))
-        return chain.from_iterable(cursor.fetchall())
-
-    pre = relations['presynaptic_to']
-    post = relations['postsynaptic_to']
-
-    def fetch_fronts(cursor, skids, max_n_hops, relation1, relation2, min_synapses):
-        fronts = [set(skids)]
-        for n_hops in range(1, max_n_hops):
-            adjacent = set(fetch_adjacent(cursor, fronts[-1], relation1, relation2, min_synapses))
-            for front in fronts:
-                adjacent -= front
-            if len(adjacent) > 0:
-                fronts.append(adjacent)
-            else:
-                break
-        # Fill in the rest
-        while len(fronts) < max_n_hops:
-            fronts.append(set())
-        return fronts
-
-    origin_fronts = fetch_fronts(cursor, origin_skids, max_n_hops, pre, post, min_synapses)
-    target_fronts = fetch_fronts(cursor, target_skids, max_n_hops, post, pre, min_synapses)
+    graph = get_connectome_graph(project_id, cursor)
+
+    origin_fronts = graph.get_fronts(origin_skids, max_n_hops, min_synapses)
+    target_fronts = graph.get_fronts(target_skids, max_n_hops, min_synapses,
+            upstream=True)
 
     skeleton_ids = origin_fronts[0].union(target_fronts[0])
 
@@ -236,4 +122,3 @@ def find_directed_path_skeletons(request, project_id=None):
         skeleton_ids = skeleton_ids.union(origin_fronts[i].intersection(target_fronts[max_n_hops -i]))
 
     return JsonResponse(tuple(skeleton_ids), safe=False)
-
@@ -5,10 +5,14 @@ import string
 import random
 import json
 import six
+import threading
+import time
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
 from django.http import JsonResponse
 
 from catmaid.fields import Double3D
@@ -280,45 +284,136 @@ def cursor_fetch_dictionary(cursor):
             for row in cursor.fetchall()
             ]
 
+class ProjectNameMapCache(object):
+    """A per-process LRU cache of name to ID maps of all relations or classes
+    of a project. Entries expire after RELATION_CLASS_MAP_CACHE_TIMEOUT seconds
+    and are invalidated when a relation or class of the project is saved or
+    deleted through Django in this process, once the change is committed.
+    Before a map is used, the number of rows and the maximum ID of the
+    project's relations or classes in the database are compared to the ones of
+    the map. This finds rows that are added or deleted without Django signals
+    and by other processes, as well as maps read in a transaction that was
+    rolled back. A version counter per project makes sure maps that are read
+    while a change happens are not stored.
+    """
+
+    def __init__(self, table, name_column, max_size=128):
+        self.query = "SELECT {}, id FROM {} WHERE project_id = %s".format(
+                name_column, table)
+        self.version_query = """
+            SELECT COUNT(*), MAX(id) FROM {} WHERE project_id = %s
+        """.format(table)
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.versions = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def get(self, project_id, cursor=None, required_names=None):
+        """Return the name to ID map of the passed in project. If one of the
+        <required_names> isn't part of a cached map, the map is reloaded.
+        """
+        project_id = int(project_id)
+        timeout = settings.RELATION_CLASS_MAP_CACHE_TIMEOUT
+        with self.lock:
+            entry = self.entries.get(project_id)
+            if entry:
+                if time.time() - entry[1] < timeout:
+                    # Mark as most recently used
+                    del self.entries[project_id]
+                    self.entries[project_id] = entry
+                else:
+                    entry = None
+            version = self.versions[project_id]
+
+        if not cursor:
+            cursor = connection.cursor()
+
+        if entry and not (required_names and
+                any(n not in entry[0] for n in required_names)):
+            cursor.execute(self.version_query, (project_id,))
+            if cursor.fetchone() == entry[2]:
+                return entry[0]
+
+        cursor.execute(self.query, (project_id,))
+        rows = cursor.fetchall()
+        name_map = dict(rows)
+
+        if timeout > 0:
+            db_version = (len(rows), max(r[1] for r in rows) if rows else None)
+            with self.lock:
+                if version == self.versions[project_id]:
+                    self.entries.pop(project_id, None)
+                    self.entries[project_id] = (name_map, time.time(),
+                            db_version)
+                    while len(self.entries) > self.max_size:
+                        self.entries.popitem(last=False)
+
+        return name_map
+
+    def invalidate(self, project_id=None):
+        """Remove the cached map of the passed in project or of all projects.
+        """
+        with self.lock:
+            if project_id is None:
+                for p in self.entries:
+                    self.versions[p] += 1
+                self.entries.clear()
+            else:
+                self.versions[project_id] += 1
+                self.entries.pop(project_id, None)
+
+
+relation_map_cache = ProjectNameMapCache('relation', 'relation_name')
+class_map_cache = ProjectNameMapCache('class', 'class_name')
+
+
+def _invalidate_name_map_cache(cache, instance):
+    # Invalidate right away and once more after the change is committed to
+    # not keep a map that has been read in the meantime by another thread.
+    project_id = instance.project_id
+    cache.invalidate(project_id)
+    transaction.on_commit(lambda: cache.invalidate(project_id))
+
+
+def _invalidate_relation_map_cache(sender, instance, **kwargs):
+    _invalidate_name_map_cache(relation_map_cache, instance)
+
+
+def _invalidate_class_map_cache(sender, instance, **kwargs):
+    _invalidate_name_map_cache(class_map_cache, instance)
+
+
+post_save.connect(_invalidate_relation_map_cache, sender=Relation)
+post_delete.connect(_invalidate_relation_map_cache, sender=Relation)
+post_save.connect(_invalidate_class_map_cache, sender=Class)
+post_delete.connect(_invalidate_class_map_cache, sender=Class)
+
+
+def _filter_name_map(name_map, name_constraints=None):
+    if name_constraints:
+        return {n: name_map[n] for n in name_constraints if n in name_map}
+    return dict(name_map)
+
+
 def get_relation_to_id_map(project_id, name_constraints=None, cursor=None):
     """
     Return a mapping of relation names to relation IDs. If a list of names is
     provided, only relations with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. Maps are cached per project, see
+    ProjectNameMapCache.
     """
-    if cursor:
-        query = "SELECT relation_name, id  FROM relation WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('relation_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Relation.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(relation_name__in=name_constraints)
-        return {rname: ID for rname, ID in query.values_list("relation_name", "id")}
+    relation_map = relation_map_cache.get(project_id, cursor, name_constraints)
+    return _filter_name_map(relation_map, name_constraints)
 
 def get_class_to_id_map(project_id, name_constraints=None, cursor=None):
     """
     Return a mapping of class names to relation IDs. If a list of names is
     provided, only classes with those names will be included. If a cursor is
-    provided, this cursor will be used.
+    provided, this cursor will be used. Maps are cached per project, see
+    ProjectNameMapCache.
     """
-    if cursor:
-        query = "SELECT class_name, id  FROM class WHERE project_id = %s"
-        params = [int(project_id)]
-        if name_constraints:
-            query += " AND (%s)" % ' OR '.join(('class_name = %s',) * len(name_constraints))
-            params += (name_constraints)
-        cursor.execute(query, params)
-        return dict(cursor.fetchall())
-    else:
-        query = Class.objects.filter(project=project_id)
-        if name_constraints:
-            query = query.filter(class_name__in=name_constraints)
-        return {cname: ID for cname, ID in query.values_list("class_name", "id")}
+    class_map = class_map_cache.get(project_id, cursor, name_constraints)
+    return _filter_name_map(class_map, name_constraints)
 
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
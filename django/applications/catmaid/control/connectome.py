@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import copy
+import threading
+import time
+import numpy as np
+
+from collections import OrderedDict
+from datetime import timedelta
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
+
+from django.conf import settings
+from django.db import connection
+
+from catmaid.control.common import get_relation_to_id_map
+
+from six.moves import range
+
+
+# Changed links are looked for starting this long before the last update, so
+# that changes of transactions that were still running are found as well.
+CHANGE_DETECTION_OVERLAP = timedelta(seconds=60)
+
+
+def _fetch_edges(project_id, cursor, skeleton_ids=None):
+    """Return source skeleton, target skeleton and synapse count arrays of all
+    synaptic connections between different skeletons of a project. If
+    <skeleton_ids> are passed in, only connections of these skeletons are
+    returned.
+    """
+    relations = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'), cursor)
+    if skeleton_ids is None:
+        skeleton_filter = ''
+    else:
+        skeleton_filter = '''
+            AND (source_skeleton_id = ANY(%(skeleton_ids)s::integer[])
+                OR target_skeleton_id = ANY(%(skeleton_ids)s::integer[]))
+        '''
+    cursor.execute('''
+        SELECT source_skeleton_id, target_skeleton_id,
+            confidence_counts[1] + confidence_counts[2] + confidence_counts[3] +
+            confidence_counts[4] + confidence_counts[5]
+        FROM catmaid_skeleton_connectivity
+        WHERE project_id = %(project_id)s
+        AND source_relation_id = %(pre)s
+        AND target_relation_id = %(post)s
+        AND source_skeleton_id <> target_skeleton_id
+        {}
+    '''.format(skeleton_filter), {
+        'project_id': project_id,
+        'pre': relations['presynaptic_to'],
+        'post': relations['postsynaptic_to'],
+        'skeleton_ids': None if skeleton_ids is None else [int(s) for s in skeleton_ids],
+    })
+    edges = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+    return edges[:, 0], edges[:, 1], edges[:, 2]
+
+
+class ConnectomeGraph(object):
+    """A directed graph of the synaptic connections between all skeletons of a
+    project, stored as compressed sparse row (CSR) adjacency matrices. Vertices
+    are indices into the sorted skeleton_ids array, edge weights are the number
+    of synapses from a presynaptic to a postsynaptic skeleton. Connections of
+    skeletons with themselves aren't included. Graphs aren't modified after
+    creation, updated() returns a new graph.
+    """
+
+    def __init__(self, project_id, sources, targets, weights, update_time):
+        self.project_id = project_id
+        self.update_time = update_time
+        # The edge list is kept for incremental updates
+        self.sources = sources
+        self.targets = targets
+        self.weights = weights
+        self.skeleton_ids = np.union1d(sources, targets)
+        n = len(self.skeleton_ids)
+        self.outgoing = csr_matrix((weights, (np.searchsorted(self.skeleton_ids, sources),
+                np.searchsorted(self.skeleton_ids, targets))), shape=(n, n))
+        self.incoming = self.outgoing.T.tocsr()
+
+    @staticmethod
+    def load(project_id, cursor=None):
+        """Load the connectivity graph of a project."""
+        if not cursor:
+            cursor = connection.cursor()
+        # Remember the time before any data is read, so that concurrent
+        # changes are found by the next update.
+        cursor.execute("SELECT clock_timestamp()")
+        update_time = cursor.fetchone()[0]
+        sources, targets, weights = _fetch_edges(project_id, cursor)
+        return ConnectomeGraph(project_id, sources, targets, weights, update_time)
+
+    def updated(self, cursor=None):
+        """Return a graph that includes all changes made after this graph was
+        loaded. Only the connections of skeletons with changed links are
+        loaded again. Deleted links can only be found if history tracking is
+        enabled, otherwise the whole graph is loaded again.
+        """
+        if not settings.HISTORY_TRACKING:
+            return ConnectomeGraph.load(self.project_id, cursor)
+
+        if not cursor:
+            cursor = connection.cursor()
+        cursor.execute("SELECT clock_timestamp()")
+        update_time = cursor.fetchone()[0]
+        cursor.execute('''
+            SELECT tc.skeleton_id
+            FROM treenode_connector tc
+            WHERE tc.project_id = %(project_id)s
+            AND tc.edition_time > %(since)s
+            UNION
+            SELECT tch.skeleton_id
+            FROM treenode_connector__history tch
+            WHERE tch.project_id = %(project_id)s
+            AND tch.sys_period && tstzrange(%(since)s, NULL)
+        ''', {
+            'project_id': self.project_id,
+            'since': self.update_time - CHANGE_DETECTION_OVERLAP,
+        })
+        changed = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+        if not len(changed):
+            graph = copy.copy(self)
+            graph.update_time = update_time
+            return graph
+
+        # Replace all edges of changed skeletons
+        keep = ~(np.isin(self.sources, changed) | np.isin(self.targets, changed))
+        sources, targets, weights = _fetch_edges(self.project_id, cursor, changed)
+        return ConnectomeGraph(self.project_id,
+                np.concatenate((self.sources[keep], sources)),
+                np.concatenate((self.targets[keep], targets)),
+                np.concatenate((self.weights[keep], weights)), update_time)
+
+    def get_indices(self, skeleton_ids):
+        """Return the vertex indices of the passed in skeletons. Skeletons
+        without connections are ignored.
+        """
+        skeleton_ids = np.asarray(list(skeleton_ids), dtype=np.int64)
+        indices = np.searchsorted(self.skeleton_ids, skeleton_ids)
+        valid = indices < len(self.skeleton_ids)
+        valid[valid] = self.skeleton_ids[indices[valid]] == skeleton_ids[valid]
+        return np.unique(indices[valid])
+
+    def get_neighbors(self, indices, min_synapses, upstream=False):
+        """Return the indices of all downstream (or upstream) partners of the
+        passed in vertices that are connected through at least <min_synapses>
+        synapses with one of them.
+        """
+        if not len(indices) or min_synapses == float('inf'):
+            return np.empty(0, dtype=np.int64)
+        rows = (self.incoming if upstream else self.outgoing)[indices]
+        return np.unique(rows.indices[rows.data >= min_synapses])
+
+    def get_circles(self, skeleton_ids, n_circles, min_pre, min_post):
+        """Return the IDs of all skeletons that are at most <n_circles> hops
+        away from the passed in skeletons, not including them. Presynaptic
+        partners need at least <min_pre> synapses, postsynaptic partners at
+        least <min_post>.
+        """
+        visited = np.zeros(len(self.skeleton_ids), dtype=np.bool_)
+        current = self.get_indices(skeleton_ids)
+        visited[current] = True
+        while n_circles > 0 and len(current):
+            n_circles -= 1
+            partners = np.union1d(self.get_neighbors(current, min_pre, upstream=True),
+                    self.get_neighbors(current, min_post))
+            current = partners[~visited[partners]]
+            visited[current] = True
+        found = self.skeleton_ids[visited]
+        return found[~np.isin(found, list(skeleton_ids))]
+
+    def get_fronts(self, skeleton_ids, n_hops, min_synapses, upstream=False):
+        """Return a list of <n_hops> sets, the first one contains the passed in
+        skeletons, every following one all skeletons that are downstream (or
+        upstream) of the previous set and haven't been seen before.
+        """
+        fronts = [set(skeleton_ids)]
+        visited = np.zeros(len(self.skeleton_ids), dtype=np.bool_)
+        current = self.get_indices(skeleton_ids)
+        visited[current] = True
+        for n in range(1, n_hops):
+            partners = self.get_neighbors(current, min_synapses, upstream)
+            current = partners[~visited[partners]]
+            if not len(current):
+                break
+            visited[current] = True
+            fronts.append(set(self.skeleton_ids[current].tolist()))
+        # Fill in the rest
+        while len(fronts) < n_hops:
+            fronts.append(set())
+        return fronts
+
+    def get_hop_distances(self, indices, max_hops, min_synapses, upstream=False):
+        """Return an array with the minimum number of hops from one of the
+        passed in vertices to each vertex, following only edges with at least
+        <min_synapses> synapses. Vertices that are further than <max_hops>
+        away have a distance of max_hops + 1.
+        """
+        distances = np.full(len(self.skeleton_ids), max_hops + 1, dtype=np.int64)
+        current = np.asarray(indices, dtype=np.int64)
+        distances[current] = 0
+        for hops in range(1, max_hops + 1):
+            partners = self.get_neighbors(current, min_synapses, upstream)
+            current = partners[distances[partners] > hops]
+            if not len(current):
+                break
+            distances[current] = hops
+        return distances
+
+    def get_directed_paths(self, sources, targets, max_hops, min_synapses):
+        """Return all simple paths from a source skeleton to a target skeleton
+        with at most <max_hops> edges, following only connections with at least
+        <min_synapses> synapses. Each path is a list of skeleton IDs.
+        """
+        source_indices = self.get_indices(sources)
+        target_indices = self.get_indices(targets)
+        if not len(source_indices) or not len(target_indices) or max_hops < 1:
+            return []
+
+        # Only vertices from which a target can be reached in the remaining
+        # number of hops are followed.
+        distance_to_target = self.get_hop_distances(target_indices, max_hops,
+                min_synapses, upstream=True)
+        is_target = np.zeros(len(self.skeleton_ids), dtype=np.bool_)
+        is_target[target_indices] = True
+
+        outgoing = self.outgoing
+        paths = []
+        for source in source_indices.tolist():
+            path = [source]
+            on_path = set(path)
+            # Each stack entry is the list of successors left for a vertex
+            stack = [self._successors(source, outgoing, min_synapses,
+                    distance_to_target, max_hops - 1)]
+            while stack:
+                if not stack[-1]:
+                    stack.pop()
+                    on_path.discard(path.pop())
+                    continue
+                vertex = stack[-1].pop()
+                if vertex in on_path:
+                    continue
+                if is_target[vertex]:
+                    paths.append(self.skeleton_ids[path + [vertex]].tolist())
+                remaining = max_hops - len(path)
+                if remaining > 0:
+                    path.append(vertex)
+                    on_path.add(vertex)
+                    stack.append(self._successors(vertex, outgoing,
+                            min_synapses, distance_to_target, remaining - 1))
+        return paths
+
+    @staticmethod
+    def _successors(vertex, matrix, min_synapses, distances, max_distance):
+        start, end = matrix.indptr[vertex], matrix.indptr[vertex + 1]
+        successors = matrix.indices[start:end]
+        valid = (matrix.data[start:end] >= min_synapses) & \
+                (distances[successors] <= max_distance)
+        return successors[valid].tolist()
+
+    def get_shortest_paths(self, sources, targets, min_synapses):
+        """Return a shortest directed path for each pair of source and target
+        skeletons that are connected, following only connections with at least
+        <min_synapses> synapses. Each path is a list of skeleton IDs.
+        """
+        source_indices = self.get_indices(sources)
+        target_indices = self.get_indices(targets)
+        if not len(source_indices) or not len(target_indices):
+            return []
+
+        graph = self.outgoing.copy()
+        graph.data[graph.data < min_synapses] = 0
+        graph.eliminate_zeros()
+        distances, predecessors = shortest_path(graph, directed=True,
+                unweighted=True, indices=source_indices,
+                return_predecessors=True)
+
+        paths = []
+        for i, source in enumerate(source_indices.tolist()):
+            for target in target_indices.tolist():
+                if target == source or np.isinf(distances[i, target]):
+                    continue
+                path = [target]
+                while path[-1] != source:
+                    path.append(predecessors[i, path[-1]])
+                paths.append(self.skeleton_ids[path[::-1]].tolist())
+        return paths
+
+
+class ConnectomeGraphCache(object):
+    """A per-process LRU cache of project connectivity graphs. A cached graph
+    is updated with all changes made in the meantime, if it is requested more
+    than CONNECTOME_GRAPH_REFRESH_INTERVAL seconds after its last update.
+    """
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, project_id, cursor=None):
+        """Return the connectivity graph of the passed in project."""
+        project_id = int(project_id)
+        interval = settings.CONNECTOME_GRAPH_REFRESH_INTERVAL
+        if interval <= 0:
+            return ConnectomeGraph.load(project_id, cursor)
+
+        with self.lock:
+            entry = self.entries.pop(project_id, None)
+            if entry:
+                # Mark as most recently used
+                self.entries[project_id] = entry
+
+        if entry and time.time() - entry[1] < interval:
+            return entry[0]
+
+        graph = entry[0].updated(cursor) if entry else \
+                ConnectomeGraph.load(project_id, cursor)
+
+        with self.lock:
+            self.entries.pop(project_id, None)
+            self.entries[project_id] = (graph, time.time())
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        return graph
+
+
+connectome_graph_cache = ConnectomeGraphCache()
+
+
+def get_connectome_graph(project_id, cursor=None):
+    """Return an up-to-date connectivity graph of the passed in project, see
+    ConnectomeGraphCache.
+    """
+    return connectome_graph_cache.get(project_id, cursor)
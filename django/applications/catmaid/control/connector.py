@@ -200,6 +200,28 @@ def _many_to_many_synapses(skids1, skids2, relation_name, project_id):
 
     relations = get_relation_to_id_map(project_id, cursor=cursor)
     gapjunction_id = relations.get('gapjunction_with', -1)
+    relation_id = relations.get(relation_name, -1)
+
+    # Only skeletons that are actually connected need to be looked at, which
+    # can be quickly found in the skeleton connectivity table.
+    cursor.execute('''
+    SELECT DISTINCT source_skeleton_id, target_skeleton_id
+    FROM catmaid_skeleton_connectivity
+    WHERE source_skeleton_id = ANY(%(skids1)s::integer[])
+      AND target_skeleton_id = ANY(%(skids2)s::integer[])
+      AND source_relation_id = %(relation_id)s
+      AND (target_relation_id != source_relation_id OR source_relation_id = %(gapjunction_id)s)
+    ''', {
+        'skids1': list(skids1),
+        'skids2': list(skids2),
+        'relation_id': relation_id,
+        'gapjunction_id': gapjunction_id
+    })
+    connected = cursor.fetchall()
+    if not connected:
+        return tuple()
+    skids1 = set(row[0] for row in connected)
+    skids2 = set(row[1] for row in connected)
 
     cursor.execute('''
     SELECT tc1.connector_id, c.location_x, c.location_y, c.location_z,
@@ -0,0 +1,762 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import multiprocessing
+import os
+
+from collections import namedtuple
+from six import print_
+
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from catmaid.control.common import get_class_to_id_map, get_relation_to_id_map
+from catmaid.models import ClassInstance
+
+
+# The version of the archive layout, which is stored in the manifest.
+COPY_ARCHIVE_VERSION = 1
+COPY_ARCHIVE_MANIFEST = 'manifest.json'
+
+# Number of bytes read from or written to a table file at a time while data is
+# streamed from or to the database.
+COPY_ARCHIVE_CHUNK_SIZE = 2**20
+
+# A table in a copy archive. Its rows are stored without project ID in
+# PostgreSQL binary COPY files. Columns that reference other tables (or users
+# through "auth_user") are mapped to new IDs during import, nullable
+# references are set to NULL if the referenced row isn't part of the archive
+# and rows with other unresolvable references are skipped.
+CopyArchiveTable = namedtuple('CopyArchiveTable', ['name', 'columns',
+        'id_sequence', 'references', 'nullable'])
+
+COPY_ARCHIVE_TABLES = (
+    CopyArchiveTable('class', ('id', 'user_id', 'creation_time',
+            'edition_time', 'class_name', 'description'), 'concept_id_seq',
+            {'user_id': 'auth_user'}, ()),
+    CopyArchiveTable('relation', ('id', 'user_id', 'creation_time',
+            'edition_time', 'relation_name', 'uri', 'description',
+            'isreciprocal'), 'concept_id_seq', {'user_id': 'auth_user'}, ()),
+    CopyArchiveTable('class_instance', ('id', 'user_id', 'creation_time',
+            'edition_time', 'class_id', 'name'), 'concept_id_seq', {
+                'user_id': 'auth_user',
+                'class_id': 'class'
+            }, ()),
+    CopyArchiveTable('class_instance_class_instance', ('id', 'user_id',
+            'creation_time', 'edition_time', 'relation_id',
+            'class_instance_a', 'class_instance_b'), 'concept_id_seq', {
+                'user_id': 'auth_user',
+                'relation_id': 'relation',
+                'class_instance_a': 'class_instance',
+                'class_instance_b': 'class_instance'
+            }, ()),
+    CopyArchiveTable('treenode', ('id', 'user_id', 'editor_id',
+            'creation_time', 'edition_time', 'location_x', 'location_y',
+            'location_z', 'parent_id', 'radius', 'confidence', 'skeleton_id'),
+            'location_id_seq', {
+                'user_id': 'auth_user',
+                'editor_id': 'auth_user',
+                'parent_id': 'treenode',
+                'skeleton_id': 'class_instance'
+            }, ('parent_id',)),
+    CopyArchiveTable('connector', ('id', 'user_id', 'editor_id',
+            'creation_time', 'edition_time', 'location_x', 'location_y',
+            'location_z', 'confidence'), 'location_id_seq', {
+                'user_id': 'auth_user',
+                'editor_id': 'auth_user'
+            }, ()),
+    CopyArchiveTable('treenode_connector', ('id', 'user_id', 'creation_time',
+            'edition_time', 'relation_id', 'treenode_id', 'connector_id',
+            'skeleton_id', 'confidence'), 'concept_id_seq', {
+                'user_id': 'auth_user',
+                'relation_id': 'relation',
+                'treenode_id': 'treenode',
+                'connector_id': 'connector',
+                'skeleton_id': 'class_instance'
+            }, ()),
+    CopyArchiveTable('treenode_class_instance', ('id', 'user_id',
+            'creation_time', 'edition_time', 'relation_id', 'treenode_id',
+            'class_instance_id'), 'concept_id_seq', {
+                'user_id': 'auth_user',
+                'relation_id': 'relation',
+                'treenode_id': 'treenode',
+                'class_instance_id': 'class_instance'
+            }, ()),
+    CopyArchiveTable('review', ('id', 'reviewer_id', 'review_time',
+            'skeleton_id', 'treenode_id'), 'review_id_seq', {
+                'reviewer_id': 'auth_user',
+                'skeleton_id': 'class_instance',
+                'treenode_id': 'treenode'
+            }, ()),
+)
+
+# Class instances of these classes are never reused during import, even if a
+# class instance with the same name exists already.
+COPY_ARCHIVE_UNIQUE_CLASSES = ('neuron', 'skeleton')
+
+
+def get_column_types(table, columns, cursor):
+    """Return a list of (column name, type) tuples for the passed in columns
+    of a table.
+    """
+    cursor.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        WHERE a.attrelid = %(table)s::regclass
+        AND a.attname = ANY(%(columns)s::text[])
+    """, {
+        'table': table,
+        'columns': list(columns),
+    })
+    column_types = dict(cursor.fetchall())
+    return [(c, column_types[c]) for c in columns]
+
+
+def _select_export_data(project_id, skeleton_ids, export_treenodes,
+        export_connectors, export_annotations, export_tags,
+        connector_placeholders, cursor):
+    """Collect the IDs of all treenodes, connectors and class instances that
+    are exported for the passed in skeletons in temporary tables.
+    """
+    relations = get_relation_to_id_map(project_id, cursor=cursor)
+
+    cursor.execute("""
+        CREATE TEMPORARY TABLE export_skeleton (id bigint PRIMARY KEY)
+            ON COMMIT DROP;
+        CREATE TEMPORARY TABLE export_treenode (id bigint PRIMARY KEY)
+            ON COMMIT DROP;
+        CREATE TEMPORARY TABLE export_connector (id bigint PRIMARY KEY)
+            ON COMMIT DROP;
+        CREATE TEMPORARY TABLE export_class_instance (id bigint PRIMARY KEY)
+            ON COMMIT DROP;
+    """)
+
+    params = {
+        'project_id': project_id,
+        'skeleton_ids': skeleton_ids,
+        'model_of': relations['model_of'],
+        'annotated_with': relations.get('annotated_with'),
+        'labeled_as': relations.get('labeled_as'),
+    }
+
+    cursor.execute("""
+        INSERT INTO export_skeleton (id)
+        SELECT DISTINCT UNNEST(%(skeleton_ids)s::bigint[])
+    """, params)
+
+    if export_treenodes:
+        cursor.execute("""
+            INSERT INTO export_treenode (id)
+            SELECT t.id
+            FROM treenode t
+            JOIN export_skeleton s
+                ON s.id = t.skeleton_id
+            WHERE t.project_id = %(project_id)s
+        """, params)
+
+    if export_connectors:
+        cursor.execute("""
+            INSERT INTO export_connector (id)
+            SELECT DISTINCT tc.connector_id
+            FROM treenode_connector tc
+            JOIN export_skeleton s
+                ON s.id = tc.skeleton_id
+            WHERE tc.project_id = %(project_id)s
+        """, params)
+
+        # Placeholder nodes are the nodes of other skeletons that are linked
+        # to exported connectors. Their skeletons are exported as well, but
+        # none of their other nodes.
+        if export_treenodes and connector_placeholders:
+            cursor.execute("""
+                INSERT INTO export_treenode (id)
+                SELECT DISTINCT tc.treenode_id
+                FROM treenode_connector tc
+                JOIN export_connector c
+                    ON c.id = tc.connector_id
+                ON CONFLICT DO NOTHING;
+
+                INSERT INTO export_skeleton (id)
+                SELECT DISTINCT t.skeleton_id
+                FROM treenode t
+                JOIN export_treenode et
+                    ON et.id = t.id
+                ON CONFLICT DO NOTHING;
+            """, params)
+
+    # Skeletons and their neurons
+    cursor.execute("""
+        INSERT INTO export_class_instance (id)
+        SELECT id FROM export_skeleton;
+
+        INSERT INTO export_class_instance (id)
+        SELECT DISTINCT cici.class_instance_b
+        FROM class_instance_class_instance cici
+        JOIN export_skeleton s
+            ON s.id = cici.class_instance_a
+        WHERE cici.relation_id = %(model_of)s
+        ON CONFLICT DO NOTHING;
+    """, params)
+
+    # Annotations, including meta-annotations from the annotation closure
+    if export_annotations and params['annotated_with']:
+        cursor.execute("""
+            WITH annotation AS (
+                SELECT DISTINCT cici.class_instance_b AS id
+                FROM class_instance_class_instance cici
+                JOIN export_class_instance e
+                    ON e.id = cici.class_instance_a
+                WHERE cici.relation_id = %(annotated_with)s
+            )
+            INSERT INTO export_class_instance (id)
+            SELECT id FROM annotation
+            UNION
+            SELECT c.ancestor_id
+            FROM catmaid_annotation_closure c
+            JOIN annotation a
+                ON a.id = c.descendant_id
+            ON CONFLICT DO NOTHING
+        """, params)
+
+    # Tags of exported treenodes
+    if export_tags and params['labeled_as']:
+        cursor.execute("""
+            INSERT INTO export_class_instance (id)
+            SELECT DISTINCT tci.class_instance_id
+            FROM treenode_class_instance tci
+            JOIN export_treenode t
+                ON t.id = tci.treenode_id
+            WHERE tci.relation_id = %(labeled_as)s
+            ON CONFLICT DO NOTHING
+        """, params)
+
+    return params
+
+
+# A constraint per table that selects all exported rows of a shard from the
+# table, which is available as "x".
+COPY_ARCHIVE_SHARD_CONSTRAINTS = {
+    'class_instance': """
+        x.id IN (SELECT id FROM export_class_instance)
+    """,
+    'class_instance_class_instance': """
+        x.project_id = %(project_id)s
+        AND x.class_instance_a IN (SELECT id FROM export_class_instance)
+        AND x.class_instance_b IN (SELECT id FROM export_class_instance)
+    """,
+    'treenode': "x.id IN (SELECT id FROM export_treenode)",
+    'connector': "x.id IN (SELECT id FROM export_connector)",
+    'treenode_connector': """
+        x.project_id = %(project_id)s
+        AND x.treenode_id IN (SELECT id FROM export_treenode)
+        AND x.connector_id IN (SELECT id FROM export_connector)
+    """,
+    'treenode_class_instance': """
+        x.project_id = %(project_id)s
+        AND x.relation_id = %(labeled_as)s
+        AND x.treenode_id IN (SELECT id FROM export_treenode)
+        AND x.class_instance_id IN (SELECT id FROM export_class_instance)
+    """,
+    'review': "x.treenode_id IN (SELECT id FROM export_treenode)",
+}
+
+
+def _export_tables(path, tables, constraints, params, file_suffix, cursor):
+    """Stream all rows matching the passed in constraints of each table into
+    a binary COPY file and return a list of table entries for the manifest.
+    """
+    exported_tables = []
+    for table in tables:
+        query = cursor.mogrify("""
+            COPY (
+                SELECT {columns}
+                FROM {table} x
+                WHERE {constraint}
+                ORDER BY x.id
+            ) TO STDOUT WITH (FORMAT binary)
+        """.format(columns=', '.join('x.' + c for c in table.columns),
+                table=table.name, constraint=constraints[table.name]), params)
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+
+        file_name = '{}.{}.copy'.format(table.name, file_suffix)
+        with io.open(os.path.join(path, file_name), 'wb') as f:
+            cursor.copy_expert(query, f, COPY_ARCHIVE_CHUNK_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+
+        exported_tables.append({
+            'name': table.name,
+            'file': file_name,
+            'columns': get_column_types(table.name, table.columns, cursor),
+        })
+    return exported_tables
+
+
+def _write_json(path, data):
+    """Write a JSON file atomically, i.e. either the complete file is written
+    or none at all.
+    """
+    tmp_path = path + '.tmp'
+    with io.open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(data, indent=2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def _read_json(path):
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _get_shard_record_path(path, shard_index):
+    return os.path.join(path, 'shard-{}.json'.format(shard_index))
+
+
+def export_copy_archive_shard(path, project_id, shard_index, skeleton_ids,
+        options, snapshot_id=None):
+    """Export all data of the passed in skeletons into the table files of a
+    shard and record the shard as completed. If a snapshot ID is passed in,
+    the export runs in its own transaction on this snapshot. Otherwise it
+    runs in the current transaction.
+    """
+    with transaction.atomic():
+        cursor = connection.cursor()
+        if snapshot_id:
+            cursor.execute("""
+                SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;
+                SET TRANSACTION SNAPSHOT %(snapshot_id)s;
+            """, {
+                'snapshot_id': snapshot_id,
+            })
+
+        params = _select_export_data(project_id, skeleton_ids,
+                options['export_treenodes'], options['export_connectors'],
+                options['export_annotations'], options['export_tags'],
+                options['connector_placeholders'], cursor)
+
+        tables = [t for t in COPY_ARCHIVE_TABLES
+                if t.name in COPY_ARCHIVE_SHARD_CONSTRAINTS]
+        if not (options['export_tags'] and params['labeled_as']):
+            tables = [t for t in tables if t.name != 'treenode_class_instance']
+
+        exported_tables = _export_tables(path, tables,
+                COPY_ARCHIVE_SHARD_CONSTRAINTS, params, shard_index, cursor)
+
+        cursor.execute("""
+            DROP TABLE export_skeleton;
+            DROP TABLE export_treenode;
+            DROP TABLE export_connector;
+            DROP TABLE export_class_instance;
+        """)
+
+    _write_json(_get_shard_record_path(path, shard_index), {
+        'shard': shard_index,
+        'tables': exported_tables,
+    })
+
+
+def _export_copy_archive_shard_worker(task):
+    """Process pool entry point to export a single shard. Each worker process
+    opens its own database connection, which is closed again after the
+    export so that no idle transaction keeps the exported snapshot alive.
+    """
+    path, project_id, shard_index, skeleton_ids, options, snapshot_id = task
+    try:
+        export_copy_archive_shard(path, project_id, shard_index, skeleton_ids,
+                options, snapshot_id)
+    finally:
+        connection.close()
+    return shard_index
+
+
+def export_copy_archive(project_id, path, skeleton_ids=None,
+        export_treenodes=True, export_connectors=True, export_annotations=True,
+        export_tags=True, connector_placeholders=False, shard_size=1000,
+        jobs=1, resume=False, log=print_):
+    """Export the tracing data of a project into a copy archive, a directory
+    with a JSON manifest and PostgreSQL binary COPY files. All data is
+    streamed from the database, which keeps memory usage constant regardless
+    of the project size. If <skeleton_ids> is passed, only these skeletons
+    are exported along with their neurons, annotations, tags and connectors.
+    Otherwise all skeletons of the project are exported.
+
+    Skeletons are exported in shards of <shard_size> skeletons, using a pool
+    of <jobs> worker processes (None: one per CPU). All workers export from
+    the same database snapshot. Completed shards are recorded in the archive
+    directory, which allows to continue an interrupted export with <resume>
+    set to true. Shards exported after resuming use a new snapshot.
+    """
+    plan_path = os.path.join(path, 'plan.json')
+    options = {
+        'export_treenodes': export_treenodes,
+        'export_connectors': export_connectors,
+        'export_annotations': export_annotations,
+        'export_tags': export_tags,
+        'connector_placeholders': connector_placeholders,
+    }
+
+    if resume and os.path.isfile(plan_path):
+        plan = _read_json(plan_path)
+        if plan['project_id'] != project_id or plan['options'] != options:
+            raise ValueError("The archive in {} was created with different "
+                    "parameters".format(path))
+        full_export, shards = plan['full_export'], plan['shards']
+        log("Resuming export of {} shards".format(len(shards)))
+    else:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        elif os.listdir(path):
+            raise ValueError("Target directory {} is not empty".format(path))
+
+        full_export = skeleton_ids is None
+        if full_export:
+            skeleton_class_id = get_class_to_id_map(project_id,
+                    ['skeleton'])['skeleton']
+            skeleton_ids = list(ClassInstance.objects.filter(
+                    project_id=project_id, class_column_id=skeleton_class_id) \
+                    .order_by('id').values_list('id', flat=True))
+        else:
+            skeleton_ids = sorted(set(skeleton_ids))
+        shards = [skeleton_ids[i:i + shard_size]
+                for i in range(0, len(skeleton_ids), shard_size)]
+        _write_json(plan_path, {
+            'project_id': project_id,
+            'options': options,
+            'full_export': full_export,
+            'shards': shards,
+        })
+
+    open_shards = [i for i in range(len(shards))
+            if not os.path.isfile(_get_shard_record_path(path, i))]
+    log("Exporting {} of {} shards".format(len(open_shards), len(shards)))
+
+    # Only isolate the export if this is the outermost transaction, the
+    # isolation level can't be changed otherwise and no snapshot can be
+    # shared with worker processes.
+    isolate = not connection.in_atomic_block
+    parallel = isolate and jobs != 1 and len(open_shards) > 1
+    if parallel:
+        # Forked worker processes must not share the database connection of
+        # this process, they create their own connection when needed.
+        connections.close_all()
+        pool = multiprocessing.Pool(jobs)
+
+    try:
+        with transaction.atomic():
+            cursor = connection.cursor()
+            snapshot_id = None
+            if isolate:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            if parallel:
+                cursor.execute("SELECT pg_export_snapshot()")
+                snapshot_id = cursor.fetchone()[0]
+
+            # Classes and relations are exported once for all shards.
+            # Connectors without links are exported along with them, because
+            # they don't belong to any shard.
+            params = {'project_id': project_id}
+            shared_tables = [t for t in COPY_ARCHIVE_TABLES
+                    if t.name in ('class', 'relation')]
+            shared_constraints = {
+                'class': "x.project_id = %(project_id)s",
+                'relation': "x.project_id = %(project_id)s",
+                'connector': """
+                    x.project_id = %(project_id)s
+                    AND NOT EXISTS (
+                        SELECT 1 FROM treenode_connector tc
+                        WHERE tc.connector_id = x.id
+                    )
+                """,
+            }
+            if export_connectors and full_export:
+                shared_tables += [t for t in COPY_ARCHIVE_TABLES
+                        if t.name == 'connector']
+            exported_tables = _export_tables(path, shared_tables,
+                    shared_constraints, params, 'shared', cursor)
+
+            if parallel:
+                tasks = [(path, project_id, i, shards[i], options, snapshot_id)
+                        for i in open_shards]
+                for n, shard_index in enumerate(pool.imap_unordered(
+                        _export_copy_archive_shard_worker, tasks)):
+                    log("Exported shard {} ({}/{})".format(shard_index, n + 1,
+                            len(open_shards)))
+                pool.close()
+            else:
+                for n, shard_index in enumerate(open_shards):
+                    export_copy_archive_shard(path, project_id, shard_index,
+                            shards[shard_index], options)
+                    log("Exported shard {} ({}/{})".format(shard_index, n + 1,
+                            len(open_shards)))
+
+            # Users are only referenced by their username
+            cursor.execute("SELECT id, username FROM auth_user ORDER BY id")
+            users = cursor.fetchall()
+    except:
+        if parallel:
+            pool.terminate()
+        raise
+    finally:
+        if parallel:
+            pool.join()
+
+    # Combine the table files of all shards
+    table_files = dict()
+    table_columns = dict()
+    for i in range(len(shards)):
+        exported_tables.extend(_read_json(
+                _get_shard_record_path(path, i))['tables'])
+    for t in exported_tables:
+        table_files.setdefault(t['name'], []).append(t['file'])
+        table_columns[t['name']] = t['columns']
+
+    manifest = {
+        'version': COPY_ARCHIVE_VERSION,
+        'project_id': project_id,
+        'creation_time': timezone.now().isoformat(),
+        'users': users,
+        'tables': [{
+            'name': t.name,
+            'columns': table_columns[t.name],
+            'files': table_files[t.name],
+        } for t in COPY_ARCHIVE_TABLES if t.name in table_files],
+    }
+    _write_json(os.path.join(path, COPY_ARCHIVE_MANIFEST), manifest)
+
+    return manifest
+
+
+def is_copy_archive(path):
+    """Whether the passed in path is the directory of a copy archive."""
+    return os.path.isfile(os.path.join(path, COPY_ARCHIVE_MANIFEST))
+
+
+def read_copy_archive_manifest(path):
+    with io.open(os.path.join(path, COPY_ARCHIVE_MANIFEST), 'r',
+            encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != COPY_ARCHIVE_VERSION:
+        raise ValueError("Unsupported copy archive version: {}".format(
+                manifest.get('version')))
+    return manifest
+
+
+def _import_copy_archive_table(table, project_id, preserve_ids, cursor):
+    """Map the IDs of all staged rows of a table and insert them into the
+    target project.
+    """
+    params = {'project_id': project_id}
+    staging_table = 'import_' + table.name
+    map_table = 'import_{}_id_map'.format(table.name)
+
+    cursor.execute("""
+        CREATE TEMPORARY TABLE {map_table} (
+            old_id bigint PRIMARY KEY,
+            new_id bigint NOT NULL,
+            reused boolean NOT NULL DEFAULT false
+        ) ON COMMIT DROP
+    """.format(map_table=map_table))
+
+    # Semantic data is reused if it exists already in the target project.
+    if table.name in ('class', 'relation'):
+        name_column = table.name + '_name'
+        cursor.execute("""
+            INSERT INTO {map_table} (old_id, new_id, reused)
+            SELECT DISTINCT ON (i.id) i.id, e.id, true
+            FROM {staging_table} i
+            JOIN {table} e
+                ON e.{name_column} = i.{name_column}
+            WHERE e.project_id = %(project_id)s
+            ORDER BY i.id, e.id
+        """.format(map_table=map_table, staging_table=staging_table,
+                table=table.name, name_column=name_column), params)
+    elif table.name == 'class_instance':
+        params['unique_classes'] = list(COPY_ARCHIVE_UNIQUE_CLASSES)
+        cursor.execute("""
+            INSERT INTO {map_table} (old_id, new_id, reused)
+            SELECT DISTINCT ON (i.id) i.id, e.id, true
+            FROM {staging_table} i
+            JOIN import_class_id_map cm
+                ON cm.old_id = i.class_id
+            JOIN class c
+                ON c.id = cm.new_id
+            JOIN class_instance e
+                ON e.class_id = cm.new_id
+                AND e.name = i.name
+            WHERE e.project_id = %(project_id)s
+            AND c.class_name <> ALL(%(unique_classes)s::text[])
+            ORDER BY i.id, e.id
+        """.format(map_table=map_table, staging_table=staging_table), params)
+
+    cursor.execute("""
+        INSERT INTO {map_table} (old_id, new_id)
+        SELECT i.id, {new_id}
+        FROM {staging_table} i
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {map_table} m
+            WHERE m.old_id = i.id
+        )
+    """.format(map_table=map_table, staging_table=staging_table,
+            new_id="i.id" if preserve_ids else
+                "nextval('{}')".format(table.id_sequence)))
+
+    columns = ['id', 'project_id']
+    values = ['m.new_id', '%(project_id)s']
+    joins = []
+    for c in table.columns[1:]:
+        columns.append(c)
+        reference = table.references.get(c)
+        if reference:
+            alias = 'ref_' + c
+            joins.append("{join} import_{reference}_id_map {alias} "
+                    "ON {alias}.old_id = i.{column}".format(
+                        join='LEFT JOIN' if c in table.nullable else 'JOIN',
+                        reference=reference, alias=alias, column=c))
+            values.append(alias + '.new_id')
+        else:
+            values.append('i.' + c)
+
+    # Don't create duplicate links between class instances
+    extra_constraint = ''
+    if table.name == 'class_instance_class_instance':
+        extra_constraint = """
+            AND NOT EXISTS (
+                SELECT 1 FROM class_instance_class_instance e
+                WHERE e.relation_id = ref_relation_id.new_id
+                AND e.class_instance_a = ref_class_instance_a.new_id
+                AND e.class_instance_b = ref_class_instance_b.new_id
+            )
+        """
+
+    cursor.execute("""
+        INSERT INTO {table} ({columns})
+        SELECT {values}
+        FROM {staging_table} i
+        JOIN {map_table} m
+            ON m.old_id = i.id
+        {joins}
+        WHERE NOT m.reused
+        {extra_constraint}
+    """.format(table=table.name, columns=', '.join(columns),
+            values=', '.join(values), staging_table=staging_table,
+            map_table=map_table, joins='\n'.join(joins),
+            extra_constraint=extra_constraint), params)
+    n_imported = cursor.rowcount
+
+    cursor.execute("""
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE m.reused)
+        FROM {map_table} m
+    """.format(map_table=map_table))
+    n_staged, n_reused = cursor.fetchone()
+
+    return n_imported, n_reused, n_staged - n_imported - n_reused
+
+
+def import_copy_archive(path, project_id, get_user_id_map,
+        preserve_ids=False, log=print_):
+    """Import a copy archive into the passed in project. The files of each table
+    are streamed into a temporary staging table, from where its rows are
+    inserted into the project with new IDs. The ID mappings are kept in
+    temporary tables as well so that references can be updated in the
+    database. Classes, relations and class instances (except neurons and
+    skeletons) are reused if they exist already in the target project.
+
+    The <get_user_id_map> function is called with a dictionary that maps the
+    IDs of all users referenced in the archive to their usernames. It is
+    expected to return a dictionary that maps each of these IDs to the ID of a
+    user in the target database.
+    """
+    manifest = read_copy_archive_manifest(path)
+    archive_tables = dict((t['name'], t) for t in manifest['tables'])
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+
+        # Stream all tables into staging tables
+        for table in COPY_ARCHIVE_TABLES:
+            archive_table = archive_tables.get(table.name)
+            column_types = archive_table['columns'] if archive_table else \
+                    get_column_types(table.name, table.columns, cursor)
+            if [c for c, _ in column_types] != list(table.columns):
+                raise ValueError("Unexpected columns for table {}".format(
+                        table.name))
+
+            staging_table = 'import_' + table.name
+            cursor.execute("""
+                CREATE TEMPORARY TABLE {staging_table} ({columns})
+                ON COMMIT DROP
+            """.format(staging_table=staging_table, columns=', '.join(
+                    '{} {}'.format(c, t) for c, t in column_types)))
+
+            if not archive_table:
+                continue
+
+            for file_name in archive_table['files']:
+                with io.open(os.path.join(path, file_name), 'rb') as f:
+                    cursor.copy_expert("""
+                        COPY {staging_table} FROM STDIN WITH (FORMAT binary)
+                    """.format(staging_table=staging_table), f,
+                            COPY_ARCHIVE_CHUNK_SIZE)
+
+            # Shards can share rows, e.g. connectors or annotations, which
+            # are only imported once.
+            if len(archive_table['files']) > 1:
+                cursor.execute("""
+                    ALTER TABLE {staging_table} RENAME TO {staging_table}_shards;
+                    CREATE TEMPORARY TABLE {staging_table} ON COMMIT DROP AS
+                    SELECT DISTINCT ON (id) *
+                    FROM {staging_table}_shards
+                    ORDER BY id;
+                    DROP TABLE {staging_table}_shards;
+                """.format(staging_table=staging_table))
+            log("Loaded table {}".format(table.name))
+
+        # Map all referenced users
+        user_columns = [(t.name, c) for t in COPY_ARCHIVE_TABLES
+                for c, r in t.references.items() if r == 'auth_user']
+        cursor.execute(' UNION '.join("""
+            SELECT {column} FROM import_{table}
+        """.format(table=t, column=c) for t, c in user_columns))
+        usernames = dict((u[0], u[1]) for u in manifest['users'])
+        referenced_users = dict((row[0], usernames.get(row[0]))
+                for row in cursor.fetchall())
+        user_id_map = get_user_id_map(referenced_users)
+        cursor.execute("""
+            CREATE TEMPORARY TABLE import_auth_user_id_map (
+                old_id bigint PRIMARY KEY,
+                new_id bigint NOT NULL
+            ) ON COMMIT DROP;
+
+            INSERT INTO import_auth_user_id_map (old_id, new_id)
+            SELECT * FROM UNNEST(%(old_ids)s::bigint[], %(new_ids)s::bigint[]);
+        """, {
+            'old_ids': list(user_id_map.keys()),
+            'new_ids': list(user_id_map.values()),
+        })
+
+        # Insert all tables in order of their dependencies
+        for table in COPY_ARCHIVE_TABLES:
+            n_imported, n_reused, n_skipped = _import_copy_archive_table(
+                    table, project_id, preserve_ids, cursor)
+            log("Imported {} rows into table {}, reused {}, skipped {}".format(
+                    n_imported, table.name, n_reused, n_skipped))
+
+        if preserve_ids:
+            # Reset counters to current maximum IDs
+            cursor.execute('''
+                SELECT setval('concept_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+                FROM concept;
+                SELECT setval('location_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+                FROM location;
+                SELECT setval('review_id_seq', coalesce(max("id"), 1), max("id") IS NOT null)
+                FROM review;
+            ''')
+
+        cursor.execute('; '.join('DROP TABLE import_{name}; '
+                'DROP TABLE import_{name}_id_map'.format(name=t.name)
+                for t in COPY_ARCHIVE_TABLES) + '; DROP TABLE import_auth_user_id_map')
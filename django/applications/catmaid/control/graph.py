@@ -11,8 +11,6 @@ from networkx.algorithms import weakly_connected_component_subgraphs
 from collections import defaultdict
 from itertools import chain
 from functools import partial
-from numpy import subtract
-from numpy.linalg import norm
 from math import sqrt
 
 from django.db import connection
@@ -85,14 +83,9 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 subdomains.append(graph)
                 continue
 
-            for parent_id, treenode_id in graph.edges_iter():
-                loc0 = locations[treenode_id]
-                loc1 = locations[parent_id]
-                graph[parent_id][treenode_id]['weight'] = norm(subtract(loc0, loc1))
-
             # Invoke Casey's magic
-            max_density = tree_max_density(graph.to_undirected(), treenode_ids,
-                    connector_ids, relation_ids, [bandwidth])
+            max_density = tree_max_density(graph, treenode_ids,
+                    connector_ids, relation_ids, [bandwidth], locations)
             synapse_group = next(six.itervalues(max_density))
             # The list of nodes of each synapse_group contains only nodes that have connectors
             # A local_max is the skeleton node most central to a synapse_group
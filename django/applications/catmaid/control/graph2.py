@@ -9,8 +9,6 @@ from networkx.algorithms import weakly_connected_component_subgraphs
 from collections import defaultdict
 from itertools import count
 from functools import partial
-from numpy import subtract
-from numpy.linalg import norm
 
 from django.db import connection
 from django.http import JsonResponse
@@ -41,23 +39,24 @@ def basic_graph(project_id, skeleton_ids, relations=None,
         relations = get_relation_to_id_map(project_id, (source_link, target_link), cursor)
     source_rel_id, target_rel_id = relations[source_link], relations[target_link]
 
+    # Synapse counts are read from the skeleton connectivity table, which is
+    # kept up to date by the database.
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%(skids)s)
-      AND t1.relation_id = %(source_rel)s
-      AND t1.connector_id = t2.connector_id
-      AND t2.skeleton_id IN (%(skids)s)
-      AND t2.relation_id = %(target_rel)s
-      AND t1.id <> t2.id
-    ''' % {'skids': ','.join(map(str, skeleton_ids)),
-           'source_rel': source_rel_id,
-           'target_rel': target_rel_id})
-
-    edges = defaultdict(partial(defaultdict, make_new_synapse_count_array))
+    SELECT source_skeleton_id, target_skeleton_id, confidence_counts
+    FROM catmaid_skeleton_connectivity
+    WHERE source_skeleton_id = ANY(%(skids)s::integer[])
+      AND source_relation_id = %(source_rel)s
+      AND target_skeleton_id = ANY(%(skids)s::integer[])
+      AND target_relation_id = %(target_rel)s
+    ''', {
+        'skids': list(map(int, skeleton_ids)),
+        'source_rel': source_rel_id,
+        'target_rel': target_rel_id
+    })
+
+    edges = defaultdict(dict)
     for row in cursor.fetchall():
-        edges[row[0]][row[1]][row[2] - 1] += 1
+        edges[row[0]][row[1]] = row[2]
 
     return {
         'edges': tuple((s, t, count)
@@ -345,10 +344,6 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
     chunks, chunkIDs = subgraphs(digraph, skeleton_id)
 
     for i, chunkID, chunk in izip(count(start=1), chunkIDs, chunks):
-        # Populate edge properties with the weight
-        for parent, child in chunk.edges_iter():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
-
         # Check if need to expand at all
         blob = tuple(c for c in cs if c[0] in chunk)
         if 0 == len(blob):
@@ -362,8 +357,8 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
             continue
 
         # Invoke Casey's magic: split by synapse domain
-        max_density = tree_max_density(chunk.to_undirected(), treenode_ids,
-                connector_ids, relation_ids, [bandwidth])
+        max_density = tree_max_density(chunk, treenode_ids,
+                connector_ids, relation_ids, [bandwidth], locations)
         # Get first element of max_density
         domains = next(six.itervalues(max_density))
 
@@ -138,8 +138,8 @@ def get_annotated_entities(project, params, relations, classes,
         params["name"] = name
 
     # Map annotation sets to their expanded sub-annotations
-    sub_annotation_ids = get_sub_annotation_ids(project, annotation_sets_to_expand,
-            relations, classes)
+    sub_annotation_ids = get_sub_annotation_ids(project.id,
+            annotation_sets_to_expand)
 
     # Collect all annotations and their sub-annotation IDs (if requested) in a
     # set each. For the actual query each set is connected with AND while
@@ -317,54 +317,44 @@ def get_annotated_entities(project, params, relations, classes,
     return entities, num_total_records
 
 
-def get_sub_annotation_ids(project_id, annotation_sets, relations, classes):
+def get_sub_annotation_ids(project_id, annotation_sets):
     """ Sub-annotations are annotations that are annotated with an annotation
     from the annotation_set passed. Additionally, transivitely annotated
-    annotations are returned as well. Note that all entries annotation_sets
-    must be frozenset instances, they need to be hashable.
+    annotations are returned as well. They are read from the annotation closure
+    table, which is kept up to date by the database. Note that all entries
+    annotation_sets must be frozenset instances, they need to be hashable.
     """
     if not annotation_sets:
         return {}
 
-    aaa_tuples = ClassInstanceClassInstance.objects.filter(
-            project_id=project_id,
-            class_instance_a__class_column=classes['annotation'],
-            class_instance_b__class_column=classes['annotation'],
-            relation_id = relations['annotated_with']).values_list(
-                    'class_instance_b', 'class_instance_a')
-
-    # A set wrapper to keep a set in a dictionary
-    class set_wrapper:
-        def __init__(self):
-            self.data = set()
-
-    # Create a dictionary of all annotations annotating a set of annotations
-    aaa = {}
-    for aa in aaa_tuples:
-        sa_set = aaa.get(aa[0])
-        if sa_set is None:
-            sa_set = set_wrapper()
-            aaa[aa[0]] = sa_set
-        sa_set.data.add(aa[1])
-
-    # Collect all sub-annotations by following the annotation hierarchy for
-    # every annotation in the annotation set passed.
+    annotation_ids = set()
+    for annotation_set in annotation_sets:
+        annotation_ids.update(annotation_set)
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT ancestor_id, descendant_id
+        FROM catmaid_annotation_closure
+        WHERE project_id = %(project_id)s
+        AND ancestor_id = ANY(%(annotation_ids)s::bigint[])
+    """, {
+        'project_id': project_id,
+        'annotation_ids': list(annotation_ids),
+    })
+
+    # Create a dictionary of all annotations annotating an annotation, directly
+    # or transitively.
+    aaa = defaultdict(set)
+    for ancestor_id, descendant_id in cursor.fetchall():
+        aaa[ancestor_id].add(descendant_id)
+
+    # Collect all sub-annotations of every annotation in the annotation set
+    # passed.
     sa_ids = {}
     for annotation_set in annotation_sets:
-        # Start with an empty result set for each requested annotation set
         ls = set()
         for a in annotation_set:
-            working_set = set([a])
-            while working_set:
-                parent_id = working_set.pop()
-                # Try to get the sub-annotations for this parent
-                child_ids = aaa.get(parent_id) or set_wrapper()
-                for child_id in child_ids.data:
-                    if child_id not in sa_ids:
-                        if child_id not in ls:
-                            # Add all children as sub annotations
-                            ls.add(child_id)
-                            working_set.add(child_id)
+            ls.update(aaa.get(a, ()))
         # Store the result list for this ID
         sa_ids[annotation_set] = list(ls)
 
@@ -1031,17 +1021,19 @@ def generate_co_annotation_query(project_id, co_annotation_ids, classIDs, relati
     SELECT DISTINCT
         a.id,
         a.name,
-        (SELECT username FROM auth_user, class_instance_class_instance cici
-          WHERE cici.class_instance_b = cc.id
-            AND cici.user_id = auth_user.id
-            ORDER BY cici.edition_time DESC LIMIT 1) AS "last_user",
-        (SELECT MAX(edition_time) FROM class_instance_class_instance cici WHERE cici.class_instance_b = a.id) AS "last_used",
-        (SELECT count(*) FROM class_instance_class_instance cici WHERE cici.class_instance_b = a.id) AS "num_usage"
+        u.username AS "last_user",
+        s.last_used AS "last_used",
+        COALESCE(s.num_usage, 0) AS "num_usage"
     """
 
     rest = """
     FROM
-        class_instance a,
+        class_instance a
+        LEFT JOIN catmaid_annotation_usage_summary s
+            ON s.annotation_id = a.id
+            AND s.user_id IS NULL
+        LEFT JOIN auth_user u
+            ON u.id = s.last_user_id,
         class_instance_class_instance cc,
         class_instance neuron,
         %s
@@ -1153,18 +1145,18 @@ def list_annotations(request, project_id=None):
     if not request.POST:
         cursor = connection.cursor()
         classes = get_class_to_id_map(project_id, ('annotation',), cursor)
-        relations = get_relation_to_id_map(project_id, ('annotated_with',), cursor)
 
+        # Users of each annotation are read from the annotation usage summary
         cursor.execute('''
-            SELECT DISTINCT ci.name, ci.id, u.id, u.username
+            SELECT ci.name, ci.id, u.id, u.username
             FROM class_instance ci
-            LEFT OUTER JOIN class_instance_class_instance cici
-                         ON (ci.id = cici.class_instance_b)
+            LEFT OUTER JOIN catmaid_annotation_usage_summary s
+                         ON (ci.id = s.annotation_id AND s.user_id IS NOT NULL)
             LEFT OUTER JOIN auth_user u
-                         ON (cici.user_id = u.id)
-            WHERE (ci.class_id = %s AND (cici.relation_id = %s OR cici.id IS NULL));
+                         ON (s.user_id = u.id)
+            WHERE ci.class_id = %s;
                        ''',
-            (classes['annotation'], relations['annotated_with']))
+            (classes['annotation'],))
         annotation_tuples = cursor.fetchall()
     else:
         annotation_query = create_annotation_query(project_id, request.POST)
@@ -1187,6 +1179,87 @@ def list_annotations(request, project_id=None):
     return JsonResponse({'annotations': annotations})
 
 
+def _get_annotation_sorting(request, fields):
+    """Return a list of (column, direction) tuples for the sorting requested by
+    a datatable. The annotation ID is always used as last column to make the
+    order unambiguous.
+    """
+    sorting = []
+    if request.POST.get('iSortCol_0', False):
+        column_count = int(request.POST.get('iSortingCols', 0))
+        for d in range(column_count):
+            column = fields[int(request.POST.get('iSortCol_%d' % d))]
+            direction = request.POST.get('sSortDir_%d' % d, 'DESC').upper()
+            sorting.append((column, 'ASC' if direction == 'ASC' else 'DESC'))
+    sorting.append(('r.id', 'ASC'))
+    return sorting
+
+
+def _get_annotation_datatable(request, rows, params, fields, display_start,
+        display_length):
+    """Return the total number of annotations selected by the <rows> query
+    along with the rows of the requested page. The query is expected to select
+    the columns id, name, last_user, last_used and num_usage. Sortable columns
+    are referenced as <fields> on the row alias "r". If an annotation ID is
+    passed in as "after_id", the page starts after this annotation in the
+    requested order, which doesn't require the database to skip all preceding
+    rows like an offset does. The rows query is used as a sub-query rather than
+    a CTE, which Postgres would materialize, so that the planner can push the
+    page conditions and the limit down into it. Counting all annotations would
+    take as long as an offset, which is why this is only done for pages
+    requested without "after_id". Otherwise, the total passed in as
+    "total_records" by the client is returned, or None.
+    """
+    sorting = _get_annotation_sorting(request, fields)
+    after_id = request.POST.get('after_id')
+
+    cursor = connection.cursor()
+    if after_id:
+        total_records = request.POST.get('total_records')
+        num_records = int(total_records) if total_records else None
+    else:
+        cursor.execute("""
+            SELECT COUNT(*) FROM ({rows}) r
+        """.format(rows=rows), params)
+        num_records = cursor.fetchone()[0]
+
+    after_row = ''
+    after_params = []
+    keyset = ''
+    if after_id:
+        # Select all rows that are sorted after the passed in annotation, based
+        # on its own sort key. Only this single row is materialized.
+        after_row = """
+            WITH after_row AS (
+                SELECT {columns} FROM ({rows}) r WHERE r.id = %s
+            )
+        """.format(rows=rows, columns=', '.join('{} AS k{}'.format(c, i)
+                for i, (c, _) in enumerate(sorting)))
+        after_params = params + [int(after_id)]
+        conditions = []
+        for i, (column, direction) in enumerate(sorting):
+            terms = ['{} = k.k{}'.format(c, j)
+                    for j, (c, _) in enumerate(sorting[:i])]
+            terms.append('{} {} k.k{}'.format(column,
+                    '<' if direction == 'DESC' else '>', i))
+            conditions.append('(' + ' AND '.join(terms) + ')')
+        keyset = 'CROSS JOIN after_row k WHERE ' + ' OR '.join(conditions)
+        display_start = 0
+
+    cursor.execute("""
+        {after_row}
+        SELECT r.id, r.name, r.last_user, r.last_used, r.num_usage
+        FROM ({rows}) r
+        {keyset}
+        ORDER BY {sorter}
+        LIMIT %s OFFSET %s
+    """.format(after_row=after_row, rows=rows, keyset=keyset,
+            sorter=', '.join('%s %s' % s for s in sorting)),
+        after_params + params + [display_length, display_start])
+
+    return num_records, cursor.fetchall()
+
+
 def _fast_co_annotations(request, project_id, display_start, display_length):
     classIDs = dict(Class.objects.filter(project_id=project_id).values_list('class_name', 'id'))
     relationIDs = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
@@ -1201,44 +1274,23 @@ def _fast_co_annotations(request, project_id, display_start, display_length):
         rest += "\nAND a.name ~ %s" # django will escape and quote the string
         entries.append(search_term)
 
-    # Sorting?
-    sorting = request.POST.get('iSortCol_0', False)
-    sorter = ''
-    if sorting:
-        column_count = int(request.POST.get('iSortingCols', 0))
-        sorting_directions = (request.POST.get('sSortDir_%d' % d, 'DESC') for d in range(column_count))
-
-        fields = ('a.name', 'last_used', 'num_usage', 'last_user')
-        sorting_index = (int(request.POST.get('iSortCol_%d' % d)) for d in range(column_count))
-        sorting_cols = (fields[i] for i in sorting_index)
-
-        sorter = '\nORDER BY ' + ','.join('%s %s' % u for u in zip(sorting_cols, sorting_directions))
-
-
-    cursor = connection.cursor()
-
-    cursor.execute("SELECT count(DISTINCT a.id) " + rest, entries)
-    num_records = cursor.fetchone()[0]
+    fields = ('r.name', "COALESCE(r.last_used, '-infinity')", 'r.num_usage',
+            "COALESCE(r.last_user, '')")
+    num_records, rows = _get_annotation_datatable(request, select + rest,
+            entries, fields, display_start, display_length)
 
     response = {
         'iTotalRecords': num_records,
         'iTotalDisplayRecords': num_records,
     }
 
-    rest += sorter
-    rest += '\nLIMIT %s OFFSET %s'
-    entries.append(display_length) # total to return
-    entries.append(display_start) # offset
-
-    cursor.execute(select + rest, entries)
-
     # 0: a.id
     # 1: a.name
     # 2: last_user
     # 3: last_used
     # 4: num_usage
     aaData = []
-    for row in cursor.fetchall():
+    for row in rows:
         last_used = row[3]
         if last_used:
             last_used = last_used.strftime("%Y-%m-%d %H:%M:%S")
@@ -1270,69 +1322,64 @@ def list_annotations_datatable(request, project_id=None):
 
     annotation_query = create_annotation_query(project_id, request.POST)
 
-    should_sort = request.POST.get('iSortCol_0', False)
     search_term = request.POST.get('sSearch', '')
+    if len(search_term) > 0:
+        annotation_query = annotation_query.filter(name__iregex=search_term)
 
+    annotation_ids, params = annotation_query.values('id').query.sql_with_params()
+    params = list(params)
 
     # Additional information should also be constrained by neurons and user
     # names. E.g., when viewing the annotation list for a user, the usage count
     # should only display the number of times the user has used an annotation.
-    conditions = ""
-    if request.POST.get('neuron_id'):
-        conditions += "AND cici.class_instance_a = %s " % \
-                request.POST.get('neuron_id')
-    if request.POST.get('user_id'):
-        conditions += "AND cici.user_id = %s " % \
-                request.POST.get('user_id')
-
-    # Add (last) annotated on time
-    annotation_query = annotation_query.extra(
-        select={'annotated_on': 'SELECT MAX(cici.creation_time) FROM ' \
-            'class_instance_class_instance cici WHERE ' \
-            'cici.class_instance_b = class_instance.id %s' % conditions})
-
-    # Add user ID of last user
-    annotation_query = annotation_query.extra(
-        select={'last_user': 'SELECT auth_user.id FROM auth_user, ' \
-            'class_instance_class_instance cici ' \
-            'WHERE cici.class_instance_b = class_instance.id ' \
-            'AND cici.user_id = auth_user.id %s' \
-            'ORDER BY cici.edition_time DESC LIMIT 1' % conditions})
-
-    # Add usage count
-    annotation_query = annotation_query.extra(
-        select={'num_usage': 'SELECT COUNT(*) FROM ' \
-            'class_instance_class_instance cici WHERE ' \
-            'cici.class_instance_b = class_instance.id %s' % conditions})
-
-    if len(search_term) > 0:
-        annotation_query = annotation_query.filter(name__iregex=search_term)
-
-    if should_sort:
-        column_count = int(request.POST.get('iSortingCols', 0))
-        sorting_directions = [request.POST.get('sSortDir_%d' % d, 'DESC')
-                for d in range(column_count)]
-        sorting_directions = list(map(lambda d: '-' if d.upper() == 'DESC' else '',
-                sorting_directions))
-
-        fields = ['name', 'annotated_on', 'num_usage', 'last_user']
-        sorting_index = [int(request.POST.get('iSortCol_%d' % d))
-                for d in range(column_count)]
-        sorting_cols = list(map(lambda i: fields[i], sorting_index))
-
-        annotation_query = annotation_query.extra(order_by=[di + col for (di, col) in zip(
-                sorting_directions, sorting_cols)])
-
-    # We only require ID, name, last used and usage number
-    annotation_query = annotation_query.values_list(
-            'id', 'name', 'annotated_on', 'num_usage', 'last_user')
-
-    # Make sure we get a distinct result (which otherwise might not be the case
-    # due to the JOINS that are made).
-    annotation_query = annotation_query.distinct()
+    # The usage of all annotations by everyone or a particular user is read
+    # from the annotation usage summary, the usage on a single neuron is
+    # computed on the fly.
+    neuron_id = request.POST.get('neuron_id')
+    user_id = request.POST.get('user_id')
+    if neuron_id:
+        usage_params = [int(neuron_id)]
+        user_condition = ''
+        if user_id:
+            user_condition = 'AND cici.user_id = %s'
+            usage_params.append(int(user_id))
+        usage = """
+            CROSS JOIN LATERAL (
+                SELECT MAX(cici.creation_time) AS last_used,
+                    COUNT(*) AS num_usage,
+                    (array_agg(cici.user_id ORDER BY cici.creation_time DESC))[1]
+                        AS last_user_id
+                FROM class_instance_class_instance cici
+                WHERE cici.class_instance_b = a.id
+                AND cici.class_instance_a = %s
+                {}
+            ) s
+        """.format(user_condition)
+    else:
+        if user_id:
+            user_condition = 's.user_id = %s'
+            usage_params = [int(user_id)]
+        else:
+            user_condition = 's.user_id IS NULL'
+            usage_params = []
+        usage = """
+            LEFT JOIN catmaid_annotation_usage_summary s
+                ON s.annotation_id = a.id
+                AND {}
+        """.format(user_condition)
+
+    rows = """
+        SELECT a.id, a.name, s.last_user_id AS last_user, s.last_used,
+            COALESCE(s.num_usage, 0) AS num_usage
+        FROM class_instance a
+        {usage}
+        WHERE a.id IN ({annotation_ids})
+    """.format(usage=usage, annotation_ids=annotation_ids)
 
-    #num_records = annotation_query.count() # len(annotation_query)
-    num_records = len(annotation_query)
+    fields = ('r.name', "COALESCE(r.last_used, '-infinity')", 'r.num_usage',
+            'COALESCE(r.last_user, -1)')
+    num_records, annotations = _get_annotation_datatable(request, rows,
+            usage_params + params, fields, display_start, display_length)
 
     response = {
         'iTotalRecords': num_records,
@@ -1340,18 +1387,18 @@ def list_annotations_datatable(request, project_id=None):
         'aaData': []
     }
 
-    for annotation in annotation_query[display_start:display_start + display_length]:
+    for annotation in annotations:
         # Format last used time
-        if annotation[2]:
-            annotated_on = annotation[2].isoformat()
+        if annotation[3]:
+            annotated_on = annotation[3].isoformat()
         else:
             annotated_on = 'never'
         # Build datatable data structure
         response['aaData'].append([
             annotation[1], # Name
             annotated_on, # Annotated on
-            annotation[3], # Usage
-            annotation[4], # Annotator ID
+            annotation[4], # Usage
+            annotation[2], # Annotator ID
             annotation[0]]) # ID
 
     return JsonResponse(response)
@@ -1,18 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import binascii
+import bisect
 import copy
+import io
 import json
+import math
 import msgpack
+import multiprocessing
+import numpy as np
 import ujson
 import psycopg2.extras
+import six
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta
 from abc import ABCMeta
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
-from django.db import connection
+from django.db import connection, connections, transaction
 from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
@@ -24,10 +32,10 @@ from catmaid.models import (UserRole, Treenode, ClassInstanceClassInstance,
         Review, Project)
 from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail
-from catmaid.control.common import get_relation_to_id_map, get_request_list
+from catmaid.control.common import (get_relation_to_id_map,
+        get_request_list, relation_map_cache)
 
-from PIL import Image, ImageDraw
-from aggdraw import Draw, Pen, Brush, Font
+from PIL import Image
 
 from six.moves import map as imap
 from six import add_metaclass, print_
@@ -39,6 +47,42 @@ ORIENTATIONS = {
     'zy': 2
 }
 
+# Maps orientations to the index of their depth dimension (X: 0, Y: 1, Z: 2).
+ORIENTATION_DEPTH_DIMENSIONS = {
+    'xy': 2,
+    'xz': 1,
+    'zy': 0
+}
+
+# Maps orientations to the indices of their width, height and depth dimension.
+ORIENTATION_DIMENSIONS = {
+    'xy': (0, 1, 2),
+    'xz': (0, 2, 1),
+    'zy': (2, 1, 0)
+}
+
+# The bounding box parameters for each dimension (X, Y, Z).
+DIMENSION_PARAMS = (('left', 'right'), ('top', 'bottom'), ('z1', 'z2'))
+
+# Tracing changes are looked for starting this long before the last update of
+# cached data. Change times are transaction start times, so that changes of
+# transactions that were still running during the update are found as well.
+CHANGE_DETECTION_OVERLAP = timedelta(seconds=60)
+
+
+def get_section_key(params):
+    """Return the orientation ID and section depth of a query as tuple. This is
+    the lower bound of the query bounding box in the depth dimension of the
+    query orientation. If the query orientation is unknown, None is returned.
+    """
+    orientation = params.get('orientation', 'xy')
+    orientation_id = ORIENTATIONS.get(orientation)
+    if orientation_id is None:
+        return None
+    dim = ORIENTATION_DEPTH_DIMENSIONS[orientation]
+    return orientation_id, params[DIMENSION_PARAMS[dim][0]]
+
+
 class BasicNodeProvider(object):
 
     def __init__(self, *args, **kwargs):
@@ -113,11 +157,14 @@ class CachedJsonNodeNodeProvder(BasicNodeProvider):
         cursor = connection.cursor()
         # For JSONB type cache, use ujson to decode, this is roughly 2x faster
         psycopg2.extras.register_default_jsonb(loads=ujson.loads)
+        section = get_section_key(params)
+        if not section:
+            return None, None
         cursor.execute("""
             SELECT json_data FROM node_query_cache
-            WHERE project_id = %s AND depth = %s
+            WHERE project_id = %s AND orientation = %s AND depth = %s
             LIMIT 1
-        """, (project_id, params['z1']))
+        """, (project_id, section[0], section[1]))
         rows = cursor.fetchone()
 
         if rows and rows[0]:
@@ -143,86 +190,243 @@ class CachedJsonNodeNodeProvder(BasicNodeProvider):
             return None, None
 
 
-class CachedJsonTextNodeProvder(BasicNodeProvider):
-    """Retrieve cached msgpack data from the node_query_cache table.
+# The cache table column and data type that is served without decoding for each
+# target format of a node query.
+RAW_CACHE_FORMAT_COLUMNS = {
+    'json': ('json_text_data', 'json_text'),
+    'msgpack': ('msgpack_data', 'msgpack'),
+}
+
+
+def add_extra_nodes_to_json_text(data, extra_tuples):
+    """Append the passed in extra node query result to a JSON encoded node
+    query result, without decoding it. If the result has no extra nodes yet, a
+    sixth element is added, otherwise the existing extra node list is extended.
+    """
+    data = data.rstrip()
+    extra_tuples_json = ujson.dumps(extra_tuples)
+    if data[-2:] == ']]':
+        # The last element is already a list of extra node results, which is
+        # closed by the second to last character.
+        return data[:-2] + ', ' + extra_tuples_json + ']]'
+    elif data[-1:] == ']':
+        return data[:-1] + ', [' + extra_tuples_json + ']]'
+    raise ValueError("Unexpected cached JSON text tuple format")
+
+
+def add_extra_nodes_to_msgpack(data, extra_tuples):
+    """Append the passed in extra node query result to a msgpack encoded five
+    element node query result, without decoding it. The result is turned into
+    a six element list, with a list of extra node results as last element.
+    """
+    data = bytes(data)
+    # A five-element list is encoded as fixarray, which means the first byte
+    # is 0x95.
+    if data[:1] != b'\x95':
+        raise ValueError("Unexpected cached Msgpack tuple format")
+    return b'\x96' + data[1:] + msgpack.packb([extra_tuples])
+
+
+class RawCachedNodeProvider(BasicNodeProvider):
+    """Retrieve cached node query results from the node_query_cache table and
+    return them in their encoded form. If the result is requested in a
+    different format than this provider's data type and the cache entry is
+    available in the requested format, too, the entry of the requested format
+    is returned. This way no decoding and re-encoding is needed for the
+    response. Extra nodes are added to the encoded data directly.
     """
 
+    cache_format = None
+
     def get_tuples(self, params, project_id, explicit_treenode_ids,
                 explicit_connector_ids, include_labels, with_relation_map):
         cursor = connection.cursor()
+        section = get_section_key(params)
+        if not section:
+            return None, None
+
+        column, data_type = RAW_CACHE_FORMAT_COLUMNS[self.cache_format]
+        target_column, target_data_type = RAW_CACHE_FORMAT_COLUMNS.get(
+                params.get('format'), (column, data_type))
+        # The entry of this provider's data type is only transferred if there
+        # is no entry in the target format.
         cursor.execute("""
-            SELECT json_text_data FROM node_query_cache
-            WHERE project_id = %s AND depth = %s
+            SELECT {target_column},
+                CASE WHEN {target_column} IS NULL THEN {column} ELSE NULL END
+            FROM node_query_cache
+            WHERE project_id = %s AND orientation = %s AND depth = %s
             LIMIT 1
-        """, (project_id, params['z1']))
+        """.format(target_column=target_column, column=column),
+            (project_id, section[0], section[1]))
         rows = cursor.fetchone()
+        if not rows:
+            return None, None
+        if rows[0]:
+            tuples, data_type = rows[0], target_data_type
+        elif rows[1]:
+            tuples = rows[1]
+        else:
+            return None, None
 
-        if rows and rows[0]:
-            tuples = rows[0]
-            # If there are exta nodes required, query them explicitely using a
-            # regular Postgis 2D query. Inject the result into cached data.
-            if explicit_treenode_ids or explicit_connector_ids:
-                extra_tuples, extra_type = get_extra_nodes(params, project_id,
-                    explicit_treenode_ids, explicit_connector_ids, include_labels,
-                    with_relation_map)
-                if extra_type != 'json':
-                    raise ValueError("Unexpected type")
+        # If there are exta nodes required, query them explicitely using a
+        # regular Postgis 2D query. Inject the result into cached data.
+        if explicit_treenode_ids or explicit_connector_ids:
+            extra_tuples, extra_type = get_extra_nodes(params, project_id,
+                explicit_treenode_ids, explicit_connector_ids, include_labels,
+                with_relation_map)
+            if extra_type != 'json':
+                raise ValueError("Unexpected type")
 
-                extra_tuples_json = json.dumps(extra_tuples)
-                if tuples[-2] == '}':
-                    # If cached response doesn't contain any extra nodes, add a
-                    # new field
-                    tuples = tuples[0:-1] + ', [' + extra_tuples_json + ']]'
-                elif tuples[-2] == ']':
-                    tuples = tuples[0:-2] + ', ' + extra_tuples_json + ']]'
-                else:
-                    raise ValueError("Unexpected cached JSON text tuple format")
+            if data_type == 'json_text':
+                tuples = add_extra_nodes_to_json_text(tuples, extra_tuples)
+            else:
+                tuples = add_extra_nodes_to_msgpack(tuples, extra_tuples)
+        elif data_type == 'msgpack':
+            tuples = bytes(tuples)
 
-            return tuples, 'json_text'
-        else:
-            return None, None
+        return tuples, data_type
 
 
-class CachedMsgpackNodeProvder(BasicNodeProvider):
+class CachedJsonTextNodeProvder(RawCachedNodeProvider):
+    """Retrieve cached JSON text data from the node_query_cache table.
+    """
+
+    cache_format = 'json'
+
+
+class CachedMsgpackNodeProvder(RawCachedNodeProvider):
     """Retrieve cached msgpack data from the node_query_cache table.
     """
 
+    cache_format = 'msgpack'
+
+
+class GridCachedNodeProvider(BasicNodeProvider):
+    """Retrieve cached data from the node_grid_cache_cell table. All cells of
+    the configured grid that intersect with the query bounding box are fetched
+    and merged. No result is returned if the query bounding box isn't
+    completely covered by the populated part of the grid, if it spans more than
+    one section of the grid or if more than <max_cells> cells would be needed.
+    """
+
+    data_type = None
+
+    def __init__(self, *args, **kwargs):
+        super(GridCachedNodeProvider, self).__init__(*args, **kwargs)
+        self.cell_width = kwargs.get('cell_width')
+        self.cell_height = kwargs.get('cell_height')
+        self.cell_depth = kwargs.get('cell_depth', kwargs.get('step'))
+        self.max_cells = kwargs.get('max_cells')
+
+    def decode(self, data):
+        """Decode raw cache data to Python objects."""
+        raise NotImplementedError()
+
     def get_tuples(self, params, project_id, explicit_treenode_ids,
-                explicit_connector_ids, include_labels, with_relation_map):
+            explicit_connector_ids, include_labels, with_relation_map):
+        if not (self.cell_width and self.cell_height and self.cell_depth):
+            raise ValueError("Need 'cell_width', 'cell_height' and 'cell_depth' "
+                    "parameters in grid node provider configuration")
+
         cursor = connection.cursor()
+        grid = get_node_grid(project_id, ORIENTATIONS[params['orientation']],
+                self.cell_width, self.cell_height, self.cell_depth, cursor)
+        if not grid:
+            return None, None
+
+        cell_range = get_grid_cell_range(params, self.cell_width,
+                self.cell_height, self.cell_depth, params['orientation'])
+        if not cell_range:
+            return None, None
+        min_x, max_x, min_y, max_y, z = cell_range
+
+        grid_id, min_xi, min_yi, min_zi, max_xi, max_yi, max_zi = grid[:7]
+        node_limit = grid[7]
+        if min_zi is None or min_x < min_xi or max_x > max_xi or \
+                min_y < min_yi or max_y > max_yi or z < min_zi or z > max_zi:
+            return None, None
+
+        if self.max_cells and \
+                (max_x - min_x + 1) * (max_y - min_y + 1) > self.max_cells:
+            return None, None
+
         cursor.execute("""
-            SELECT msgpack_data FROM node_query_cache
-            WHERE project_id = %s AND depth = %s
-            LIMIT 1
-        """, (project_id, params['z1']))
-        rows = cursor.fetchone()
+            SELECT {}
+            FROM node_grid_cache_cell
+            WHERE grid_id = %(grid_id)s
+            AND z_index = %(z)s
+            AND x_index BETWEEN %(min_x)s AND %(max_x)s
+            AND y_index BETWEEN %(min_y)s AND %(max_y)s
+        """.format(GRID_CACHE_DATA_COLUMNS[self.data_type]), {
+            'grid_id': grid_id,
+            'z': z,
+            'min_x': min_x,
+            'max_x': max_x,
+            'min_y': min_y,
+            'max_y': max_y,
+        })
+        cells = [row[0] for row in cursor.fetchall() if row[0]]
+
+        extra_nodes = explicit_treenode_ids or explicit_connector_ids
+        limit = params.get('limit')
+        within_limit = not limit or (node_limit and node_limit <= limit)
+        if len(cells) == 1 and not extra_nodes and within_limit:
+            # A single cell can be returned without decoding it, if it can't
+            # contain more nodes than requested.
+            data = cells[0]
+            if self.data_type == 'msgpack':
+                data = bytes(data)
+            return data, self.data_type
+
+        tuples = merge_node_list_results([self.decode(c) for c in cells],
+                params)
+
+        # If there are exta nodes required, query them explicitely using a
+        # regular Postgis 2D query. Inject the result into the merged data.
+        if extra_nodes:
+            extra_tuples, extra_type = get_extra_nodes(params, project_id,
+                explicit_treenode_ids, explicit_connector_ids, include_labels,
+                with_relation_map)
+            if extra_type != 'json':
+                raise ValueError("Unexpected type")
+            tuples.append([extra_tuples])
 
-        if rows and rows[0]:
-            tuples = rows[0]
-            # If there are exta nodes required, query them explicitely using a
-            # regular Postgis 2D query. Inject the result into cached data.
-            if explicit_treenode_ids or explicit_connector_ids:
-                extra_tuples, extra_type = get_extra_nodes(params, project_id,
-                    explicit_treenode_ids, explicit_connector_ids, include_labels,
-                    with_relation_map)
-                if extra_type != 'json':
-                    raise ValueError("Unexpected type")
+        return tuples, 'json'
 
-                # To inject msgpack data, we expect a five element list, which
-                # means the first byte is '\x95'. For now an error is raised if,
-                # the first byte is something else.
-                if tuples[0] != b'\x95':
-                    raise ValueError("Unexpected cached Msgpack tuple format")
 
-                extra_msgpack = msgpack.packb([extra_tuples])
+class GridCachedJsonNodeProvider(GridCachedNodeProvider):
+    """Retrieve cached JSON data from the node_grid_cache_cell table.
+    """
 
-                # Extend the five-element list with extra tuples by making it a
-                # six element list and just appending the extra list
-                tuples = b'\x96' + tuples[1:] + extra_msgpack
+    data_type = 'json'
 
-            return bytes(tuples), 'msgpack'
-        else:
-            return None, None
+    def get_tuples(self, *args, **kwargs):
+        # For JSONB type cache, use ujson to decode, this is roughly 2x faster
+        psycopg2.extras.register_default_jsonb(loads=ujson.loads)
+        return super(GridCachedJsonNodeProvider, self).get_tuples(*args, **kwargs)
+
+    def decode(self, data):
+        return data
+
+
+class GridCachedJsonTextNodeProvider(GridCachedNodeProvider):
+    """Retrieve cached JSON text data from the node_grid_cache_cell table.
+    """
+
+    data_type = 'json_text'
+
+    def decode(self, data):
+        return ujson.loads(data)
+
+
+class GridCachedMsgpackNodeProvider(GridCachedNodeProvider):
+    """Retrieve cached msgpack data from the node_grid_cache_cell table.
+    """
+
+    data_type = 'msgpack'
+
+    def decode(self, data):
+        return msgpack.unpackb(bytes(data), raw=False)
 
 
 @add_metaclass(ABCMeta)
@@ -825,6 +1029,9 @@ AVAILABLE_NODE_PROVIDERS = {
     'cached_json': CachedJsonNodeNodeProvder,
     'cached_json_text': CachedJsonTextNodeProvder,
     'cached_msgpack': CachedMsgpackNodeProvder,
+    'cached_json_grid': GridCachedJsonNodeProvider,
+    'cached_json_text_grid': GridCachedJsonTextNodeProvider,
+    'cached_msgpack_grid': GridCachedMsgpackNodeProvider,
 }
 
 
@@ -836,6 +1043,22 @@ CACHE_NODE_PROVIDER_DATA_TYPES = {
 }
 
 
+# The database cache identifier for each grid cache node provider
+GRID_CACHE_NODE_PROVIDER_DATA_TYPES = {
+    'cached_json_grid': 'json',
+    'cached_json_text_grid': 'json_text',
+    'cached_msgpack_grid': 'msgpack',
+}
+
+
+# The grid cache cell column used for each data type
+GRID_CACHE_DATA_COLUMNS = {
+    'json': 'json_data',
+    'json_text': 'json_text_data',
+    'msgpack': 'msgpack_data',
+}
+
+
 def get_configured_node_providers(provider_entries, connection=None):
     node_providers = []
     for entry in provider_entries:
@@ -862,13 +1085,14 @@ def update_node_query_cache(node_providers=None, log=print_):
     if not node_providers:
         node_providers = settings.NODE_PROVIDERS
 
-    for np in node_providers:
-        log("Checking node provder {}".format(np))
-        if type(np) in (list, tuple):
-            key = np[0]
-            options = np[1]
+    section_updates = OrderedDict()
+    for provider in node_providers:
+        log("Checking node provder {}".format(provider))
+        if type(provider) in (list, tuple):
+            key = provider[0]
+            options = provider[1]
         else:
-            key = np
+            key = provider
             options = {}
 
         project_id = options.get('project_id')
@@ -878,21 +1102,58 @@ def update_node_query_cache(node_providers=None, log=print_):
             project_ids = list(Project.objects.all().order_by('id').values_list('id', flat=True))
 
         clean_cache = options.get('clean', False)
+        # Unless a clean rebuild is requested, only sections that changed since
+        # their last update are recomputed by default.
+        incremental = options.get('incremental', True) and not clean_cache
+
+        grid_data_type = GRID_CACHE_NODE_PROVIDER_DATA_TYPES.get(key)
+        if grid_data_type:
+            cell_width = options.get('cell_width')
+            cell_height = options.get('cell_height')
+            cell_depth = options.get('cell_depth', options.get('step'))
+            if not (cell_width and cell_height and cell_depth):
+                raise ValueError("Need 'cell_width', 'cell_height' and "
+                        "'cell_depth' parameters in node provider configuration")
+            for project_id in project_ids:
+                log("Updating grid cache for project {}".format(project_id))
+                update_grid_cache(project_id, grid_data_type,
+                        options.get('orientation', 'xy'), cell_width,
+                        cell_height, cell_depth,
+                        node_limit=options.get('node_limit', None),
+                        delete=clean_cache, log=log)
+            continue
 
         data_type = CACHE_NODE_PROVIDER_DATA_TYPES.get(key)
         if not data_type:
             log("Skipping non-caching node provider: {}".format(key))
             continue
 
+        step = options.get('step')
+        if not step:
+            raise ValueError("Need 'step' parameter in node provider configuration")
+        node_limit = options.get('node_limit', None)
+        # Additional formats can be stored along with the provider's own data
+        # type, cached providers use them to avoid converting results.
+        data_types = tuple(options.get('data_types', (data_type,)))
+
+        # Section caches of all providers with compatible options are updated
+        # together, which allows to populate them in a single pass.
         for project_id in project_ids:
-            log("Updating cache for project {}".format(project_id))
-            orientations = [options.get('orientation', 'xy')]
-            steps = [options.get('step')]
-            if not steps:
-                raise ValueError("Need 'step' parameter in node provider configuration")
-            node_limit = options.get('node_limit', None)
-            update_cache(project_id, data_type, orientations, steps,
-                    node_limit=node_limit, delete=clean_cache, log=log)
+            update_key = (project_id, data_types, node_limit, clean_cache,
+                    incremental)
+            section_entries = section_updates.setdefault(update_key, [])
+            section_entry = (options.get('orientation', 'xy'), step)
+            if section_entry not in section_entries:
+                section_entries.append(section_entry)
+
+    for update_key, section_entries in six.iteritems(section_updates):
+        project_id, data_types, node_limit, clean_cache, incremental = update_key
+        log("Updating cache for project {}".format(project_id))
+        orientations = [e[0] for e in section_entries]
+        steps = [e[1] for e in section_entries]
+        update_cache(project_id, list(data_types), orientations, steps,
+                node_limit=node_limit, delete=clean_cache, log=log,
+                incremental=incremental)
 
 
 def get_tracing_bounding_box(project_id, cursor=None):
@@ -918,25 +1179,19 @@ def get_tracing_bounding_box(project_id, cursor=None):
 
     return row
 
-def update_cache(project_id, data_type, orientations, steps,
-        node_limit=None, delete=False, bb_limits=None, log=print_):
-    if data_type not in ('json', 'json_text', 'msgpack'):
-        raise ValueError('Type must be one of: json, json_text, msgpack')
-    if len(steps) != len(orientations):
-        raise ValueError('Need one depth resolution flag per orientation')
-    if project_id is None:
-        raise ValueError('Need project ID')
-
-    orientation_ids = list(map(lambda x: ORIENTATIONS[x], orientations))
-
-    cursor = connection.cursor()
 
+def get_cache_bounding_box(project_id, bb_limits=None, cursor=None,
+        log=print_):
+    """Return the tracing data bounding box of the passed in project as list
+    of minimum and maximum point, constrained by optional bounding box limits.
+    If no tracing data is available, None is returned.
+    """
     log(' -> Finding tracing data bounding box')
     row = get_tracing_bounding_box(project_id, cursor)
     bb = [row[0], row[1]]
     if None in bb[0] or None in bb[1]:
         log(' -> Found no valid bounding box, skipping project: {}'.format(bb))
-        return
+        return None
     else:
         log(' -> Found bounding box: {}'.format(bb))
 
@@ -949,6 +1204,222 @@ def update_cache(project_id, data_type, orientations, steps,
         bb[1][2] = min(bb[1][2], bb_limits[1][2])
         log(' -> Applied limits to bounding box: {}'.format(bb))
 
+    return bb
+
+
+def get_tracing_change_query(dims='xyz'):
+    """Return an SQL query for the bounding box in the passed in dimensions and
+    the change time of all treenode edges, connectors and connector links of
+    project %(project_id)s that were created, updated or deleted after
+    %(since)s. For each dimension, the minimum columns come first, followed by
+    the maximum columns and the change time. Deletions and old locations of
+    moved nodes can only be found if history tracking is enabled.
+    """
+    def columns(min_template, max_template):
+        return ', '.join([min_template.format(dim=d, DIM=d.upper()) for d in dims] +
+                [max_template.format(dim=d, DIM=d.upper()) for d in dims])
+
+    if settings.HISTORY_TRACKING:
+        # Previous versions of updated and deleted nodes and links. For
+        # treenodes, the edge to their (current) parent is respected.
+        history_query = """
+            UNION ALL
+            SELECT {treenode_history}, upper(th.sys_period)
+            FROM treenode__history th
+            LEFT JOIN treenode p
+                ON p.id = th.parent_id
+            WHERE th.project_id = %(project_id)s
+            AND th.sys_period && tstzrange(%(since)s, NULL)
+            UNION ALL
+            SELECT {connector_history}, upper(ch.sys_period)
+            FROM connector__history ch
+            WHERE ch.project_id = %(project_id)s
+            AND ch.sys_period && tstzrange(%(since)s, NULL)
+            UNION ALL
+            SELECT {link_history}, upper(tch.sys_period)
+            FROM treenode_connector__history tch
+            LEFT JOIN treenode t
+                ON t.id = tch.treenode_id
+            LEFT JOIN connector c
+                ON c.id = tch.connector_id
+            WHERE tch.project_id = %(project_id)s
+            AND tch.sys_period && tstzrange(%(since)s, NULL)
+        """.format(
+            treenode_history=columns('LEAST(th.location_{dim}, p.location_{dim})',
+                    'GREATEST(th.location_{dim}, p.location_{dim})'),
+            connector_history=columns('ch.location_{dim}', 'ch.location_{dim}'),
+            link_history=columns('LEAST(t.location_{dim}, c.location_{dim})',
+                    'GREATEST(t.location_{dim}, c.location_{dim})'))
+    else:
+        history_query = ""
+
+    return """
+        WITH changed_treenode AS (
+            SELECT t.id, t.edition_time
+            FROM treenode t
+            WHERE t.project_id = %(project_id)s
+            AND t.edition_time > %(since)s
+        )
+        -- Edges of new and updated treenodes
+        SELECT {treenode_edge}, ct.edition_time
+        FROM changed_treenode ct
+        JOIN treenode_edge te
+            ON te.id = ct.id
+        UNION ALL
+        -- Edges of child nodes, they change with their parent
+        SELECT {treenode_edge}, ct.edition_time
+        FROM changed_treenode ct
+        JOIN treenode c
+            ON c.parent_id = ct.id
+        JOIN treenode_edge te
+            ON te.id = c.id
+        UNION ALL
+        -- New and updated connectors
+        SELECT {connector}, c.edition_time
+        FROM connector c
+        WHERE c.project_id = %(project_id)s
+        AND c.edition_time > %(since)s
+        UNION ALL
+        -- New and updated connector links
+        SELECT {link_edge}, tc.edition_time
+        FROM treenode_connector tc
+        JOIN treenode_connector_edge tce
+            ON tce.id = tc.id
+        WHERE tc.project_id = %(project_id)s
+        AND tc.edition_time > %(since)s
+    """.format(
+        treenode_edge=columns('ST_{DIM}Min(te.edge)', 'ST_{DIM}Max(te.edge)'),
+        connector=columns('c.location_{dim}', 'c.location_{dim}'),
+        link_edge=columns('ST_{DIM}Min(tce.edge)', 'ST_{DIM}Max(tce.edge)')) + \
+        history_query
+
+
+def get_outdated_cache_depths(project_id, orientation, step, min_depth,
+        max_depth, cursor=None):
+    """Return a sorted list of section depths of the node query cache of the
+    passed in project and orientation that need to be recomputed. These are all
+    existing sections that intersect with tracing data that was created,
+    updated or deleted after the respective section was last updated. Sections
+    that are within the passed in depth range, but outside of the cached range
+    are returned as well, the section grid of existing cache entries is
+    respected. If no cache entries exist yet, None is returned. Deletions and
+    old locations of moved nodes can only be found if history tracking is
+    enabled. Changes made up to CHANGE_DETECTION_OVERLAP before a section
+    update are included, because they might have been committed only after it.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    orientation_id = ORIENTATIONS[orientation]
+    dim = 'xyz'[ORIENTATION_DEPTH_DIMENSIONS[orientation]]
+
+    cursor.execute("""
+        SELECT MIN(depth), MAX(depth), MIN(update_time)
+        FROM node_query_cache
+        WHERE project_id = %(project_id)s
+        AND orientation = %(orientation)s
+    """, {
+        'project_id': project_id,
+        'orientation': orientation_id
+    })
+    cached_min_depth, cached_max_depth, last_update = cursor.fetchone()
+    if last_update is None:
+        return None
+
+    cursor.execute("""
+        WITH change(min_depth, max_depth, change_time) AS (
+            {change_query}
+        )
+        SELECT DISTINCT nqc.depth
+        FROM node_query_cache nqc
+        JOIN change
+            ON change.change_time > nqc.update_time - %(overlap)s
+            AND floatrange(change.min_depth, change.max_depth, '[]') &&
+                floatrange(nqc.depth, nqc.depth + %(step)s, '[)')
+        WHERE nqc.project_id = %(project_id)s
+        AND nqc.orientation = %(orientation)s
+    """.format(change_query=get_tracing_change_query(dim)), {
+        'project_id': project_id,
+        'orientation': orientation_id,
+        'since': last_update - CHANGE_DETECTION_OVERLAP,
+        'overlap': CHANGE_DETECTION_OVERLAP,
+        'step': step,
+    })
+    depths = set(row[0] for row in cursor.fetchall())
+
+    # Add sections outside of the cached range, aligned with the existing
+    # section grid.
+    depth = cached_min_depth - step
+    while depth + step > min_depth:
+        depths.add(depth)
+        depth -= step
+    depth = cached_max_depth + step
+    while depth <= max_depth:
+        depths.add(depth)
+        depth += step
+
+    # Like get_section_depths(), a section starting at the maximum depth is
+    # included.
+    return sorted(d for d in depths if d + step > min_depth and d <= max_depth)
+
+
+def get_section_depths(bb, orientation, step):
+    """Return the start depth of all sections with the passed in thickness
+    that are needed to cover the passed in bounding box (including its
+    maximum) in the depth dimension of the passed in orientation.
+    """
+    dim = ORIENTATION_DEPTH_DIMENSIONS[orientation]
+    n_sections = int(math.floor((bb[1][dim] - bb[0][dim]) / step + 1e-9)) + 1
+    return [bb[0][dim] + i * step for i in range(n_sections)]
+
+
+def get_section_params(bb, orientation, depth, step):
+    """Return bounding box query parameters for the passed in section, which
+    covers the passed in bounding box in all but the depth dimension of the
+    passed in orientation.
+    """
+    params = {
+        'left': bb[0][0],
+        'top': bb[0][1],
+        'z1': bb[0][2],
+        'right': bb[1][0],
+        'bottom': bb[1][1],
+        'z2': bb[1][2],
+    }
+    min_param, max_param = DIMENSION_PARAMS[ORIENTATION_DEPTH_DIMENSIONS[orientation]]
+    params[min_param] = depth
+    params[max_param] = depth + step
+    return params
+
+
+def update_cache(project_id, data_type, orientations, steps,
+        node_limit=None, delete=False, bb_limits=None, log=print_,
+        incremental=False):
+    """Populate the node query cache of the passed in project for each
+    orientation with sections of the respective depth resolution. Instead of a
+    single data type, a list of data types can be passed in. If <incremental>
+    is true, only sections that were changed since their last update and
+    sections not yet cached are recomputed, each with a separate query. All
+    other orientations are populated together, using a single pass over all
+    tracing data (see populate_cache()).
+    """
+    data_types = data_type if type(data_type) in (list, tuple) else [data_type]
+    for dt in data_types:
+        if dt not in ('json', 'json_text', 'msgpack'):
+            raise ValueError('Type must be one of: json, json_text, msgpack')
+    if len(steps) != len(orientations):
+        raise ValueError('Need one depth resolution flag per orientation')
+    if project_id is None:
+        raise ValueError('Need project ID')
+
+    orientation_ids = list(map(lambda x: ORIENTATIONS[x], orientations))
+
+    cursor = connection.cursor()
+
+    bb = get_cache_bounding_box(project_id, bb_limits, cursor, log)
+    if not bb:
+        return
+
     if delete:
         for n, o in enumerate(orientations):
             orientation_id = orientation_ids[n]
@@ -962,65 +1433,1010 @@ def update_cache(project_id, data_type, orientations, steps,
                 'orientation': orientation_id
             })
 
-    params = {
-        'left': bb[0][0],
-        'top': bb[0][1],
-        'z1': None,
-        'right': bb[1][0],
-        'bottom': bb[1][1],
-        'z2': None,
-        'project_id': project_id,
-        'limit': node_limit
-    }
-
-    min_z = bb[0][2]
-    max_z = bb[1][2]
-
-    data_types = [data_type]
-    update_json_cache = 'json' in data_types
-    update_json_text_cache = 'json_text' in data_types
-    update_msgpack_cache = 'msgpack' in data_types
-
-    provider = Postgis2dNodeProvider()
     types = ', '.join(data_types)
+    provider = Postgis2dNodeProvider()
 
+    full_orientations, full_steps = [], []
     for o, step in zip(orientations, steps):
         orientation_id = ORIENTATIONS[o]
+        depths = None
+        if incremental and not delete:
+            dim = ORIENTATION_DEPTH_DIMENSIONS[o]
+            depths = get_outdated_cache_depths(project_id, o, step,
+                    bb[0][dim], bb[1][dim], cursor)
+            if depths is None:
+                log(' -> No existing cache for orientation {}, populating all sections'.format(o))
+            else:
+                log(' -> Found {} outdated sections in orientation {}'.format(len(depths), o))
+        if depths is None:
+            full_orientations.append(o)
+            full_steps.append(step)
+            continue
+
         log(' -> Populating cache for orientation {} with depth resolution {} for types: {}'.format(o, step, types))
-        z = min_z
-        while z < max_z:
-            params['z1'] = z
-            params['z2'] = z + step
+        for depth in depths:
+            params = get_section_params(bb, o, depth, step)
+            params['project_id'] = project_id
+            params['limit'] = node_limit
+            # Remember the time before the query, so that changes made while
+            # the section is computed are recognized in incremental updates.
+            cursor.execute("SELECT clock_timestamp()")
+            update_time = cursor.fetchone()[0]
             result_tuple = _node_list_tuples_query(params, project_id, provider)
 
-            if update_json_cache:
-                data = ujson.dumps(result_tuple)
+            if 'json' in data_types:
                 cursor.execute("""
                     INSERT INTO node_query_cache (project_id, orientation, depth, update_time, json_data)
-                    VALUES (%s, %s, %s, now(), %s)
+                    VALUES (%s, %s, %s, %s, %s)
                     ON CONFLICT (project_id, orientation, depth)
                     DO UPDATE SET json_data = EXCLUDED.json_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, json.dumps(result_tuple)))
+                """, (project_id, orientation_id, depth, update_time, json.dumps(result_tuple)))
 
-            if update_json_text_cache:
-                data = ujson.dumps(result_tuple)
+            if 'json_text' in data_types:
                 cursor.execute("""
                     INSERT INTO node_query_cache (project_id, orientation, depth, update_time, json_text_data)
-                    VALUES (%s, %s, %s, now(), %s)
+                    VALUES (%s, %s, %s, %s, %s)
                     ON CONFLICT (project_id, orientation, depth)
                     DO UPDATE SET json_text_data = EXCLUDED.json_text_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, json.dumps(result_tuple)))
+                """, (project_id, orientation_id, depth, update_time, json.dumps(result_tuple)))
 
-            if update_msgpack_cache:
+            if 'msgpack' in data_types:
                 data = msgpack.packb(result_tuple)
                 cursor.execute("""
                     INSERT INTO node_query_cache (project_id, orientation, depth, update_time, msgpack_data)
-                    VALUES (%s, %s, %s, now(), %s)
+                    VALUES (%s, %s, %s, %s, %s)
                     ON CONFLICT (project_id, orientation, depth)
                     DO UPDATE SET msgpack_data = EXCLUDED.msgpack_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, psycopg2.Binary(data)))
+                """, (project_id, orientation_id, depth, update_time, psycopg2.Binary(data)))
+
+    if full_orientations:
+        populate_cache(project_id, data_types, full_orientations, full_steps,
+                bb, node_limit, log)
+
+
+def _stream_query(query, params, name, itersize=10000):
+    """Execute the passed in query using a server side cursor and yield all
+    result rows. Only <itersize> rows are kept in memory at a time. This has to
+    be called within a transaction.
+    """
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(name=name)
+    cursor.itersize = itersize
+    try:
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+def _csv_value(value):
+    """Format a value for PostgreSQL's CSV COPY format. None is encoded as
+    NULL, bytea values are expected as strings in hex format."""
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, six.string_types):
+        return '"' + value.replace('"', '""') + '"'
+    return six.text_type(value)
+
+
+class NodeCacheSections(object):
+    """Collect tracing data of a project in memory and assign nodes, connectors
+    and links to sections of multiple orientations and depth resolutions. Each
+    node is stored only once, sections only reference node IDs.
+    """
+
+    def __init__(self, bb, orientations, steps, depths=None):
+        self.bb = bb
+        self.layers = []
+        if not depths:
+            depths = [get_section_depths(bb, o, step) for o, step in
+                    zip(orientations, steps)]
+        for o, step, depths in zip(orientations, steps, depths):
+            self.layers.append({
+                'orientation': o,
+                'dim': ORIENTATION_DEPTH_DIMENSIONS[o],
+                'step': step,
+                'depths': depths,
+                'edges': [[] for _ in depths],
+                'links': [[] for _ in depths],
+                'connectors': [[] for _ in depths],
+            })
+
+        # Node data, mapped by ID
+        self.treenodes = {}
+        self.connectors = {}
+        self.links = {}
+        self.link_connectors = {}
+
+    def _sections(self, layer, min_loc, max_loc):
+        """Return the indices of all sections in a layer that intersect with
+        the closed range between the passed in locations.
+        """
+        dim, depths, step = layer['dim'], layer['depths'], layer['step']
+        first = max(0, bisect.bisect_right(depths, min_loc[dim]) - 1)
+        last = bisect.bisect_right(depths, max_loc[dim]) - 1
+        if first < len(depths) and min_loc[dim] >= depths[first] + step:
+            first += 1
+        return range(first, last + 1)
+
+    def add_treenode(self, row, min_loc, max_loc):
+        """Add a treenode and its edge to its parent."""
+        node_id = row[0]
+        self.treenodes[node_id] = row
+        for layer in self.layers:
+            edges = layer['edges']
+            for i in self._sections(layer, min_loc, max_loc):
+                edges[i].append(node_id)
+
+    def add_link(self, connector_row, link_row, min_loc, max_loc):
+        """Add a link between a connector and a treenode."""
+        connector_id, link_id = connector_row[0], link_row[4]
+        self.connectors[connector_id] = connector_row
+        self.links[link_id] = link_row
+        self.link_connectors[link_id] = connector_id
+        for layer in self.layers:
+            links = layer['links']
+            for i in self._sections(layer, min_loc, max_loc):
+                links[i].append(link_id)
+
+    def add_connector(self, connector_row, loc):
+        """Add a connector location."""
+        connector_id = connector_row[0]
+        self.connectors[connector_id] = connector_row
+        for layer in self.layers:
+            connectors = layer['connectors']
+            for i in self._sections(layer, loc, loc):
+                connectors[i].append(connector_id)
+
+    def get_missing_treenode_ids(self):
+        """Return IDs of parent nodes and linked nodes that have not been
+        added."""
+        missing = set()
+        treenodes = self.treenodes
+        for row in six.itervalues(treenodes):
+            if row[1] is not None and row[1] not in treenodes:
+                missing.add(row[1])
+        for link in six.itervalues(self.links):
+            if link[0] not in treenodes:
+                missing.add(link[0])
+        return missing
+
+    def get_result(self, layer, index, node_limit=None):
+        """Return the node query result for a section, in the same format as
+        _node_list_tuples_query()."""
+        treenodes, connectors = self.treenodes, self.connectors
+        treenode_ids = []
+        seen = set()
+        for node_id in layer['edges'][index]:
+            for n in (node_id, treenodes[node_id][1]):
+                if n is not None and n not in seen:
+                    seen.add(n)
+                    treenode_ids.append(n)
+
+        connector_links = OrderedDict()
+        for link_id in layer['links'][index]:
+            link = self.links[link_id]
+            connector_links.setdefault(self.link_connectors[link_id], []).append(link)
+            if link[0] not in seen:
+                seen.add(link[0])
+                treenode_ids.append(link[0])
+        for connector_id in layer['connectors'][index]:
+            connector_links.setdefault(connector_id, [])
+
+        section_treenodes = [treenodes[n] for n in treenode_ids if n in treenodes]
+        section_connectors = [connectors[c] + (l,) for c, l in six.iteritems(connector_links)]
+
+        limit_reached = False
+        if node_limit:
+            section_treenodes = section_treenodes[:node_limit]
+            section_connectors = section_connectors[:node_limit]
+            limit_reached = len(section_treenodes) == node_limit
+
+        return [section_treenodes, section_connectors, {}, limit_reached, {}]
+
+
+class NodeGridCells(NodeCacheSections):
+    """Collect tracing data of a single section of a node grid in memory and
+    assign nodes, connectors and links to the grid cells they intersect with.
+    Cells are identified by their (column, row) index in the width and height
+    dimension of the grid orientation. Like regular node queries, cells
+    include their upper bound in these dimensions. In the depth dimension,
+    only data in the range [<min_depth>, <max_depth>) is respected.
+    """
+
+    def __init__(self, orientation, cell_width, cell_height, min_depth,
+            max_depth):
+        width_dim, height_dim, depth_dim = ORIENTATION_DIMENSIONS[orientation]
+        self.cell_sizes = ((width_dim, cell_width), (height_dim, cell_height))
+        self.depth_dim = depth_dim
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.layers = [{
+            'edges': defaultdict(list),
+            'links': defaultdict(list),
+            'connectors': defaultdict(list),
+        }]
+
+        # Node data, mapped by ID
+        self.treenodes = {}
+        self.connectors = {}
+        self.links = {}
+        self.link_connectors = {}
+
+    def _sections(self, layer, min_loc, max_loc):
+        """Return the indices of all cells that intersect with the closed range
+        between the passed in locations.
+        """
+        dim = self.depth_dim
+        if max_loc[dim] < self.min_depth or min_loc[dim] >= self.max_depth:
+            return []
+        (w, cell_width), (h, cell_height) = self.cell_sizes
+        return [(x, y)
+                for x in range(int(math.floor(min_loc[w] / cell_width)),
+                        int(math.floor(max_loc[w] / cell_width)) + 1)
+                for y in range(int(math.floor(min_loc[h] / cell_height)),
+                        int(math.floor(max_loc[h] / cell_height)) + 1)]
+
+    def get_cells(self):
+        """Return the indices of all cells with any data."""
+        layer = self.layers[0]
+        return set(layer['edges']) | set(layer['links']) | \
+                set(layer['connectors'])
+
+
+def _read_node_cache_data(sections, params, cursor, log=print_):
+    """Stream all treenode edges, connector links and connectors of project
+    <params['project_id']> that intersect with the bounding box in <params>
+    (min_x, min_y, min_z, max_x, max_y, max_z) into the passed in
+    NodeCacheSections instance. Parents and linked nodes outside of the
+    bounding box are added as well. This has to be called within a
+    transaction.
+    """
+    n_rows = 0
+    for row in _stream_query("""
+        SELECT t.id, t.parent_id, t.location_x, t.location_y,
+            t.location_z, t.confidence, t.radius, t.skeleton_id,
+            EXTRACT(EPOCH FROM t.edition_time), t.user_id,
+            ST_XMin(te.edge), ST_YMin(te.edge), ST_ZMin(te.edge),
+            ST_XMax(te.edge), ST_YMax(te.edge), ST_ZMax(te.edge)
+        FROM treenode_edge te
+        JOIN treenode t
+            ON t.id = te.id
+        WHERE te.project_id = %(project_id)s
+        AND te.edge &&& ST_MakeLine(ARRAY[
+            ST_MakePoint(%(min_x)s, %(min_y)s, %(min_z)s),
+            ST_MakePoint(%(max_x)s, %(max_y)s, %(max_z)s)]::geometry[])
+    """, params, 'node_cache_treenodes'):
+        sections.add_treenode(row[:10], row[10:13], row[13:16])
+        n_rows += 1
+    log(' -> Read {} treenodes'.format(n_rows))
+
+    n_rows = 0
+    for row in _stream_query("""
+        SELECT c.id, c.location_x, c.location_y, c.location_z,
+            c.confidence, EXTRACT(EPOCH FROM c.edition_time), c.user_id,
+            tc.treenode_id, tc.relation_id, tc.confidence,
+            EXTRACT(EPOCH FROM tc.edition_time), tc.id,
+            ST_XMin(tce.edge), ST_YMin(tce.edge), ST_ZMin(tce.edge),
+            ST_XMax(tce.edge), ST_YMax(tce.edge), ST_ZMax(tce.edge)
+        FROM treenode_connector_edge tce
+        JOIN treenode_connector tc
+            ON tc.id = tce.id
+        JOIN connector c
+            ON c.id = tc.connector_id
+        WHERE tce.project_id = %(project_id)s
+        AND tce.edge &&& ST_MakeLine(ARRAY[
+            ST_MakePoint(%(min_x)s, %(min_y)s, %(min_z)s),
+            ST_MakePoint(%(max_x)s, %(max_y)s, %(max_z)s)]::geometry[])
+    """, params, 'node_cache_links'):
+        sections.add_link(row[:7], row[7:12], row[12:15], row[15:18])
+        n_rows += 1
+    log(' -> Read {} connector links'.format(n_rows))
+
+    n_rows = 0
+    for row in _stream_query("""
+        SELECT c.id, c.location_x, c.location_y, c.location_z,
+            c.confidence, EXTRACT(EPOCH FROM c.edition_time), c.user_id
+        FROM connector_geom cg
+        JOIN connector c
+            ON c.id = cg.id
+        WHERE cg.project_id = %(project_id)s
+        AND cg.geom &&& ST_MakeLine(ARRAY[
+            ST_MakePoint(%(min_x)s, %(min_y)s, %(min_z)s),
+            ST_MakePoint(%(max_x)s, %(max_y)s, %(max_z)s)]::geometry[])
+    """, params, 'node_cache_connectors'):
+        sections.add_connector(row, row[1:4])
+        n_rows += 1
+    log(' -> Read {} connectors'.format(n_rows))
+
+    # Parents and linked nodes outside of the bounding box
+    missing_treenode_ids = list(sections.get_missing_treenode_ids())
+    if missing_treenode_ids:
+        cursor.execute("""
+            SELECT t.id, t.parent_id, t.location_x, t.location_y,
+                t.location_z, t.confidence, t.radius, t.skeleton_id,
+                EXTRACT(EPOCH FROM t.edition_time), t.user_id
+            FROM treenode t
+            JOIN UNNEST(%(treenode_ids)s::bigint[]) query(id)
+                ON t.id = query.id
+        """, {
+            'treenode_ids': missing_treenode_ids
+        })
+        for row in cursor.fetchall():
+            sections.treenodes[row[0]] = row
+        log(' -> Read {} additional treenodes'.format(len(missing_treenode_ids)))
+
+
+def populate_cache(project_id, data_types, orientations, steps, bb,
+        node_limit=None, log=print_, batch_size=500, depths=None):
+    """Populate the node query cache of the passed in project for all passed in
+    orientations and depth resolutions (one per orientation) within the
+    passed in bounding box. Instead of querying each section individually,
+    all treenode edges, connector links and connectors are streamed once from
+    the database and assigned to their sections in memory. The results are
+    written in batches using COPY. This requires enough memory to hold the
+    tracing data within the bounding box. Optionally, the list of section
+    depths can be passed in for each orientation, by default all sections
+    covering the bounding box are populated.
+    """
+    log(' -> Populating cache for orientations {} with depth resolutions {} '
+            'for types: {}'.format(', '.join(orientations),
+            ', '.join(str(s) for s in steps), ', '.join(data_types)))
+
+    sections = NodeCacheSections(bb, orientations, steps, depths)
+    params = {
+        'project_id': project_id,
+        'min_x': bb[0][0],
+        'min_y': bb[0][1],
+        'min_z': bb[0][2],
+        'max_x': bb[1][0],
+        'max_y': bb[1][1],
+        'max_z': bb[1][2],
+    }
+
+    with transaction.atomic():
+        cursor = connection.cursor()
+        # Remember the time before any data is read, so that concurrent changes
+        # are recognized in incremental updates.
+        cursor.execute("SELECT clock_timestamp()")
+        update_time = cursor.fetchone()[0]
+
+        _read_node_cache_data(sections, params, cursor, log)
+
+        cursor.execute("""
+            CREATE TEMPORARY TABLE node_query_cache_update (
+                LIKE node_query_cache INCLUDING DEFAULTS
+            ) ON COMMIT DROP
+        """)
+
+        columns = ('project_id', 'orientation', 'depth', 'update_time',
+                'json_data', 'json_text_data', 'msgpack_data')
+        copy_query = """
+            COPY node_query_cache_update ({})
+            FROM STDIN WITH (FORMAT csv)
+        """.format(', '.join(columns))
+
+        def write(buf):
+            buf.seek(0)
+            cursor.copy_expert(copy_query, buf)
+
+        buf = io.StringIO()
+        n_rows, n_buffered = 0, 0
+        for layer in sections.layers:
+            orientation_id = ORIENTATIONS[layer['orientation']]
+            for i, depth in enumerate(layer['depths']):
+                result = sections.get_result(layer, i, node_limit)
+                json_data = json.dumps(result) if 'json' in data_types else None
+                json_text_data = json.dumps(result) if 'json_text' in data_types else None
+                msgpack_data = '\\x' + binascii.hexlify(msgpack.packb(result)).decode('ascii') \
+                        if 'msgpack' in data_types else None
+                buf.write(','.join(_csv_value(v) for v in (project_id,
+                        orientation_id, depth, update_time, json_data,
+                        json_text_data, msgpack_data)))
+                buf.write('\n')
+                n_rows += 1
+                n_buffered += 1
+                if n_buffered == batch_size:
+                    write(buf)
+                    buf = io.StringIO()
+                    n_buffered = 0
+        if n_buffered:
+            write(buf)
+
+        # Only data types that were computed are updated in existing rows
+        cursor.execute("""
+            INSERT INTO node_query_cache ({columns})
+            SELECT {columns} FROM node_query_cache_update
+            ON CONFLICT (project_id, orientation, depth)
+            DO UPDATE SET
+                json_data = COALESCE(EXCLUDED.json_data, node_query_cache.json_data),
+                json_text_data = COALESCE(EXCLUDED.json_text_data, node_query_cache.json_text_data),
+                msgpack_data = COALESCE(EXCLUDED.msgpack_data, node_query_cache.msgpack_data),
+                update_time = EXCLUDED.update_time
+        """.format(columns=', '.join(columns)))
+        cursor.execute("DROP TABLE node_query_cache_update")
+
+    log(' -> Wrote {} cache sections'.format(n_rows))
+
+
+def get_build_partition_count(n_sections, partition_size):
+    """Return the number of partitions needed to split the passed in number of
+    sections into partitions of the passed in size.
+    """
+    return int(math.ceil(n_sections / float(partition_size)))
+
+
+def create_cache_build(project_id, data_types, orientation, step,
+        node_limit=None, bb_limits=None, partition_size=100, delete=False,
+        cursor=None, log=print_):
+    """Create a new node query cache build for the passed in orientation and
+    return its ID. The sections of the build are split into partitions of
+    <partition_size> consecutive sections, which can be populated independently
+    using update_cache_build_partition(). If there is no tracing data in the
+    bounding box, None is returned.
+    """
+    if partition_size < 1:
+        raise ValueError('Partition size has to be positive')
+    if not cursor:
+        cursor = connection.cursor()
 
-            z += step
+    bb = get_cache_bounding_box(project_id, bb_limits, cursor, log)
+    if not bb:
+        return None
+
+    orientation_id = ORIENTATIONS[orientation]
+    if delete:
+        log(' -> Deleting existing cache entries in orientation {}'.format(orientation))
+        cursor.execute("""
+            DELETE FROM node_query_cache
+            WHERE project_id = %(project_id)s
+            AND orientation = %(orientation)s
+        """, {
+            'project_id': project_id,
+            'orientation': orientation_id
+        })
+
+    n_sections = len(get_section_depths(bb, orientation, step))
+    cursor.execute("""
+        INSERT INTO node_query_cache_build (project_id, orientation, step,
+            data_types, node_limit, min_x, min_y, min_z, max_x, max_y, max_z,
+            n_sections, partition_size)
+        VALUES (%(project_id)s, %(orientation)s, %(step)s, %(data_types)s,
+            %(node_limit)s, %(min_x)s, %(min_y)s, %(min_z)s, %(max_x)s,
+            %(max_y)s, %(max_z)s, %(n_sections)s, %(partition_size)s)
+        RETURNING id
+    """, {
+        'project_id': project_id,
+        'orientation': orientation_id,
+        'step': step,
+        'data_types': list(data_types),
+        'node_limit': node_limit,
+        'min_x': bb[0][0],
+        'min_y': bb[0][1],
+        'min_z': bb[0][2],
+        'max_x': bb[1][0],
+        'max_y': bb[1][1],
+        'max_z': bb[1][2],
+        'n_sections': n_sections,
+        'partition_size': partition_size,
+    })
+    build_id = cursor.fetchone()[0]
+    log(' -> Created cache build {} for orientation {} with {} sections in {} partitions'.format(
+            build_id, orientation, n_sections,
+            get_build_partition_count(n_sections, partition_size)))
+    return build_id
+
+
+def get_unfinished_cache_build(project_id, data_types, orientation, step,
+        node_limit=None, cursor=None):
+    """Return the ID of the most recent incomplete cache build with the passed
+    in parameters or None if there is none.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute("""
+        SELECT id FROM node_query_cache_build
+        WHERE project_id = %(project_id)s
+        AND orientation = %(orientation)s
+        AND step = %(step)s
+        AND data_types = %(data_types)s::text[]
+        AND node_limit IS NOT DISTINCT FROM %(node_limit)s
+        AND completion_time IS NULL
+        ORDER BY creation_time DESC
+        LIMIT 1
+    """, {
+        'project_id': project_id,
+        'orientation': ORIENTATIONS[orientation],
+        'step': step,
+        'data_types': list(data_types),
+        'node_limit': node_limit,
+    })
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_open_cache_build_partitions(build_id, cursor=None):
+    """Return a list of the indices of all partitions of the passed in cache
+    build that haven't been populated yet.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute("""
+        SELECT p.index
+        FROM node_query_cache_build b,
+        LATERAL generate_series(0, CEIL(b.n_sections::float / b.partition_size)::int - 1) p(index)
+        WHERE b.id = %(build_id)s
+        AND NOT EXISTS (
+            SELECT 1 FROM node_query_cache_build_partition bp
+            WHERE bp.build_id = b.id
+            AND bp.partition_index = p.index
+        )
+        ORDER BY p.index
+    """, {
+        'build_id': build_id
+    })
+    return [row[0] for row in cursor.fetchall()]
+
+
+def update_cache_build_partition(build_id, partition_index, log=print_):
+    """Populate all sections of a single partition of a cache build and mark
+    the partition as done. If this was the last open partition, the build is
+    marked as complete. Both the cache data and the partition record are
+    written in the same transaction, which makes it safe to run this function
+    concurrently for different partitions.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT project_id, orientation, step, data_types, node_limit,
+            min_x, min_y, min_z, max_x, max_y, max_z, n_sections,
+            partition_size
+        FROM node_query_cache_build
+        WHERE id = %(build_id)s
+    """, {
+        'build_id': build_id
+    })
+    row = cursor.fetchone()
+    if not row:
+        raise ValueError('Could not find cache build {}'.format(build_id))
+    project_id, orientation_id, step, data_types, node_limit = row[:5]
+    bb = [list(row[5:8]), list(row[8:11])]
+    n_sections, partition_size = row[11:13]
+
+    orientation = dict((v, k) for k, v in six.iteritems(ORIENTATIONS))[orientation_id]
+    all_depths = get_section_depths(bb, orientation, step)
+    depths = all_depths[partition_index * partition_size:
+            (partition_index + 1) * partition_size]
+    if not depths:
+        raise ValueError('Partition {} of cache build {} is empty'.format(
+                partition_index, build_id))
+
+    # Only read tracing data of this partition's sections
+    dim = ORIENTATION_DEPTH_DIMENSIONS[orientation]
+    bb[0][dim] = depths[0]
+    bb[1][dim] = depths[-1] + step
+
+    with transaction.atomic():
+        populate_cache(project_id, data_types, [orientation], [step], bb,
+                node_limit, log, depths=[depths])
+        cursor.execute("""
+            INSERT INTO node_query_cache_build_partition (build_id, partition_index)
+            VALUES (%(build_id)s, %(partition_index)s)
+            ON CONFLICT (build_id, partition_index) DO NOTHING
+        """, {
+            'build_id': build_id,
+            'partition_index': partition_index,
+        })
+        cursor.execute("""
+            UPDATE node_query_cache_build b
+            SET completion_time = now()
+            WHERE b.id = %(build_id)s
+            AND b.completion_time IS NULL
+            AND (
+                SELECT COUNT(*) FROM node_query_cache_build_partition bp
+                WHERE bp.build_id = b.id
+            ) >= %(n_partitions)s
+        """, {
+            'build_id': build_id,
+            'n_partitions': get_build_partition_count(n_sections, partition_size),
+        })
+
+
+def _update_cache_build_partition_worker(task):
+    """Process pool entry point to populate a single cache build partition.
+    Each worker process opens its own database connection.
+    """
+    build_id, partition_index = task
+    update_cache_build_partition(build_id, partition_index, log=lambda x: None)
+    return task
+
+
+def prepare_cache_builds(project_id, data_types, orientations, steps,
+        node_limit=None, delete=False, bb_limits=None, partition_size=100,
+        resume=False, log=print_):
+    """Create a cache build for each passed in orientation and return a list of
+    (build ID, partition index) tuples, one for each partition that needs to
+    be populated. If <resume> is true, the most recent unfinished build with
+    the same parameters is continued, if there is one.
+    """
+    for dt in data_types:
+        if dt not in ('json', 'json_text', 'msgpack'):
+            raise ValueError('Type must be one of: json, json_text, msgpack')
+    if len(steps) != len(orientations):
+        raise ValueError('Need one depth resolution flag per orientation')
+    if project_id is None:
+        raise ValueError('Need project ID')
+
+    cursor = connection.cursor()
+    tasks = []
+    for o, step in zip(orientations, steps):
+        build_id = None
+        if resume:
+            build_id = get_unfinished_cache_build(project_id, data_types, o,
+                    step, node_limit, cursor)
+            if build_id:
+                log(' -> Resuming cache build {} for orientation {}'.format(build_id, o))
+        if not build_id:
+            build_id = create_cache_build(project_id, data_types, o, step,
+                    node_limit, bb_limits, partition_size, delete, cursor, log)
+            if not build_id:
+                continue
+        partitions = get_open_cache_build_partitions(build_id, cursor)
+        log(' -> {} open partitions in orientation {}'.format(len(partitions), o))
+        tasks.extend((build_id, p) for p in partitions)
+
+    return tasks
+
+
+def populate_cache_build_partitions(tasks, jobs=None, log=print_):
+    """Populate all passed in (build ID, partition index) tuples, which can
+    belong to builds of different projects, using a pool of <jobs> worker
+    processes (by default one per CPU). Progress is reported after each
+    completed partition.
+    """
+    if not tasks:
+        log(' -> Nothing to update')
+        return
+
+    if jobs == 1:
+        for n, task in enumerate(tasks):
+            _update_cache_build_partition_worker(task)
+            log(' -> Populated partition {} of cache build {} ({}/{})'.format(
+                    task[1], task[0], n + 1, len(tasks)))
+        return
+
+    # Forked worker processes must not share the database connection of this
+    # process, they create their own connection when needed.
+    connections.close_all()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for n, task in enumerate(pool.imap_unordered(
+                _update_cache_build_partition_worker, tasks)):
+            log(' -> Populated partition {} of cache build {} ({}/{})'.format(
+                    task[1], task[0], n + 1, len(tasks)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def update_cache_parallel(project_id, data_types, orientations, steps,
+        node_limit=None, delete=False, bb_limits=None, jobs=None,
+        partition_size=100, resume=False, log=print_):
+    """Populate the node query cache of the passed in project like
+    update_cache(), but split each orientation into partitions of consecutive
+    sections, which are populated by a pool of <jobs> worker processes (by
+    default one per CPU). Completed partitions are recorded, which allows
+    resuming an interrupted update with <resume> set to true.
+    """
+    tasks = prepare_cache_builds(project_id, data_types, orientations, steps,
+            node_limit, delete, bb_limits, partition_size, resume, log)
+    populate_cache_build_partitions(tasks, jobs, log)
+
+
+def get_node_grid(project_id, orientation_id, cell_width, cell_height,
+        cell_depth, cursor=None):
+    """Return the ID, populated index range and node limit of the node grid
+    cache matching the passed in parameters as tuple (id, min_x_index,
+    min_y_index, min_z_index, max_x_index, max_y_index, max_z_index,
+    node_limit) or None if there is no such grid.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    cursor.execute("""
+        SELECT id, min_x_index, min_y_index, min_z_index,
+            max_x_index, max_y_index, max_z_index, node_limit
+        FROM node_grid_cache
+        WHERE project_id = %(project_id)s
+        AND orientation = %(orientation)s
+        AND cell_width = %(cell_width)s
+        AND cell_height = %(cell_height)s
+        AND cell_depth = %(cell_depth)s
+    """, {
+        'project_id': project_id,
+        'orientation': orientation_id,
+        'cell_width': float(cell_width),
+        'cell_height': float(cell_height),
+        'cell_depth': float(cell_depth),
+    })
+    return cursor.fetchone()
+
+
+def get_grid_cell_range(params, cell_width, cell_height, cell_depth,
+        orientation='xy'):
+    """Return the range of grid cells intersecting with the bounding box in
+    <params> as tuple (min_x, max_x, min_y, max_y, z), all inclusive. The X, Y
+    and Z index of a cell refer to the width, height and depth dimension of
+    the passed in orientation. Grid cell (i, j, k) covers
+    [i * cell_width, (i + 1) * cell_width) in the width dimension, and likewise
+    in the height and depth dimension. Since cells are only cached in the
+    depth of one section, None is returned if the bounding box spans more than
+    one section.
+    """
+    (min_w, max_w), (min_h, max_h), (min_d, max_d) = [DIMENSION_PARAMS[d]
+            for d in ORIENTATION_DIMENSIONS[orientation]]
+
+    z = int(math.floor(params[min_d] / cell_depth))
+    if params[max_d] > (z + 1) * cell_depth + 0.0001:
+        return None
+
+    min_x = int(math.floor(params[min_w] / cell_width))
+    max_x = max(min_x, int(math.ceil(params[max_w] / cell_width)) - 1)
+    min_y = int(math.floor(params[min_h] / cell_height))
+    max_y = max(min_y, int(math.ceil(params[max_h] / cell_height)) - 1)
+
+    return min_x, max_x, min_y, max_y, z
+
+
+def merge_node_list_results(results, params=None, limit=None):
+    """Merge the passed in list of node query results into a single result.
+    Nodes shared between results are only included once. If the merged result
+    has more treenodes or connectors than <limit> (defaults to
+    params['limit']), the lists are clipped to this limit, preferring nodes
+    within the bounding box in <params>.
+    """
+    treenodes, connectors = [], []
+    seen_treenodes, seen_connectors = set(), set()
+    labels = defaultdict(list)
+    relation_map = {}
+    limit_reached = False
+
+    for result in results:
+        for tn in result[0]:
+            if tn[0] not in seen_treenodes:
+                seen_treenodes.add(tn[0])
+                treenodes.append(tn)
+        for c in result[1]:
+            if c[0] not in seen_connectors:
+                seen_connectors.add(c[0])
+                connectors.append(c)
+        for node_id, node_labels in six.iteritems(result[2]):
+            merged_labels = labels[node_id]
+            merged_labels.extend(l for l in node_labels if l not in merged_labels)
+        limit_reached = limit_reached or result[3]
+        relation_map.update(result[4])
+
+    if limit is None and params:
+        limit = params.get('limit')
+
+    if limit:
+        if len(treenodes) > limit or len(connectors) > limit:
+            limit_reached = True
+            if params:
+                left, right = params['left'], params['right']
+                top, bottom = params['top'], params['bottom']
+                z1, z2 = params['z1'], params['z2']
+                def is_outside(x, y, z):
+                    return not (left <= x < right and top <= y < bottom \
+                            and z1 <= z < z2)
+                treenodes.sort(key=lambda tn: is_outside(tn[2], tn[3], tn[4]))
+                connectors.sort(key=lambda c: is_outside(c[1], c[2], c[3]))
+            treenodes = treenodes[:limit]
+            connectors = connectors[:limit]
+
+    return [treenodes, connectors, labels, limit_reached, relation_map]
+
+
+def update_grid_cache(project_id, data_type, orientation, cell_width,
+        cell_height, cell_depth, node_limit=None, delete=False, bb_limits=None,
+        log=print_):
+    """Populate the node grid cache of the passed in project and orientation.
+    Cell width, height and depth refer to the respective dimensions of the
+    orientation. For each grid cell that intersects with the tracing data
+    bounding box, the result of a regular node query is stored. Instead of
+    querying each cell individually, the tracing data of each section of the
+    grid is read once and assigned to cells in memory (see NodeGridCells).
+    Cells without any nodes are not stored, they are represented by the
+    populated index range of the grid.
+    """
+    if data_type not in GRID_CACHE_DATA_COLUMNS:
+        raise ValueError('Type must be one of: json, json_text, msgpack')
+    if project_id is None:
+        raise ValueError('Need project ID')
+    if not (cell_width > 0 and cell_height > 0 and cell_depth > 0):
+        raise ValueError('Need positive cell dimensions')
+
+    orientation_id = ORIENTATIONS[orientation]
+    data_column = GRID_CACHE_DATA_COLUMNS[data_type]
+
+    cursor = connection.cursor()
+
+    bb = get_cache_bounding_box(project_id, bb_limits, cursor, log)
+    if not bb:
+        return
+
+    # Cached cells are only returned without clipping them if the node limit
+    # of the request isn't smaller than the one of the grid. If cells are
+    # populated with different node limits, the largest one is stored.
+    cursor.execute("""
+        INSERT INTO node_grid_cache (project_id, orientation, cell_width,
+            cell_height, cell_depth, node_limit)
+        VALUES (%(project_id)s, %(orientation)s, %(cell_width)s,
+            %(cell_height)s, %(cell_depth)s, %(node_limit)s)
+        ON CONFLICT (project_id, orientation, cell_width, cell_height, cell_depth)
+        DO UPDATE SET node_limit = CASE
+            WHEN node_grid_cache.min_x_index IS NULL THEN EXCLUDED.node_limit
+            WHEN node_grid_cache.node_limit IS NULL
+                OR EXCLUDED.node_limit IS NULL THEN NULL
+            ELSE GREATEST(node_grid_cache.node_limit, EXCLUDED.node_limit)
+            END
+        RETURNING id
+    """, {
+        'project_id': project_id,
+        'orientation': orientation_id,
+        'cell_width': float(cell_width),
+        'cell_height': float(cell_height),
+        'cell_depth': float(cell_depth),
+        'node_limit': node_limit,
+    })
+    grid_id = cursor.fetchone()[0]
+
+    if delete:
+        log(' -> Deleting existing grid cache cells in orientation {}'.format(orientation))
+        cursor.execute("""
+            DELETE FROM node_grid_cache_cell
+            WHERE grid_id = %(grid_id)s;
+
+            UPDATE node_grid_cache
+            SET min_x_index = NULL, min_y_index = NULL, min_z_index = NULL,
+                max_x_index = NULL, max_y_index = NULL, max_z_index = NULL,
+                node_limit = %(node_limit)s
+            WHERE id = %(grid_id)s;
+        """, {
+            'grid_id': grid_id,
+            'node_limit': node_limit,
+        })
+
+    # Indices in the width, height and depth dimension of the orientation
+    width_dim, height_dim, depth_dim = ORIENTATION_DIMENSIONS[orientation]
+    min_xi = int(math.floor(bb[0][width_dim] / cell_width))
+    min_yi = int(math.floor(bb[0][height_dim] / cell_height))
+    min_zi = int(math.floor(bb[0][depth_dim] / cell_depth))
+    max_xi = int(math.floor(bb[1][width_dim] / cell_width))
+    max_yi = int(math.floor(bb[1][height_dim] / cell_height))
+    max_zi = int(math.floor(bb[1][depth_dim] / cell_depth))
+
+    log(' -> Populating grid cache for orientation {} with cell size {}x{}x{} '
+            'for type {} (index range [{}, {}, {}] - [{}, {}, {}])'.format(
+            orientation, cell_width, cell_height, cell_depth, data_type,
+            min_xi, min_yi, min_zi, max_xi, max_yi, max_zi))
+
+    if data_type == 'msgpack':
+        data_array_type, data_value = 'bytea[]', 'cell.data'
+    elif data_type == 'json':
+        data_array_type, data_value = 'text[]', 'cell.data::jsonb'
+    else:
+        data_array_type, data_value = 'text[]', 'cell.data'
+
+    for zi in range(min_zi, max_zi + 1):
+        min_depth, max_depth = zi * cell_depth, (zi + 1) * cell_depth
+        cells = NodeGridCells(orientation, cell_width, cell_height,
+                min_depth, max_depth)
+        section_bb = [list(bb[0]), list(bb[1])]
+        section_bb[0][depth_dim] = max(bb[0][depth_dim], min_depth)
+        section_bb[1][depth_dim] = min(bb[1][depth_dim], max_depth)
+        params = {
+            'project_id': project_id,
+            'min_x': section_bb[0][0],
+            'min_y': section_bb[0][1],
+            'min_z': section_bb[0][2],
+            'max_x': section_bb[1][0],
+            'max_y': section_bb[1][1],
+            'max_z': section_bb[1][2],
+        }
+
+        with transaction.atomic():
+            cursor.execute("SELECT clock_timestamp()")
+            update_time = cursor.fetchone()[0]
+            _read_node_cache_data(cells, params, cursor, log=lambda x: None)
+
+            layer = cells.layers[0]
+            x_indices, y_indices, data = [], [], []
+            for xi, yi in cells.get_cells():
+                if not (min_xi <= xi <= max_xi and min_yi <= yi <= max_yi):
+                    continue
+                result = cells.get_result(layer, (xi, yi), node_limit)
+                x_indices.append(xi)
+                y_indices.append(yi)
+                if data_type == 'msgpack':
+                    data.append(psycopg2.Binary(msgpack.packb(result)))
+                else:
+                    data.append(json.dumps(result))
+
+            # Empty cells don't need to be stored
+            cursor.execute("""
+                DELETE FROM node_grid_cache_cell c
+                WHERE c.grid_id = %(grid_id)s
+                AND c.z_index = %(z)s
+                AND c.x_index BETWEEN %(min_x)s AND %(max_x)s
+                AND c.y_index BETWEEN %(min_y)s AND %(max_y)s
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM UNNEST(%(x)s::int[], %(y)s::int[]) cell(x, y)
+                    WHERE cell.x = c.x_index
+                    AND cell.y = c.y_index
+                )
+            """, {
+                'grid_id': grid_id,
+                'z': zi,
+                'min_x': min_xi,
+                'max_x': max_xi,
+                'min_y': min_yi,
+                'max_y': max_yi,
+                'x': x_indices,
+                'y': y_indices,
+            })
+
+            if x_indices:
+                cursor.execute("""
+                    INSERT INTO node_grid_cache_cell (grid_id, x_index,
+                        y_index, z_index, update_time, {column})
+                    SELECT %(grid_id)s, cell.x, cell.y, %(z)s,
+                        %(update_time)s, {value}
+                    FROM UNNEST(%(x)s::int[], %(y)s::int[],
+                        %(data)s::{array_type}) cell(x, y, data)
+                    ON CONFLICT (grid_id, z_index, x_index, y_index)
+                    DO UPDATE SET {column} = EXCLUDED.{column},
+                        update_time = EXCLUDED.update_time;
+                """.format(column=data_column, value=data_value,
+                        array_type=data_array_type), {
+                    'grid_id': grid_id,
+                    'z': zi,
+                    'update_time': update_time,
+                    'x': x_indices,
+                    'y': y_indices,
+                    'data': data,
+                })
+
+        log(' -> Populated grid cache section {} of {}'.format(
+                zi - min_zi + 1, max_zi - min_zi + 1))
+
+    # Extend the populated index range of the grid
+    cursor.execute("""
+        UPDATE node_grid_cache
+        SET min_x_index = LEAST(min_x_index, %(min_x)s),
+            min_y_index = LEAST(min_y_index, %(min_y)s),
+            min_z_index = LEAST(min_z_index, %(min_z)s),
+            max_x_index = GREATEST(max_x_index, %(max_x)s),
+            max_y_index = GREATEST(max_y_index, %(max_y)s),
+            max_z_index = GREATEST(max_z_index, %(max_z)s)
+        WHERE id = %(grid_id)s
+    """, {
+        'grid_id': grid_id,
+        'min_x': min_xi,
+        'min_y': min_yi,
+        'min_z': min_zi,
+        'max_x': max_xi,
+        'max_y': max_yi,
+        'max_z': max_zi,
+    })
 
 
 def prepare_db_statements(connection):
@@ -1130,10 +2546,26 @@ def node_list_tuples(request, project_id=None, provider=None):
       paramType: form
     - name: format
       description: |
-        Either "json" (default) or "msgpack", optional.
+        Either "json" (default), "msgpack", "png" or "gif", optional. The image
+        formats render nodes as an overview image of the size defined by
+        view_width and view_height.
       required: false
       type: string
       paramType: form
+    - name: with_edges
+      description: |
+        Whether edges should be rendered in image formats.
+      required: false
+      type: boolean
+      defaultValue: false
+      paramType: form
+    - name: with_connectors
+      description: |
+        Whether connectors should be rendered in image formats.
+      required: false
+      type: boolean
+      defaultValue: false
+      paramType: form
     - name: with_relation_map
       description: |
         Whether an ID to name mapping for the used relations should be included
@@ -1171,6 +2603,8 @@ def node_list_tuples(request, project_id=None, provider=None):
     target_options = {
         'view_width': int(data.get('view_width', 1000)),
         'view_height': int(data.get('view_height', 1000)),
+        'with_edges': data.get('with_edges', 'false') == 'true',
+        'with_connectors': data.get('with_connectors', 'false') == 'true',
     }
     override_provider = data.get('src')
     with_relation_map = data.get('with_relation_map', 'used')
@@ -1198,6 +2632,8 @@ def node_list_tuples(request, project_id=None, provider=None):
             else:
                 orientation = 'xz'
     params['orientation'] = orientation
+    # Cached node providers can return results directly in the target format
+    params['format'] = target_format
 
     if override_provider:
         node_providers = get_configured_node_providers([override_provider])
@@ -1221,10 +2657,7 @@ def _node_list_tuples_query(params, project_id, node_provider,
         cursor = connection.cursor()
 
         if with_relation_map or include_labels:
-            cursor.execute('''
-            SELECT relation_name, id FROM relation WHERE project_id=%s
-            ''' % project_id)
-            relation_map = dict(cursor.fetchall())
+            relation_map = get_relation_to_id_map(project_id, cursor=cursor)
             id_to_relation = {v: k for k, v in relation_map.items()}
 
         # A set of extra treenode and connector IDs
@@ -1323,6 +2756,12 @@ def _node_list_tuples_query(params, project_id, node_provider,
                     labels[row[0]].append(row[1])
 
         if with_relation_map == 'used':
+            if any(r not in id_to_relation for r in used_relations):
+                # Relations might have been added by another process since the
+                # cached relation map was loaded.
+                relation_map_cache.invalidate(int(project_id))
+                relation_map = get_relation_to_id_map(project_id, cursor=cursor)
+                id_to_relation = {v: k for k, v in relation_map.items()}
             export_relation_map = {r:id_to_relation[r] for r in used_relations}
         elif with_relation_map == 'all':
             export_relation_map = id_to_relation
@@ -1410,7 +2849,9 @@ def create_node_response(result, params, target_format, target_options, data_typ
         xscale = width / (params['right'] - params['left'])
         yscale = height / (params['bottom'] - params['top'])
         image = render_nodes_xy(data, params, width, height, view_min_x,
-                view_min_y, xscale, yscale)
+                view_min_y, xscale, yscale,
+                with_edges=target_options.get('with_edges', False),
+                with_connectors=target_options.get('with_connectors', False))
         # serialize to HTTP response
         if target_format == 'png':
             response = HttpResponse(content_type="image/png")
@@ -1422,88 +2863,150 @@ def create_node_response(result, params, target_format, target_options, data_typ
     else:
         raise ValueError("Unknown target format: {}".format(target_format))
 
+def _get_clip_range(start, end, bb_min, bb_max):
+    """Return the parametric range [t0, t1] of each line segment from <start>
+    to <end> (both N x D arrays) that is inside the bounding box defined by
+    the D-dimensional <bb_min> and <bb_max>. Segments outside of the bounding
+    box have t0 > t1.
+    """
+    delta = end - start
+    t0 = np.zeros(len(start))
+    t1 = np.ones(len(start))
+    for dim in range(start.shape[1]):
+        d = delta[:, dim]
+        flat = np.abs(d) < 0.0001
+        # Flat segments are either completely in or out of this dimension's
+        # range.
+        outside = flat & ((start[:, dim] < bb_min[dim]) | (start[:, dim] > bb_max[dim]))
+        t1[outside] = -1.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ta = (bb_min[dim] - start[:, dim]) / d
+            tb = (bb_max[dim] - start[:, dim]) / d
+        sloped = ~flat
+        t0[sloped] = np.maximum(t0[sloped], np.minimum(ta, tb)[sloped])
+        t1[sloped] = np.minimum(t1[sloped], np.maximum(ta, tb)[sloped])
+    return t0, t1
+
+
+def _draw_points(pixels, xs, ys, color, radius=0):
+    """Set all pixels within <radius> of the passed in pixel coordinates to the
+    passed in color.
+    """
+    height, width = pixels.shape[:2]
+    r = int(math.ceil(radius))
+    ox, oy = np.mgrid[-r:r + 1, -r:r + 1]
+    in_disc = ox * ox + oy * oy <= radius * radius
+    ox, oy = ox[in_disc], oy[in_disc]
+    px = (np.round(xs).astype(np.int64)[:, np.newaxis] + ox).ravel()
+    py = (np.round(ys).astype(np.int64)[:, np.newaxis] + oy).ravel()
+    visible = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+    pixels[py[visible], px[visible]] = color
+
+
+def _draw_lines(pixels, start, end, color):
+    """Draw all lines from <start> to <end> (N x 2 arrays of pixel coordinates)
+    by sampling each line once per pixel.
+    """
+    if not len(start):
+        return
+    delta = end - start
+    n_samples = np.ceil(np.abs(delta).max(axis=1)).astype(np.int64) + 1
+    line_index = np.repeat(np.arange(len(start)), n_samples)
+    offsets = np.cumsum(n_samples) - n_samples
+    sample_index = np.arange(n_samples.sum()) - np.repeat(offsets, n_samples)
+    frac = sample_index / np.maximum(n_samples - 1, 1)[line_index].astype(np.float64)
+    points = start[line_index] + frac[:, np.newaxis] * delta[line_index]
+    _draw_points(pixels, points[:, 0], points[:, 1], color)
+
+
 def render_nodes_xy(node_data, params, width, height, view_min_x=0, view_min_y=0,
-        xscale=1.0, yscale=1.0):
-    """Render the passed in node data to an image.
+        xscale=1.0, yscale=1.0, radius=2.0, virtual_nodes=True,
+        with_edges=False, with_connectors=False):
+    """Render the passed in node data to an image. All nodes are handled as
+    NumPy arrays: their visibility, virtual nodes at the intersection of edges
+    with the section and their pixel locations are computed at once and are
+    written directly into the image buffer. Optionally, edges within the
+    bounding box and connectors in the section are rendered, too.
     """
-    import random
-    background = (255, 0, 0, 0)
-    image = Image.new('RGBA', (width, height), background)
-
-    radius = 4
-    hr = radius / 2.0
-    node_pen = Pen((255, 0, 255), 1)
-    root_pen = Pen('red', 1)
-    #leaf_pen = Pen('red', 1)
-    node_brush = Brush((255, 0, 255))
-    root_brush = Brush('red')
-    #leaf_brush = Brush('red')
-
-    virtual_nodes = True
-
-    left, right = params['left'], params['right']
-    top, bottom = params['top'], params['bottom']
-    z1, z2 = params['z1'], params['z2']
-
-    # Map parents to children
-    nodes = dict()
-    treenodes = node_data[0]
-    for tn in treenodes:
-        nodes[tn[0]] = tn
-
-    draw = Draw(image)
-    # Add treenodes:
-    for tn in treenodes:
-        parent_id = tn[1]
-        x, y, z = tn[2], tn[3], tn[4]
-        xs, ys = None, None
-        virtual_node_created = False
-
-        is_outside = x < left or x >= right or y < top \
-                or y >= bottom or z < z1 or z >= z2
-
-        # If this node and its parent are outside, create a virtual node
-        # location and replace current coordinates.
-        if is_outside:
-            if virtual_nodes and parent_id:
-                parent_node = nodes.get(parent_id)
-                if parent_node:
-                    px, py, pz = parent_node[2], parent_node[3], parent_node[4]
-                    p_is_outside = px < left or px >= right or py < top \
-                            or py >= bottom or pz < z1 or pz >= z2
-
-                    # If the parent ist outside, too, find virtual node
-                    # location.
-                    if p_is_outside:
-                        dx, dy, dz = px - x, py - y, pz - z
-                        if dz > -0.0001 and dz < 0.0001:
-                            continue
-                        t = (z1 - z) / dz
-
-                        x = x + t * dx
-                        y = y + t * dy
-                        z = z1
-                        virtual_node_created = True
-
-            if not virtual_node_created:
-                continue
+    node_color = (255, 0, 255, 255)
+    root_color = (255, 0, 0, 255)
+    edge_color = (255, 0, 255, 255)
+    connector_color = (0, 128, 255, 255)
 
-        xs = xscale * (x - view_min_x)
-        ys = yscale * (y - view_min_y)
+    # A transparent red background
+    pixels = np.zeros((height, width, 4), dtype=np.uint8)
+    pixels[:, :, 0] = 255
 
-        if parent_id:
-            pen = node_pen
-            brush = node_brush
+    bb_min = np.array([params['left'], params['top'], params['z1']])
+    bb_max = np.array([params['right'], params['bottom'], params['z2']])
+    view_min = np.array([view_min_x, view_min_y])
+    scale = np.array([xscale, yscale])
+
+    def in_section(locations):
+        return np.all((locations >= bb_min) & (locations < bb_max), axis=1)
+
+    treenodes = node_data[0]
+    if treenodes:
+        columns = list(zip(*treenodes))
+        node_ids = np.array(columns[0], dtype=np.int64)
+        # Root nodes have no parent, which is represented as NaN
+        parent_ids = np.array(columns[1], dtype=np.float64)
+        locations = np.array(columns[2:5], dtype=np.float64).T
+
+        # Find the index of each parent node in the result, if available
+        is_root = np.isnan(parent_ids)
+        order = np.argsort(node_ids)
+        sorted_ids = node_ids[order]
+        parent_pos = np.searchsorted(sorted_ids, np.where(is_root, -1, parent_ids))
+        parent_pos = np.minimum(parent_pos, len(sorted_ids) - 1)
+        has_parent = ~is_root & (sorted_ids[parent_pos] == parent_ids)
+        parent_index = order[parent_pos]
+
+        inside = in_section(locations)
+
+        if with_edges and has_parent.any():
+            start = locations[has_parent]
+            end = locations[parent_index[has_parent]]
+            t0, t1 = _get_clip_range(start, end, bb_min, bb_max)
+            visible = t0 <= t1
+            delta = end[visible] - start[visible]
+            clipped_start = start[visible] + t0[visible, np.newaxis] * delta
+            clipped_end = start[visible] + t1[visible, np.newaxis] * delta
+            _draw_lines(pixels, (clipped_start[:, :2] - view_min) * scale,
+                    (clipped_end[:, :2] - view_min) * scale, edge_color)
+
+        # If a node and its parent are outside, a virtual node is placed where
+        # the edge between them intersects with the section.
+        if virtual_nodes:
+            candidates = ~inside & has_parent
+            candidates[candidates] &= ~inside[parent_index[candidates]]
+            start = locations[candidates]
+            delta = locations[parent_index[candidates]] - start
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (bb_min[2] - start[:, 2]) / delta[:, 2]
+            crossing = (np.abs(delta[:, 2]) >= 0.0001) & (t >= 0) & (t <= 1)
+            virtual = start[crossing] + t[crossing, np.newaxis] * delta[crossing]
+            virtual = virtual[np.all((virtual[:, :2] >= bb_min[:2]) &
+                    (virtual[:, :2] < bb_max[:2]), axis=1)]
         else:
-            pen = root_pen
-            brush = root_brush
+            virtual = np.empty((0, 3))
 
-        # Render node or virtual node
-        draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), pen, brush)
+        # Regular nodes and virtual nodes are drawn first, root nodes on top
+        nodes = np.concatenate((locations[inside & ~is_root], virtual))
+        screen = (nodes[:, :2] - view_min) * scale
+        _draw_points(pixels, screen[:, 0], screen[:, 1], node_color, radius)
+        roots = locations[inside & is_root]
+        screen = (roots[:, :2] - view_min) * scale
+        _draw_points(pixels, screen[:, 0], screen[:, 1], root_color, radius)
 
-    draw.flush()
+    connectors = node_data[1]
+    if with_connectors and connectors:
+        locations = np.array([c[1:4] for c in connectors], dtype=np.float64)
+        locations = locations[in_section(locations)]
+        screen = (locations[:, :2] - view_min) * scale
+        _draw_points(pixels, screen[:, 0], screen[:, 1], connector_color, radius)
 
-    return image
+    return Image.fromarray(pixels, 'RGBA')
 
 
 @requires_user_role(UserRole.Annotate)
@@ -1625,6 +3128,101 @@ def node_update(request, project_id=None):
     })
 
 
+def find_nearest_nodes(project_id, points, skeleton_ids=None, cursor=None):
+    """Find the treenode nearest to each of the passed in (x, y, z) points,
+    optionally only respecting nodes of the passed in skeletons. All points
+    are looked up with a single query. Returns a list with a (treenode_id, x,
+    y, z, skeleton_id) tuple for each point, in the same order, or None if no
+    node could be found for a point.
+
+    If skeletons are passed in, their nodes are read using the skeleton index
+    of the treenode table and the nearest one is selected directly. Otherwise,
+    the spatial index of the treenode_edge table is used in two steps: first,
+    the index is walked in order of the distance to edge bounding boxes (<<->>)
+    to find a candidate node. No node farther away than this candidate can be
+    the nearest one. The nearest node is then selected among the nodes within
+    this distance, using the index as well.
+    """
+    if not points:
+        return []
+
+    cursor = cursor or connection.cursor()
+
+    query_points = """
+        WITH query_point AS (
+            SELECT i, x, y, z, ST_MakePoint(x, y, z) AS geom
+            FROM UNNEST(%(xs)s::float8[], %(ys)s::float8[], %(zs)s::float8[])
+                WITH ORDINALITY p(x, y, z, i)
+        )
+    """
+
+    if skeleton_ids:
+        # Walking the spatial index while filtering by skeleton would have to
+        # look at all nodes of other skeletons closer to a point.
+        cursor.execute(query_points + """
+            SELECT qp.i, n.id, n.location_x, n.location_y, n.location_z,
+                n.skeleton_id
+            FROM query_point qp
+            CROSS JOIN LATERAL (
+                SELECT t.id, t.location_x, t.location_y, t.location_z,
+                    t.skeleton_id
+                FROM treenode t
+                WHERE t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+                AND t.project_id = %(project_id)s
+                ORDER BY (t.location_x - qp.x) ^ 2 + (t.location_y - qp.y) ^ 2
+                    + (t.location_z - qp.z) ^ 2, t.id
+                LIMIT 1
+            ) n
+        """, {
+            'project_id': project_id,
+            'xs': [p[0] for p in points],
+            'ys': [p[1] for p in points],
+            'zs': [p[2] for p in points],
+            'skeleton_ids': skeleton_ids,
+        })
+    else:
+        cursor.execute(query_points + """
+            , candidate AS (
+                SELECT qp.i, qp.x, qp.y, qp.z, qp.geom, c.distance
+                FROM query_point qp
+                CROSS JOIN LATERAL (
+                    SELECT ST_3DDistance(ST_StartPoint(te.edge), qp.geom) AS distance
+                    FROM treenode_edge te
+                    WHERE te.project_id = %(project_id)s
+                    ORDER BY te.edge <<->> qp.geom
+                    LIMIT 1
+                ) c
+            )
+            SELECT c.i, n.id, n.location_x, n.location_y, n.location_z,
+                n.skeleton_id
+            FROM candidate c
+            CROSS JOIN LATERAL (
+                SELECT t.id, t.location_x, t.location_y, t.location_z,
+                    t.skeleton_id
+                FROM treenode_edge te
+                JOIN treenode t
+                    ON t.id = te.id
+                WHERE te.project_id = %(project_id)s
+                AND te.edge &&& ST_MakeLine(ARRAY[
+                    ST_MakePoint(c.x - c.distance, c.y - c.distance, c.z - c.distance),
+                    ST_MakePoint(c.x + c.distance, c.y + c.distance, c.z + c.distance)]::geometry[])
+                AND ST_3DDWithin(ST_StartPoint(te.edge), c.geom, c.distance)
+                ORDER BY ST_3DDistance(ST_StartPoint(te.edge), c.geom), t.id
+                LIMIT 1
+            ) n
+        """, {
+            'project_id': project_id,
+            'xs': [p[0] for p in points],
+            'ys': [p[1] for p in points],
+            'zs': [p[2] for p in points],
+        })
+
+    nearest_nodes = [None] * len(points)
+    for row in cursor.fetchall():
+        nearest_nodes[row[0] - 1] = row[1:]
+    return nearest_nodes
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def node_nearest(request, project_id=None):
     params = {}
@@ -1664,42 +3262,73 @@ def node_nearest(request, project_id=None):
             for neur_skel_relation in neuron_skeletons:
                 skeletons.append(neur_skel_relation.class_instance_a_id)
 
-        # Get all treenodes connected to skeletons
         response_on_error = 'Finding the treenodes failed.'
-        treenodes = Treenode.objects.filter(project=project_id, skeleton__in=skeletons)
-
-        def getNearestTreenode(x, y, z, treenodes):
-            minDistance = -1
-            nearestTreenode = None
-            for tn in treenodes:
-                xdiff = x - tn.location_x
-                ydiff = y - tn.location_y
-                zdiff = z - tn.location_z
-                distanceSquared = xdiff ** 2 + ydiff ** 2 + zdiff ** 2
-                if distanceSquared < minDistance or minDistance < 0:
-                    nearestTreenode = tn
-                    minDistance = distanceSquared
-            return nearestTreenode
-
-        nearestTreenode = getNearestTreenode(
-            params['x'],
-            params['y'],
-            params['z'],
-            treenodes)
-        if nearestTreenode is None:
+        nearest_node = None
+        if skeletons:
+            nearest_node = find_nearest_nodes(int(project_id),
+                    [(params['x'], params['y'], params['z'])], skeletons)[0]
+        if nearest_node is None:
             raise Exception('No treenodes were found for skeletons in %s' % skeletons)
 
         return JsonResponse({
-            'treenode_id': nearestTreenode.id,
-            'x': int(nearestTreenode.location_x),
-            'y': int(nearestTreenode.location_y),
-            'z': int(nearestTreenode.location_z),
-            'skeleton_id': nearestTreenode.skeleton_id})
+            'treenode_id': nearest_node[0],
+            'x': int(nearest_node[1]),
+            'y': int(nearest_node[2]),
+            'z': int(nearest_node[3]),
+            'skeleton_id': nearest_node[4]})
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
 
+@api_view(['POST'])
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def nodes_nearest(request, project_id=None):
+    """Find the treenode nearest to each of the passed in points.
+
+    All points are looked up at once, optionally only nodes of particular
+    skeletons are respected.
+    ---
+    parameters:
+      - name: points
+        description: A list of [x, y, z] project space points
+        type: array
+        items:
+          type: array
+          items:
+            type: number
+        required: true
+        paramType: form
+      - name: skeleton_ids
+        description: Only find nodes of these skeletons
+        type: array
+        items:
+          type: integer
+        required: false
+        paramType: form
+    type:
+      - type: array
+        items:
+          type: array
+        description: |
+          For each point a list of the form [treenode_id, x, y, z,
+          skeleton_id], or null if no node was found.
+        required: true
+    """
+    points = get_request_list(request.POST, 'points')
+    if not points:
+        raise ValueError('Need at least one point')
+    points = [tuple(float(c) for c in p) for p in points]
+    for p in points:
+        if len(p) != 3:
+            raise ValueError('Points need to have three coordinates')
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', map_fn=int)
+
+    nearest_nodes = find_nearest_nodes(int(project_id), points, skeleton_ids)
+
+    return JsonResponse(nearest_nodes, safe=False)
+
+
 def _fetch_location(project_id, location_id):
     """Get the locations of the passed in node ID in the passed in project."""
     locations = _fetch_locations(project_id, [location_id])
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import math
+
+from django.db import connection
+from django.http import HttpResponse, Http404
+
+from catmaid.models import UserRole, ProjectStack, NodeOverviewPyramid
+from catmaid.control.authentication import requires_user_role
+from catmaid.control.node import (_node_list_tuples_query, render_nodes_xy,
+        get_tracing_bounding_box, get_tracing_change_query,
+        Postgis3dNodeProvider, CHANGE_DETECTION_OVERLAP)
+
+from PIL import Image
+
+from six import print_
+
+
+class StackTileGeometry(object):
+    """Map tiles of a node overview pyramid to project space bounding boxes
+    and back. Tiles are aligned with the image tiles of a stack: a tile of zoom
+    level z covers (tile_size * 2^z) stack pixels in X and Y and one section in
+    Z. Only XY stacks are supported.
+    """
+
+    def __init__(self, translation, resolution, dimension, tile_size):
+        self.translation = translation
+        self.resolution = resolution
+        self.dimension = dimension
+        self.tile_size = tile_size
+
+    @staticmethod
+    def from_project_stack(project_stack, tile_size):
+        if project_stack.orientation != 0:
+            raise ValueError("Node overview tiles are only available for XY stacks")
+        t, stack = project_stack.translation, project_stack.stack
+        r, d = stack.resolution, stack.dimension
+        return StackTileGeometry((t.x, t.y, t.z), (r.x, r.y, r.z),
+                (d.x, d.y, d.z), tile_size)
+
+    def get_tile_extent(self, zoom_level):
+        """Return the project space width and height of a tile."""
+        scale = self.tile_size * 2 ** zoom_level
+        return scale * self.resolution[0], scale * self.resolution[1]
+
+    def get_grid_size(self, zoom_level):
+        """Return the number of columns, rows and sections of a zoom level."""
+        scale = float(self.tile_size * 2 ** zoom_level)
+        return (int(math.ceil(self.dimension[0] / scale)),
+                int(math.ceil(self.dimension[1] / scale)),
+                self.dimension[2])
+
+    def get_tile_params(self, zoom_level, section, row, col):
+        """Return the node query parameters for the passed in tile."""
+        width, height = self.get_tile_extent(zoom_level)
+        left = self.translation[0] + col * width
+        top = self.translation[1] + row * height
+        z1 = self.translation[2] + section * self.resolution[2]
+        return {
+            'left': left,
+            'right': left + width,
+            'top': top,
+            'bottom': top + height,
+            'z1': z1,
+            'z2': z1 + self.resolution[2],
+        }
+
+    def get_tile_range(self, zoom_level, bb_min, bb_max):
+        """Return the inclusive ranges of columns, rows and sections of all
+        tiles that intersect with the passed in project space bounding box as
+        ((min_col, max_col), (min_row, max_row), (min_section, max_section)).
+        None is returned, if the bounding box is outside of the stack.
+        """
+        width, height = self.get_tile_extent(zoom_level)
+        extents = (width, height, self.resolution[2])
+        ranges = []
+        for dim, n in enumerate(self.get_grid_size(zoom_level)):
+            first = int(math.floor((bb_min[dim] - self.translation[dim]) / extents[dim]))
+            last = int(math.floor((bb_max[dim] - self.translation[dim]) / extents[dim]))
+            first, last = max(0, first), min(n - 1, last)
+            if first > last:
+                return None
+            ranges.append((first, last))
+        return tuple(ranges)
+
+
+def render_overview_tile(project_id, geometry, zoom_level, section, row, col,
+        with_edges=True):
+    """Render all nodes of a single tile and return it as PNG encoded image. If
+    the tile doesn't show any nodes, None is returned.
+    """
+    params = geometry.get_tile_params(zoom_level, section, row, col)
+    params['project_id'] = project_id
+    params['limit'] = None
+    node_data = _node_list_tuples_query(params, project_id,
+            Postgis3dNodeProvider(), with_relation_map=None)
+    if not (node_data[0] or node_data[1]):
+        return None
+
+    tile_size = geometry.tile_size
+    scale = tile_size / (params['right'] - params['left'])
+    image = render_nodes_xy(node_data, params, tile_size, tile_size,
+            params['left'], params['top'], scale, scale,
+            with_edges=with_edges, with_connectors=True)
+    if not image.split()[3].getbbox():
+        return None
+
+    data = io.BytesIO()
+    image.save(data, 'PNG')
+    return data.getvalue()
+
+
+def get_outdated_overview_tiles(project_id, geometry, zoom_levels, since,
+        cursor=None):
+    """Return a set of (zoom level, section, row, col) tuples of all tiles that
+    intersect with tracing data that changed after <since>.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute(get_tracing_change_query('xyz'), {
+        'project_id': project_id,
+        'since': since,
+    })
+    tiles = set()
+    for row in cursor.fetchall():
+        for zoom_level in zoom_levels:
+            tile_range = geometry.get_tile_range(zoom_level, row[0:3], row[3:6])
+            if tile_range:
+                tiles.update(iter_tiles(zoom_level, tile_range))
+    return tiles
+
+
+def iter_tiles(zoom_level, tile_range):
+    """Yield (zoom level, section, row, col) tuples for all tiles in the
+    passed in tile range (see StackTileGeometry.get_tile_range()).
+    """
+    (min_col, max_col), (min_row, max_row), (min_section, max_section) = tile_range
+    for section in range(min_section, max_section + 1):
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                yield (zoom_level, section, row, col)
+
+
+def update_node_overview(project_id, stack_id, zoom_levels, tile_size=512,
+        incremental=False, delete=False, with_edges=True, log=print_):
+    """Render the node overview tiles of the passed in zoom levels for a stack
+    and store them in the node_overview_tile table. If <incremental> is true,
+    only tiles of already rendered zoom levels that intersect with tracing data
+    changed since the last update are rendered again, including changes made
+    up to CHANGE_DETECTION_OVERLAP before it, which might have been committed
+    only after it. Tiles without nodes are removed.
+    """
+    project_stack = ProjectStack.objects.select_related('stack').get(
+            project_id=project_id, stack_id=stack_id)
+    geometry = StackTileGeometry.from_project_stack(project_stack, tile_size)
+
+    cursor = connection.cursor()
+    # Remember the time before any data is read, so that concurrent changes
+    # are found by the next incremental update.
+    cursor.execute("SELECT clock_timestamp()")
+    update_time = cursor.fetchone()[0]
+
+    pyramid, _ = NodeOverviewPyramid.objects.get_or_create(project_id=project_id,
+            stack_id=stack_id, tile_size=tile_size)
+
+    if delete:
+        log(' -> Deleting existing tiles')
+        cursor.execute("""
+            DELETE FROM node_overview_tile WHERE pyramid_id = %(pyramid_id)s
+        """, {
+            'pyramid_id': pyramid.id
+        })
+        pyramid.zoom_levels = []
+        pyramid.update_time = None
+
+    tiles = set()
+    existing_zoom_levels = set(pyramid.zoom_levels)
+    new_zoom_levels = [z for z in zoom_levels if z not in existing_zoom_levels]
+    if incremental and pyramid.update_time:
+        outdated_zoom_levels = [z for z in zoom_levels if z in existing_zoom_levels]
+        tiles.update(get_outdated_overview_tiles(project_id, geometry,
+                outdated_zoom_levels,
+                pyramid.update_time - CHANGE_DETECTION_OVERLAP, cursor))
+        log(' -> Found {} outdated tiles'.format(len(tiles)))
+    else:
+        new_zoom_levels = zoom_levels
+        # All tiles of these zoom levels are rendered again
+        cursor.execute("""
+            DELETE FROM node_overview_tile
+            WHERE pyramid_id = %(pyramid_id)s
+            AND zoom_level = ANY(%(zoom_levels)s::int[])
+        """, {
+            'pyramid_id': pyramid.id,
+            'zoom_levels': list(zoom_levels),
+        })
+
+    if new_zoom_levels:
+        bb_min, bb_max = get_tracing_bounding_box(project_id, cursor)
+        if bb_min and None not in bb_min:
+            for zoom_level in new_zoom_levels:
+                tile_range = geometry.get_tile_range(zoom_level, bb_min, bb_max)
+                if tile_range:
+                    tiles.update(iter_tiles(zoom_level, tile_range))
+
+    log(' -> Rendering {} tiles'.format(len(tiles)))
+    n_stored = 0
+    for zoom_level, section, row, col in sorted(tiles):
+        image = render_overview_tile(project_id, geometry, zoom_level,
+                section, row, col, with_edges)
+        tile = {
+            'pyramid_id': pyramid.id,
+            'zoom_level': zoom_level,
+            'section': section,
+            'row': row,
+            'col': col,
+            'update_time': update_time,
+            'image': image,
+        }
+        if image:
+            cursor.execute("""
+                INSERT INTO node_overview_tile (pyramid_id, zoom_level,
+                    section, row, col, update_time, image)
+                VALUES (%(pyramid_id)s, %(zoom_level)s, %(section)s, %(row)s,
+                    %(col)s, %(update_time)s, %(image)s)
+                ON CONFLICT (pyramid_id, zoom_level, section, row, col)
+                DO UPDATE SET image = EXCLUDED.image,
+                    update_time = EXCLUDED.update_time
+            """, tile)
+            n_stored += 1
+        else:
+            cursor.execute("""
+                DELETE FROM node_overview_tile
+                WHERE pyramid_id = %(pyramid_id)s
+                AND zoom_level = %(zoom_level)s
+                AND section = %(section)s
+                AND row = %(row)s
+                AND col = %(col)s
+            """, tile)
+
+    pyramid.zoom_levels = sorted(existing_zoom_levels.union(zoom_levels))
+    pyramid.update_time = update_time
+    pyramid.save()
+
+    log(' -> Stored {} non-empty tiles'.format(n_stored))
+
+
+def get_empty_tile(tile_size):
+    """Return a transparent PNG encoded tile."""
+    data = io.BytesIO()
+    Image.new('RGBA', (tile_size, tile_size), (255, 0, 0, 0)).save(data, 'PNG')
+    return data.getvalue()
+
+
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def node_overview_tile(request, project_id=None, stack_id=None, zoom_level=None,
+        section=None, row=None, col=None):
+    """Get a pre-rendered node overview image tile
+
+    Tiles are aligned with the image tiles of the stack and are rendered with
+    the management command catmaid_update_node_overview. Tiles without nodes
+    are returned as transparent image. If the requested zoom level hasn't been
+    rendered for the stack, a 404 error is returned.
+    ---
+    parameters:
+    - name: tile_size
+      description: |
+        The width and height of a tile in pixels.
+      required: false
+      type: integer
+      defaultValue: 512
+      paramType: query
+    """
+    tile_size = int(request.GET.get('tile_size', 512))
+    zoom_level, section, row, col = int(zoom_level), int(section), int(row), int(col)
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT p.zoom_levels, t.image
+        FROM node_overview_pyramid p
+        LEFT JOIN node_overview_tile t
+            ON t.pyramid_id = p.id
+            AND t.zoom_level = %(zoom_level)s
+            AND t.section = %(section)s
+            AND t.row = %(row)s
+            AND t.col = %(col)s
+        WHERE p.project_id = %(project_id)s
+        AND p.stack_id = %(stack_id)s
+        AND p.tile_size = %(tile_size)s
+    """, {
+        'project_id': int(project_id),
+        'stack_id': int(stack_id),
+        'tile_size': tile_size,
+        'zoom_level': zoom_level,
+        'section': section,
+        'row': row,
+        'col': col,
+    })
+    result = cursor.fetchone()
+    if not result or zoom_level not in result[0]:
+        raise Http404("No node overview available for zoom level {}".format(zoom_level))
+
+    image = result[1]
+    data = bytes(image) if image else get_empty_tile(tile_size)
+    return HttpResponse(data, content_type='image/png')
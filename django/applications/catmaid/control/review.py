@@ -70,11 +70,13 @@ def get_review_count(skeleton_ids):
     # Count nodes that have been reviewed by each user in each partner skeleton
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
-    WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
-    ''' % ",".join(map(str, skeleton_ids)))
+    SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+    FROM catmaid_skeleton_review_summary
+    WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+    AND reviewer_id IS NOT NULL
+    ''', {
+        'skeleton_ids': list(skeleton_ids)
+    })
     # Build dictionary
     reviews = defaultdict(lambda: defaultdict(int))
     for row in cursor.fetchall():
@@ -91,6 +93,11 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
     evaluates to false a union review is returned. Otherwise a list of
     user IDs is expected to create a review status for a sub-union or a
     single user.
+
+    Review counts are read from the review summary table. Only skeletons for
+    which the requested reviews can't be expressed in terms of single
+    reviewers or the union of all reviewers are counted using the review
+    table.
     """
     if user_ids and excluding_user_ids:
         raise ValueError("user_ids and excluding_user_ids can't be used at the same time")
@@ -121,9 +128,77 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
     for row in cursor.fetchall():
         skeletons[row[0]] = [row[1], 0]
 
+    # The function is_counted(reviewer_id, first_review_time,
+    # last_review_time) tells whether all (True), none (False) or only some
+    # (None) of the reviews of a reviewer on a skeleton should be counted.
+    if whitelist_id:
+        accept_after = dict(ReviewerWhitelist.objects.filter(
+                project_id=project_id, user_id=whitelist_id).values_list(
+                'reviewer_id', 'accept_after'))
+        def is_counted(reviewer_id, first_review_time, last_review_time):
+            reviewer_accept_after = accept_after.get(reviewer_id)
+            if reviewer_accept_after is None or \
+                    reviewer_accept_after > last_review_time:
+                return False
+            if reviewer_accept_after <= first_review_time:
+                return True
+            return None
+    elif user_ids:
+        allowed_user_ids = set(user_ids)
+        is_counted = lambda reviewer_id, *args: reviewer_id in allowed_user_ids
+    elif excluding_user_ids:
+        excluded_user_ids = set(excluding_user_ids)
+        is_counted = lambda reviewer_id, *args: reviewer_id not in excluded_user_ids
+    else:
+        is_counted = None
+
+    # Union rows have no reviewer ID. They are all that is needed if no
+    # filter is used.
+    cursor.execute('''
+        SELECT skeleton_id, reviewer_id, num_reviewed_nodes,
+            first_review_time, last_review_time
+        FROM catmaid_skeleton_review_summary
+        WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        {}
+    '''.format('AND reviewer_id IS NULL' if is_counted is None else ''), {
+        'skeleton_ids': list(skeleton_ids)
+    })
+
+    union_counts = {}
+    reviewer_summaries = defaultdict(list)
+    for skeleton_id, reviewer_id, count, first_time, last_time in cursor.fetchall():
+        if reviewer_id is None:
+            union_counts[skeleton_id] = count
+        else:
+            reviewer_summaries[skeleton_id].append(
+                    (count, is_counted(reviewer_id, first_time, last_time)))
+
+    if is_counted is None:
+        for skeleton_id, count in six.iteritems(union_counts):
+            skeletons[skeleton_id][1] = count
+        return skeletons
+
+    # Nodes reviewed by multiple reviewers can only be counted once. Unless
+    # all or only one reviewer of a skeleton are relevant, reviews have to be
+    # counted individually.
+    unresolved_skeleton_ids = []
+    for skeleton_id, summaries in six.iteritems(reviewer_summaries):
+        counts = [count for count, counted in summaries if counted]
+        if any(counted is None for _, counted in summaries):
+            unresolved_skeleton_ids.append(skeleton_id)
+        elif len(counts) == len(summaries):
+            skeletons[skeleton_id][1] = union_counts.get(skeleton_id, 0)
+        elif len(counts) == 1:
+            skeletons[skeleton_id][1] = counts[0]
+        elif counts:
+            unresolved_skeleton_ids.append(skeleton_id)
+
+    if not unresolved_skeleton_ids:
+        return skeletons
+
     query_params = {
         'project_id': project_id,
-        'skeleton_ids': skeleton_ids
+        'skeleton_ids': unresolved_skeleton_ids
     }
 
     query_joins = []
@@ -162,8 +237,8 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
               SELECT * FROM UNNEST(%(skeleton_ids)s::bigint[])
           ) query_skeleton(id)
             ON r.skeleton_id = query_skeleton.id
-          GROUP BY skeleton_id, treenode_id
           {}
+          GROUP BY skeleton_id, treenode_id
     ) AS sub
     GROUP BY skeleton_id
     '''.format('\n'.join(query_joins), extra_conditions), query_params)
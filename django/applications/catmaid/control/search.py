@@ -1,12 +1,180 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import re
+
+from django.db import connection
 from django.http import JsonResponse
 
+from rest_framework.decorators import api_view
+
 from catmaid.models import (UserRole, ClassInstance, ConnectorClassInstance,
         Treenode, Connector, TreenodeClassInstance)
 from catmaid.control.authentication import requires_user_role
-from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.common import get_relation_to_id_map, get_request_list
+
+
+# Search terms shorter than this can't be matched by trigrams, only prefix
+# searches are done for them.
+MIN_SUBSTRING_SEARCH_LENGTH = 3
+
+
+def escape_like_pattern(term):
+    """Escape all characters with a special meaning in LIKE patterns."""
+    return re.sub(r'([\\%_])', r'\\\1', term)
+
+
+def find_class_instances_by_name(project_id, query, types=None,
+        prefix_only=False, limit=50, cursor=None):
+    """Find class instances like neurons, annotations and labels in a project,
+    whose name contains the query string, ignoring case. Exact matches are
+    returned first, followed by names starting with the query in alphabetical
+    order and names containing it, most similar first. Substrings shorter than
+    MIN_SUBSTRING_SEARCH_LENGTH characters aren't searched for. Neurons and
+    skeletons can also be found by their ID. The search can be constrained to
+    class instances of the passed in class names. A list of
+    (id, name, class_name, match) tuples is returned, with match being one of
+    "id", "exact", "prefix" or "substring".
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    params = {
+        'project_id': project_id,
+        'query': query,
+        'prefix': escape_like_pattern(query) + '%',
+        'substring': '%' + escape_like_pattern(query) + '%',
+        'types': types,
+        'limit': limit,
+    }
+    type_filter = 'AND c.class_name = ANY(%(types)s::text[])' if types else ''
+
+    results = []
+
+    # Neurons and skeletons by ID
+    if query.isdigit():
+        cursor.execute("""
+            SELECT ci.id, ci.name, c.class_name, 'id'
+            FROM class_instance ci
+            JOIN class c
+                ON c.id = ci.class_id
+            WHERE ci.id = %(id)s
+            AND ci.project_id = %(project_id)s
+            AND c.class_name IN ('neuron', 'skeleton')
+            {type_filter}
+        """.format(type_filter=type_filter), dict(params, id=int(query)))
+        results.extend(cursor.fetchall())
+
+    # Names starting with the query, which are read in name order from an
+    # index. Exact matches are sorted first this way.
+    cursor.execute("""
+        SELECT ci.id, ci.name, c.class_name,
+            CASE WHEN upper(ci.name) = upper(%(query)s) THEN 'exact'
+                ELSE 'prefix' END
+        FROM class_instance ci
+        JOIN class c
+            ON c.id = ci.class_id
+        WHERE ci.project_id = %(project_id)s
+        AND upper(ci.name) COLLATE "C" LIKE upper(%(prefix)s)
+        {type_filter}
+        ORDER BY upper(ci.name) COLLATE "C"
+        LIMIT %(limit)s
+    """.format(type_filter=type_filter), params)
+    results.extend(cursor.fetchall())
+
+    # Other names containing the query, most similar first. The trigram index
+    # provides them in this order.
+    if not prefix_only and len(query) >= MIN_SUBSTRING_SEARCH_LENGTH and \
+            len(results) < limit:
+        cursor.execute("""
+            SELECT ci.id, ci.name, c.class_name, 'substring'
+            FROM class_instance ci
+            JOIN class c
+                ON c.id = ci.class_id
+            WHERE ci.project_id = %(project_id)s
+            AND upper(ci.name) LIKE upper(%(substring)s)
+            AND upper(ci.name) NOT LIKE upper(%(prefix)s)
+            {type_filter}
+            ORDER BY upper(ci.name) <-> upper(%(query)s)
+            LIMIT %(limit)s
+        """.format(type_filter=type_filter), dict(params,
+                limit=limit - len(results)))
+        results.extend(cursor.fetchall())
+
+    # An ID match can also match by name
+    seen = set()
+    unique_results = []
+    for r in results:
+        if r[0] not in seen:
+            seen.add(r[0])
+            unique_results.append(r)
+
+    return unique_results[:limit]
+
+
+@api_view(['GET'])
+@requires_user_role(UserRole.Browse)
+def search_names(request, project_id=None):
+    """Find neurons, annotations, labels and other class instances by name.
+
+    This search is meant to be used for type-ahead searches. Names are matched
+    ignoring case. Exact matches are returned first, followed by names starting
+    with the query in alphabetical order and names containing the query, most
+    similar first. For queries shorter than three characters only names
+    starting with the query are returned. Neurons and skeletons can also be
+    found by their ID. Each result is an object with the fields "id", "name",
+    "class_name" and "match", which is one of "id", "exact", "prefix" or
+    "substring".
+    ---
+    parameters:
+      - name: project_id
+        description: Project to search in
+        type: integer
+        paramType: path
+        required: true
+      - name: query
+        description: The text to search for
+        type: string
+        paramType: form
+        required: true
+      - name: types
+        description: Only return class instances of these classes, e.g. neuron, annotation or label
+        type: array
+        items:
+          type: string
+        paramType: form
+        required: false
+      - name: prefix
+        description: Whether to only return names that start with the query
+        type: boolean
+        paramType: form
+        default: false
+        required: false
+      - name: limit
+        description: The maximum number of results
+        type: integer
+        paramType: form
+        default: 50
+        required: false
+    """
+    query = request.GET.get('query', '').strip()
+    if not query:
+        raise ValueError('Need non-empty query')
+    types = get_request_list(request.GET, 'types')
+    prefix_only = request.GET.get('prefix', 'false') == 'true'
+    limit = int(request.GET.get('limit', 50))
+    if limit < 1:
+        raise ValueError('Limit needs to be positive')
+
+    results = find_class_instances_by_name(int(project_id), query, types,
+            prefix_only, limit)
+
+    return JsonResponse([{
+        'id': r[0],
+        'name': r[1],
+        'class_name': r[2],
+        'match': r[3],
+    } for r in results], safe=False)
 
 
 @requires_user_role(UserRole.Browse)
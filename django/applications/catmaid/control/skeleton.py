@@ -35,7 +35,7 @@ from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.neuron_annotations import (annotations_for_skeleton,
         create_annotation_query, _annotate_entities, _update_neuron_annotations)
 from catmaid.control.review import get_review_status
-from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
+from catmaid.control.tree_util import Arbor, find_root
 
 
 def get_skeleton_permissions(request, project_id, skeleton_id):
@@ -121,28 +121,22 @@ def open_leaves(request, project_id=None, skeleton_id=None):
         WHERE t.skeleton_id = %s
         ''', (int(skeleton_id),))
 
-    # Some entries repeated, when a node has more than one tag
-    # Create a graph with edges from parent to child, and accumulate parents
-    tree = nx.DiGraph()
-    for row in cursor.fetchall():
-        node_id = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], node_id)
-        else:
-            tree.add_node(node_id)
+    rows = cursor.fetchall()
+    arbor = Arbor([row[0] for row in rows], [row[1] for row in rows])
 
-    if tnid not in tree:
+    if tnid not in arbor:
         raise Exception("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
-    reroot(tree, tnid)
-    distances = edge_count_to_root(tree, root_node=tnid)
-    leaves = set()
+    root = arbor.index(tnid)
+    arbor.reroot(root)
+    # Number of nodes on the path to the query node
+    distances = dict(zip(arbor.node_ids.tolist(), (arbor.depths() + 1).tolist()))
 
-    for node_id, out_degree in tree.out_degree_iter():
-        if 0 == out_degree or node_id == tnid and 1 == out_degree:
-            # Found an end node
-            leaves.add(node_id)
+    # End nodes, including the query node if it is one
+    child_counts = arbor.child_counts()
+    ends = child_counts == 0
+    ends[root] = child_counts[root] == 1
+    leaves = arbor.node_ids[ends]
 
     # Select all nodes and their tags
     cursor.execute('''
@@ -157,7 +151,7 @@ def open_leaves(request, project_id=None, skeleton_id=None):
                 AND tci.relation_id = %s)
           ON t.id = tci.treenode_id
         GROUP BY t.id
-        ''', (list(leaves), labeled_as))
+        ''', (leaves.tolist(), labeled_as))
 
     # Iterate end nodes to find which are open.
     nearest = []
@@ -251,47 +245,98 @@ def find_labels(request, project_id=None, skeleton_id=None):
             ''', (labeled_as, label_regex, int(skeleton_id)))
 
     # Some entries repeated, when a node has more than one matching label
-    # Create a graph with edges from parent to child, and accumulate parents
-    tree = nx.DiGraph()
+    parents = {}
+    locations = {}
+    tags = defaultdict(list)
     for row in cursor.fetchall():
         nodeID = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], nodeID)
-        else:
-            tree.add_node(nodeID)
-        tree.node[nodeID]['loc'] = (row[2], row[3], row[4])
+        parents[nodeID] = row[1]
+        locations[nodeID] = (row[2], row[3], row[4])
         if row[5]:
-            props = tree.node[nodeID]
-            tags = props.get('tags')
-            if tags:
-                tags.append(row[5])
-            else:
-                props['tags'] = [row[5]]
+            tags[nodeID].append(row[5])
 
-    if tnid not in tree:
+    arbor = Arbor(list(parents.keys()), list(parents.values()))
+
+    if tnid not in arbor:
         raise Exception("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
-    reroot(tree, tnid)
-    distances = edge_count_to_root(tree, root_node=tnid)
+    arbor.reroot(arbor.index(tnid))
+    # Number of nodes on the path to the query node
+    distances = arbor.depths() + 1
 
     nearest = []
 
-    for nodeID, props in tree.nodes_iter(data=True):
-        if 'tags' in props:
-            # Found a node with a matching label
-            d = distances[nodeID]
-            nearest.append([nodeID, props['loc'], d, props['tags']])
+    for nodeID, index in zip(tags.keys(), arbor.indices(list(tags.keys()))):
+        # Found a node with a matching label
+        d = int(distances[index])
+        nearest.append([nodeID, locations[nodeID], d, tags[nodeID]])
 
     nearest.sort(key=lambda n: n[2])
 
     return JsonResponse(nearest, safe=False)
 
 
+def get_skeletons_within_distance(project_id, treenode_ids, distance,
+        size_mode=0, limit=100, cursor=None):
+    """Find skeletons with nodes within a Euclidean distance of each of the
+    passed in treenodes. All origin treenodes are looked up with a single
+    query, which uses the 3D spatial index of the treenode_edge table. The
+    size mode constrains the number of nodes a skeleton needs within the
+    search area: more than one (0), exactly one (1) or any (2). Returns a
+    dictionary mapping each treenode ID to a list of at most <limit> skeleton
+    IDs.
+    """
+    if 0 == size_mode:
+        having = "HAVING count(*) > 1"
+    elif 1 == size_mode:
+        having = "HAVING count(*) = 1"
+    else:
+        having = ""
+
+    cursor = cursor or connection.cursor()
+    cursor.execute("""
+        SELECT origin.id, s.skeleton_id
+        FROM treenode origin
+        CROSS JOIN LATERAL (
+            SELECT t.skeleton_id
+            FROM treenode_edge te
+            JOIN treenode t
+                ON t.id = te.id
+            WHERE te.project_id = %(project_id)s
+            AND te.edge &&& ST_MakeLine(ARRAY[
+                ST_MakePoint(origin.location_x - %(distance)s,
+                    origin.location_y - %(distance)s,
+                    origin.location_z - %(distance)s),
+                ST_MakePoint(origin.location_x + %(distance)s,
+                    origin.location_y + %(distance)s,
+                    origin.location_z + %(distance)s)]::geometry[])
+            AND ST_3DDWithin(ST_StartPoint(te.edge), ST_MakePoint(
+                origin.location_x, origin.location_y, origin.location_z),
+                %(distance)s)
+            GROUP BY t.skeleton_id
+            {having}
+            ORDER BY t.skeleton_id
+            LIMIT %(limit)s
+        ) s
+        WHERE origin.id = ANY(%(treenode_ids)s::bigint[])
+        AND origin.project_id = %(project_id)s
+    """.format(having=having), {
+        'project_id': project_id,
+        'treenode_ids': treenode_ids,
+        'distance': distance,
+        'limit': limit,
+    })
+
+    skeletons = dict((tnid, []) for tnid in treenode_ids)
+    for tnid, skeleton_id in cursor.fetchall():
+        skeletons[tnid].append(skeleton_id)
+    return skeletons
+
+
 @api_view(['POST'])
 @requires_user_role(UserRole.Browse)
 def within_spatial_distance(request, project_id=None):
-    """Find skeletons within a given L-infinity distance of a treenode.
+    """Find skeletons within a given Euclidean distance of a treenode.
 
     Returns at most 100 results.
     ---
@@ -302,7 +347,7 @@ def within_spatial_distance(request, project_id=None):
           type: integer
           paramType: form
         - name: distance
-          description: L-infinity distance in nanometers within which to search
+          description: Euclidean distance in nanometers within which to search
           required: false
           default: 0
           type: integer
@@ -336,49 +381,82 @@ def within_spatial_distance(request, project_id=None):
     if 0 == distance:
         return JsonResponse({"skeletons": []})
     size_mode = int(request.POST.get("size_mode", 0))
-    having = ""
-
-    if 0 == size_mode:
-        having = "HAVING count(*) > 1"
-    elif 1 == size_mode:
-        having = "HAVING count(*) = 1"
-    # else, no constraint
-
-    cursor = connection.cursor()
-    cursor.execute('SELECT location_x, location_y, location_z FROM treenode WHERE id=%s' % tnid)
-    pos = cursor.fetchone()
 
     limit = 100
-    x0 = pos[0] - distance
-    x1 = pos[0] + distance
-    y0 = pos[1] - distance
-    y1 = pos[1] + distance
-    z0 = pos[2] - distance
-    z1 = pos[2] + distance
-
-    # Cheap emulation of the distance
-    cursor.execute('''
-SELECT skeleton_id, count(*)
-FROM treenode
-WHERE project_id = %s
-  AND location_x > %s
-  AND location_x < %s
-  AND location_y > %s
-  AND location_y < %s
-  AND location_z > %s
-  AND location_z < %s
-GROUP BY skeleton_id
-%s
-LIMIT %s
-''' % (project_id, x0, x1, y0, y1, z0, z1, having, limit))
-
-
-    skeletons = tuple(row[0] for row in cursor.fetchall())
+    skeletons = get_skeletons_within_distance(project_id, [tnid], distance,
+            size_mode, limit)[tnid]
 
     return JsonResponse({"skeletons": skeletons,
                          "reached_limit": limit == len(skeletons)})
 
 
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def within_spatial_distance_multiple(request, project_id=None):
+    """Find skeletons within a given Euclidean distance of each of the passed
+    in treenodes.
+
+    All treenodes are looked up at once, which makes this a good fit to e.g.
+    find neighboring skeletons of many merge candidates. Returns at most 100
+    skeletons per treenode.
+    ---
+    parameters:
+        - name: treenode_ids
+          description: IDs of the origin treenodes to search around
+          required: true
+          type: array
+          items:
+            type: integer
+          paramType: form
+        - name: distance
+          description: Euclidean distance in nanometers within which to search
+          required: true
+          type: number
+          paramType: form
+        - name: size_mode
+          description: |
+            Whether to return skeletons with only one node in the search area
+            (1), more than one node in the search area (0) or any (2).
+          required: false
+          default: 0
+          type: integer
+          paramType: form
+    type:
+      reached_limit:
+        description: |
+          IDs of treenodes for which the limit of at most 100 skeletons was
+          reached
+        type: array
+        required: true
+        items:
+          type: integer
+      skeletons:
+        description: |
+          An object mapping each treenode ID to the IDs of skeletons
+          matching the search criteria
+        type: object
+        required: true
+    """
+    project_id = int(project_id)
+    treenode_ids = get_request_list(request.POST, 'treenode_ids', map_fn=int)
+    if not treenode_ids:
+        raise ValueError("Need at least one treenode")
+    distance = float(request.POST.get('distance', 0))
+    if distance <= 0:
+        raise ValueError("Need a positive distance")
+    size_mode = int(request.POST.get("size_mode", 0))
+
+    limit = 100
+    skeletons = get_skeletons_within_distance(project_id, treenode_ids,
+            distance, size_mode, limit)
+
+    return JsonResponse({
+        "skeletons": skeletons,
+        "reached_limit": [tnid for tnid, s in six.iteritems(skeletons)
+                          if limit == len(s)]
+    })
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def skeleton_statistics(request, project_id=None, skeleton_id=None):
     p = get_object_or_404(Project, pk=project_id)
@@ -738,21 +816,11 @@ def split_skeleton(request, project_id=None):
         ORDER BY t.id
         FOR NO KEY UPDATE OF t
         ''', (skeleton_id, skeleton_id)) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
+    rows = cursor.fetchall()
+    arbor = Arbor([row[0] for row in rows], [row[1] for row in rows])
     # find downstream nodes starting from target treenode_id
     # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
+    change_list = arbor.node_ids[arbor.downstream(arbor.index(treenode_id))].tolist()
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -941,24 +1009,37 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2,
 
     # Obtain the synapses made by all skeleton_ids considering the desired
     # direction of the synapse, as specified by relation_id_1 and relation_id_2:
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence),
-        t1.treenode_id, t2.treenode_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id = ANY(%s::integer[])
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t1.id != t2.id
-      AND t2.relation_id = %s
-    ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
-
-    # Sum the number of synapses
-    for srcID, partnerID, confidence, tn1, tn2 in cursor.fetchall():
-        partner = partners[partnerID]
-        partner.skids[srcID][confidence - 1] += 1
-        if with_nodes:
+    if with_nodes:
+        cursor.execute('''
+        SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence),
+            t1.treenode_id, t2.treenode_id
+        FROM treenode_connector t1,
+             treenode_connector t2
+        WHERE t1.skeleton_id = ANY(%s::integer[])
+          AND t1.relation_id = %s
+          AND t1.connector_id = t2.connector_id
+          AND t1.id != t2.id
+          AND t2.relation_id = %s
+        ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
+
+        # Sum the number of synapses
+        for srcID, partnerID, confidence, tn1, tn2 in cursor.fetchall():
+            partner = partners[partnerID]
+            partner.skids[srcID][confidence - 1] += 1
             partner.links.append([tn1, tn2, srcID])
+    else:
+        # Without individual links, the synapse counts per confidence can be
+        # read from the skeleton connectivity table.
+        cursor.execute('''
+        SELECT source_skeleton_id, target_skeleton_id, confidence_counts
+        FROM catmaid_skeleton_connectivity
+        WHERE source_skeleton_id = ANY(%s::integer[])
+          AND source_relation_id = %s
+          AND target_relation_id = %s
+        ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
+
+        for srcID, partnerID, confidence_counts in cursor.fetchall():
+            partners[partnerID].skids[srcID] = confidence_counts
 
     # There may not be any synapses
     if not partners:
@@ -990,8 +1071,9 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2,
     # Find which reviewers have reviewed any partner skeletons
     cursor.execute('''
     SELECT DISTINCT reviewer_id
-    FROM review
+    FROM catmaid_skeleton_review_summary
     WHERE skeleton_id = ANY(%s::integer[])
+    AND reviewer_id IS NOT NULL
     ''', (partner_skids,))
     reviewers = [row[0] for row in cursor]
 
@@ -1191,29 +1273,28 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids):
     post_rel_id = relation_map['postsynaptic_to']
     pre_rel_id = relation_map['presynaptic_to']
 
-    # Obtain all synapses made between row skeletons and column skeletons.
+    # Obtain the number of synapses made between row skeletons and column
+    # skeletons.
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t2.skeleton_id IN (%s)
-      AND t1.connector_id = t2.connector_id
-      AND t1.relation_id = %s
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, row_skeleton_ids)),
-           ','.join(map(str, col_skeleton_ids)),
-           pre_rel_id, post_rel_id))
+    SELECT source_skeleton_id, target_skeleton_id, confidence_counts
+    FROM catmaid_skeleton_connectivity
+    WHERE source_skeleton_id = ANY(%(row_skeleton_ids)s::integer[])
+      AND target_skeleton_id = ANY(%(col_skeleton_ids)s::integer[])
+      AND source_relation_id = %(pre_rel_id)s
+      AND target_relation_id = %(post_rel_id)s
+    ''', {
+        'row_skeleton_ids': list(row_skeleton_ids),
+        'col_skeleton_ids': list(col_skeleton_ids),
+        'pre_rel_id': pre_rel_id,
+        'post_rel_id': post_rel_id
+    })
 
     # Build a sparse connectivity representation. For all skeletons requested
     # map a dictionary of partner skeletons and the number of synapses
     # connecting to each partner.
     outgoing = defaultdict(dict)
-    for r in cursor.fetchall():
-        source, target = r[0], r[1]
-        mapping = outgoing[source]
-        count = mapping.get(target, 0)
-        mapping[target] = count + 1
+    for source, target, confidence_counts in cursor.fetchall():
+        outgoing[source][target] = sum(confidence_counts)
 
     return outgoing
 
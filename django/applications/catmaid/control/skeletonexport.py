@@ -4,19 +4,23 @@ from __future__ import unicode_literals
 import array
 import json
 import logging
+import msgpack
 import networkx as nx
+import numpy as np
 import pytz
 import six
 import struct
 
 from functools import partial
-from collections import defaultdict, deque
-from math import sqrt
+from itertools import groupby
+from operator import itemgetter
+from collections import defaultdict, deque, namedtuple, OrderedDict
 from datetime import datetime
 
+from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 
 from rest_framework.decorators import api_view
 
@@ -30,7 +34,7 @@ from catmaid.control.review import get_treenodes_to_reviews, \
 
 from psycopg2.extras import DateTimeTZRange
 
-from catmaid.control.tree_util import edge_count_to_root, partition
+from catmaid.control.tree_util import Arbor, edge_count_to_root
 
 # Python 2 and 3 compatible map and zip iterator
 from six.moves import map, zip
@@ -69,48 +73,63 @@ def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
     return treenode_qs, labels_qs, labelconnector_qs
 
 
-def get_swc_string(treenodes_qs, linearize_ids=False):
-    all_rows = []
-    for tn in treenodes_qs:
-        swc_row = [tn.id]
-        swc_row.append(0)
-        swc_row.append(tn.location_x)
-        swc_row.append(tn.location_y)
-        swc_row.append(tn.location_z)
-        swc_row.append(max(tn.radius, 0))
-        swc_row.append(-1 if tn.parent_id is None else tn.parent_id)
-        all_rows.append(swc_row)
+def get_swc_rows(treenodes_qs):
+    """Yield an SWC row for each treenode of the passed in query set. Treenodes
+    are read in chunks through a server-side cursor.
+    """
+    treenodes = treenodes_qs.values_list('id', 'location_x', 'location_y',
+            'location_z', 'radius', 'parent_id')
+    for tn in treenodes.iterator():
+        yield [tn[0], 0, tn[1], tn[2], tn[3], max(tn[4], 0),
+                -1 if tn[5] is None else tn[5]]
+
 
+def linearize_swc_rows(all_rows):
+    """Map the node IDs of the passed in SWC rows to incremental IDs in
+    breadth-first order, starting with the root. Returns the rows sorted by
+    their new ID.
+    """
+    # Find successors for each node
+    successors = defaultdict(list)
+    root = None
+    for tn in all_rows:
+        node, parent = tn[0], tn[6]
+        if parent == -1:
+            root = node
+        else:
+            successors[parent].append(node)
+    # Map each node to a new incremental ID
+    id_map = dict()
+    working_set = deque([root])
+    count = 1
+    while working_set:
+        node = working_set.popleft()
+        id_map[node] = count
+        count += 1
+        working_set.extend(successors[node])
+    # Replace each original ID with the mapped ID
+    for tn in all_rows:
+        tn[0] = id_map[tn[0]]
+        tn[6] = id_map[tn[6]] if tn[6] != -1 else -1
+    # Sort based on node ID
+    all_rows.sort(key=lambda tn: tn[0])
+    return all_rows
+
+
+def iter_swc_lines(treenodes_qs, linearize_ids=False):
+    """Yield the SWC representation of the passed in treenodes line by line.
+    Linearizing IDs requires all rows to be in memory.
+    """
+    rows = get_swc_rows(treenodes_qs)
     if linearize_ids:
-        # Find successors for each node
-        successors = defaultdict(list)
-        root = None
-        for tn in all_rows:
-            node, parent = tn[0], tn[6]
-            if parent == -1:
-                root = node
-            else:
-                successors[parent].append(node)
-        # Map each node to a new incremental ID
-        id_map = dict()
-        working_set = deque([root])
-        count = 1
-        while working_set:
-            node = working_set.popleft()
-            id_map[node] = count
-            count += 1
-            working_set.extend(successors[node])
-        # Replace each original ID with the mapped ID
-        for tn in all_rows:
-            tn[0] = id_map[tn[0]]
-            tn[6] = id_map[tn[6]] if tn[6] != -1 else -1
-        # Sort based on node ID
-        all_rows.sort(key=lambda tn: tn[0])
-
-    result = ""
-    for row in all_rows:
-        result += " ".join(map(str, row)) + "\n"
-    return result
+        rows = linearize_swc_rows(list(rows))
+    for row in rows:
+        yield " ".join(map(str, row)) + "\n"
+
+
+def get_swc_string(treenodes_qs, linearize_ids=False):
+    return "".join(iter_swc_lines(treenodes_qs, linearize_ids))
+
 
 def export_skeleton_response(request, project_id=None, skeleton_id=None, format=None):
     treenode_qs, labels_qs, labelconnector_qs = get_treenodes_qs(project_id, skeleton_id)
@@ -120,6 +139,10 @@ def export_skeleton_response(request, project_id=None, skeleton_id=None, format=
 
     if format == 'swc':
         linearize_ids = request.GET.get('linearize_ids', 'false') == 'true'
+        stream = request.GET.get('stream', 'false') == 'true'
+        if stream:
+            return StreamingHttpResponse(iter_swc_lines(treenode_qs, linearize_ids),
+                    content_type='text/plain')
         return HttpResponse(get_swc_string(treenode_qs, linearize_ids), content_type='text/plain')
     elif format == 'json':
         return JsonResponse(treenode_qs)
@@ -359,6 +382,22 @@ def compact_skeleton_detail_many(request, project_id=None):
       type: boolean
       defaultValue: "false"
       paramType: form
+    - name: stream
+      description: |
+        Whether the result should be streamed. Skeletons are then loaded and
+        sent in batches, which starts the response immediately and limits
+        the memory needed for large exports.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    - name: format
+      description: |
+        Either "json" (default) or "msgpack".
+      required: false
+      type: string
+      defaultValue: "json"
+      paramType: form
     type:
     - type: array
       items:
@@ -374,15 +413,44 @@ def compact_skeleton_detail_many(request, project_id=None):
     with_reviews = request.POST.get("with_reviews", "false") == "true"
     with_annotations = request.POST.get("with_annotations", "false") == "true"
     with_user_info = request.POST.get("with_user_info", "false") == "true"
+    stream = request.POST.get("stream", "false") == "true"
+    data_format = request.POST.get("format", "json")
 
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
-    skeletons = {}
-    for skeleton_id in skeleton_ids:
-        skeletons[skeleton_id] = _compact_skeleton(project_id, skeleton_id,
+    if data_format not in ('json', 'msgpack'):
+        raise ValueError("Format must be one of: json, msgpack")
+
+    if stream:
+        # Errors can't be reported anymore once the response started, which is
+        # why all skeletons are checked upfront.
+        skeleton_ids = list(OrderedDict.fromkeys(skeleton_ids))
+        existing = set(ClassInstance.objects.filter(pk__in=skeleton_ids) \
+                .values_list('id', flat=True))
+        for skeleton_id in skeleton_ids:
+            if skeleton_id not in existing:
+                raise ValueError("Skeleton #%s doesn't exist" % skeleton_id)
+
+        skeletons = iter_compact_skeletons(project_id, skeleton_ids,
                 with_connectors, with_tags, with_history, with_merge_history,
                 with_reviews, with_annotations, with_user_info)
+        if data_format == 'msgpack':
+            return StreamingHttpResponse(stream_compact_skeletons_msgpack(
+                    skeletons, len(skeleton_ids)),
+                    content_type='application/octet-stream')
+        return StreamingHttpResponse(stream_compact_skeletons_json(skeletons),
+                content_type='application/json')
+
+    skeletons = _compact_skeletons(project_id, skeleton_ids, with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info)
+
+    if data_format == 'msgpack':
+        packer = msgpack.Packer(default=default, use_bin_type=True)
+        return HttpResponse(packer.pack({
+            "skeletons": skeletons
+        }), content_type='application/octet-stream')
 
     return JsonResponse({
         "skeletons": skeletons
@@ -392,6 +460,51 @@ def compact_skeleton_detail_many(request, project_id=None):
     })
 
 
+def iter_compact_skeletons(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        with_reviews=False, with_annotations=False, with_user_info=False,
+        batch_size=None):
+    """Yield (skeleton ID, compact skeleton) tuples for all passed in
+    skeletons, see _compact_skeleton(). Skeletons are loaded in batches of
+    <batch_size> skeletons, so that only one batch has to be kept in memory.
+    """
+    if not batch_size:
+        batch_size = settings.STREAMED_EXPORT_BATCH_SIZE
+    for i in range(0, len(skeleton_ids), batch_size):
+        skeletons = _compact_skeletons(project_id,
+                skeleton_ids[i:i + batch_size], with_connectors, with_tags,
+                with_history, with_merge_history, with_reviews,
+                with_annotations, with_user_info)
+        for item in six.iteritems(skeletons):
+            yield item
+
+
+def stream_compact_skeletons_json(skeletons):
+    """Encode (skeleton ID, compact skeleton) tuples incrementally in the JSON
+    format of compact_skeleton_detail_many().
+    """
+    yield '{"skeletons":{'
+    separator = ''
+    for skeleton_id, skeleton in skeletons:
+        yield '{}"{}":{}'.format(separator, skeleton_id, json.dumps(skeleton,
+                separators=(',', ':'), default=default))
+        separator = ','
+    yield '}}'
+
+
+def stream_compact_skeletons_msgpack(skeletons, n_skeletons):
+    """Encode <n_skeletons> (skeleton ID, compact skeleton) tuples
+    incrementally in the msgpack format of compact_skeleton_detail_many().
+    """
+    packer = msgpack.Packer(default=default, use_bin_type=True)
+    yield packer.pack_map_header(1)
+    yield packer.pack("skeletons")
+    yield packer.pack_map_header(n_skeletons)
+    for skeleton_id, skeleton in skeletons:
+        yield packer.pack(skeleton_id)
+        yield packer.pack(skeleton)
+
+
 def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         with_tags=True, with_history=False, with_merge_history=True,
         with_reviews=False, with_annotations=False, with_user_info=False):
@@ -414,29 +527,45 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
     the original creation time is needed for data that was created without
     history tables enabled.
     """
+    return _compact_skeletons(project_id, [skeleton_id], with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info)[skeleton_id]
+
 
+def _compact_skeletons(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        with_reviews=False, with_annotations=False, with_user_info=False):
+    """Get a compact treenode representation of multiple skeletons, see
+    _compact_skeleton(). Each kind of data is fetched for all skeletons with a
+    single query and is grouped by skeleton afterwards. Returns a dictionary
+    that maps each skeleton ID to its result list.
+    """
     cursor = connection.cursor()
 
+    # Avoid duplicate results for duplicate IDs
+    skeleton_ids = list(OrderedDict.fromkeys(int(s) for s in skeleton_ids))
+    skeletons = OrderedDict((skid, [[], [], defaultdict(list), [], []])
+            for skid in skeleton_ids)
+
     if not with_history:
         cursor.execute('''
-            SELECT id, parent_id, user_id,
-                location_x, location_y, location_z,
-                radius, confidence
-            FROM treenode
-            WHERE skeleton_id = %s
-        ''', (skeleton_id,))
-
-        nodes = tuple(cursor.fetchall())
+            SELECT t.skeleton_id, t.id, t.parent_id, t.user_id,
+                t.location_x, t.location_y, t.location_z,
+                t.radius, t.confidence
+            FROM treenode t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON t.skeleton_id = skeleton.id
+        ''', {
+            'skeleton_ids': skeleton_ids
+        })
     else:
-        params = {
-            'skeleton_id': skeleton_id
-        }
         # Get present and historic nodes. If a historic validity range is empty
         # (e.g. due to a change in the same transaction), the edition time is
         # taken for both start and end validity, because this is what actually
         # happened.
         query = '''
             SELECT
+                treenode.skeleton_id,
                 treenode.id,
                 treenode.parent_id,
                 treenode.user_id,
@@ -448,9 +577,11 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 treenode.edition_time,
                 treenode.creation_time
             FROM treenode
-            WHERE treenode.skeleton_id = %(skeleton_id)s
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON treenode.skeleton_id = skeleton.id
             UNION ALL
             SELECT
+                treenode__history.skeleton_id,
                 treenode__history.id,
                 treenode__history.parent_id,
                 treenode__history.user_id,
@@ -462,7 +593,8 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 COALESCE(lower(treenode__history.sys_period), treenode__history.edition_time),
                 COALESCE(upper(treenode__history.sys_period), treenode__history.edition_time)
             FROM treenode__history
-            WHERE treenode__history.skeleton_id = %(skeleton_id)s
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON treenode__history.skeleton_id = skeleton.id
         '''
 
         if with_merge_history:
@@ -470,6 +602,7 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 {}
                 UNION ALL
                 SELECT
+                    t.skeleton_id,
                     th.id,
                     th.parent_id,
                     th.user_id,
@@ -483,28 +616,30 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 FROM treenode__history th
                 JOIN treenode t
                     ON th.id = t.id
-                    AND t.skeleton_id = %(skeleton_id)s
                     AND th.skeleton_id <> t.skeleton_id
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                    ON t.skeleton_id = skeleton.id
             '''.format(query)
 
-        cursor.execute(query, params)
-
-        nodes = tuple(cursor.fetchall())
+        cursor.execute(query, {
+            'skeleton_ids': skeleton_ids
+        })
 
-    if 0 == len(nodes):
-        # Check if the skeleton exists
-        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-            raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
+    for row in cursor.fetchall():
+        skeletons[row[0]][0].append(row[1:])
+
+    # Check if skeletons without nodes exist
+    empty_skeleton_ids = [skid for skid, s in six.iteritems(skeletons) if not s[0]]
+    if empty_skeleton_ids:
+        existing = set(ClassInstance.objects.filter(pk__in=empty_skeleton_ids) \
+                .values_list('id', flat=True))
+        for skid in empty_skeleton_ids:
+            if skid not in existing:
+                raise Exception("Skeleton #%s doesn't exist" % skid)
         # Otherwise returns an empty list of nodes
 
-    connectors = ()
-    tags = defaultdict(list)
-    reviews = []
-
     if with_connectors or with_tags or with_annotations:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id, cursor=cursor)
 
     if with_connectors:
         # Fetch all connectors with their partner treenode IDs
@@ -512,30 +647,26 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         post = relations['postsynaptic_to']
         gj = relations.get('gapjunction_with', -1)
         relation_index = {pre: 0, post: 1, gj: 2}
+        params = {
+            'skeleton_ids': skeleton_ids,
+            'pre': pre,
+            'post': post,
+            'gj': gj
+        }
         if not with_history:
             user_select = ', tc.user_id' if with_user_info else ''
             cursor.execute('''
-                SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                    c.location_x, c.location_y, c.location_z
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                    tc.relation_id, c.location_x, c.location_y, c.location_z
                     {user_select}
-                FROM treenode_connector tc,
-                    connector c
-                WHERE tc.skeleton_id = %s
-                AND tc.connector_id = c.id
-                AND (tc.relation_id = %s OR tc.relation_id = %s OR tc.relation_id = %s)
-            '''.format(user_select=user_select), (skeleton_id, pre, post, gj))
-
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5]) for row in cursor.fetchall())
+                FROM treenode_connector tc
+                JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                    ON tc.skeleton_id = skeleton.id
+                JOIN connector c
+                    ON tc.connector_id = c.id
+                WHERE (tc.relation_id = %(pre)s OR tc.relation_id = %(post)s OR tc.relation_id = %(gj)s)
+            '''.format(user_select=user_select), params)
         else:
-            params = {
-                'skeleton_id': skeleton_id,
-                'pre': pre,
-                'post': post,
-                'gj': gj
-            }
             user_select = ', links.user_id' if with_user_info else ''
 
             # Get present and historic connectors. If a historic validity range
@@ -543,52 +674,56 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
             # edition time is taken for both start and end validity, because
             # this is what actually happened.
             query = '''
-                SELECT links.treenode_id, links.connector_id, links.relation_id,
-                        c.location_x, c.location_y, c.location_z,
-                        links.valid_from, links.valid_to
+                SELECT links.skeleton_id, links.treenode_id, links.connector_id,
+                        links.relation_id, c.location_x, c.location_y,
+                        c.location_z, links.valid_from, links.valid_to
                         {user_select}
                 FROM (
-                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                        tc.edition_time, tc.creation_time, tc.user_id
+                    SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                        tc.relation_id, tc.edition_time, tc.creation_time,
+                        tc.user_id
                     FROM treenode_connector tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                        ON tc.skeleton_id = skeleton.id
                     UNION ALL
-                    SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
+                    SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                        tc.relation_id,
                         COALESCE(lower(tc.sys_period), tc.edition_time),
                         COALESCE(upper(tc.sys_period), tc.edition_time),
                         tc.user_id
                     FROM treenode_connector__history tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                        ON tc.skeleton_id = skeleton.id
                     {extra_query}
-                ) links(treenode_id, connector_id, relation_id, valid_from, valid_to, user_id)
+                ) links(skeleton_id, treenode_id, connector_id, relation_id, valid_from, valid_to, user_id)
                 JOIN connector__with_history c
                     ON links.connector_id = c.id
                 WHERE (links.relation_id = %(pre)s OR links.relation_id = %(post)s OR links.relation_id = %(gj)s)
             '''
 
             if with_merge_history:
-                merge_user_select = ', tch.user_id' if with_user_info else ''
                 extra_query = '''
                     UNION ALL
-                    SELECT tch.treenode_id, tch.connector_id, tch.relation_id,
+                    SELECT tc.skeleton_id, tch.treenode_id, tch.connector_id,
+                        tch.relation_id,
                         COALESCE(lower(tch.sys_period), tch.edition_time),
                         COALESCE(upper(tch.sys_period), tch.edition_time),
                         tch.user_id
                     FROM treenode_connector__history tch
                     JOIN treenode_connector tc
                         ON tc.id = tch.id
-                        AND tc.skeleton_id = %(skeleton_id)s
                         AND tch.skeleton_id <> tc.skeleton_id
-                '''.format(user_select=merge_user_select)
+                    JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                        ON tc.skeleton_id = skeleton.id
+                '''
             else:
                 extra_query = ''
 
             cursor.execute(query.format(extra_query=extra_query, user_select=user_select), params)
 
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7], row[8]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7]) for row in cursor.fetchall())
+        for row in cursor.fetchall():
+            skeletons[row[0]][1].append((row[1], row[2],
+                    relation_index.get(row[3], -1)) + tuple(row[4:]))
 
     if with_tags:
         history_suffix = '__with_history' if with_history else ''
@@ -596,71 +731,70 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         user_select = ', tci.user_id' if with_user_info else ''
         # Fetch all node tags
         cursor.execute('''
-            SELECT c.name, tci.treenode_id
+            SELECT t.skeleton_id, c.name, tci.treenode_id
                    {0}
                    {user_select}
-            FROM treenode{1} t,
-                 treenode_class_instance{1} tci,
-                 class_instance{1} c
-            WHERE t.skeleton_id = %s
-              AND t.id = tci.treenode_id
-              AND tci.relation_id = %s
-              AND c.id = tci.class_instance_id
-        '''.format(t_history_query, history_suffix, user_select=user_select),
-        (skeleton_id, relations['labeled_as']))
+            FROM treenode{1} t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON t.skeleton_id = skeleton.id
+            JOIN treenode_class_instance{1} tci
+                ON t.id = tci.treenode_id
+            JOIN class_instance{1} c
+                ON c.id = tci.class_instance_id
+            WHERE tci.relation_id = %(labeled_as)s
+        '''.format(t_history_query, history_suffix, user_select=user_select), {
+            'skeleton_ids': skeleton_ids,
+            'labeled_as': relations['labeled_as']
+        })
 
-        if with_history:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2], row[3]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
+        if with_history or with_user_info:
+            for row in cursor.fetchall():
+                skeletons[row[0]][2][row[1]].append(list(row[2:]))
         else:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append(row[1])
+            for row in cursor.fetchall():
+                skeletons[row[0]][2][row[1]].append(row[2])
 
     if with_reviews:
         r_history_query = ', r.review_time' if with_history else ''
         history_suffix = '__with_history' if with_history else ''
         cursor.execute("""
-            SELECT r.treenode_id, r.id, r.reviewer_id{0}
+            SELECT r.skeleton_id, r.treenode_id, r.id, r.reviewer_id{0}
             FROM review{1} r
-            WHERE r.skeleton_id = %s
-        """.format(r_history_query, history_suffix), [skeleton_id])
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON r.skeleton_id = skeleton.id
+        """.format(r_history_query, history_suffix), {
+            'skeleton_ids': skeleton_ids
+        })
 
-        for r in cursor.fetchall():
-            reviews.append(r)
+        for row in cursor.fetchall():
+            skeletons[row[0]][3].append(row[1:])
 
-    annotations = []
     if with_annotations:
         history_suffix = '__with_history' if with_history else ''
         link_history_query = ', annotation_link.edition_time' if with_history else ''
         user_select = ', neuron_link.user_id' if with_user_info else ''
-        # Fetch all node tags
+        # Fetch all annotations
         cursor.execute('''
-            SELECT annotation_link.class_instance_b
+            SELECT neuron_link.class_instance_a, annotation_link.class_instance_b
                    {0}
                    {user_select}
             FROM class_instance_class_instance{1} neuron_link
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON neuron_link.class_instance_a = skeleton.id
             JOIN class_instance_class_instance{1} annotation_link
                 ON annotation_link.class_instance_a = neuron_link.class_instance_b
-            WHERE neuron_link.class_instance_a = %(skeleton_id)s
-              AND neuron_link.relation_id = %(model_of)s
+            WHERE neuron_link.relation_id = %(model_of)s
               AND annotation_link.relation_id = %(annotated_with)s
         '''.format(link_history_query, history_suffix, user_select=user_select), {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'model_of': relations['model_of'],
             'annotated_with': relations['annotated_with']
         })
 
-        annotations = list(cursor.fetchall())
+        for row in cursor.fetchall():
+            skeletons[row[0]][4].append(row[1:])
 
-    return [nodes, connectors, tags, reviews, annotations]
+    return skeletons
 
 
 def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
@@ -723,9 +857,7 @@ def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
             # Otherwise returns an empty list of nodes
 
     if 0 != with_connectors or 0 != with_tags:
-        # postgres is caching this query
-        cursor.execute("SELECT relation_name, id FROM relation WHERE project_id=%s" % project_id)
-        relations = dict(cursor.fetchall())
+        relations = get_relation_to_id_map(project_id, cursor=cursor)
 
     if 0 != with_connectors:
         # Fetch all inputs and outputs
@@ -949,118 +1081,28 @@ def skeleton_with_metadata(request, project_id=None, skeleton_id=None):
             'default': default
         })
 
+SkeletonMeasurements = namedtuple('SkeletonMeasurements', ['raw_cable',
+        'smooth_cable', 'principal_branch_cable', 'n_nodes', 'n_ends',
+        'n_branch', 'n_pre', 'n_post'])
+
+# Skeletons are measured together until at least this many nodes are loaded
+MEASUREMENT_BATCH_NODE_COUNT = 100000
+
+
 def _measure_skeletons(skeleton_ids):
+    return dict(_iter_measured_skeletons(skeleton_ids))
+
+def _iter_measured_skeletons(skeleton_ids):
+    """Yield (skeleton ID, measurements) tuples for all passed in skeletons
+    that have nodes. Nodes are read through a server-side cursor, ordered by
+    skeleton, so that only one batch of skeletons has to be kept in memory.
+    """
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
 
     skids_string = ",".join(map(str, skeleton_ids))
 
     cursor = connection.cursor()
-    cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Skeleton():
-        def __init__(self):
-            self.nodes = {}
-            self.raw_cable = 0
-            self.smooth_cable = 0
-            self.principal_branch_cable = 0
-            self.n_ends = 0
-            self.n_branch = 0
-            self.n_pre = 0
-            self.n_post = 0
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in six.itervalues(skeletons):
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in six.iteritems(nodes):
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in six.iteritems(nodes):
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(six.itervalues(oids))
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in six.iteritems(oids):
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in six.iteritems(nodes):
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
 
     # Count inputs
     cursor.execute('''
@@ -1073,8 +1115,7 @@ def _measure_skeletons(skeleton_ids):
     GROUP BY tc.skeleton_id
     ''' % skids_string)
 
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_pre = row[1]
+    n_pre = dict(cursor.fetchall())
 
     # Count outputs
     cursor.execute('''
@@ -1092,18 +1133,123 @@ def _measure_skeletons(skeleton_ids):
       GROUP BY tc1.skeleton_id
     ''' % skids_string)
 
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_post = row[1]
+    n_post = dict(cursor.fetchall())
 
-    return skeletons
+    node_cursor = connection.chunked_cursor()
+    try:
+        node_cursor.execute('''
+        SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
+        FROM treenode
+        WHERE skeleton_id IN (%s)
+        ORDER BY skeleton_id
+        ''' % skids_string)
+
+        # Skeletons are measured together in batches of whole skeletons
+        batch = []
+        for skeleton_id, rows in groupby(node_cursor, key=itemgetter(2)):
+            batch.extend(rows)
+            if len(batch) >= MEASUREMENT_BATCH_NODE_COUNT:
+                for result in _measure_skeleton_batch(batch, n_pre, n_post):
+                    yield result
+                batch = []
+        if batch:
+            for result in _measure_skeleton_batch(batch, n_pre, n_post):
+                yield result
+    finally:
+        node_cursor.close()
+
+def _measure_skeleton_batch(rows, n_pre, n_post):
+    """Yield (skeleton ID, SkeletonMeasurements) tuples for the passed in
+    treenode rows (id, parent_id, skeleton_id, x, y, z), which are ordered by
+    skeleton. All skeletons are measured at once as one forest.
+    """
+    arbor = Arbor([row[0] for row in rows], [row[1] for row in rows],
+            [row[3:6] for row in rows])
+    skeleton_ids, skeletons = np.unique([row[2] for row in rows],
+            return_inverse=True)
+    n_skeletons = len(skeleton_ids)
+    n_nodes = len(arbor)
+    locations = arbor.locations
+    lengths = arbor.edge_lengths()
+    children = np.flatnonzero(arbor.parents != -1)
+    parents = arbor.parents[children]
+
+    # Count end nodes and branch nodes. A root node with two children is in
+    # the middle of the skeleton, being a slab node.
+    child_counts = arbor.child_counts()
+    is_root = arbor.parents == -1
+    is_end = np.where(is_root, child_counts == 1, child_counts == 0)
+    is_branch = np.where(is_root, child_counts > 2, child_counts > 1)
+
+    # Compute weighted position for slab nodes only (root, branch and end
+    # nodes do not move): the average of its neighbors' positions, weighted
+    # by their distance, contributes 60%.
+    is_slab = ~(is_end | is_branch)
+    weights = np.bincount(children, lengths[children], n_nodes) + \
+            np.bincount(parents, lengths[children], n_nodes)
+    neighbors = np.empty((n_nodes, 3))
+    for dim in range(3):
+        neighbors[:, dim] = \
+                np.bincount(children, lengths[children] * locations[parents, dim], n_nodes) + \
+                np.bincount(parents, lengths[children] * locations[children, dim], n_nodes)
+    has_weights = weights != 0
+    neighbors[has_weights] /= weights[has_weights, np.newaxis]
+    neighbors[~has_weights] = 0
+    smoothed = locations.copy()
+    smoothed[is_slab] = locations[is_slab] * 0.4 + neighbors[is_slab] * 0.6
+
+    smooth_lengths = np.zeros(n_nodes)
+    smooth_lengths[children] = np.linalg.norm(smoothed[children] -
+            smoothed[parents], axis=1)
+
+    # The principal branch runs from the deepest node of each skeleton to its
+    # root.
+    order = np.lexsort((arbor.depths(), skeletons))
+    deepest = order[np.append(np.diff(skeletons[order]) != 0, True)]
+    is_principal = np.zeros(n_nodes, dtype=np.bool_)
+    while len(deepest):
+        is_principal[deepest] = True
+        deepest = arbor.parents[deepest]
+        deepest = deepest[deepest != -1]
+
+    def per_skeleton(values):
+        return np.bincount(skeletons, values, n_skeletons).tolist()
+
+    measurements = zip(per_skeleton(lengths), per_skeleton(smooth_lengths),
+            per_skeleton(smooth_lengths * is_principal),
+            np.bincount(skeletons, minlength=n_skeletons).tolist(),
+            per_skeleton(is_end), per_skeleton(is_branch))
+
+    for skeleton_id, m in zip(skeleton_ids.tolist(), measurements):
+        yield skeleton_id, SkeletonMeasurements(m[0], m[1], m[2], m[3],
+                int(m[4]), int(m[5]), n_pre.get(skeleton_id, 0),
+                n_post.get(skeleton_id, 0))
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in six.iteritems(request.POST) if k.startswith('skeleton_ids['))
+    # Input has to be validated before a streaming response is started
+    if not skeleton_ids:
+        raise ValueError("Must provide the ID of at least one skeleton.")
+    stream = request.POST.get('stream', 'false') == 'true'
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
-    return JsonResponse([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()], safe=False)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+    rows = (asRow(skid, sk) for skid, sk in _iter_measured_skeletons(skeleton_ids))
+    if stream:
+        return StreamingHttpResponse(stream_json_list(rows),
+                content_type='application/json')
+    return JsonResponse(list(rows), safe=False)
+
+
+def stream_json_list(items):
+    """Encode the passed in items incrementally as JSON list."""
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item, separators=(',', ':'), default=default)
+        separator = ','
+    yield ']'
 
 
 def _skeleton_neuroml_cell(skeleton_id, preID, postID):
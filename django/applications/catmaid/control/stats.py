@@ -2,10 +2,13 @@
 from __future__ import unicode_literals
 
 import json
+import six
 import time
 import pytz
 from datetime import timedelta, datetime
 from dateutil import parser as dateparser
+from multiprocessing.pool import ThreadPool
+from six import print_
 
 from django.conf import settings
 from django.http import JsonResponse
@@ -702,66 +705,298 @@ def select_review_stats(cursor, project_id, start_date_utc, end_date_utc,
 
     return cursor.fetchall()
 
+# Columns of the statistics summary table that are populated independently
+# from each other. Each one has its own checkpoint.
+STATS_SUMMARY_METRICS = ('n_reviewed_nodes', 'n_connector_links',
+        'cable_length', 'n_treenodes', 'n_imported_treenodes')
+
+# Checkpoints of this name store the execution time of the last transaction
+# that has been respected by update_recent_stats_summary().
+STATS_SUMMARY_TRANSACTION_LOG = 'transaction_log'
+
+# How far the transaction log is read again before the last known position
+STATS_SUMMARY_TRANSACTION_LOG_OVERLAP = timedelta(minutes=5)
+
+
+def get_stats_summary_range(project_id, metric, incremental=True, cursor=None):
+    """Return the (start, end) time range for which the passed in metric has to
+    be (re)computed. The end is the beginning of the current hour and the start
+    is one hour before the checkpoint of the last computation, which is done
+    to increase robustness. A start of None means no lower bound, which is the
+    case without checkpoint or if <incremental> is false.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    cursor.execute("""
+        SELECT date_trunc('hour', CURRENT_TIMESTAMP),
+            (SELECT last_update - interval '1 hour'
+             FROM catmaid_stats_summary_checkpoint
+             WHERE project_id = %(project_id)s
+             AND metric = %(metric)s
+             AND %(incremental)s)
+    """, dict(project_id=project_id, metric=metric, incremental=incremental))
+    end, start = cursor.fetchone()
+    return start, end
+
+def set_stats_summary_checkpoint(project_id, metric, last_update, cursor=None):
+    """Store that the passed in metric has been computed for all hours before
+    <last_update>.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    cursor.execute("""
+        INSERT INTO catmaid_stats_summary_checkpoint (project_id, metric,
+                last_update)
+        VALUES (%(project_id)s, %(metric)s, %(last_update)s)
+        ON CONFLICT (project_id, metric) DO UPDATE
+        SET last_update = EXCLUDED.last_update
+    """, dict(project_id=project_id, metric=metric, last_update=last_update))
+
+def get_stats_summary_partitions(project_id, metric, start, end,
+        partition_hours=24*30, cursor=None):
+    """Split the time range [start, end) into a list of (start, end) tuples of
+    at most <partition_hours> hours, which can be computed independently. All
+    boundaries are full hours. Without a start, the range begins with the
+    first data relevant for the metric.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    if start is None:
+        cursor.execute("""
+            SELECT date_trunc('hour', MIN(t))
+            FROM {} WHERE project_id = %(project_id)s
+        """.format(STATS_SUMMARY_SOURCES[metric]), dict(project_id=project_id))
+        start = cursor.fetchone()[0]
+        if start is None:
+            return []
+
+    partitions = []
+    partition_size = timedelta(hours=partition_hours)
+    while start < end:
+        partitions.append((start, min(start + partition_size, end)))
+        start += partition_size
+    return partitions
+
 @transaction.atomic
 def populate_stats_summary(project_id, delete=False, incremental=True):
-    """Create statistics summary tables from scratch until yesterday.
+    """Create statistics summary tables from scratch until the current hour.
     """
     cursor = connection.cursor()
     if delete:
         cursor.execute("""
-            DELETE FROM catmaid_stats_summary WHERE project_id = %(project_id)s
+            DELETE FROM catmaid_stats_summary WHERE project_id = %(project_id)s;
+            DELETE FROM catmaid_stats_summary_checkpoint WHERE project_id = %(project_id)s;
         """, dict(project_id=project_id))
 
-    populate_review_stats_summary(project_id, incremental, cursor)
-    populate_connector_stats_summary(project_id, incremental, cursor)
-    populate_cable_stats_summary(project_id, incremental, cursor)
-    populate_nodecount_stats_summary(project_id, incremental, cursor)
-    populate_import_nodecount_stats_summary(project_id, incremental, cursor)
+    for metric in STATS_SUMMARY_METRICS:
+        start, end = get_stats_summary_range(project_id, metric, incremental,
+                cursor)
+        STATS_SUMMARY_POPULATORS[metric](project_id, start, end, cursor)
+        set_stats_summary_checkpoint(project_id, metric, end, cursor)
+
+def _populate_stats_summary_task(task):
+    """Compute a single metric of a single project for one time partition in
+    its own transaction.
+    """
+    project_id, metric, start, end = task
+    with transaction.atomic():
+        STATS_SUMMARY_POPULATORS[metric](project_id, start, end)
+    return task
+
+def _populate_stats_summary_worker(task):
+    """Pool entry point for _populate_stats_summary_task(). Each worker thread
+    uses its own database connection.
+    """
+    try:
+        return _populate_stats_summary_task(task)
+    finally:
+        connection.close()
+
+def populate_stats_summary_parallel(project_ids, delete=False,
+        incremental=True, jobs=None, partition_hours=24*30, log=print_):
+    """Update the statistics summary of all passed in projects like
+    populate_stats_summary(), but compute all metrics of all projects
+    concurrently, using a pool of <jobs> worker threads (by default one per
+    CPU), each with its own database connection. With a single job, all
+    partitions are computed in the calling thread. Longer time ranges, like
+    those of a non-incremental update, are split into partitions of
+    <partition_hours> hours. The checkpoint of a metric is only updated once
+    all its partitions have been computed.
+    """
+    cursor = connection.cursor()
+    if delete:
+        cursor.execute("""
+            DELETE FROM catmaid_stats_summary
+            WHERE project_id = ANY(%(project_ids)s::integer[]);
+            DELETE FROM catmaid_stats_summary_checkpoint
+            WHERE project_id = ANY(%(project_ids)s::integer[]);
+        """, dict(project_ids=list(project_ids)))
+
+    tasks = []
+    open_partitions = {}
+    checkpoints = {}
+    for project_id in project_ids:
+        for metric in STATS_SUMMARY_METRICS:
+            start, end = get_stats_summary_range(project_id, metric,
+                    incremental, cursor)
+            partitions = get_stats_summary_partitions(project_id, metric,
+                    start, end, partition_hours, cursor)
+            if partitions:
+                tasks.extend((project_id, metric, p_start, p_end)
+                        for p_start, p_end in partitions)
+                open_partitions[(project_id, metric)] = len(partitions)
+                checkpoints[(project_id, metric)] = end
+            else:
+                set_stats_summary_checkpoint(project_id, metric, end, cursor)
+
+    if not tasks:
+        log(' -> Nothing to update')
+        return
+
+    # Statistics are computed by the database, which is why threads are
+    # sufficient and work also from within daemonic processes, like Celery
+    # workers. Different metrics of the same hours update the same summary
+    # rows concurrently. To avoid deadlocks, all populators insert their rows
+    # ordered by user and date, i.e. they lock them in the same order.
+    def complete(n, task):
+        project_id, metric = task[0], task[1]
+        open_partitions[(project_id, metric)] -= 1
+        if open_partitions[(project_id, metric)] == 0:
+            set_stats_summary_checkpoint(project_id, metric,
+                    checkpoints[(project_id, metric)], cursor)
+        log(' -> Computed {} of project {} from {} to {} ({}/{})'.format(
+                metric, project_id, task[2], task[3], n + 1, len(tasks)))
+
+    if jobs == 1:
+        for n, task in enumerate(tasks):
+            complete(n, _populate_stats_summary_task(task))
+        return
+
+    pool = ThreadPool(jobs)
+    try:
+        for n, task in enumerate(pool.imap_unordered(
+                _populate_stats_summary_worker, tasks)):
+            complete(n, task)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def get_recent_stats_summary_hours(project_ids=None, cursor=None):
+    """Find all hours with transactions that happened after the transaction
+    log position of each project. Returns a dictionary that maps project IDs
+    to a tuple of the hours to update and the new log position. Without
+    stored position, the log is read from one hour before the earliest metric
+    checkpoint. Projects without any checkpoint have no statistics summary
+    yet and are ignored.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+
+    # Transactions are visible only after they are committed, but their
+    # execution time is the start of the transaction. Reading the log with an
+    # overlap makes sure slower transactions aren't missed. Hours are
+    # recomputed as a whole, which makes reading a transaction twice harmless.
+    cursor.execute("""
+        WITH log_position AS (
+            SELECT project_id,
+                COALESCE(
+                    MAX(last_update) FILTER (WHERE metric = %(log_metric)s),
+                    MIN(last_update) - interval '1 hour') - %(overlap)s AS position
+            FROM catmaid_stats_summary_checkpoint
+            WHERE %(project_ids)s::integer[] IS NULL
+                OR project_id = ANY(%(project_ids)s::integer[])
+            GROUP BY project_id
+        )
+        SELECT cti.project_id,
+            array_agg(DISTINCT date_trunc('hour', cti.execution_time)),
+            MAX(cti.execution_time)
+        FROM log_position lp
+        JOIN catmaid_transaction_info cti
+            ON cti.project_id = lp.project_id
+            AND cti.execution_time > lp.position
+        WHERE cti.execution_time > (SELECT MIN(position) FROM log_position)
+        GROUP BY cti.project_id
+    """, {
+        'log_metric': STATS_SUMMARY_TRANSACTION_LOG,
+        'overlap': STATS_SUMMARY_TRANSACTION_LOG_OVERLAP,
+        'project_ids': list(project_ids) if project_ids is not None else None,
+    })
+
+    return dict((project_id, (sorted(hours), position))
+            for project_id, hours, position in cursor.fetchall())
 
-def populate_review_stats_summary(project_id, incremental=True, cursor=None):
+def update_recent_stats_summary(project_ids=None, log=print_):
+    """Update the statistics summary of all hours, including the current one,
+    in which transactions happened since the last update. This follows the
+    transaction log, which makes it cheap enough to run every few minutes.
+    Each hour of a project is updated in its own database transaction. The
+    regular population with populate_stats_summary() stays the authoritative
+    source for past hours and doesn't depend on this.
+    """
+    cursor = connection.cursor()
+    recent_hours = get_recent_stats_summary_hours(project_ids, cursor)
+    if not recent_hours:
+        log(' -> Nothing to update')
+        return
+
+    for project_id, (hours, position) in six.iteritems(recent_hours):
+        for hour in hours:
+            with transaction.atomic():
+                for metric in STATS_SUMMARY_METRICS:
+                    STATS_SUMMARY_POPULATORS[metric](project_id, hour,
+                            hour + timedelta(hours=1), cursor)
+        set_stats_summary_checkpoint(project_id,
+                STATS_SUMMARY_TRANSACTION_LOG, position, cursor)
+        log(' -> Updated {} hour(s) of project {}'.format(len(hours), project_id))
+
+def populate_review_stats_summary(project_id, start=None, end=None,
+        cursor=None):
     """Add review summary information to the summary table. Create hourly
     aggregates in UTC time. These aggregates can still be moved in other
-    timezones with good enough precision for our purpose. By default, this
-    happens in an incremental manner, but can optionally be fone for all data
-    from scratch (overriding existing statistics).
+    timezones with good enough precision for our purpose. Only reviews in the
+    time range [<start>, <end>) are counted, existing statistics of this range
+    are overridden. Both boundaries have to be full hours, no start means no
+    lower bound and no end means the beginning of the current hour.
     """
     if not cursor:
         cursor = connection.cursor()
 
     # Add reviewer info
     cursor.execute("""
-        WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
-                ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
-                    '-infinity') END AS max_date
-            FROM catmaid_stats_summary
-            WHERE project_id=%(project_id)s
-                AND n_reviewed_nodes > 0
-        ),
-        review_info AS (
+        WITH review_info AS (
             SELECT r.reviewer_id AS user_id,
                 date_trunc('hour', r.review_time) AS date,
                 count(*) AS n_reviewed_nodes
-            FROM review r, last_precomputation
+            FROM review r
             WHERE r.project_id = %(project_id)s
-            AND r.review_time > last_precomputation.max_date
-            AND r.review_time < date_trunc('hour', CURRENT_TIMESTAMP)
+            AND r.review_time >= COALESCE(%(start)s::timestamptz, '-infinity')
+            AND r.review_time < COALESCE(%(end)s::timestamptz,
+                date_trunc('hour', CURRENT_TIMESTAMP))
             GROUP BY r.reviewer_id, date
         )
         INSERT INTO catmaid_stats_summary (project_id, user_id, date,
                 n_reviewed_nodes)
         SELECT %(project_id)s, ri.user_id, ri.date, ri.n_reviewed_nodes
         FROM review_info ri
+        ORDER BY ri.user_id, ri.date
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET n_reviewed_nodes = EXCLUDED.n_reviewed_nodes;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, start=start, end=end))
 
-def populate_connector_stats_summary(project_id, incremental=True, cursor=None):
+def populate_connector_stats_summary(project_id, start=None, end=None,
+        cursor=None):
     """Add connector summary information to the summary table. Create hourly
     aggregates in UTC time. These aggregates can still be moved in other
-    timezones with good enough precision for our purpose. By default, this
-    happens in an incremental manner, but can optionally be fone for all data
-    from scratch (overriding existing statistics).
+    timezones with good enough precision for our purpose. Only links created
+    in the time range [<start>, <end>) are counted, existing statistics of
+    this range are overridden. Both boundaries have to be full hours, no start
+    means no lower bound and no end means the beginning of the current hour.
     """
     if not cursor:
         cursor = connection.cursor()
@@ -770,23 +1005,16 @@ def populate_connector_stats_summary(project_id, incremental=True, cursor=None):
     pre_id, post_id = relations.get('presynaptic_to'), relations.get('postsynaptic_to')
     if pre_id and post_id:
         cursor.execute("""
-            WITH last_precomputation AS (
-                SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
-                    ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
-                        '-infinity') END AS max_date
-                FROM catmaid_stats_summary
-                WHERE project_id=%(project_id)s
-                    AND n_connector_links > 0
-            ),
-            connector_info AS (
+            WITH connector_info AS (
                 SELECT t1.user_id,
                     date_trunc('hour', t1.creation_time) AS date,
                     count(*) AS n_connector_links
-                FROM last_precomputation, treenode_connector t1
+                FROM treenode_connector t1
                 JOIN treenode_connector t2 ON t1.connector_id = t2.connector_id
                 WHERE t1.project_id=%(project_id)s
-                AND t1.creation_time >= last_precomputation.max_date
-                AND t1.creation_time < date_trunc('hour', CURRENT_TIMESTAMP)
+                AND t1.creation_time >= COALESCE(%(start)s::timestamptz, '-infinity')
+                AND t1.creation_time < COALESCE(%(end)s::timestamptz,
+                    date_trunc('hour', CURRENT_TIMESTAMP))
                 AND t1.relation_id <> t2.relation_id
                 AND (t1.relation_id = %(pre_id)s OR t1.relation_id = %(post_id)s)
                 AND (t2.relation_id = %(pre_id)s OR t2.relation_id = %(post_id)s)
@@ -797,29 +1025,25 @@ def populate_connector_stats_summary(project_id, incremental=True, cursor=None):
                     n_connector_links)
             SELECT %(project_id)s, ci.user_id, ci.date, ci.n_connector_links
             FROM connector_info ci
+            ORDER BY ci.user_id, ci.date
             ON CONFLICT (project_id, user_id, date) DO UPDATE
             SET n_connector_links = EXCLUDED.n_connector_links;
         """, dict(project_id=project_id, pre_id=pre_id, post_id=post_id,
-                  incremental=incremental))
-
-def populate_cable_stats_summary(project_id, incremental=True, cursor=None):
-    """Add cable length summary data to the statistics summary table. By
-    default, this happens in an incremental manner, but can optionally be fone
-    for all data from scratch (overriding existing statistics).
+                  start=start, end=end))
+
+def populate_cable_stats_summary(project_id, start=None, end=None,
+        cursor=None):
+    """Add cable length summary data to the statistics summary table. Only
+    nodes created in the time range [<start>, <end>) are respected, existing
+    statistics of this range are overridden. Both boundaries have to be full
+    hours, no start means no lower bound and no end means the beginning of the
+    current hour.
     """
     if not cursor:
         cursor = connection.cursor()
 
     cursor.execute("""
-        WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
-                ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
-                    '-infinity') END AS max_date
-            FROM catmaid_stats_summary
-            WHERE project_id=%(project_id)s
-                AND cable_length > 0
-        ),
-        cable_info AS (
+        WITH cable_info AS (
             SELECT child.uid AS user_id,
                 child.date AS date,
                 SUM(edge.length) AS cable_length
@@ -831,10 +1055,11 @@ def populate_cable_stats_summary(project_id, incremental=True, cursor=None):
                     child.location_x,
                     child.location_y,
                     child.location_z
-                FROM treenode child, last_precomputation
+                FROM treenode child
                 WHERE child.project_id = %(project_id)s
-                  AND child.creation_time >= last_precomputation.max_date
-                  AND child.creation_time < date_trunc('hour', CURRENT_TIMESTAMP)
+                  AND child.creation_time >= COALESCE(%(start)s::timestamptz, '-infinity')
+                  AND child.creation_time < COALESCE(%(end)s::timestamptz,
+                      date_trunc('hour', CURRENT_TIMESTAMP))
             ) AS child
             INNER JOIN LATERAL (
                 SELECT sqrt(pow(child.location_x - parent.location_x, 2)
@@ -851,85 +1076,77 @@ def populate_cable_stats_summary(project_id, incremental=True, cursor=None):
                 cable_length)
         SELECT %(project_id)s, ci.user_id, ci.date, ci.cable_length
         FROM cable_info ci
+        ORDER BY ci.user_id, ci.date
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET cable_length = EXCLUDED.cable_length;
-    """, dict(project_id=project_id, incremental=incremental))
-
-def populate_nodecount_stats_summary(project_id, incremental=True,
-                                     cursor=None):
-    """Add node count summary data to the statistics summary table. By default,
-    this happens in an incremental manner, but can optionally be fone for all
-    data from scratch (overriding existing statistics).
+    """, dict(project_id=project_id, start=start, end=end))
+
+def populate_nodecount_stats_summary(project_id, start=None, end=None,
+        cursor=None):
+    """Add node count summary data to the statistics summary table. Only nodes
+    created in the time range [<start>, <end>) are counted, existing
+    statistics of this range are overridden. Both boundaries have to be full
+    hours, no start means no lower bound and no end means the beginning of the
+    current hour.
     """
     if not cursor:
         cursor = connection.cursor()
 
-    # Add node count incrementally by finding the last precomputed treenode
-    # count value above zero for the passed in project and (re)compute
-    # statistics starting one hour before. This means, some statistics
-    # might be recomputed, which is done to increase reobustness.
     cursor.execute("""
-        WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
-                ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
-                    '-infinity') END AS max_date
-            FROM catmaid_stats_summary
-            WHERE project_id=%(project_id)s
-                AND n_treenodes > 0
-        ),
-        node_info AS (
+        WITH node_info AS (
             SELECT user_id,
                 date_trunc('hour', creation_time) AS date,
                 count(*) as node_count
-            FROM treenode, last_precomputation
+            FROM treenode
             WHERE project_id=%(project_id)s
-            AND creation_time >= last_precomputation.max_date
+            AND creation_time >= COALESCE(%(start)s::timestamptz, '-infinity')
+            AND creation_time < COALESCE(%(end)s::timestamptz,
+                date_trunc('hour', CURRENT_TIMESTAMP))
             GROUP BY 1, 2
         )
         INSERT INTO catmaid_stats_summary (project_id, user_id, date,
                 n_treenodes)
         SELECT %(project_id)s, ni.user_id, ni.date, ni.node_count
         FROM node_info ni
+        ORDER BY ni.user_id, ni.date
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET n_treenodes = EXCLUDED.n_treenodes;
-    """, dict(project_id=project_id, incremental=incremental))
-
-def populate_import_nodecount_stats_summary(project_id, incremental=True,
-                                            cursor=None):
-    """Add import node count summary data to the statistics summary table. By
-    default, this happens in an incremental manner, but can optionally be fone
-    for all data from scratch (overriding existing statistics).
+    """, dict(project_id=project_id, start=start, end=end))
+
+def populate_import_nodecount_stats_summary(project_id, start=None, end=None,
+        cursor=None):
+    """Add import node count summary data to the statistics summary table.
+    Only nodes imported in the time range [<start>, <end>) are counted,
+    existing statistics of this range are overridden. Both boundaries have to
+    be full hours, no start means no lower bound and no end means the beginning
+    of the current hour.
     """
     if not cursor:
         cursor = connection.cursor()
 
-    # Add import node count incrementally by finding the last precomputed
-    # import treenode count value above zero for the passed in project and
-    # (re)compute statistics starting one hour before. This means, some
-    # statistics might be recomputed, which is done to increase reobustness.
+    # Import transactions are found first, which allows to only look at the
+    # node history of these transactions.
     cursor.execute("""
-        WITH last_precomputation AS (
-            SELECT CASE WHEN %(incremental)s = FALSE THEN '-infinity'
-                ELSE COALESCE(date_trunc('hour', MAX(date)) - interval '1 hour',
-                    '-infinity') END AS max_date
-            FROM catmaid_stats_summary
-            WHERE project_id=%(project_id)s
-                AND n_imported_treenodes > 0
+        WITH transactions AS (
+            SELECT cti.transaction_id, cti.execution_time
+            FROM catmaid_transaction_info cti
+            WHERE cti.project_id = %(project_id)s
+            AND cti.execution_time >= COALESCE(%(start)s::timestamptz, '-infinity')
+            AND cti.execution_time < COALESCE(%(end)s::timestamptz,
+                date_trunc('hour', CURRENT_TIMESTAMP))
+            AND cti.label = 'skeletons.import'
         ),
         node_info AS (
             SELECT sorted_row_history.user_id AS user_id,
                 date_trunc('hour', sorted_row_history.creation_time) AS date,
                 count(*) AS node_count
             FROM (
-                SELECT DISTINCT t.id, t.user_id, t.creation_time,
+                SELECT t.id, t.user_id, t.creation_time,
                     ROW_NUMBER() OVER(PARTITION BY t.id ORDER BY t.edition_time) AS n
-                FROM last_precomputation, treenode__with_history t
-                JOIN catmaid_transaction_info cti
-                  ON t.txid = cti.transaction_id
-                WHERE cti.project_id = %(project_id)s
-                  AND t.creation_time = cti.execution_time
-                  AND t.creation_time >= last_precomputation.max_date
-                  AND label = 'skeletons.import'
+                FROM transactions tx
+                JOIN treenode__with_history t
+                  ON t.txid = tx.transaction_id
+                WHERE t.creation_time = tx.execution_time
             ) sorted_row_history
             WHERE sorted_row_history.n = 1
             GROUP BY 1, 2
@@ -938,6 +1155,28 @@ def populate_import_nodecount_stats_summary(project_id, incremental=True,
                 n_imported_treenodes)
         SELECT %(project_id)s, ni.user_id, ni.date, ni.node_count
         FROM node_info ni
+        ORDER BY ni.user_id, ni.date
         ON CONFLICT (project_id, user_id, date) DO UPDATE
         SET n_imported_treenodes = EXCLUDED.n_imported_treenodes;
-    """, dict(project_id=project_id, incremental=incremental))
+    """, dict(project_id=project_id, start=start, end=end))
+
+STATS_SUMMARY_POPULATORS = {
+    'n_reviewed_nodes': populate_review_stats_summary,
+    'n_connector_links': populate_connector_stats_summary,
+    'cable_length': populate_cable_stats_summary,
+    'n_treenodes': populate_nodecount_stats_summary,
+    'n_imported_treenodes': populate_import_nodecount_stats_summary,
+}
+
+# Time stamps (t) of the data each metric is computed from
+STATS_SUMMARY_SOURCES = {
+    'n_reviewed_nodes': '(SELECT project_id, review_time AS t FROM review) r',
+    'n_connector_links': '(SELECT project_id, creation_time AS t FROM treenode_connector) tc',
+    'cable_length': '(SELECT project_id, creation_time AS t FROM treenode) t',
+    'n_treenodes': '(SELECT project_id, creation_time AS t FROM treenode) t',
+    'n_imported_treenodes': """(
+        SELECT project_id, execution_time AS t
+        FROM catmaid_transaction_info
+        WHERE label = 'skeletons.import'
+    ) cti""",
+}
@@ -1,114 +1,232 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import logging
 import six
 import numpy as np
-from numpy import array, float32
 from numpy.linalg import norm
 import networkx as nx
 from collections import namedtuple
 
-logger = logging.getLogger(__name__)
-
-try:
-    from scipy.sparse.csgraph import dijkstra
-except ImportError:
-    logger.warning("CATMAID was unable to load the scipy module. "
-        "Synapse clustering won't be available")
-
 from catmaid.control.common import get_relation_to_id_map
+from catmaid.control.tree_util import Arbor, tree_levels
 from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
 
 
+SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
+
+# exp(-x) is zero in double precision for x larger than this
+KERNEL_CUTOFF = 746.0
+
+
 def synapse_clustering( skeleton_id, h_list ):
 
-    Gwud = createSpatialGraphFromSkeletonID( skeleton_id )
+    node_ids, parents, lengths = spatialTreeFromSkeletonID( skeleton_id )
     synNodes, connector_ids, relations = synapseNodesFromSkeletonID( skeleton_id )
 
-    return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
+    return tree_max_density_arrays(node_ids, parents, lengths, synNodes,
+            connector_ids, relations, h_list)
 
 
-def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
-    """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+def tree_max_density(G, synNodes, connector_ids, relations, h_list, locations=None):
+    """ G: networkx tree or forest. If it is directed, edges point from parent to child.
         synNodes: list of node IDs where there is a synapse.
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
+        locations: optional dictionary of node ID vs x, y, z tuple. If not
+        provided, edge lengths are read from the 'weight' edge property.
     """
+    node_ids, parents, lengths = graphToTree( G, locations )
+    return tree_max_density_arrays(node_ids, parents, lengths, synNodes,
+            connector_ids, relations, h_list)
+
+
+def tree_max_density_arrays(node_ids, parents, lengths, synNodes,
+        connector_ids, relations, h_list):
+    """ Find synapse groups by hill climbing on the synapse density of a tree,
+    for each bandwidth in h_list. The tree is given as array of node IDs and
+    synchronized arrays of parent indices (-1 for roots) and edge lengths to
+    the parent, see tree_arrays(). synNodes, connector_ids and relations are
+    synchronized lists like for tree_max_density(). Returns a dictionary of
+    bandwidth vs dictionary of group index vs SynapseGroup.
+    """
+    node_ids = np.asarray(node_ids)
+    index = {node: i for i, node in enumerate(node_ids.tolist())}
+    synIndices = np.fromiter((index[node] for node in synNodes), dtype=np.int64,
+            count=len(synNodes))
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
+    # Each synapse node contributes only once to the density
+    D = geodesicDistances(parents, lengths, np.unique(synIndices))
+    density = densityField(D, h_list)
 
-    SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
+    for i, h in enumerate(h_list):
+        targLoc = hillClimb(parents, density[:, i])[synIndices]
+        uniqueTargs, groupIndices = np.unique(targLoc, return_inverse=True)
 
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-
-        targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:
-                currNode = startNode
-                allOnPath = []
-
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
-                while True:
-                    allOnPath.append(currNode)
-
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
+        synapseGroups[h] = groups = {}
+        for ind, val in enumerate(node_ids[uniqueTargs].tolist()):
+            groups[ind] = SynapseGroup([], [], [], val)
 
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-
-                    if currNode == prevNode:
-                        break
-
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
-
-        loc2group = {}
-
-        synapseGroups[h] = {}
-        for ind, val in enumerate(uniqueTargs):
-            loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
-
-        for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
-            synapseGroups[h][ gi ].node_ids.append( node )
-            synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
-            synapseGroups[h][ gi ].relations.append( relations[ind] )
+        for ind, gi in enumerate(groupIndices.tolist()):
+            groups[gi].node_ids.append( synNodes[ind] )
+            groups[gi].connector_ids.append( connector_ids[ind] )
+            groups[gi].relations.append( relations[ind] )
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
-    nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
+def tree_arrays(node_ids, parent_ids, locations):
+    """ Return an array of parent indices (-1 for roots) and the lengths of
+    the edges to the parents for the passed in node IDs, parent IDs (None for
+    roots) and node locations (N x 3). Nodes with a parent that isn't part of
+    node_ids are treated like roots.
+    """
+    arbor = Arbor(node_ids, parent_ids, locations)
+    return arbor.parents, arbor.edge_lengths()
+
+def graphToTree( G, locations=None ):
+    """ Return node IDs, parent indices and edge lengths of a networkx tree or
+    forest, see tree_max_density(). """
+    node_ids = list(G.nodes())
+    index = {node: i for i, node in enumerate(node_ids)}
+    parents = np.full(len(node_ids), -1, dtype=np.int64)
+
+    if G.is_directed():
+        edges = G.edges()
+    else:
+        # Orient edges away from an arbitrary root of each component
+        edges = [edge for component in nx.connected_components(G)
+                 for edge in nx.bfs_edges(G, next(iter(component)))]
 
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
+    for parent, child in edges:
+        parents[index[child]] = index[parent]
 
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+    if locations is None:
+        lengths = np.zeros(len(node_ids))
+        for parent, child in edges:
+            lengths[index[child]] = G[parent][child]['weight']
+    else:
+        has_parent = parents != -1
+        xyz = np.array([locations[node] for node in node_ids],
+                dtype=np.float64).reshape(-1, 3)
+        lengths = np.zeros(len(node_ids))
+        lengths[has_parent] = norm(xyz[has_parent] - xyz[parents[has_parent]], axis=1)
+
+    return np.array(node_ids), parents, lengths
+
+def nearestKeyNodes( pointers, isKey, lengths=None ):
+    """ Follow the passed in pointers (node indices, -1 for none) from each node
+    until a key node is reached. Returns the reached node index for each node
+    and, if lengths are passed in, the summed length of the followed edges. """
+    target = pointers.copy()
+    distance = None if lengths is None else lengths.copy()
+    # Pointer jumping: each iteration doubles the covered path length
+    while True:
+        follow = np.flatnonzero(target != -1)
+        follow = follow[~isKey[target[follow]]]
+        if not len(follow):
+            return target, distance
+        nextTarget = target[follow]
+        if distance is not None:
+            distance[follow] += distance[nextTarget]
+        target[follow] = target[nextTarget]
+
+def geodesicDistances( parents, lengths, sources ):
+    """ Return an N x M matrix with the path length along the tree between
+    each of the N nodes and each of the M source node indices. Nodes in
+    different components have an infinite distance. Instead of searching paths
+    from each source, distances are propagated for all sources at once, up to
+    the roots and down again. This is done only for key nodes (roots, leaves,
+    branch nodes and sources), distances of the nodes in between are
+    interpolated from both ends of their unbranched chain. """
+    n = len(parents)
+    D = np.empty((n, len(sources)))
+    hasParent = parents != -1
+    isKey = ~hasParent
+    isKey[np.bincount(parents[hasParent], minlength=n) != 1] = True
+    isKey[sources] = True
+
+    # Tree of key nodes with the path lengths between them as edge lengths
+    keyAncestors, keyDistances = nearestKeyNodes(parents, isKey, lengths)
+    keys = np.flatnonzero(isKey)
+    keyIndices = np.full(n, -1, dtype=np.int64)
+    keyIndices[keys] = np.arange(len(keys))
+    keyParents = keyAncestors[keys]
+    keyParents[keyParents != -1] = keyIndices[keyParents[keyParents != -1]]
+    keyLengths = keyDistances[keys]
+
+    DK = np.full((len(keys), len(sources)), np.inf)
+    DK[keyIndices[sources], np.arange(len(sources))] = 0
+    levels = tree_levels(keyParents)
+    # Shortest distances to sources in the subtree of each node
+    for nodes in reversed(levels[1:]):
+        np.minimum.at(DK, keyParents[nodes], DK[nodes] + keyLengths[nodes, np.newaxis])
+    # Shortest distances through the parent
+    for nodes in levels[1:]:
+        DK[nodes] = np.minimum(DK[nodes],
+                DK[keyParents[nodes]] + keyLengths[nodes, np.newaxis])
+    D[keys] = DK
+
+    # Nodes in unbranched chains between a key ancestor and key descendant
+    chain = np.flatnonzero(~isKey)
+    if len(chain):
+        children = np.full(n, -1, dtype=np.int64)
+        children[parents[hasParent]] = np.flatnonzero(hasParent)
+        keyDescendants = nearestKeyNodes(children, isKey)[0][chain]
+        up = keyDistances[chain]
+        down = keyDistances[keyDescendants] - up
+        D[chain] = np.minimum(D[keyAncestors[chain]] + up[:, np.newaxis],
+                D[keyDescendants] + down[:, np.newaxis])
+    return D
+
+def densityField( D, h_list ):
+    """ Return an N x len(h_list) matrix with the sum of Gaussian kernels of the
+    distances to all sources for each node and bandwidth. If only few distances
+    have a kernel value that doesn't underflow to zero, only those are
+    evaluated. """
+    D2 = np.square(D)
+    density = np.empty((len(D), len(h_list)))
+    for i, h in enumerate(h_list):
+        h2 = float(h) * float(h)
+        near = D2 < KERNEL_CUTOFF * h2
+        if np.count_nonzero(near) > near.size // 4:
+            kernels = np.multiply(D2, -1.0 / h2)
+            density[:, i] = np.exp(kernels, out=kernels).sum(axis=1)
+        else:
+            rows, cols = np.nonzero(near)
+            density[:, i] = np.bincount(rows, minlength=len(D),
+                    weights=np.exp(D2[rows, cols] * (-1.0 / h2)))
+    return density
+
+def hillClimb( parents, densityField ):
+    """ Return for each node index the index of the local density maximum that
+    is reached by moving repeatedly to the neighbor with the highest density,
+    as long as that increases the density. """
+    n = len(parents)
+    best = np.arange(n)
+    bestDensity = densityField.copy()
+
+    # Densest child of each node
+    children = np.flatnonzero(parents != -1)
+    if len(children):
+        childParents = parents[children]
+        order = np.lexsort((densityField[children], childParents))
+        last = np.append(np.diff(childParents[order]) != 0, True)
+        densest = children[order[last]]
+        densestParents = parents[densest]
+        better = densityField[densest] > bestDensity[densestParents]
+        best[densestParents[better]] = densest[better]
+        bestDensity[densestParents[better]] = densityField[densest[better]]
+
+        better = densityField[childParents] > bestDensity[children]
+        best[children[better]] = childParents[better]
+
+    # Follow the ascent until all nodes point to a local maximum
+    while True:
+        next_best = best[best]
+        if np.array_equal(next_best, best):
+            return best
+        best = next_best
 
 def countTargets( skeleton_id ):
     nTargets = {}
@@ -120,20 +238,16 @@ def countTargets( skeleton_id ):
             nTargets[cid] = TreenodeConnector.objects.filter(connector_id=cid,relation_id=PRE).count()
     return nTargets
 
-def createSpatialGraphFromSkeletonID(sid):
-    # retrieve all nodes of the skeleton
+def spatialTreeFromSkeletonID(sid):
+    """ Return node IDs, parent indices and edge lengths of a skeleton, see
+    tree_arrays(). """
     treenode_qs = Treenode.objects.filter(skeleton_id=sid).values_list(
         'id', 'parent_id', 'location_x', 'location_y', 'location_z')
-    # build the networkx graph from it
-    G = nx.Graph()
-    locations = {}
-    for tnid, parent_id, location_x, location_y, location_z in treenode_qs:
-        if parent_id:
-            G.add_edge(parent_id, tnid)
-        locations[tnid] = array((location_x, location_y, location_z), dtype=float32)
-    for iFrom, iTo in G.edges(data=False):
-        G[iFrom][iTo]['weight'] = norm(locations[iFrom] - locations[iTo])
-    return G
+    rows = tuple(treenode_qs)
+    node_ids = [row[0] for row in rows]
+    parents, lengths = tree_arrays(node_ids, [row[1] for row in rows],
+            [row[2:] for row in rows])
+    return np.array(node_ids, dtype=np.int64), parents, lengths
 
 def synapseNodesFromSkeletonID(sid):
     sk = ClassInstance.objects.get(pk=sid)
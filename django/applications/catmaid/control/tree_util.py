@@ -1,20 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-# A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# A 'tree' is a networkx.DiGraph with a single root node (a node without parents),
+# an Arbor stores a tree in arrays.
 
 import six
+import numpy as np
 
 from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
-from math import sqrt
-from itertools import islice
+from itertools import groupby
+
+from django.db import connection
+
 from catmaid.models import Treenode
 from six.moves import range
 
-from six.moves import zip as izip
-
 
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
@@ -195,40 +197,229 @@ def spanning_tree(tree, preserve):
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
     Returns the total cable length. """
-    return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
-
-
-def lazy_load_trees(skeleton_ids, node_properties):
-    """ Return a lazy collection of pairs of (long, DiGraph)
-    representing (skeleton_id, tree).
-    The node_properties is a list of strings, each being a name of a column
-    in the django model of the Treenode table that is not the treenode id, parent_id
-    or skeleton_id. """
-
-    values_list = ('id', 'parent_id', 'skeleton_id')
-    props = tuple(set(node_properties) - set(values_list))
-    values_list += props
-
-    ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
-            .order_by('skeleton') \
-            .values_list(*values_list)
-    skid = None
-    tree = None
-    for t in ts:
-        if t[2] != skid:
-            if tree:
-                yield (skid, tree)
-            # Prepare for the next one
-            skid = t[2]
-            tree = DiGraph()
-
-        fields = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
-        tree.add_node(t[0], fields)
-
-        if t[1]:
-            # From child to parent
-            tree.add_edge(t[0], t[1])
-
-    if tree:
-        yield (skid, tree)
+    edges = tree.edges()
+    if not edges:
+        return 0
+    a = np.array([locations[edge[0]] for edge in edges], dtype=np.float64)
+    b = np.array([locations[edge[1]] for edge in edges], dtype=np.float64)
+    return np.linalg.norm(b - a, axis=1).sum()
+
+
+def tree_depths(parents):
+    """ Return the number of edges between each node and its root, given an
+    array with the index of each node's parent (-1 for roots). """
+    has_parent = parents != -1
+    depths = has_parent.astype(np.int64)
+    ancestors = np.where(has_parent, parents, np.arange(len(parents)))
+    # Pointer jumping: each iteration doubles the covered path length
+    while True:
+        next_ancestors = ancestors[ancestors]
+        if np.array_equal(next_ancestors, ancestors):
+            return depths
+        depths += depths[ancestors] * (ancestors != next_ancestors)
+        ancestors = next_ancestors
+
+def tree_roots(parents):
+    """ Return the index of the root of each node, given an array with the
+    index of each node's parent (-1 for roots). """
+    roots = np.where(parents != -1, parents, np.arange(len(parents)))
+    # Pointer jumping: each iteration doubles the covered path length
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+def tree_levels(parents):
+    """ Return a list of node index arrays, one for each number of edges to the
+    root, starting with the roots. """
+    depths = tree_depths(parents)
+    order = np.argsort(depths, kind='mergesort')
+    return np.split(order, np.flatnonzero(np.diff(depths[order])) + 1)
+
+
+class Arbor(object):
+    """ A tree (or forest) of nodes stored in arrays, which needs far less
+    memory than a networkx DiGraph and allows vectorized analyses. Nodes are
+    referred to by their index in node_ids, parents holds the index of each
+    node's parent (-1 for roots). Optionally, locations is an N x 3 array of
+    node positions and properties a dictionary of property name vs array of
+    per-node values. """
+
+    def __init__(self, node_ids, parent_ids, locations=None, properties=None):
+        """ Parent IDs are None for root nodes. Nodes with a parent that isn't
+        part of node_ids become roots. """
+        self.node_ids = np.asarray(node_ids, dtype=np.int64).reshape(-1)
+        self._order = np.argsort(self.node_ids)
+        self.parents = self.indices([-1 if p is None else p for p in parent_ids])
+        self.locations = None if locations is None else \
+                np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        self.properties = properties or {}
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node_id):
+        return -1 != self.indices([node_id])[0]
+
+    def indices(self, node_ids):
+        """ Return an array with the index of each of the passed in node IDs,
+        or -1 for those that aren't part of this arbor. """
+        node_ids = np.asarray(node_ids, dtype=np.int64).reshape(-1)
+        if not len(self.node_ids):
+            return np.full(len(node_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self.node_ids, node_ids, sorter=self._order)
+        positions[positions == len(self.node_ids)] = 0
+        indices = self._order[positions]
+        indices[self.node_ids[indices] != node_ids] = -1
+        return indices
+
+    def index(self, node_id):
+        """ Return the index of a node or raise a KeyError if it isn't part of
+        this arbor. """
+        index = self.indices([node_id])[0]
+        if -1 == index:
+            raise KeyError(node_id)
+        return int(index)
+
+    def roots(self):
+        return np.flatnonzero(self.parents == -1)
+
+    def child_counts(self):
+        return np.bincount(self.parents[self.parents != -1], minlength=len(self))
+
+    def children(self, index):
+        return np.flatnonzero(self.parents == index)
+
+    def end_nodes(self):
+        """ Return the indices of all nodes without children. """
+        return np.flatnonzero(self.child_counts() == 0)
+
+    def branch_nodes(self):
+        """ Return the indices of all nodes with more than one child. """
+        return np.flatnonzero(self.child_counts() > 1)
+
+    def depths(self):
+        """ Return the number of edges between each node and its root. """
+        return tree_depths(self.parents)
+
+    def topological_order(self):
+        """ Return all node indices, parents before their children. """
+        return np.argsort(self.depths(), kind='mergesort')
+
+    def edge_lengths(self):
+        """ Return the length of the edge to the parent of each node (0 for
+        roots). """
+        lengths = np.zeros(len(self))
+        has_parent = self.parents != -1
+        lengths[has_parent] = np.linalg.norm(self.locations[has_parent] -
+                self.locations[self.parents[has_parent]], axis=1)
+        return lengths
+
+    def cable_length(self):
+        return self.edge_lengths().sum()
+
+    def subtree_sizes(self):
+        """ Return the number of nodes downstream of each node, including the
+        node itself. """
+        sizes = np.ones(len(self), dtype=np.int64)
+        for level in reversed(tree_levels(self.parents)[1:]):
+            np.add.at(sizes, self.parents[level], sizes[level])
+        return sizes
+
+    def path_to_root(self, index):
+        """ Return the list of node indices from a node to its root. """
+        parents = self.parents
+        path = [index]
+        while parents[path[-1]] != -1:
+            path.append(parents[path[-1]])
+        return path
+
+    def reroot(self, index):
+        """ Reverse in place the direction of the edges from the node with the
+        passed in index to its root. """
+        path = self.path_to_root(index)
+        self.parents[path[1:]] = path[:-1]
+        self.parents[index] = -1
+
+    def common_ancestor(self, indices):
+        """ Return the index of the nearest common ancestor of all passed in
+        nodes, which have to be part of the same tree. """
+        on_path = np.zeros(len(self), dtype=np.bool_)
+        path = self.path_to_root(indices[0])
+        on_path[path] = True
+        # Walk up from all other nodes until the first path is met, the
+        # highest of these meeting points is the common ancestor.
+        position = {node: i for i, node in enumerate(path)}
+        highest = 0
+        parents = self.parents
+        for index in indices[1:]:
+            while not on_path[index]:
+                index = parents[index]
+            highest = max(highest, position[index])
+        return path[highest]
+
+    def partition(self):
+        """ Partition the arbor into lists of node indices, each running from
+        an end node to either the root or a branch node. Branch nodes are
+        repeated as ends of all sequences except the longest one that
+        finishes at the root. """
+        depths = self.depths()
+        parents = self.parents.tolist()
+        seen = np.zeros(len(self), dtype=np.bool_)
+        # Iterate end nodes sorted from highest to lowest distance to root
+        ends = self.end_nodes()
+        for index in ends[np.argsort(-depths[ends], kind='mergesort')].tolist():
+            sequence = [index]
+            parent = parents[index]
+            while parent != -1:
+                sequence.append(parent)
+                if seen[parent]:
+                    break
+                seen[parent] = True
+                parent = parents[parent]
+            if len(sequence) > 1:
+                yield sequence
+
+    def downstream(self, index):
+        """ Return the indices of all nodes downstream of a node, including
+        the node itself. """
+        parents = self.parents.copy()
+        parents[index] = -1
+        return np.flatnonzero(tree_roots(parents) == index)
+
+    def components(self, mask):
+        """ Return for each node of the subset selected by the boolean mask the
+        index of the topmost node of the connected part of the subset it
+        belongs to, and -1 for all other nodes. """
+        parents = self.parents.copy()
+        linked = parents != -1
+        linked[linked] = mask[parents[linked]]
+        parents[~linked] = -1
+        tops = tree_roots(parents)
+        tops[~mask] = -1
+        return tops
+
 
+def lazy_load_arbors(skeleton_ids, node_properties=(), cursor=None):
+    """ Return a lazy collection of pairs of (skeleton_id, Arbor) with node
+    locations. The node_properties is a list of strings, each being a name of
+    a column of the treenode table, whose values are stored in the properties
+    of each Arbor. """
+    columns = [Treenode._meta.get_field(name).column for name in node_properties]
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute("""
+        SELECT skeleton_id, id, parent_id, location_x, location_y, location_z
+            {}
+        FROM treenode
+        WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ORDER BY skeleton_id
+    """.format(''.join(', ' + c for c in columns)), {
+        'skeleton_ids': [int(skid) for skid in skeleton_ids],
+    })
+    for skeleton_id, rows in groupby(cursor, key=itemgetter(0)):
+        rows = list(rows)
+        yield skeleton_id, Arbor([row[1] for row in rows], [row[2] for row in rows],
+                [row[3:6] for row in rows], {name: np.array([row[6 + i] for row in rows])
+                    for i, name in enumerate(node_properties)})
@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 import itertools
 import math
-import networkx as nx
+import numpy as np
 import re
 import six
 
@@ -25,6 +25,7 @@ from catmaid.control.common import get_relation_to_id_map, \
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.node import _fetch_location, _fetch_locations
 from catmaid.control.link import create_connector_link
+from catmaid.control.tree_util import Arbor
 from catmaid.util import Point3D, is_collinear
 
 
@@ -1016,23 +1017,15 @@ def update_confidence(request, project_id=None, treenode_id=None):
     else:
         raise ValueError('Failed to update confidence at treenode %s.' % tnid)
 
-def _skeleton_as_graph(skeleton_id):
+def _skeleton_as_arbor(skeleton_id):
     # Fetch all nodes of the skeleton
     cursor = connection.cursor()
     cursor.execute('''
         SELECT id, parent_id
         FROM treenode
         WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
+    rows = cursor.fetchall()
+    return Arbor([row[0] for row in rows], [row[1] for row in rows])
 
 
 def _find_first_interesting_node(sequence):
@@ -1079,19 +1072,18 @@ def find_previous_branchnode_or_root(request, project_id=None, treenode_id=None)
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = _skeleton_as_arbor(skid)
+        child_counts = arbor.child_counts()
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
-        while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
-                    break # Found a branch node
-            else:
-                break # Found the root node
+        index = arbor.index(tnid)
+        while -1 != arbor.parents[index]:
+            index = arbor.parents[index] # Can ony have one parent
+            seq.append(int(arbor.node_ids[index]))
+            if 1 != child_counts[index]:
+                break # Found a branch node
+        tnid = int(arbor.node_ids[index])
 
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
@@ -1106,32 +1098,33 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
     try:
         tnid = int(treenode_id)
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
-
-        children = graph.successors(tnid)
+        arbor = _skeleton_as_arbor(skid)
+        child_counts = arbor.child_counts()
+        # The only child of each node with exactly one child
+        only_child = np.full(len(arbor), -1, dtype=np.int64)
+        has_parent = arbor.parents != -1
+        only_child[arbor.parents[has_parent]] = np.flatnonzero(has_parent)
+
+        children = arbor.children(arbor.index(tnid))
         branches = []
-        for child_node_id in children:
+        for child in children:
             # Travel downstream until finding a child node with more than one
             # child or reaching an end node
-            seq = [child_node_id] # Does not include the starting node tnid
-            branch_end = child_node_id
-            while True:
-                branch_children = graph.successors(branch_end)
-                if 1 == len(branch_children):
-                    branch_end = branch_children[0]
-                    seq.append(branch_end)
-                else:
-                    break # Found an end node or a branch node
+            seq = [child] # Does not include the starting node tnid
+            while 1 == child_counts[seq[-1]]:
+                seq.append(only_child[seq[-1]])
 
-            branches.append([child_node_id,
+            seq = arbor.node_ids[seq].tolist()
+            branches.append([seq[0],
                              _find_first_interesting_node(seq),
-                             branch_end])
+                             seq[-1]])
 
         # If more than one branch exists, sort based on downstream arbor size.
         if len(children) > 1:
-            branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
-                   reverse=True)
+            subtree_sizes = arbor.subtree_sizes()
+            sizes = dict(zip(arbor.node_ids[children].tolist(),
+                    subtree_sizes[children].tolist()))
+            branches.sort(key=lambda b: sizes[b[0]], reverse=True)
 
         # Leaf nodes will have no branches
         if len(children) > 0:
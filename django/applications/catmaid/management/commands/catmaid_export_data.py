@@ -4,12 +4,14 @@ from __future__ import unicode_literals
 from itertools import chain
 from django.core import serializers
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from catmaid.control.copyarchive import export_copy_archive
 from catmaid.control.neuron_annotations import (get_annotated_entities,
         get_annotation_to_id_map)
 from catmaid.control.tracing import check_tracing_setup
-from catmaid.models import (Class, ClassInstance, ClassInstanceClassInstance,
-        Relation, Connector, Project, Treenode, TreenodeClassInstance,
-        TreenodeConnector, User)
+from catmaid.models import (AnnotationClosure, Class, ClassInstance,
+        ClassInstanceClassInstance, Relation, Connector, Project, Treenode,
+        TreenodeClassInstance, TreenodeConnector, User)
 
 from six.moves import input, map
 
@@ -46,15 +48,44 @@ class Exporter():
         self.export_tags = options['export_tags']
         self.export_users = options['export_users']
         self.required_annotations = options['required_annotations']
-        self.target_file = options.get('file', 'export_pid_{}.json').format(project.id)
+        self.connector_placeholders = options['connector_placeholders']
+        self.jobs = options.get('jobs', 1)
+        self.shard_size = options.get('shard_size', 1000)
+        self.resume = options.get('resume', False)
+        self.format = options.get('format') or 'json'
+        default_target = 'export_pid_{}' if self.format == 'copy' else 'export_pid_{}.json'
+        self.target_file = (options.get('file') or default_target).format(project.id)
 
         self.show_traceback = True
-        self.format = 'json'
         self.indent = 2
 
         self.to_serialize = []
         self.seen = {}
 
+    def get_annotated_neurons(self, classes, relations):
+        """Return information on all neurons annotated with the required
+        annotations, including their skeleton IDs.
+        """
+        annotation_map = get_annotation_to_id_map(self.project.id,
+                self.required_annotations, relations, classes)
+        annotation_ids = list(map(str, annotation_map.values()))
+        if not annotation_ids:
+            missing_annotations = set(self.required_annotations) - set(annotation_map.keys())
+            raise CommandError("Could not find the following annotations: " +
+                    ", ".join(missing_annotations))
+
+        query_params = {
+            'annotated_with': ",".join(annotation_ids),
+            'sub_annotated_with': ",".join(annotation_ids)
+        }
+        neuron_info, num_total_records = get_annotated_entities(self.project,
+                query_params, relations, classes, ['neuron'], with_skeletons=True)
+
+        logger.info("Found {} neurons with the following annotations: {}".format(
+                num_total_records, ", ".join(self.required_annotations)))
+
+        return neuron_info
+
     def collect_data(self):
         self.to_serialize = []
 
@@ -67,24 +98,7 @@ class Exporter():
             raise CommandError("Project with ID %s is no tracing project." % self.project.id)
 
         if self.required_annotations:
-            annotation_map = get_annotation_to_id_map(self.project.id,
-                    self.required_annotations, relations, classes)
-            annotation_ids = list(map(str, annotation_map.values()))
-            if not annotation_ids:
-                missing_annotations = set(self.required_annotations) - set(annotation_map.keys())
-                raise CommandError("Could not find the following annotations: " +
-                        ", ".join(missing_annotations))
-
-            query_params = {
-                'annotated_with': ",".join(annotation_ids),
-                'sub_annotated_with': ",".join(annotation_ids)
-            }
-            neuron_info, num_total_records = get_annotated_entities(self.project,
-                    query_params, relations, classes, ['neuron'], with_skeletons=True)
-
-            logger.info("Found {} neurons with the following annotations: {}".format(
-                    num_total_records, ", ".join(self.required_annotations)))
-
+            neuron_info = self.get_annotated_neurons(classes, relations)
             skeleton_id_constraints = list(chain.from_iterable([n['skeleton_ids'] for n in neuron_info]))
 
             neuron_ids = [n['id'] for n in neuron_info]
@@ -176,27 +190,25 @@ class Exporter():
             # annotations.
             if self.export_annotations and 'annotated_with' in relations:
                 annotated_with = relations['annotated_with']
-                all_annotations = set()
-                all_annotation_links = set()
-                working_set = [e for e in entities]
-                while working_set:
-                    annotation_links = ClassInstanceClassInstance.objects.filter(
-                            project_id=self.project.id, relation=annotated_with,
-                            class_instance_a__in=working_set)
-                    annotations = ClassInstance.objects.filter(project_id=self.project.id,
-                            cici_via_b__in=annotation_links)
-
-                    # Reset working set to add next entries
-                    working_set = []
-
-                    for al in annotation_links:
-                        if al not in all_annotation_links:
-                            all_annotation_links.add(al)
-
-                    for a in annotations:
-                        if a not in all_annotations:
-                            all_annotations.add(a)
-                            working_set.append(a)
+                # Meta-annotations are read from the annotation closure table,
+                # which lists all direct and transitive ancestors of an
+                # annotation.
+                direct_annotation_ids = set(ClassInstanceClassInstance.objects.filter(
+                        project_id=self.project.id, relation=annotated_with,
+                        class_instance_a__in=entities).values_list(
+                            'class_instance_b', flat=True))
+                meta_annotation_ids = set(AnnotationClosure.objects.filter(
+                        project_id=self.project.id,
+                        descendant_id__in=direct_annotation_ids).values_list(
+                            'ancestor_id', flat=True))
+                annotation_ids = direct_annotation_ids | meta_annotation_ids
+
+                all_annotations = set(ClassInstance.objects.filter(
+                        project_id=self.project.id, id__in=annotation_ids))
+                all_annotation_links = set(ClassInstanceClassInstance.objects.filter(
+                        Q(class_instance_a__in=entities) |
+                        Q(class_instance_a__in=annotation_ids),
+                        project_id=self.project.id, relation=annotated_with))
 
                 if all_annotations:
                     self.to_serialize.append(all_annotations)
@@ -271,9 +283,53 @@ class Exporter():
             self.to_serialize.append(users)
 
 
+    def export_copy(self):
+        """Write all matching data into a copy archive directory, streaming
+        each table from the database using COPY.
+        """
+        classes = dict(Class.objects.filter(
+                project=self.project).values_list('class_name', 'id'))
+        relations = dict(Relation.objects.filter(
+                project=self.project).values_list('relation_name', 'id'))
+
+        if not check_tracing_setup(self.project.id, classes, relations):
+            raise CommandError("Project with ID %s is no tracing project." % self.project.id)
+
+        if self.jobs < 0:
+            raise CommandError("Number of jobs can't be negative")
+        if self.shard_size < 1:
+            raise CommandError("Shards need to contain at least one skeleton")
+
+        if self.required_annotations:
+            neuron_info = self.get_annotated_neurons(classes, relations)
+            if not neuron_info:
+                raise CommandError("No matching neurons found")
+            skeleton_ids = list(chain.from_iterable([n['skeleton_ids'] for n in neuron_info]))
+            print("Will export %s neurons" % len(neuron_info))
+        else:
+            skeleton_ids = None
+            print("Will export all neurons")
+
+        start_export = ask_to_continue()
+        if not start_export:
+            raise CommandError("Canceled by user")
+
+        try:
+            export_copy_archive(self.project.id, self.target_file,
+                    skeleton_ids, self.export_treenodes,
+                    self.export_connectors, self.export_annotations,
+                    self.export_tags, self.connector_placeholders,
+                    self.shard_size, self.jobs or None, self.resume,
+                    log=logger.info)
+        except ValueError as e:
+            raise CommandError(str(e))
+
     def export(self):
         """ Writes all objects matching
         """
+        if self.format == 'copy':
+            return self.export_copy()
+
         try:
             self.collect_data()
 
@@ -293,7 +349,7 @@ class Command(BaseCommand):
     """ Call e.g. like
         ./manage.py catmaid_export_data --source 1 --required-annotation "Kenyon cells"
     """
-    help = "Export CATMAID data into a JSON representation"
+    help = "Export CATMAID data into a JSON representation or a copy archive"
 
     def add_arguments(self, parser):
         parser.add_argument('--source', default=None,
@@ -325,6 +381,16 @@ class Command(BaseCommand):
             'skeletons. Meta-annotations can be used as well.')
         parser.add_argument('--connector-placeholders', dest='connector_placeholders',
             action='store_true', help='Should placeholder nodes be exported')
+        parser.add_argument('--format', dest='format', default='json',
+            choices=('json', 'copy'), help='Export a JSON file or a copy ' +
+            'archive directory with a binary COPY file per table, which is ' +
+            'much faster for large projects')
+        parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+            help='Export copy archive shards using this many worker processes (0: one per CPU)')
+        parser.add_argument('--shard-size', dest='shard_size', type=int,
+            default=1000, help='Number of skeletons per copy archive shard')
+        parser.add_argument('--resume', dest='resume', action='store_true',
+            default=False, help='Continue an interrupted copy archive export')
 
     def ask_for_project(self, title):
         """ Return a valid project object.
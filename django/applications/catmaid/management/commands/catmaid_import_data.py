@@ -11,6 +11,7 @@ from django.core import serializers
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, transaction
 from catmaid.control.annotationadmin import copy_annotations
+from catmaid.control.copyarchive import import_copy_archive, is_copy_archive
 from catmaid.models import (Class, ClassInstance, ClassInstanceClassInstance,
         Project, Relation, User)
 
@@ -397,6 +398,53 @@ class FileImporter:
         ''')
 
 
+class CopyImporter:
+    """Import a copy archive, which is streamed into the database using
+    COPY. IDs are mapped in the database as well, no model objects are created
+    for imported data.
+    """
+    def __init__(self, source, target, user, options):
+        self.source = source
+        self.target = target
+        self.options = options
+        self.user = user
+        self.create_unknown_users = options['create_unknown_users']
+        self.preserve_ids = options['preserve_ids']
+
+    def get_user_id_map(self, referenced_users):
+        """Map each referenced archive user ID to a user in the target
+        database, either the override user or a user with the same username.
+        """
+        if self.user:
+            return dict((user_id, self.user.id) for user_id in referenced_users)
+
+        user_map = dict(User.objects.all().values_list('username', 'id'))
+        user_id_map = dict()
+        for user_id, username in six.iteritems(referenced_users):
+            existing_user_id = user_map.get(username)
+            if existing_user_id is None:
+                if not username or not self.create_unknown_users:
+                    raise CommandError("User \"{}\" is not found in "
+                            "existing data. Please use --user or "
+                            "--create-unknown-users".format(username))
+                logger.info("Created new inactive user: " + username)
+                user = User.objects.create(username=username, is_active=False)
+                existing_user_id = user_map[username] = user.id
+            user_id_map[user_id] = existing_user_id
+        return user_id_map
+
+    def import_data(self):
+        for t in ('treenodes', 'connectors', 'annotations', 'tags'):
+            if not self.options['import_' + t]:
+                raise CommandError("Copy archives can only be imported " +
+                        "completely, please select data during export")
+        try:
+            import_copy_archive(self.source, self.target.id,
+                    self.get_user_id_map, self.preserve_ids, log=logger.info)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+
 class InternalImporter:
     def __init__(self, source, target, user, options):
         self.source = source
@@ -415,7 +463,7 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--source', dest='source', default=None,
-            help='The ID of the source project or the path to a file to import')
+            help='The ID of the source project or the path to a file or copy archive to import')
         parser.add_argument('--target', dest='target', default=None,
             help='The ID of the target project')
         parser.add_argument('--user', dest='user', default=None,
@@ -498,8 +546,12 @@ class Command(BaseCommand):
                 Importer = InternalImporter
             except ValueError:
                 source = options['source']
-                logger.info("Using file importer")
-                Importer = FileImporter
+                if is_copy_archive(source):
+                    logger.info("Using copy archive importer")
+                    Importer = CopyImporter
+                else:
+                    logger.info("Using file importer")
+                    Importer = FileImporter
         else:
             source = self.ask_for_project('source')
 
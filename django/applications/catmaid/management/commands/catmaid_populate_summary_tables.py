@@ -1,7 +1,8 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db import connection
 
-from catmaid.control.stats import populate_stats_summary
+from catmaid.control.stats import (populate_stats_summary_parallel,
+        update_recent_stats_summary)
 from catmaid.models import Project
 
 
@@ -13,6 +14,12 @@ class Command(BaseCommand):
             default=False, help='Remove all existing statistics before recomputation'),
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             default=False, help='Compute only statistics for these projects only (otherwise all)'),
+        parser.add_argument('--jobs', dest='jobs', type=int, default=0,
+            help='Compute statistics using this many concurrent database connections (0: one per CPU)'),
+        parser.add_argument('--partition-hours', dest='partition_hours', type=int,
+            default=24*30, help='Split longer time ranges into partitions of this many hours'),
+        parser.add_argument('--recent', action='store_true', dest='recent',
+            default=False, help='Only update hours with transactions since the last update, including the current hour'),
 
     def handle(self, *args, **options):
         cursor = connection.cursor()
@@ -23,6 +30,19 @@ class Command(BaseCommand):
         else:
             projects = Project.objects.all()
 
+        if options['recent']:
+            if options['clean']:
+                raise CommandError('Recent statistics can\'t be cleaned')
+            update_recent_stats_summary(list(projects.values_list('id',
+                    flat=True)) if project_ids else None, log=self.stdout.write)
+            return
+
+        jobs, partition_hours = options['jobs'], options['partition_hours']
+        if jobs < 0:
+            raise CommandError('Number of jobs can\'t be negative')
+        if partition_hours < 1:
+            raise CommandError('Partitions need to cover at least one hour')
+
         delete = False
         clean = options['clean']
         if clean:
@@ -30,9 +50,14 @@ class Command(BaseCommand):
                 delete = True
             else:
                 # Removing statistics for all projects is much faster this way.
-                cursor.execute("TRUNCATE catmaid_stats_summary")
+                cursor.execute("""
+                    TRUNCATE catmaid_stats_summary;
+                    TRUNCATE catmaid_stats_summary_checkpoint;
+                """)
 
         incremental = not clean
-        for p in projects:
-            populate_stats_summary(p.id, delete, incremental)
-            self.stdout.write('Computed statistics for project {}'.format(p.id))
+        project_ids = list(projects.values_list('id', flat=True))
+        populate_stats_summary_parallel(project_ids, delete, incremental,
+                jobs or None, partition_hours, log=self.stdout.write)
+        self.stdout.write('Computed statistics for projects {}'.format(
+                ', '.join(str(p) for p in project_ids)))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the annotation closure table, which stores for each ' \
+           'annotation all annotations that are directly or transitively ' \
+           'annotated with it. The table is updated automatically by the ' \
+           'database, which is why this is only needed if the table got out ' \
+           'of sync.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Rebuild the annotation closure for these projects only (otherwise all)')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        project_ids = options['project_id']
+        cursor = connection.cursor()
+
+        if project_ids:
+            project_ids = [int(p) for p in project_ids]
+            for project_id in project_ids:
+                if not Project.objects.filter(pk=project_id).exists():
+                    raise CommandError('Project "%s" does not exist' % project_id)
+            cursor.execute("""
+                DELETE FROM catmaid_annotation_closure
+                WHERE project_id = ANY(%(project_ids)s::integer[])
+            """, {
+                'project_ids': project_ids
+            })
+            project_filter = 'AND cici.project_id = ANY(%(project_ids)s::integer[])'
+        else:
+            cursor.execute("TRUNCATE catmaid_annotation_closure")
+            project_filter = ''
+
+        # Refresh the closure of all annotations that are used as
+        # meta-annotation.
+        cursor.execute("""
+            SELECT refresh_annotation_closure(array_agg(DISTINCT cici.class_instance_b))
+            FROM class_instance_class_instance cici
+            JOIN relation r
+                ON r.id = cici.relation_id
+            JOIN class_instance ci_a
+                ON ci_a.id = cici.class_instance_a
+            JOIN class c_a
+                ON c_a.id = ci_a.class_id
+            JOIN class_instance ci_b
+                ON ci_b.id = cici.class_instance_b
+            JOIN class c_b
+                ON c_b.id = ci_b.class_id
+            WHERE r.relation_name = 'annotated_with'
+            AND c_a.class_name = 'annotation'
+            AND c_b.class_name = 'annotation'
+            {project_filter}
+            HAVING COUNT(*) > 0
+        """.format(project_filter=project_filter), {
+            'project_ids': project_ids
+        })
+
+        if project_ids:
+            cursor.execute("""
+                SELECT COUNT(*) FROM catmaid_annotation_closure
+                WHERE project_id = ANY(%(project_ids)s::integer[])
+            """, {
+                'project_ids': project_ids
+            })
+        else:
+            cursor.execute("SELECT COUNT(*) FROM catmaid_annotation_closure")
+
+        self.stdout.write('Created {} annotation closure entries'.format(
+                cursor.fetchone()[0]))
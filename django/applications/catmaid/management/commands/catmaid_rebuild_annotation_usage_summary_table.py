@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the annotation usage summary table, which stores how ' \
+           'often and when each annotation was used last, per user and for ' \
+           'all users combined. The table is updated automatically by the ' \
+           'database, which is why this is only needed if the table got out ' \
+           'of sync.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Rebuild annotation usage summaries for these projects only (otherwise all)')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        project_ids = options['project_id']
+        cursor = connection.cursor()
+
+        if project_ids:
+            project_ids = [int(p) for p in project_ids]
+            for project_id in project_ids:
+                if not Project.objects.filter(pk=project_id).exists():
+                    raise CommandError('Project "%s" does not exist' % project_id)
+            cursor.execute("""
+                DELETE FROM catmaid_annotation_usage_summary
+                WHERE project_id = ANY(%(project_ids)s::integer[])
+            """, {
+                'project_ids': project_ids
+            })
+            project_filter = 'AND cici.project_id = ANY(%(project_ids)s::integer[])'
+        else:
+            cursor.execute("TRUNCATE catmaid_annotation_usage_summary")
+            project_filter = ''
+
+        usage = """
+            SELECT cici.project_id, cici.class_instance_b AS annotation_id,
+                cici.user_id, cici.creation_time
+            FROM class_instance_class_instance cici
+            JOIN relation r
+                ON r.id = cici.relation_id
+            JOIN class_instance ci
+                ON ci.id = cici.class_instance_b
+            JOIN class c
+                ON c.id = ci.class_id
+            WHERE r.relation_name = 'annotated_with'
+            AND c.class_name = 'annotation'
+            {project_filter}
+        """.format(project_filter=project_filter)
+
+        # User rows and union rows, the latter have no user
+        cursor.execute("""
+            WITH usage AS ({usage})
+            INSERT INTO catmaid_annotation_usage_summary (project_id,
+                annotation_id, user_id, num_usage, last_used, last_user_id)
+            SELECT MAX(project_id), annotation_id, user_id, COUNT(*),
+                MAX(creation_time), user_id
+            FROM usage
+            GROUP BY annotation_id, user_id
+        """.format(usage=usage), {
+            'project_ids': project_ids
+        })
+        n_user_rows = cursor.rowcount
+
+        cursor.execute("""
+            WITH usage AS ({usage})
+            INSERT INTO catmaid_annotation_usage_summary (project_id,
+                annotation_id, user_id, num_usage, last_used, last_user_id)
+            SELECT DISTINCT ON (annotation_id) project_id, annotation_id, NULL,
+                COUNT(*) OVER (PARTITION BY annotation_id), creation_time,
+                user_id
+            FROM usage
+            ORDER BY annotation_id, creation_time DESC
+        """.format(usage=usage), {
+            'project_ids': project_ids
+        })
+
+        self.stdout.write('Created {} user and {} union annotation usage '
+                'summary entries'.format(n_user_rows, cursor.rowcount))
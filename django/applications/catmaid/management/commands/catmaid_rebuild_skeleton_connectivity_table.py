@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the skeleton connectivity table, which stores the number ' \
+           'of links between skeletons through shared connectors. The table ' \
+           'is updated automatically by the database, which is why this is ' \
+           'only needed if the table got out of sync.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Rebuild skeleton connectivity for these projects only (otherwise all)')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        project_ids = options['project_id']
+        cursor = connection.cursor()
+
+        if project_ids:
+            project_ids = [int(p) for p in project_ids]
+            for project_id in project_ids:
+                if not Project.objects.filter(pk=project_id).exists():
+                    raise CommandError('Project "%s" does not exist' % project_id)
+            cursor.execute("""
+                DELETE FROM catmaid_skeleton_connectivity
+                WHERE project_id = ANY(%(project_ids)s::integer[])
+            """, {
+                'project_ids': project_ids
+            })
+            project_filter = 'WHERE t1.project_id = ANY(%(project_ids)s::integer[])'
+        else:
+            cursor.execute("TRUNCATE catmaid_skeleton_connectivity")
+            project_filter = ''
+
+        cursor.execute("""
+            INSERT INTO catmaid_skeleton_connectivity (project_id,
+                source_skeleton_id, source_relation_id, target_skeleton_id,
+                target_relation_id, confidence_counts)
+            SELECT t1.project_id, t1.skeleton_id, t1.relation_id,
+                t2.skeleton_id, t2.relation_id, ARRAY[
+                    COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 1),
+                    COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 2),
+                    COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 3),
+                    COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 4),
+                    COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 5)
+                ]::int[]
+            FROM treenode_connector t1
+            JOIN treenode_connector t2
+                ON t1.connector_id = t2.connector_id
+                AND t1.id <> t2.id
+            {project_filter}
+            GROUP BY t1.project_id, t1.skeleton_id, t1.relation_id,
+                t2.skeleton_id, t2.relation_id
+        """.format(project_filter=project_filter), {
+            'project_ids': project_ids
+        })
+
+        self.stdout.write('Created {} skeleton connectivity entries'.format(
+                cursor.rowcount))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the skeleton review summary table, which stores the ' \
+           'number of reviewed nodes of each skeleton per reviewer and for ' \
+           'all reviewers combined. The table is updated automatically by ' \
+           'the database, which is why this is only needed if the table got ' \
+           'out of sync.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            help='Rebuild review summaries for these projects only (otherwise all)')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        project_ids = options['project_id']
+        cursor = connection.cursor()
+
+        if project_ids:
+            project_ids = [int(p) for p in project_ids]
+            for project_id in project_ids:
+                if not Project.objects.filter(pk=project_id).exists():
+                    raise CommandError('Project "%s" does not exist' % project_id)
+            cursor.execute("""
+                DELETE FROM catmaid_skeleton_review_summary
+                WHERE project_id = ANY(%(project_ids)s::integer[])
+            """, {
+                'project_ids': project_ids
+            })
+            project_filter = 'WHERE project_id = ANY(%(project_ids)s::integer[])'
+        else:
+            cursor.execute("TRUNCATE catmaid_skeleton_review_summary")
+            project_filter = ''
+
+        # Reviewer rows and union rows, the latter have no reviewer
+        cursor.execute("""
+            INSERT INTO catmaid_skeleton_review_summary (project_id,
+                skeleton_id, reviewer_id, num_reviewed_nodes,
+                first_review_time, last_review_time)
+            SELECT MAX(project_id), skeleton_id, reviewer_id,
+                COUNT(DISTINCT treenode_id), MIN(review_time), MAX(review_time)
+            FROM review
+            {project_filter}
+            GROUP BY skeleton_id, reviewer_id
+        """.format(project_filter=project_filter), {
+            'project_ids': project_ids
+        })
+        n_reviewer_rows = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO catmaid_skeleton_review_summary (project_id,
+                skeleton_id, reviewer_id, num_reviewed_nodes,
+                first_review_time, last_review_time)
+            SELECT MAX(project_id), skeleton_id, NULL,
+                COUNT(DISTINCT treenode_id), MIN(review_time), MAX(review_time)
+            FROM review
+            {project_filter}
+            GROUP BY skeleton_id
+        """.format(project_filter=project_filter), {
+            'project_ids': project_ids
+        })
+
+        self.stdout.write('Created {} reviewer and {} union review summary '
+                'entries'.format(n_reviewer_rows, cursor.rowcount))
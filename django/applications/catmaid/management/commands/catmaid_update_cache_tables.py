@@ -7,7 +7,8 @@ from django.conf import settings
 from django.db import connection
 
 from catmaid.control.node import (_node_list_tuples_query, update_cache,
-        Postgis2dNodeProvider, ORIENTATIONS)
+        update_grid_cache, prepare_cache_builds,
+        populate_cache_build_partitions, Postgis2dNodeProvider, ORIENTATIONS)
 from catmaid.models import Project
 
 
@@ -17,10 +18,12 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--clean', action='store_true', dest='clean',
             default=False, help='Remove all existing cache data before update'),
+        parser.add_argument('--incremental', action='store_true', dest='incremental',
+            default=False, help='Only update sections that changed since their last update'),
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             default=False, help='Compute only statistics for these projects only (otherwise all)'),
-        parser.add_argument('--type', dest='data_type', default="msgpack",
-            help='Which type of cache to populate: json, json_text, msgpack'),
+        parser.add_argument('--type', dest='data_type', nargs='+', default=['msgpack'],
+            help='Which types of cache to populate: json, json_text, msgpack'),
         parser.add_argument('--orientation', dest='orientations', nargs='+',
             default='xz', help='Which orientations should be generated: xy, xz, zy'),
         parser.add_argument('--step', dest='steps', nargs='+', required=True,
@@ -37,6 +40,16 @@ class Command(BaseCommand):
             help='Optional minimum Z project space coordinate for cache update'),
         parser.add_argument('--max-z', dest='max_z', default='inf',
             help='Optional maximum Z project space coordinate for cache update'),
+        parser.add_argument('--cell-width', dest='cell_width', default=None,
+            help='Populate a grid cache with cells of this width instead of a section cache'),
+        parser.add_argument('--cell-height', dest='cell_height', default=None,
+            help='Populate a grid cache with cells of this height instead of a section cache'),
+        parser.add_argument('--jobs', dest='jobs', type=int, default=None,
+            help='Populate the cache in partitions using this many worker processes (0: one per CPU)'),
+        parser.add_argument('--partition-size', dest='partition_size', type=int,
+            default=100, help='Number of sections per partition in parallel updates'),
+        parser.add_argument('--resume', action='store_true', dest='resume',
+            default=False, help='Continue the last interrupted parallel update with the same parameters'),
         parser.add_argument('--node-limit', dest='node_limit',
             default=settings.NODE_LIST_MAXIMUM_COUNT, help='Override node limit from settings. 0 means no limit'),
 
@@ -60,15 +73,10 @@ class Command(BaseCommand):
             raise CommandError('Need depth resolution per orientation (--step)')
         steps = [float(s) for s in steps]
 
-        delete = False
-        clean = options['clean']
-        if clean:
-            if project_ids:
-                delete = True
-            else:
-                # Removing cache data for all projects is faster this way.
-                cursor.execute("TRUNCATE node_query_cache")
+        cell_width, cell_height = options['cell_width'], options['cell_height']
+        grid_cache = bool(cell_width or cell_height)
 
+        clean = options['clean']
         bb_limits = [
             [float(options['min_x']), float(options['min_y']), float(options['min_z'])],
             [float(options['max_x']), float(options['max_y']), float(options['max_z'])]
@@ -78,17 +86,85 @@ class Command(BaseCommand):
         if node_limit == 0:
             node_limit = None
 
-        data_type = options['data_type']
-
-        if data_type not in ('json', 'json_text', 'msgpack'):
-            raise CommandError('Type must be one of: json, json_text, msgpack')
+        data_types = options['data_type']
+        if type(data_types) not in (list, tuple):
+            data_types = [data_types]
+
+        incremental = options['incremental']
+        if incremental and clean:
+            raise CommandError('Incremental updates can\'t be combined with --clean')
+
+        jobs, resume = options['jobs'], options['resume']
+        parallel = jobs is not None or resume
+        if parallel:
+            if incremental:
+                raise CommandError('Parallel updates can\'t be combined with --incremental')
+            if resume and clean:
+                raise CommandError('Resumed updates can\'t be combined with --clean')
+            if options['partition_size'] < 1:
+                raise CommandError('Partition size has to be positive')
+            if jobs is not None and jobs < 0:
+                raise CommandError('Number of jobs can\'t be negative')
+
+        for data_type in data_types:
+            if data_type not in ('json', 'json_text', 'msgpack'):
+                raise CommandError('Type must be one of: json, json_text, msgpack')
         if len(steps) != len(orientations):
             raise CommandError('Need one depth resolution flag per orientation')
 
+        if grid_cache:
+            if not (cell_width and cell_height):
+                raise CommandError('Need both --cell-width and --cell-height for grid caches')
+            if incremental:
+                raise CommandError('Grid caches can\'t be updated incrementally')
+            if parallel:
+                raise CommandError('Grid caches can\'t be updated in parallel')
+
+        delete = False
+        if clean:
+            if project_ids:
+                delete = True
+            elif grid_cache:
+                # Removing cache data for all projects is faster this way.
+                cursor.execute("TRUNCATE node_grid_cache, node_grid_cache_cell")
+            else:
+                # Removing cache data for all projects is faster this way.
+                cursor.execute("TRUNCATE node_query_cache")
+
+        if grid_cache:
+            cell_width, cell_height = float(cell_width), float(cell_height)
+            for p in projects:
+                self.stdout.write('Updating grid cache for project {}'.format(p.id))
+                for n, data_type in enumerate(data_types):
+                    for orientation, step in zip(orientations, steps):
+                        # Existing cells are only deleted once
+                        update_grid_cache(p.id, data_type, orientation,
+                                cell_width, cell_height, step, node_limit,
+                                delete and n == 0, bb_limits,
+                                log=self.stdout.write)
+                self.stdout.write('Updated grid cache for project {}'.format(p.id))
+            self.stdout.write('Done')
+            return
+
+        if parallel:
+            # Partitions of all projects are populated by the same worker pool
+            tasks = []
+            for p in projects:
+                self.stdout.write('Preparing cache update for project {}'.format(p.id))
+                tasks.extend(prepare_cache_builds(p.id, data_types,
+                        orientations, steps, node_limit, delete, bb_limits,
+                        options['partition_size'], resume,
+                        log=self.stdout.write))
+            populate_cache_build_partitions(tasks, jobs or None,
+                    log=self.stdout.write)
+            self.stdout.write('Done')
+            return
+
         for p in projects:
             self.stdout.write('Updating cache for project {}'.format(p.id))
-            update_cache(p.id, data_type, orientations, steps, node_limit,
-                    delete, bb_limits, log=self.stdout.write)
+            update_cache(p.id, data_types, orientations, steps, node_limit,
+                    delete, bb_limits, log=self.stdout.write,
+                    incremental=incremental)
             self.stdout.write('Updated cache for project {}'.format(p.id))
 
         self.stdout.write('Done')
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control.nodeoverview import update_node_overview
+from catmaid.models import ProjectStack
+
+
+class Command(BaseCommand):
+    help = "Render node overview image tiles for stacks of all or individual projects."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            default=False, help='Render tiles for these projects only (otherwise all)'),
+        parser.add_argument('--stack_id', dest='stack_id', nargs='+',
+            default=False, help='Render tiles for these stacks only (otherwise all linked XY stacks)'),
+        parser.add_argument('--zoom-level', dest='zoom_levels', nargs='+',
+            type=int, required=True, help='The zoom levels to render, 0 is full resolution'),
+        parser.add_argument('--tile-size', dest='tile_size', type=int,
+            default=512, help='Width and height of tiles in pixels'),
+        parser.add_argument('--incremental', action='store_true', dest='incremental',
+            default=False, help='Only render tiles that changed since their last update'),
+        parser.add_argument('--clean', action='store_true', dest='clean',
+            default=False, help='Remove all existing tiles of a stack before update'),
+        parser.add_argument('--no-edges', action='store_false', dest='with_edges',
+            default=True, help='Only render nodes, no edges'),
+
+    def handle(self, *args, **options):
+        if options['incremental'] and options['clean']:
+            raise CommandError('Incremental updates can\'t be combined with --clean')
+        if options['tile_size'] < 1:
+            raise CommandError('Tile size has to be positive')
+        if any(z < 0 for z in options['zoom_levels']):
+            raise CommandError('Zoom levels can\'t be negative')
+
+        project_stacks = ProjectStack.objects.filter(orientation=0).order_by(
+                'project_id', 'stack_id')
+        if options['project_id']:
+            project_stacks = project_stacks.filter(project_id__in=options['project_id'])
+        if options['stack_id']:
+            project_stacks = project_stacks.filter(stack_id__in=options['stack_id'])
+
+        for ps in project_stacks:
+            self.stdout.write('Updating node overview of stack {} in project {}'.format(
+                    ps.stack_id, ps.project_id))
+            update_node_overview(ps.project_id, ps.stack_id,
+                    options['zoom_levels'], options['tile_size'],
+                    options['incremental'], options['clean'],
+                    options['with_edges'], log=self.stdout.write)
+
+        self.stdout.write('Done')
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    """Add tables for a spatially tiled node query cache. Like the section
+    based node_query_cache table, these tables can be recreated from other
+    tables at any time and don't need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0038_add_missing_initial_skeleton_summaries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeGridCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orientation', models.IntegerField(default=0)),
+                ('cell_width', models.FloatField()),
+                ('cell_height', models.FloatField()),
+                ('cell_depth', models.FloatField()),
+                ('min_x_index', models.IntegerField(null=True)),
+                ('min_y_index', models.IntegerField(null=True)),
+                ('min_z_index', models.IntegerField(null=True)),
+                ('max_x_index', models.IntegerField(null=True)),
+                ('max_y_index', models.IntegerField(null=True)),
+                ('max_z_index', models.IntegerField(null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+            ],
+            options={
+                'db_table': 'node_grid_cache',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='nodegridcache',
+            unique_together=set([('project', 'orientation', 'cell_width', 'cell_height', 'cell_depth')]),
+        ),
+        migrations.CreateModel(
+            name='NodeGridCacheCell',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('x_index', models.IntegerField()),
+                ('y_index', models.IntegerField()),
+                ('z_index', models.IntegerField()),
+                ('update_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('json_data', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                ('json_text_data', models.TextField(blank=True, null=True)),
+                ('msgpack_data', models.BinaryField(null=True)),
+                ('grid', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.NodeGridCache')),
+            ],
+            options={
+                'db_table': 'node_grid_cache_cell',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='nodegridcachecell',
+            unique_together=set([('grid', 'z_index', 'x_index', 'y_index')]),
+        ),
+        migrations.RunSQL("""
+            ALTER TABLE node_grid_cache ALTER COLUMN orientation SET DEFAULT 0;
+            ALTER TABLE node_grid_cache_cell ALTER COLUMN update_time SET DEFAULT now();
+
+            CREATE INDEX node_grid_cache_cell_update_time_idx
+            ON node_grid_cache_cell (update_time);
+        """, """
+            DROP INDEX node_grid_cache_cell_update_time_idx;
+        """),
+    ]
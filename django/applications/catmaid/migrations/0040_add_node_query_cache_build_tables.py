@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    """Add tables to keep track of partitioned node query cache updates, which
+    can be computed in parallel and resumed after an interruption. Like the
+    cache tables themselves, these don't need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0039_add_node_grid_cache_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeQueryCacheBuild',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orientation', models.IntegerField(default=0)),
+                ('step', models.FloatField()),
+                ('data_types', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), size=None)),
+                ('node_limit', models.IntegerField(null=True)),
+                ('min_x', models.FloatField()),
+                ('min_y', models.FloatField()),
+                ('min_z', models.FloatField()),
+                ('max_x', models.FloatField()),
+                ('max_y', models.FloatField()),
+                ('max_z', models.FloatField()),
+                ('n_sections', models.IntegerField()),
+                ('partition_size', models.IntegerField()),
+                ('creation_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('completion_time', models.DateTimeField(null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+            ],
+            options={
+                'db_table': 'node_query_cache_build',
+            },
+        ),
+        migrations.CreateModel(
+            name='NodeQueryCacheBuildPartition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('partition_index', models.IntegerField()),
+                ('completion_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('build', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.NodeQueryCacheBuild')),
+            ],
+            options={
+                'db_table': 'node_query_cache_build_partition',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='nodequerycachebuildpartition',
+            unique_together=set([('build', 'partition_index')]),
+        ),
+        migrations.RunSQL("""
+            ALTER TABLE node_query_cache_build ALTER COLUMN orientation SET DEFAULT 0;
+            ALTER TABLE node_query_cache_build ALTER COLUMN creation_time SET DEFAULT now();
+            ALTER TABLE node_query_cache_build_partition ALTER COLUMN completion_time SET DEFAULT now();
+        """, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    """Add tables for pre-rendered node overview image tiles. These can be
+    recreated at any time and don't need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0040_add_node_query_cache_build_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeOverviewPyramid',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tile_size', models.IntegerField()),
+                ('zoom_levels', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None)),
+                ('update_time', models.DateTimeField(null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ('stack', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Stack')),
+            ],
+            options={
+                'db_table': 'node_overview_pyramid',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='nodeoverviewpyramid',
+            unique_together=set([('project', 'stack', 'tile_size')]),
+        ),
+        migrations.CreateModel(
+            name='NodeOverviewTile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom_level', models.IntegerField()),
+                ('section', models.IntegerField()),
+                ('row', models.IntegerField()),
+                ('col', models.IntegerField()),
+                ('update_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('image', models.BinaryField()),
+                ('pyramid', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.NodeOverviewPyramid')),
+            ],
+            options={
+                'db_table': 'node_overview_tile',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='nodeoverviewtile',
+            unique_together=set([('pyramid', 'zoom_level', 'section', 'row', 'col')]),
+        ),
+        migrations.RunSQL("""
+            ALTER TABLE node_overview_pyramid ALTER COLUMN zoom_levels SET DEFAULT '{}'::int[];
+            ALTER TABLE node_overview_tile ALTER COLUMN update_time SET DEFAULT now();
+        """, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_pair_count_ctes(changed_links, other_links):
+    """Return CTEs that count all pairs of links on the same connector that
+    involve at least one of the <changed_links>, grouped by skeleton and
+    relation pair and by the lower confidence of both links. <other_links> are
+    all other links.
+    """
+    return """
+        other_link_pair AS (
+            SELECT l1.project_id,
+                l1.skeleton_id AS skeleton_id_1,
+                l1.relation_id AS relation_id_1,
+                l2.skeleton_id AS skeleton_id_2,
+                l2.relation_id AS relation_id_2,
+                LEAST(l1.confidence, l2.confidence) AS confidence
+            FROM {changed_links} l1
+            JOIN {other_links} l2
+                ON l1.connector_id = l2.connector_id
+        ), link_pair AS (
+            -- Both directions of pairs between changed and other links
+            SELECT project_id, skeleton_id_1, relation_id_1,
+                skeleton_id_2, relation_id_2, confidence
+            FROM other_link_pair
+            UNION ALL
+            SELECT project_id, skeleton_id_2, relation_id_2,
+                skeleton_id_1, relation_id_1, confidence
+            FROM other_link_pair
+            UNION ALL
+            -- Pairs of changed links
+            SELECT l1.project_id, l1.skeleton_id, l1.relation_id,
+                l2.skeleton_id, l2.relation_id,
+                LEAST(l1.confidence, l2.confidence)
+            FROM {changed_links} l1
+            JOIN {changed_links} l2
+                ON l1.connector_id = l2.connector_id
+                AND l1.id <> l2.id
+        ), link_pair_count AS (
+            SELECT project_id,
+                skeleton_id_1 AS source_skeleton_id,
+                relation_id_1 AS source_relation_id,
+                skeleton_id_2 AS target_skeleton_id,
+                relation_id_2 AS target_relation_id,
+                ARRAY[
+                    COUNT(*) FILTER (WHERE confidence = 1),
+                    COUNT(*) FILTER (WHERE confidence = 2),
+                    COUNT(*) FILTER (WHERE confidence = 3),
+                    COUNT(*) FILTER (WHERE confidence = 4),
+                    COUNT(*) FILTER (WHERE confidence = 5)
+                ]::int[] AS confidence_counts
+            FROM link_pair
+            GROUP BY project_id, skeleton_id_1, relation_id_1,
+                skeleton_id_2, relation_id_2
+        )
+    """.format(changed_links=changed_links, other_links=other_links)
+
+
+def lock_connectors(affected_links):
+    """Return a statement that locks the connectors of all links returned by the
+    <affected_links> query, in connector order. Concurrent link changes of the
+    same connectors have to wait for this transaction to finish, which makes
+    sure the link pairs counted by a following statement, which uses a new
+    snapshot, include all their links. Without it, two transactions adding a
+    link to the same connector would not count the pair of both new links.
+    Unlike FOR UPDATE, this doesn't conflict with the lock new links take on
+    their connector, which would lead to deadlocks. Changes made in a
+    transaction with a higher isolation level can't be accounted for, they
+    would need a rebuild of the connectivity table.
+    """
+    return """
+        PERFORM 1
+        FROM connector c
+        WHERE c.id IN ({affected_links})
+        ORDER BY c.id
+        FOR NO KEY UPDATE;
+    """.format(affected_links=affected_links)
+
+
+add_link_pair_counts = """
+    INSERT INTO catmaid_skeleton_connectivity (project_id,
+        source_skeleton_id, source_relation_id, target_skeleton_id,
+        target_relation_id, confidence_counts)
+    SELECT project_id, source_skeleton_id, source_relation_id,
+        target_skeleton_id, target_relation_id, confidence_counts
+    FROM link_pair_count
+    ON CONFLICT (source_skeleton_id, source_relation_id, target_skeleton_id,
+        target_relation_id)
+    DO UPDATE SET confidence_counts = ARRAY[
+        catmaid_skeleton_connectivity.confidence_counts[1] + EXCLUDED.confidence_counts[1],
+        catmaid_skeleton_connectivity.confidence_counts[2] + EXCLUDED.confidence_counts[2],
+        catmaid_skeleton_connectivity.confidence_counts[3] + EXCLUDED.confidence_counts[3],
+        catmaid_skeleton_connectivity.confidence_counts[4] + EXCLUDED.confidence_counts[4],
+        catmaid_skeleton_connectivity.confidence_counts[5] + EXCLUDED.confidence_counts[5]
+    ];
+"""
+
+# Only existing rows are updated, because counts can't become negative. Rows
+# of deleted skeletons might have been removed already.
+subtract_link_pair_counts = """
+    UPDATE catmaid_skeleton_connectivity c
+    SET confidence_counts = ARRAY[
+        c.confidence_counts[1] - d.confidence_counts[1],
+        c.confidence_counts[2] - d.confidence_counts[2],
+        c.confidence_counts[3] - d.confidence_counts[3],
+        c.confidence_counts[4] - d.confidence_counts[4],
+        c.confidence_counts[5] - d.confidence_counts[5]
+    ]
+    FROM link_pair_count d
+    WHERE c.source_skeleton_id = d.source_skeleton_id
+    AND c.source_relation_id = d.source_relation_id
+    AND c.target_skeleton_id = d.target_skeleton_id
+    AND c.target_relation_id = d.target_relation_id;
+
+    DELETE FROM catmaid_skeleton_connectivity
+    WHERE confidence_counts = '{0,0,0,0,0}'::int[];
+"""
+
+forward = """
+    ALTER TABLE catmaid_skeleton_connectivity
+        ADD CONSTRAINT catmaid_skeleton_connectivity_source_skeleton_id_fk
+        FOREIGN KEY (source_skeleton_id) REFERENCES class_instance (id)
+        ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED;
+    ALTER TABLE catmaid_skeleton_connectivity
+        ADD CONSTRAINT catmaid_skeleton_connectivity_target_skeleton_id_fk
+        FOREIGN KEY (target_skeleton_id) REFERENCES class_instance (id)
+        ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED;
+
+    -- Rows without any link pair are removed after each update
+    CREATE INDEX catmaid_skeleton_connectivity_empty_idx
+        ON catmaid_skeleton_connectivity (id)
+        WHERE confidence_counts = '{0,0,0,0,0}'::int[];
+
+
+    CREATE OR REPLACE FUNCTION on_insert_treenode_connector_update_connectivity()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        """ + lock_connectors("""
+            SELECT connector_id FROM inserted_treenode_connector
+        """) + """
+
+        WITH new_link AS (
+            SELECT * FROM inserted_treenode_connector
+        ), """ + link_pair_count_ctes('new_link', """(
+            SELECT tc.* FROM treenode_connector tc
+            WHERE NOT EXISTS (SELECT 1 FROM new_link n WHERE n.id = tc.id)
+        )""") + add_link_pair_counts + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_edit_treenode_connector_update_connectivity()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        """ + lock_connectors("""
+            SELECT connector_id FROM old_treenode_connector
+            UNION
+            SELECT connector_id FROM new_treenode_connector
+        """) + """
+
+        -- Remove link pairs of the old version of all links that changed in
+        -- a way that matters for connectivity.
+        WITH old_link_data AS (
+            SELECT * FROM old_treenode_connector
+        ), new_link_data AS (
+            SELECT * FROM new_treenode_connector
+        ), changed_link AS (
+            SELECT ol.id
+            FROM old_link_data ol
+            JOIN new_link_data nl
+                ON ol.id = nl.id
+            WHERE ol.skeleton_id <> nl.skeleton_id
+                OR ol.relation_id <> nl.relation_id
+                OR ol.connector_id <> nl.connector_id
+                OR ol.confidence <> nl.confidence
+        ), old_link AS (
+            SELECT ol.*
+            FROM old_link_data ol
+            JOIN changed_link cl
+                ON ol.id = cl.id
+        ), """ + link_pair_count_ctes('old_link', """(
+            SELECT tc.* FROM treenode_connector tc
+            WHERE NOT EXISTS (SELECT 1 FROM changed_link c WHERE c.id = tc.id)
+        )""") + subtract_link_pair_counts + """
+
+        -- Add link pairs of the new version of these links.
+        WITH old_link_data AS (
+            SELECT * FROM old_treenode_connector
+        ), new_link_data AS (
+            SELECT * FROM new_treenode_connector
+        ), changed_link AS (
+            SELECT nl.id
+            FROM old_link_data ol
+            JOIN new_link_data nl
+                ON ol.id = nl.id
+            WHERE ol.skeleton_id <> nl.skeleton_id
+                OR ol.relation_id <> nl.relation_id
+                OR ol.connector_id <> nl.connector_id
+                OR ol.confidence <> nl.confidence
+        ), new_link AS (
+            SELECT nl.*
+            FROM new_link_data nl
+            JOIN changed_link cl
+                ON nl.id = cl.id
+        ), """ + link_pair_count_ctes('new_link', """(
+            SELECT tc.* FROM treenode_connector tc
+            WHERE NOT EXISTS (SELECT 1 FROM changed_link c WHERE c.id = tc.id)
+        )""") + add_link_pair_counts + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_delete_treenode_connector_update_connectivity()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        """ + lock_connectors("""
+            SELECT connector_id FROM deleted_treenode_connector
+        """) + """
+
+        WITH old_link AS (
+            SELECT * FROM deleted_treenode_connector
+        ), """ + link_pair_count_ctes('old_link', 'treenode_connector') + \
+        subtract_link_pair_counts + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE TRIGGER on_insert_treenode_connector_update_connectivity
+    AFTER INSERT ON treenode_connector
+    REFERENCING NEW TABLE AS inserted_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_treenode_connector_update_connectivity();
+
+    CREATE TRIGGER on_edit_treenode_connector_update_connectivity
+    AFTER UPDATE ON treenode_connector
+    REFERENCING NEW TABLE AS new_treenode_connector OLD TABLE AS old_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_connector_update_connectivity();
+
+    CREATE TRIGGER on_delete_treenode_connector_update_connectivity
+    AFTER DELETE ON treenode_connector
+    REFERENCING OLD TABLE AS deleted_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_treenode_connector_update_connectivity();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_treenode_connector_update_connectivity ON treenode_connector;
+    DROP TRIGGER on_edit_treenode_connector_update_connectivity ON treenode_connector;
+    DROP TRIGGER on_delete_treenode_connector_update_connectivity ON treenode_connector;
+
+    DROP FUNCTION on_insert_treenode_connector_update_connectivity();
+    DROP FUNCTION on_edit_treenode_connector_update_connectivity();
+    DROP FUNCTION on_delete_treenode_connector_update_connectivity();
+"""
+
+# Count all link pairs of existing connectors
+initial_data = """
+    INSERT INTO catmaid_skeleton_connectivity (project_id, source_skeleton_id,
+        source_relation_id, target_skeleton_id, target_relation_id,
+        confidence_counts)
+    SELECT t1.project_id, t1.skeleton_id, t1.relation_id, t2.skeleton_id,
+        t2.relation_id, ARRAY[
+            COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 1),
+            COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 2),
+            COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 3),
+            COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 4),
+            COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 5)
+        ]::int[]
+    FROM treenode_connector t1
+    JOIN treenode_connector t2
+        ON t1.connector_id = t2.connector_id
+        AND t1.id <> t2.id
+    GROUP BY t1.project_id, t1.skeleton_id, t1.relation_id, t2.skeleton_id,
+        t2.relation_id;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a table that stores the number of links between pairs of skeletons
+    through shared connectors. It is maintained by triggers on the
+    treenode_connector table and can be rebuilt at any time, which is why it
+    doesn't need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0041_add_node_overview_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SkeletonConnectivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('confidence_counts', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=5)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                # Create skeleton ID constraints manually below
+                ('source_relation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.Relation')),
+                ('source_skeleton', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.ClassInstance')),
+                ('target_relation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.Relation')),
+                ('target_skeleton', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.ClassInstance')),
+            ],
+            options={
+                'db_table': 'catmaid_skeleton_connectivity',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='skeletonconnectivity',
+            unique_together=set([('source_skeleton', 'source_relation', 'target_skeleton', 'target_relation')]),
+        ),
+        migrations.RunSQL(forward, backward),
+        migrations.RunSQL(initial_data, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def refresh_reviewer_summaries(affected_pairs):
+    """Return a statement that recomputes the review summary of all skeleton
+    and reviewer combinations returned by the <affected_pairs> query.
+    Combinations without any review left are removed from the summary.
+    """
+    return """
+        WITH affected_pair AS (
+            {affected_pairs}
+        ), pair_summary AS (
+            SELECT ap.skeleton_id, ap.reviewer_id, s.project_id,
+                s.num_reviewed_nodes, s.first_review_time, s.last_review_time
+            FROM affected_pair ap
+            CROSS JOIN LATERAL (
+                SELECT MAX(r.project_id) AS project_id,
+                    COUNT(DISTINCT r.treenode_id) AS num_reviewed_nodes,
+                    MIN(r.review_time) AS first_review_time,
+                    MAX(r.review_time) AS last_review_time
+                FROM review r
+                WHERE r.skeleton_id = ap.skeleton_id
+                AND r.reviewer_id = ap.reviewer_id
+            ) s
+        ), removed_pair AS (
+            DELETE FROM catmaid_skeleton_review_summary srs
+            USING pair_summary ps
+            WHERE ps.num_reviewed_nodes = 0
+            AND srs.skeleton_id = ps.skeleton_id
+            AND srs.reviewer_id = ps.reviewer_id
+        )
+        INSERT INTO catmaid_skeleton_review_summary (project_id, skeleton_id,
+            reviewer_id, num_reviewed_nodes, first_review_time,
+            last_review_time)
+        SELECT project_id, skeleton_id, reviewer_id, num_reviewed_nodes,
+            first_review_time, last_review_time
+        FROM pair_summary
+        WHERE num_reviewed_nodes > 0
+        ON CONFLICT (skeleton_id, reviewer_id)
+        DO UPDATE SET num_reviewed_nodes = EXCLUDED.num_reviewed_nodes,
+            first_review_time = EXCLUDED.first_review_time,
+            last_review_time = EXCLUDED.last_review_time;
+    """.format(affected_pairs=affected_pairs)
+
+
+def refresh_union_summaries(affected_skeletons):
+    """Return a statement that recomputes the union review summary, i.e. the
+    row without reviewer, of all skeletons returned by the
+    <affected_skeletons> query.
+    """
+    return """
+        WITH affected_skeleton AS (
+            {affected_skeletons}
+        ), skeleton_summary AS (
+            SELECT ask.skeleton_id, s.project_id, s.num_reviewed_nodes,
+                s.first_review_time, s.last_review_time
+            FROM affected_skeleton ask
+            CROSS JOIN LATERAL (
+                SELECT MAX(r.project_id) AS project_id,
+                    COUNT(DISTINCT r.treenode_id) AS num_reviewed_nodes,
+                    MIN(r.review_time) AS first_review_time,
+                    MAX(r.review_time) AS last_review_time
+                FROM review r
+                WHERE r.skeleton_id = ask.skeleton_id
+            ) s
+        ), removed_skeleton AS (
+            DELETE FROM catmaid_skeleton_review_summary srs
+            USING skeleton_summary ss
+            WHERE ss.num_reviewed_nodes = 0
+            AND srs.skeleton_id = ss.skeleton_id
+            AND srs.reviewer_id IS NULL
+        )
+        INSERT INTO catmaid_skeleton_review_summary (project_id, skeleton_id,
+            reviewer_id, num_reviewed_nodes, first_review_time,
+            last_review_time)
+        SELECT project_id, skeleton_id, NULL, num_reviewed_nodes,
+            first_review_time, last_review_time
+        FROM skeleton_summary
+        WHERE num_reviewed_nodes > 0
+        ON CONFLICT (skeleton_id) WHERE reviewer_id IS NULL
+        DO UPDATE SET num_reviewed_nodes = EXCLUDED.num_reviewed_nodes,
+            first_review_time = EXCLUDED.first_review_time,
+            last_review_time = EXCLUDED.last_review_time;
+    """.format(affected_skeletons=affected_skeletons)
+
+
+def lock_union_summaries(affected_reviews):
+    """Return a statement that locks the union review summary of all skeletons
+    of the reviews returned by the <affected_reviews> query, creating it if
+    needed. Concurrent review changes of the same skeletons have to wait for
+    this transaction to finish, which makes sure a following recount of the
+    union summary, which uses a new snapshot, sees all their reviews. Changes
+    made in a transaction with a higher isolation level can't be accounted
+    for, they would need a rebuild of the summary table.
+    """
+    return """
+        INSERT INTO catmaid_skeleton_review_summary (project_id, skeleton_id,
+            reviewer_id, num_reviewed_nodes, first_review_time,
+            last_review_time)
+        SELECT MAX(ar.project_id), ar.skeleton_id, NULL, 0,
+            MIN(ar.review_time), MAX(ar.review_time)
+        FROM ({affected_reviews}) ar
+        GROUP BY ar.skeleton_id
+        ORDER BY ar.skeleton_id
+        ON CONFLICT (skeleton_id) WHERE reviewer_id IS NULL
+        DO UPDATE SET num_reviewed_nodes =
+            catmaid_skeleton_review_summary.num_reviewed_nodes;
+    """.format(affected_reviews=affected_reviews)
+
+
+forward = """
+    ALTER TABLE catmaid_skeleton_review_summary
+        ADD CONSTRAINT catmaid_skeleton_review_summary_skeleton_id_fk
+        FOREIGN KEY (skeleton_id) REFERENCES class_instance (id)
+        ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED;
+    ALTER TABLE catmaid_skeleton_review_summary
+        ADD CONSTRAINT catmaid_skeleton_review_summary_reviewer_id_fk
+        FOREIGN KEY (reviewer_id) REFERENCES auth_user (id)
+        ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED;
+
+    -- Rows without reviewer store the union review of a skeleton, i.e. the
+    -- number of nodes reviewed by anyone.
+    CREATE UNIQUE INDEX catmaid_skeleton_review_summary_union_uniq
+        ON catmaid_skeleton_review_summary (skeleton_id)
+        WHERE reviewer_id IS NULL;
+
+    -- Allow fast recomputation of the summary of a skeleton and reviewer.
+    CREATE INDEX review_skeleton_id_reviewer_id_idx
+        ON review (skeleton_id, reviewer_id);
+
+
+    CREATE OR REPLACE FUNCTION on_insert_review_update_summary()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        """ + refresh_reviewer_summaries("""
+            SELECT DISTINCT skeleton_id, reviewer_id
+            FROM inserted_review
+        """) + """
+
+        -- New reviews only add to the union review if their nodes haven't
+        -- been reviewed before by anyone, which is why it is recounted.
+        """ + lock_union_summaries("""
+            SELECT project_id, skeleton_id, review_time FROM inserted_review
+        """) + refresh_union_summaries("""
+            SELECT DISTINCT skeleton_id
+            FROM inserted_review
+        """) + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_edit_review_update_summary()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        -- Both the old and the new skeleton and reviewer of changed reviews
+        -- need to be updated.
+        """ + refresh_reviewer_summaries("""
+            SELECT skeleton_id, reviewer_id FROM old_review
+            UNION
+            SELECT skeleton_id, reviewer_id FROM new_review
+        """) + lock_union_summaries("""
+            SELECT project_id, skeleton_id, review_time FROM old_review
+            UNION ALL
+            SELECT project_id, skeleton_id, review_time FROM new_review
+        """) + refresh_union_summaries("""
+            SELECT skeleton_id FROM old_review
+            UNION
+            SELECT skeleton_id FROM new_review
+        """) + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_delete_review_update_summary()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        """ + refresh_reviewer_summaries("""
+            SELECT DISTINCT skeleton_id, reviewer_id
+            FROM deleted_review
+        """) + lock_union_summaries("""
+            SELECT project_id, skeleton_id, review_time FROM deleted_review
+        """) + refresh_union_summaries("""
+            SELECT DISTINCT skeleton_id
+            FROM deleted_review
+        """) + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE TRIGGER on_insert_review_update_summary
+    AFTER INSERT ON review
+    REFERENCING NEW TABLE AS inserted_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_review_update_summary();
+
+    CREATE TRIGGER on_edit_review_update_summary
+    AFTER UPDATE ON review
+    REFERENCING NEW TABLE AS new_review OLD TABLE AS old_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_review_update_summary();
+
+    CREATE TRIGGER on_delete_review_update_summary
+    AFTER DELETE ON review
+    REFERENCING OLD TABLE AS deleted_review
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_review_update_summary();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_review_update_summary ON review;
+    DROP TRIGGER on_edit_review_update_summary ON review;
+    DROP TRIGGER on_delete_review_update_summary ON review;
+
+    DROP FUNCTION on_insert_review_update_summary();
+    DROP FUNCTION on_edit_review_update_summary();
+    DROP FUNCTION on_delete_review_update_summary();
+
+    DROP INDEX review_skeleton_id_reviewer_id_idx;
+"""
+
+# Summarize all existing reviews, per reviewer and as union
+initial_data = """
+    INSERT INTO catmaid_skeleton_review_summary (project_id, skeleton_id,
+        reviewer_id, num_reviewed_nodes, first_review_time, last_review_time)
+    SELECT MAX(project_id), skeleton_id, reviewer_id,
+        COUNT(DISTINCT treenode_id), MIN(review_time), MAX(review_time)
+    FROM review
+    GROUP BY skeleton_id, reviewer_id;
+
+    INSERT INTO catmaid_skeleton_review_summary (project_id, skeleton_id,
+        reviewer_id, num_reviewed_nodes, first_review_time, last_review_time)
+    SELECT MAX(project_id), skeleton_id, NULL,
+        COUNT(DISTINCT treenode_id), MIN(review_time), MAX(review_time)
+    FROM review
+    GROUP BY skeleton_id;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a table that stores the number of reviewed nodes of each skeleton,
+    both per reviewer and as union of all reviewers. It is maintained by
+    triggers on the review table and can be rebuilt at any time, which is why
+    it doesn't need history tracking.
+    """
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catmaid', '0042_add_skeleton_connectivity_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SkeletonReviewSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_reviewed_nodes', models.IntegerField(default=0)),
+                ('first_review_time', models.DateTimeField()),
+                ('last_review_time', models.DateTimeField()),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                # Create skeleton and reviewer ID constraints manually below
+                ('reviewer', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('skeleton', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.ClassInstance')),
+            ],
+            options={
+                'db_table': 'catmaid_skeleton_review_summary',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='skeletonreviewsummary',
+            unique_together=set([('skeleton', 'reviewer')]),
+        ),
+        migrations.RunSQL(forward, backward),
+        migrations.RunSQL(initial_data, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Previously, incremental updates continued one hour before the last hour with
+# non-zero values of a metric. With a checkpoint at this last hour, updates
+# continue from the same point in time.
+initial_data = """
+    INSERT INTO catmaid_stats_summary_checkpoint (project_id, metric, last_update)
+    SELECT project_id, metric, date_trunc('hour', MAX(date))
+    FROM catmaid_stats_summary,
+    LATERAL (
+        SELECT 'n_reviewed_nodes' WHERE n_reviewed_nodes > 0
+        UNION ALL
+        SELECT 'n_connector_links' WHERE n_connector_links > 0
+        UNION ALL
+        SELECT 'cable_length' WHERE cable_length > 0
+        UNION ALL
+        SELECT 'n_treenodes' WHERE n_treenodes > 0
+        UNION ALL
+        SELECT 'n_imported_treenodes' WHERE n_imported_treenodes > 0
+    ) m(metric)
+    GROUP BY project_id, metric;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a table to store until when each statistics summary metric has been
+    computed for a project. Like the summary table itself, it doesn't need
+    history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0043_add_skeleton_review_summary_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsSummaryCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.TextField()),
+                ('last_update', models.DateTimeField()),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+            ],
+            options={
+                'db_table': 'catmaid_stats_summary_checkpoint',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='statssummarycheckpoint',
+            unique_together=set([('project', 'metric')]),
+        ),
+        migrations.RunSQL(initial_data, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def annotation_links(links):
+    """Return a query that selects all links of <links> by which an annotation
+    is annotated with another annotation, i.e. all meta-annotation links.
+    """
+    return """
+        SELECT cici.project_id, cici.class_instance_b AS ancestor_id,
+            cici.class_instance_a AS descendant_id
+        FROM {links} cici
+        JOIN relation r
+            ON r.id = cici.relation_id
+        JOIN class_instance ci_a
+            ON ci_a.id = cici.class_instance_a
+        JOIN class c_a
+            ON c_a.id = ci_a.class_id
+        JOIN class_instance ci_b
+            ON ci_b.id = cici.class_instance_b
+        JOIN class c_b
+            ON c_b.id = ci_b.class_id
+        WHERE r.relation_name = 'annotated_with'
+        AND c_a.class_name = 'annotation'
+        AND c_b.class_name = 'annotation'
+    """.format(links=links)
+
+
+def affected_ancestors(changed_ancestors):
+    """Return a query that selects the annotations whose closure needs to be
+    updated if the sub-annotations of the annotations returned by the
+    <changed_ancestors> query changed: these annotations themselves and all
+    their ancestors.
+    """
+    return """
+        WITH changed_ancestor AS (
+            {changed_ancestors}
+        )
+        SELECT array_agg(DISTINCT a.id)
+        FROM (
+            SELECT ancestor_id AS id FROM changed_ancestor
+            UNION ALL
+            SELECT c.ancestor_id
+            FROM catmaid_annotation_closure c
+            JOIN changed_ancestor ca
+                ON c.descendant_id = ca.ancestor_id
+        ) a
+    """.format(changed_ancestors=changed_ancestors)
+
+
+# Deleted links can't be checked for their class instance classes, because the
+# class instances might have been deleted as well. A deleted link needs to be
+# looked at if it is part of the closure.
+def deleted_annotation_links(links):
+    return """
+        SELECT cici.class_instance_b AS ancestor_id
+        FROM {links} cici
+        JOIN catmaid_annotation_closure c
+            ON c.ancestor_id = cici.class_instance_b
+            AND c.descendant_id = cici.class_instance_a
+            AND c.depth = 1
+    """.format(links=links)
+
+
+def lock_annotation_closure(changed_links):
+    """Return a statement that locks the annotation closure of the projects of
+    all links returned by the <changed_links> query. New paths can combine
+    links of concurrent transactions, which wouldn't see each other's links.
+    Concurrent changes of meta-annotation links of the same project have to
+    wait for this transaction to finish, which makes sure a following update
+    of the closure, which uses a new snapshot, sees all their links. Changes
+    made in a transaction with a higher isolation level can't be accounted
+    for, they would need a rebuild of the closure.
+    """
+    return """
+        PERFORM pg_advisory_xact_lock(
+            'catmaid_annotation_closure'::regclass::int, p.project_id)
+        FROM (
+            SELECT DISTINCT project_id
+            FROM ({changed_links}) l
+            ORDER BY project_id
+        ) p;
+    """.format(changed_links=changed_links)
+
+
+forward = """
+    -- Recompute all sub-annotations of the passed in annotations. The
+    -- hierarchy is traversed breadth first, which makes sure each
+    -- sub-annotation is stored with its shortest distance and cycles are
+    -- handled.
+    CREATE OR REPLACE FUNCTION refresh_annotation_closure(ancestor_ids bigint[])
+        RETURNS void
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        current_depth integer := 1;
+        n_added integer;
+    BEGIN
+        DELETE FROM catmaid_annotation_closure
+        WHERE ancestor_id = ANY(ancestor_ids);
+
+        INSERT INTO catmaid_annotation_closure (project_id, ancestor_id,
+            descendant_id, depth)
+        SELECT l.project_id, l.ancestor_id, l.descendant_id, 1
+        FROM (""" + annotation_links('class_instance_class_instance') + """) l
+        WHERE l.ancestor_id = ANY(ancestor_ids)
+        ON CONFLICT (ancestor_id, descendant_id) DO NOTHING;
+        GET DIAGNOSTICS n_added = ROW_COUNT;
+
+        WHILE n_added > 0 LOOP
+            INSERT INTO catmaid_annotation_closure (project_id, ancestor_id,
+                descendant_id, depth)
+            SELECT c.project_id, c.ancestor_id, l.descendant_id,
+                current_depth + 1
+            FROM catmaid_annotation_closure c
+            JOIN (""" + annotation_links('class_instance_class_instance') + """) l
+                ON l.ancestor_id = c.descendant_id
+            WHERE c.ancestor_id = ANY(ancestor_ids)
+            AND c.depth = current_depth
+            ON CONFLICT (ancestor_id, descendant_id) DO NOTHING;
+            GET DIAGNOSTICS n_added = ROW_COUNT;
+
+            current_depth := current_depth + 1;
+        END LOOP;
+    END;
+    $$;
+
+
+    -- New links only add paths to the closure, which don't need a full
+    -- recomputation: each new link connects the annotation it links to and
+    -- all its ancestors with the linked annotation and all its descendants.
+    -- This is repeated until no path is added or shortened anymore, which
+    -- also covers paths that use multiple new links.
+    CREATE OR REPLACE FUNCTION on_insert_cici_update_annotation_closure()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        n_changed integer;
+    BEGIN
+        """ + lock_annotation_closure(
+                annotation_links('inserted_cici')) + """
+
+        LOOP
+            INSERT INTO catmaid_annotation_closure (project_id, ancestor_id,
+                descendant_id, depth)
+            SELECT l.project_id, a.ancestor_id, d.descendant_id,
+                MIN(a.depth + 1 + d.depth)
+            FROM (""" + annotation_links('inserted_cici') + """) l
+            CROSS JOIN LATERAL (
+                SELECT l.ancestor_id, 0 AS depth
+                UNION ALL
+                SELECT c.ancestor_id, c.depth
+                FROM catmaid_annotation_closure c
+                WHERE c.descendant_id = l.ancestor_id
+            ) a
+            CROSS JOIN LATERAL (
+                SELECT l.descendant_id, 0 AS depth
+                UNION ALL
+                SELECT c.descendant_id, c.depth
+                FROM catmaid_annotation_closure c
+                WHERE c.ancestor_id = l.descendant_id
+            ) d
+            GROUP BY l.project_id, a.ancestor_id, d.descendant_id
+            ON CONFLICT (ancestor_id, descendant_id) DO UPDATE
+            SET depth = LEAST(catmaid_annotation_closure.depth, EXCLUDED.depth)
+            WHERE EXCLUDED.depth < catmaid_annotation_closure.depth;
+            GET DIAGNOSTICS n_changed = ROW_COUNT;
+
+            EXIT WHEN n_changed = 0;
+        END LOOP;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_edit_cici_update_annotation_closure()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        ancestor_ids bigint[];
+    BEGIN
+        """ + lock_annotation_closure("""
+            SELECT project_id FROM (
+        """ + annotation_links('new_cici') + """
+            ) l
+            UNION
+            SELECT cici.project_id FROM old_cici cici
+            JOIN (""" + deleted_annotation_links('old_cici') + """) d
+                ON d.ancestor_id = cici.class_instance_b
+        """) + """
+
+        -- Both the old and the new annotations of changed links need to be
+        -- updated.
+        """ + affected_ancestors("""
+            SELECT ancestor_id FROM (
+        """ + annotation_links('new_cici') + """
+            ) l
+            UNION
+        """ + deleted_annotation_links('old_cici')) + """
+        INTO ancestor_ids;
+
+        IF ancestor_ids IS NOT NULL THEN
+            PERFORM refresh_annotation_closure(ancestor_ids);
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_delete_cici_update_annotation_closure()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        ancestor_ids bigint[];
+    BEGIN
+        """ + lock_annotation_closure("""
+            SELECT cici.project_id FROM deleted_cici cici
+            JOIN (""" + deleted_annotation_links('deleted_cici') + """) d
+                ON d.ancestor_id = cici.class_instance_b
+        """) + """
+
+        """ + affected_ancestors(deleted_annotation_links('deleted_cici')) + """
+        INTO ancestor_ids;
+
+        IF ancestor_ids IS NOT NULL THEN
+            PERFORM refresh_annotation_closure(ancestor_ids);
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE TRIGGER on_insert_cici_update_annotation_closure
+    AFTER INSERT ON class_instance_class_instance
+    REFERENCING NEW TABLE AS inserted_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_cici_update_annotation_closure();
+
+    CREATE TRIGGER on_edit_cici_update_annotation_closure
+    AFTER UPDATE ON class_instance_class_instance
+    REFERENCING NEW TABLE AS new_cici OLD TABLE AS old_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_cici_update_annotation_closure();
+
+    CREATE TRIGGER on_delete_cici_update_annotation_closure
+    AFTER DELETE ON class_instance_class_instance
+    REFERENCING OLD TABLE AS deleted_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_cici_update_annotation_closure();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_cici_update_annotation_closure ON class_instance_class_instance;
+    DROP TRIGGER on_edit_cici_update_annotation_closure ON class_instance_class_instance;
+    DROP TRIGGER on_delete_cici_update_annotation_closure ON class_instance_class_instance;
+
+    DROP FUNCTION on_insert_cici_update_annotation_closure();
+    DROP FUNCTION on_edit_cici_update_annotation_closure();
+    DROP FUNCTION on_delete_cici_update_annotation_closure();
+    DROP FUNCTION refresh_annotation_closure(bigint[]);
+"""
+
+# Compute the closure of all annotations that have sub-annotations
+initial_data = """
+    SELECT refresh_annotation_closure(array_agg(DISTINCT l.ancestor_id))
+    FROM (""" + annotation_links('class_instance_class_instance') + """) l
+    HAVING COUNT(*) > 0;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a table that stores for each annotation all annotations that are
+    annotated with it, directly or transitively, along with their distance in
+    the annotation hierarchy. It is maintained by triggers on the
+    class_instance_class_instance table and can be rebuilt at any time, which
+    is why it doesn't need history tracking.
+    """
+
+    dependencies = [
+        ('catmaid', '0044_add_stats_summary_checkpoint_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                # Closure entries are removed by the class_instance_class_instance
+                # triggers below, which need to see them when links of deleted
+                # annotations are removed.
+                ('ancestor', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='catmaid.ClassInstance')),
+                ('descendant', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='catmaid.ClassInstance')),
+            ],
+            options={
+                'db_table': 'catmaid_annotation_closure',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='annotationclosure',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.RunSQL(forward, backward),
+        migrations.RunSQL(initial_data, migrations.RunSQL.noop),
+    ]
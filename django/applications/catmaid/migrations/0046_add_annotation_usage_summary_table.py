@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def annotation_usage(links):
+    """Return a query that selects all links of <links> by which something is
+    annotated with an annotation, i.e. all uses of annotations.
+    """
+    return """
+        SELECT l.project_id, l.class_instance_b AS annotation_id, l.user_id,
+            l.creation_time
+        FROM {links} l
+        JOIN relation r
+            ON r.id = l.relation_id
+        JOIN class_instance ci
+            ON ci.id = l.class_instance_b
+        JOIN class c
+            ON c.id = ci.class_id
+        WHERE r.relation_name = 'annotated_with'
+        AND c.class_name = 'annotation'
+    """.format(links=links)
+
+
+def add_usage(links):
+    """Return statements that add all annotation uses in <links> to the usage
+    summary, both per user and as union of all users.
+    """
+    return """
+        WITH usage AS (
+            """ + annotation_usage(links) + """
+        )
+        INSERT INTO catmaid_annotation_usage_summary (project_id,
+            annotation_id, user_id, num_usage, last_used, last_user_id)
+        SELECT MAX(project_id), annotation_id, user_id, COUNT(*),
+            MAX(creation_time), user_id
+        FROM usage
+        GROUP BY annotation_id, user_id
+        ON CONFLICT (annotation_id, user_id)
+        DO UPDATE SET num_usage =
+                catmaid_annotation_usage_summary.num_usage + EXCLUDED.num_usage,
+            last_used = GREATEST(catmaid_annotation_usage_summary.last_used,
+                EXCLUDED.last_used);
+
+        WITH usage AS (
+            """ + annotation_usage(links) + """
+        ), annotation_usage AS (
+            SELECT DISTINCT ON (annotation_id) project_id, annotation_id,
+                COUNT(*) OVER (PARTITION BY annotation_id) AS num_usage,
+                creation_time AS last_used, user_id AS last_user_id
+            FROM usage
+            ORDER BY annotation_id, creation_time DESC
+        )
+        INSERT INTO catmaid_annotation_usage_summary (project_id,
+            annotation_id, user_id, num_usage, last_used, last_user_id)
+        SELECT project_id, annotation_id, NULL, num_usage, last_used,
+            last_user_id
+        FROM annotation_usage
+        ON CONFLICT (annotation_id) WHERE user_id IS NULL
+        DO UPDATE SET num_usage =
+                catmaid_annotation_usage_summary.num_usage + EXCLUDED.num_usage,
+            last_used = GREATEST(catmaid_annotation_usage_summary.last_used,
+                EXCLUDED.last_used),
+            last_user_id = CASE
+                WHEN EXCLUDED.last_used >= catmaid_annotation_usage_summary.last_used
+                THEN EXCLUDED.last_user_id
+                ELSE catmaid_annotation_usage_summary.last_user_id
+            END;
+    """
+
+
+def removed_usage(links, user_column):
+    """Return a query that selects the number of removed uses and the time of
+    the last removed use in <links>, grouped by annotation and the passed in
+    user column. Removed links can't be checked for the class of the linked
+    class instance, because it might have been deleted as well. Only links to
+    annotations with a usage summary are of interest though.
+    """
+    return """
+        SELECT l.class_instance_b AS annotation_id, {user_column} AS user_id,
+            COUNT(*) AS num_usage, MAX(l.creation_time) AS last_used
+        FROM {links} l
+        JOIN relation r
+            ON r.id = l.relation_id
+        WHERE r.relation_name = 'annotated_with'
+        GROUP BY l.class_instance_b, {user_column}
+    """.format(links=links, user_column=user_column)
+
+
+def remove_usage(links):
+    """Return statements that remove all annotation uses in <links> from the
+    usage summary. Counts are decremented and rows without any use left are
+    removed. Only if the last use of an annotation has been removed, its last
+    use and user are looked up again.
+    """
+    statements = []
+    for user_column, user_condition in (('l.user_id', 's.user_id = ru.user_id'),
+            ('NULL::integer', 's.user_id IS NULL')):
+        removed = removed_usage(links, user_column)
+        statements.append("""
+            UPDATE catmaid_annotation_usage_summary s
+            SET num_usage = s.num_usage - ru.num_usage
+            FROM ({removed}) ru
+            WHERE s.annotation_id = ru.annotation_id
+            AND {user_condition};
+
+            DELETE FROM catmaid_annotation_usage_summary s
+            USING ({removed}) ru
+            WHERE s.annotation_id = ru.annotation_id
+            AND {user_condition}
+            AND s.num_usage <= 0;
+
+            UPDATE catmaid_annotation_usage_summary s
+            SET (last_used, last_user_id) = (
+                SELECT cici.creation_time, cici.user_id
+                FROM class_instance_class_instance cici
+                JOIN relation r
+                    ON r.id = cici.relation_id
+                WHERE cici.class_instance_b = s.annotation_id
+                AND r.relation_name = 'annotated_with'
+                AND (s.user_id IS NULL OR cici.user_id = s.user_id)
+                ORDER BY cici.creation_time DESC
+                LIMIT 1
+            )
+            FROM ({removed}) ru
+            WHERE s.annotation_id = ru.annotation_id
+            AND {user_condition}
+            AND ru.last_used >= s.last_used;
+        """.format(removed=removed, user_condition=user_condition))
+
+    return ''.join(statements)
+
+
+forward = """
+    ALTER TABLE catmaid_annotation_usage_summary
+        ADD CONSTRAINT catmaid_annotation_usage_summary_annotation_id_fk
+        FOREIGN KEY (annotation_id) REFERENCES class_instance (id)
+        ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED;
+    ALTER TABLE catmaid_annotation_usage_summary
+        ADD CONSTRAINT catmaid_annotation_usage_summary_user_id_fk
+        FOREIGN KEY (user_id) REFERENCES auth_user (id)
+        ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED;
+    ALTER TABLE catmaid_annotation_usage_summary
+        ADD CONSTRAINT catmaid_annotation_usage_summary_last_user_id_fk
+        FOREIGN KEY (last_user_id) REFERENCES auth_user (id)
+        ON DELETE SET NULL DEFERRABLE INITIALLY DEFERRED;
+
+    -- Rows without user store the usage of an annotation by anyone.
+    CREATE UNIQUE INDEX catmaid_annotation_usage_summary_union_uniq
+        ON catmaid_annotation_usage_summary (annotation_id)
+        WHERE user_id IS NULL;
+
+    -- Allow fast lookup of the last use of an annotation.
+    CREATE INDEX class_instance_class_instance_b_creation_time_idx
+        ON class_instance_class_instance (class_instance_b, creation_time);
+
+
+    CREATE OR REPLACE FUNCTION on_insert_cici_update_annotation_usage()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        """ + add_usage('inserted_cici') + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_edit_cici_update_annotation_usage()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        -- Changed links are treated like removed old links and new links.
+        """ + remove_usage('old_cici') + add_usage('new_cici') + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE OR REPLACE FUNCTION on_delete_cici_update_annotation_usage()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        """ + remove_usage('deleted_cici') + """
+
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE TRIGGER on_insert_cici_update_annotation_usage
+    AFTER INSERT ON class_instance_class_instance
+    REFERENCING NEW TABLE AS inserted_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_cici_update_annotation_usage();
+
+    CREATE TRIGGER on_edit_cici_update_annotation_usage
+    AFTER UPDATE ON class_instance_class_instance
+    REFERENCING NEW TABLE AS new_cici OLD TABLE AS old_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_cici_update_annotation_usage();
+
+    CREATE TRIGGER on_delete_cici_update_annotation_usage
+    AFTER DELETE ON class_instance_class_instance
+    REFERENCING OLD TABLE AS deleted_cici
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_cici_update_annotation_usage();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_cici_update_annotation_usage ON class_instance_class_instance;
+    DROP TRIGGER on_edit_cici_update_annotation_usage ON class_instance_class_instance;
+    DROP TRIGGER on_delete_cici_update_annotation_usage ON class_instance_class_instance;
+
+    DROP FUNCTION on_insert_cici_update_annotation_usage();
+    DROP FUNCTION on_edit_cici_update_annotation_usage();
+    DROP FUNCTION on_delete_cici_update_annotation_usage();
+
+    DROP INDEX class_instance_class_instance_b_creation_time_idx;
+"""
+
+# Summarize all existing annotation uses, per user and as union
+initial_data = add_usage('class_instance_class_instance')
+
+
+class Migration(migrations.Migration):
+    """Add a table that stores how often each annotation has been used, when
+    it has been used last and by whom, both per user and as union of all users.
+    It is maintained by triggers on the class_instance_class_instance table and
+    can be rebuilt at any time, which is why it doesn't need history tracking.
+    """
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catmaid', '0045_add_annotation_closure_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnnotationUsageSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num_usage', models.IntegerField(default=0)),
+                ('last_used', models.DateTimeField()),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                # Create annotation and user ID constraints manually below
+                ('annotation', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.ClassInstance')),
+                ('user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('last_user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'catmaid_annotation_usage_summary',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='annotationusagesummary',
+            unique_together=set([('annotation', 'user')]),
+        ),
+        migrations.RunSQL(forward, backward),
+        migrations.RunSQL(initial_data, migrations.RunSQL.noop),
+    ]
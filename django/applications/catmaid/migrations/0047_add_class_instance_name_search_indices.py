@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+forward = """
+    -- The pg_trgm extension is part of the standard Postgres contrib modules.
+    -- If the database user isn't allowed to create it, it has to be created
+    -- by a superuser before this migration is applied.
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+    -- Allow case-insensitive prefix searches on class instance names per
+    -- project, which return results in name order. With the C collation, the
+    -- index can be used for LIKE prefix queries.
+    CREATE INDEX class_instance_project_id_upper_name_idx
+        ON class_instance (project_id, (upper(name) COLLATE "C"));
+
+    -- Allow case-insensitive substring searches on class instance names, which
+    -- are also used by Django's "icontains" lookup. A GiST index additionally
+    -- allows to return the most similar names first without ranking all
+    -- matches.
+    CREATE INDEX class_instance_upper_name_trgm_idx
+        ON class_instance USING gist (upper(name) gist_trgm_ops);
+"""
+
+backward = """
+    DROP INDEX class_instance_project_id_upper_name_idx;
+    DROP INDEX class_instance_upper_name_trgm_idx;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add indices for fast prefix, substring and similarity searches on class
+    instance names, which include neuron names, annotations and labels.
+    """
+
+    dependencies = [
+        ('catmaid', '0046_add_annotation_usage_summary_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
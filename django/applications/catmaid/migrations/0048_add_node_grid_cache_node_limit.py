@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """Store the node limit grid cache cells have been populated with, which
+    allows to return single cells without clipping them to the limit of a
+    request.
+    """
+
+    dependencies = [
+        ('catmaid', '0047_add_class_instance_name_search_indices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nodegridcache',
+            name='node_limit',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -12,7 +12,7 @@ from django import forms
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.gis.db import models as spatial_models
-from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields import ArrayField, JSONField
 from django.core.validators import RegexValidator
 from django.db import connection, models
 from django.db.models import Q
@@ -1166,6 +1166,95 @@ class SkeletonSummary(models.Model):
         return "Skeleton {} summary ({} nodes, {} nm)".format(
                 self.skeleton_id, self.num_nodes, self.cable_length)
 
+
+class SkeletonConnectivity(models.Model):
+    """Holds the number of link pairs that connect two skeletons through
+    shared connectors, for each combination of link relations. Counts are
+    grouped by the lower confidence of both links. Data insertion and updates
+    are managed by the database through triggers on the treenode_connector
+    table.
+    """
+
+    class Meta:
+        db_table = "catmaid_skeleton_connectivity"
+        unique_together = (("source_skeleton", "source_relation",
+                "target_skeleton", "target_relation"),)
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    source_skeleton = models.ForeignKey(ClassInstance, on_delete=models.CASCADE,
+            related_name='+', db_constraint=False)
+    source_relation = models.ForeignKey(Relation, on_delete=models.CASCADE,
+            related_name='+')
+    target_skeleton = models.ForeignKey(ClassInstance, on_delete=models.CASCADE,
+            related_name='+', db_constraint=False)
+    target_relation = models.ForeignKey(Relation, on_delete=models.CASCADE,
+            related_name='+')
+    # Number of link pairs for each confidence, index 0 refers to confidence 1
+    confidence_counts = ArrayField(models.IntegerField(), size=5)
+
+
+class SkeletonReviewSummary(models.Model):
+    """Holds the number of distinct nodes of a skeleton that have been reviewed
+    by a particular reviewer along with the time of the first and last review.
+    Rows without reviewer represent the union review of a skeleton, i.e. the
+    number of nodes reviewed by anyone. Data insertion and updates are managed
+    by the database through triggers on the review table.
+    """
+
+    class Meta:
+        db_table = "catmaid_skeleton_review_summary"
+        unique_together = (("skeleton", "reviewer"),)
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    skeleton = models.ForeignKey(ClassInstance, on_delete=models.CASCADE,
+            related_name='+', db_constraint=False)
+    reviewer = models.ForeignKey(User, on_delete=models.CASCADE, null=True,
+            related_name='+', db_constraint=False)
+    num_reviewed_nodes = models.IntegerField(default=0)
+    first_review_time = models.DateTimeField()
+    last_review_time = models.DateTimeField()
+
+class AnnotationClosure(models.Model):
+    """Holds for each annotation all annotations that are annotated with it,
+    directly or through other annotations, along with the shortest distance
+    between both in the annotation hierarchy. Data insertion and updates are
+    managed by the database through triggers on the class_instance_class_instance
+    table.
+    """
+
+    class Meta:
+        db_table = "catmaid_annotation_closure"
+        unique_together = (("ancestor", "descendant"),)
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    ancestor = models.ForeignKey(ClassInstance, on_delete=models.DO_NOTHING,
+            related_name='+', db_constraint=False)
+    descendant = models.ForeignKey(ClassInstance, on_delete=models.DO_NOTHING,
+            related_name='+', db_constraint=False)
+    depth = models.IntegerField()
+
+class AnnotationUsageSummary(models.Model):
+    """Holds the number of times an annotation has been used by a particular
+    user along with the time of the last use. Rows without user represent the
+    use of an annotation by anyone and also store who used it last. Data
+    insertion and updates are managed by the database through triggers on the
+    class_instance_class_instance table.
+    """
+
+    class Meta:
+        db_table = "catmaid_annotation_usage_summary"
+        unique_together = (("annotation", "user"),)
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    annotation = models.ForeignKey(ClassInstance, on_delete=models.CASCADE,
+            related_name='+', db_constraint=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True,
+            related_name='+', db_constraint=False)
+    num_usage = models.IntegerField(default=0)
+    last_used = models.DateTimeField()
+    last_user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True,
+            related_name='+', db_constraint=False)
+
 @python_2_unicode_compatible
 class StatsSummary(models.Model):
     class Meta:
@@ -1188,6 +1277,20 @@ class StatsSummary(models.Model):
         return "Stats summary for {} on {}".format(
                     self.user, self.date)
 
+
+class StatsSummaryCheckpoint(models.Model):
+    """Stores for each project and statistics summary metric (a column of the
+    statistics summary table) until which hour (exclusive) statistics have
+    been computed. Incremental updates continue from there.
+    """
+    class Meta:
+        db_table = "catmaid_stats_summary_checkpoint"
+        unique_together = (("project", "metric"),)
+
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    metric = models.TextField()
+    last_update = models.DateTimeField()
+
 class NodeQueryCache(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     orientation = models.IntegerField(default=0, null=False)
@@ -1202,6 +1305,117 @@ class NodeQueryCache(models.Model):
         unique_together = (('project', 'orientation', 'depth'),)
 
 
+class NodeQueryCacheBuild(models.Model):
+    """Keep track of a node query cache update of one orientation that is split
+    into partitions of consecutive sections. Partitions can be computed in
+    parallel and completed ones are stored in NodeQueryCacheBuildPartition,
+    which allows interrupted builds to be resumed.
+    """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    orientation = models.IntegerField(default=0, null=False)
+    step = models.FloatField(null=False)
+    data_types = ArrayField(models.TextField())
+    node_limit = models.IntegerField(null=True)
+    min_x = models.FloatField(null=False)
+    min_y = models.FloatField(null=False)
+    min_z = models.FloatField(null=False)
+    max_x = models.FloatField(null=False)
+    max_y = models.FloatField(null=False)
+    max_z = models.FloatField(null=False)
+    n_sections = models.IntegerField(null=False)
+    partition_size = models.IntegerField(null=False)
+    creation_time = models.DateTimeField(default=timezone.now)
+    completion_time = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = "node_query_cache_build"
+
+
+class NodeQueryCacheBuildPartition(models.Model):
+    build = models.ForeignKey(NodeQueryCacheBuild, on_delete=models.CASCADE)
+    partition_index = models.IntegerField(null=False)
+    completion_time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = "node_query_cache_build_partition"
+        unique_together = (('build', 'partition_index'),)
+
+
+class NodeOverviewPyramid(models.Model):
+    """Define a pyramid of pre-rendered node overview images for a stack, with
+    tiles of a particular size. The zoom levels that have been rendered are
+    stored, along with the time of the last update, which is used to find
+    outdated tiles. Tiles without nodes are not stored in NodeOverviewTile.
+    """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    stack = models.ForeignKey(Stack, on_delete=models.CASCADE)
+    tile_size = models.IntegerField(null=False)
+    zoom_levels = ArrayField(models.IntegerField(), default=list)
+    update_time = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = "node_overview_pyramid"
+        unique_together = (('project', 'stack', 'tile_size'),)
+
+
+class NodeOverviewTile(models.Model):
+    pyramid = models.ForeignKey(NodeOverviewPyramid, on_delete=models.CASCADE)
+    zoom_level = models.IntegerField(null=False)
+    section = models.IntegerField(null=False)
+    row = models.IntegerField(null=False)
+    col = models.IntegerField(null=False)
+    update_time = models.DateTimeField(default=timezone.now)
+    image = models.BinaryField(null=False)
+
+    class Meta:
+        db_table = "node_overview_tile"
+        unique_together = (('pyramid', 'zoom_level', 'section', 'row', 'col'),)
+
+
+class NodeGridCache(models.Model):
+    """Define a regular grid of cells with a particular size for a project and
+    orientation. Cell width, height and depth as well as the X, Y and Z
+    indices of cells refer to the width, height and depth dimension of the
+    orientation. Node query results for each cell are stored in
+    NodeGridCacheCell. The populated index range of the grid is stored as well:
+    cells inside this range, but without a NodeGridCacheCell entry, don't
+    contain any nodes. The node limit is the largest limit cells have been
+    populated with, NULL means no limit.
+    """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    orientation = models.IntegerField(default=0, null=False)
+    cell_width = models.FloatField(null=False)
+    cell_height = models.FloatField(null=False)
+    cell_depth = models.FloatField(null=False)
+    min_x_index = models.IntegerField(null=True)
+    min_y_index = models.IntegerField(null=True)
+    min_z_index = models.IntegerField(null=True)
+    max_x_index = models.IntegerField(null=True)
+    max_y_index = models.IntegerField(null=True)
+    max_z_index = models.IntegerField(null=True)
+    node_limit = models.IntegerField(null=True)
+
+    class Meta:
+        db_table = "node_grid_cache"
+        unique_together = (('project', 'orientation', 'cell_width',
+                'cell_height', 'cell_depth'),)
+
+
+class NodeGridCacheCell(models.Model):
+    grid = models.ForeignKey(NodeGridCache, on_delete=models.CASCADE)
+    x_index = models.IntegerField(null=False)
+    y_index = models.IntegerField(null=False)
+    z_index = models.IntegerField(null=False)
+    update_time = models.DateTimeField(default=timezone.now)
+    json_data = JSONField(blank=True, null=True)
+    json_text_data = models.TextField(blank=True, null=True)
+    msgpack_data = models.BinaryField(null=True)
+
+    class Meta:
+        db_table = "node_grid_cache_cell"
+        unique_together = (('grid', 'z_index', 'x_index', 'y_index'),)
+
+
 @python_2_unicode_compatible
 class UserProfile(models.Model):
     """ A class that stores a set of custom user preferences.
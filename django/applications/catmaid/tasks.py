@@ -4,8 +4,10 @@ from catmaid.control.cropping import cleanup as cropping_cleanup, process_crop_j
 from catmaid.control.nat import export_skeleton_as_nrrd_async
 from catmaid.control.treenodeexport import process_export_job
 from catmaid.control.roi import create_roi_image
-from catmaid.control.node import update_node_query_cache as do_update_node_query_cache
-from celery import shared_task
+from catmaid.control.nodeoverview import update_node_overview as do_update_node_overview
+from catmaid.control.node import (update_node_query_cache as do_update_node_query_cache,
+        prepare_cache_builds, update_cache_build_partition)
+from celery import group, shared_task
 
 
 @shared_task
@@ -26,6 +28,14 @@ def update_project_statistics():
     return "Updated project statistics summary"
 
 
+@shared_task
+def update_recent_project_statistics():
+    """Update project statistics of all hours with new transactions
+    """
+    call_command('catmaid_populate_summary_tables', recent=True)
+    return "Updated recent project statistics summary"
+
+
 @shared_task
 def update_node_query_cache():
     """Update the query cache of changed sections for node providers defined in
@@ -33,3 +43,41 @@ def update_node_query_cache():
     """
     do_update_node_query_cache()
     return "Updating node query cache"
+
+
+@shared_task
+def update_node_query_cache_build_partition(build_id, partition_index):
+    """Populate a single partition of a node query cache build.
+    """
+    update_cache_build_partition(build_id, partition_index)
+    return "Updated partition {} of node query cache build {}".format(
+            partition_index, build_id)
+
+
+@shared_task
+def update_node_query_cache_parallel(project_ids, data_types, orientations,
+        steps, node_limit=None, partition_size=100, resume=True):
+    """Create node query cache builds for the passed in projects and populate
+    their partitions with individual tasks, which can be processed by multiple
+    workers in parallel. By default, unfinished builds with the same parameters
+    are resumed.
+    """
+    tasks = []
+    for project_id in project_ids:
+        tasks.extend(prepare_cache_builds(project_id, data_types, orientations,
+                steps, node_limit, partition_size=partition_size,
+                resume=resume))
+    group(update_node_query_cache_build_partition.s(build_id, partition_index)
+            for build_id, partition_index in tasks).apply_async()
+    return "Queued {} node query cache partitions".format(len(tasks))
+
+
+@shared_task
+def update_node_overview(project_id, stack_id, zoom_levels, tile_size=512):
+    """Render node overview tiles of a stack that changed since their last
+    update, zoom levels that haven't been rendered yet are rendered completely.
+    """
+    do_update_node_overview(project_id, stack_id, zoom_levels, tile_size,
+            incremental=True)
+    return "Updated node overview of stack {} in project {}".format(stack_id,
+            project_id)
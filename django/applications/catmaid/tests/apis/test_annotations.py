@@ -256,3 +256,55 @@ class AnnotationsApiTests(CatmaidApiTestCase):
         ]
         self.assertEqual(parsed_response['totalRecords'], 1)
         six.assertCountEqual(self, parsed_response['entities'], expected_entities)
+
+
+    def test_annotation_datatable(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+            '/%d/annotations/add' % (self.test_project_id,),
+            {'annotations[0]': 'A',
+             'annotations[1]': 'B',
+             'annotations[2]': 'C',
+             'skeleton_ids[0]': 235,
+             'skeleton_ids[1]': 2388})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+            '/%d/annotations/add' % (self.test_project_id,),
+            {'annotations[0]': 'B',
+             'skeleton_ids[0]': 361})
+        self.assertEqual(response.status_code, 200)
+
+        def get_page(params):
+            params.update({
+                'iSortingCols': 2,
+                'iSortCol_0': 2,
+                'sSortDir_0': 'desc',
+                'iSortCol_1': 0,
+                'sSortDir_1': 'asc',
+            })
+            response = self.client.post(
+                '/%d/annotations/table-list' % (self.test_project_id,), params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content.decode('utf-8'))
+
+        # Annotations are sorted by usage count and then name
+        parsed_response = get_page({'iDisplayStart': 0, 'iDisplayLength': 2})
+        self.assertEqual(parsed_response['iTotalRecords'], 3)
+        self.assertEqual([(a[0], a[2]) for a in parsed_response['aaData']],
+                [('B', 3), ('A', 2)])
+
+        # Continuing after the last annotation of a page is the same as using
+        # an offset. The total number of annotations is only counted for the
+        # first page, later pages return the total passed in by the client.
+        last_id = parsed_response['aaData'][-1][4]
+        offset_response = get_page({'iDisplayStart': 2, 'iDisplayLength': 2})
+        keyset_response = get_page({'after_id': last_id, 'iDisplayLength': 2,
+                'total_records': parsed_response['iTotalRecords']})
+        self.assertEqual(offset_response, keyset_response)
+        self.assertEqual([(a[0], a[2]) for a in keyset_response['aaData']],
+                [('C', 2)])
+
+        keyset_response = get_page({'after_id': last_id, 'iDisplayLength': 2})
+        self.assertEqual(keyset_response['iTotalRecords'], None)
+        self.assertEqual(offset_response['aaData'], keyset_response['aaData'])
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from .common import CatmaidApiTestCase
+
+
+class GraphsApiTests(CatmaidApiTestCase):
+    def test_shortest_paths(self):
+        self.fake_authentication()
+
+        def find_shortest_paths(sources, targets, min_synapses=None):
+            params = {}
+            for i, skeleton_id in enumerate(sources):
+                params['sources[%d]' % i] = skeleton_id
+            for i, skeleton_id in enumerate(targets):
+                params['targets[%d]' % i] = skeleton_id
+            if min_synapses is not None:
+                params['min_synapses'] = min_synapses
+            response = self.client.post(
+                    '/%d/graph/shortest-paths' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content.decode('utf-8'))
+
+        # Skeleton 235 is presynaptic to 361 (one synapse) and 373 (two
+        # synapses), 2388 is presynaptic to 2364.
+        parsed_response = find_shortest_paths([235, 2388], [361, 373, 2364])
+        self.assertEqual(sorted(parsed_response),
+                [[235, 361], [235, 373], [2388, 2364]])
+
+        parsed_response = find_shortest_paths([235], [361, 373],
+                min_synapses=2)
+        self.assertEqual(parsed_response, [[235, 373]])
+
+        # Paths are directed
+        parsed_response = find_shortest_paths([361, 373], [235])
+        self.assertEqual(parsed_response, [])
+
+        parsed_response = find_shortest_paths([235], [])
+        self.assertIn('error', parsed_response)
@@ -91,6 +91,36 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_nodes_nearest(self):
+        self.fake_authentication()
+        response = self.client.post(
+                '/%d/nodes/nearest' % self.test_project_id,
+                {
+                    'points[0][0]': 5115, 'points[0][1]': 3835, 'points[0][2]': 4050,
+                    'points[1][0]': 5115, 'points[1][1]': 3835, 'points[1][2]': 0,
+                    'skeleton_ids': [2388],
+                    })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = [
+                [2394, 3110.0, 6030.0, 0.0, 2388],
+                [2394, 3110.0, 6030.0, 0.0, 2388]]
+        self.assertEqual(expected_result, parsed_response)
+
+        response = self.client.post(
+                '/%d/nodes/nearest' % self.test_project_id,
+                {
+                    'points[0][0]': 5115, 'points[0][1]': 3835, 'points[0][2]': 4050,
+                    'points[1][0]': 7030, 'points[1][1]': 1980, 'points[1][2]': 0,
+                    })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = [
+                [2437, 5290.0, 3930.0, 279.0, 2433],
+                [367, 7030.0, 1980.0, 0.0, 361]]
+        self.assertEqual(expected_result, parsed_response)
+
+
     def test_node_user_info(self):
         self.fake_authentication()
 
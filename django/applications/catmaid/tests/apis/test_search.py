@@ -151,3 +151,45 @@ class SearchApiTests(CatmaidApiTestCase):
                     "nodes":[{"id":403, "x":7840, "y":2380, "z":0, "skid":373}]},
                 {"id":233, "name":"branched neuron", "class_name":"neuron"}]
         self.assertEqual(expected_result, parsed_response)
+
+
+    def test_search_names(self):
+        self.fake_authentication()
+
+        def search(params):
+            response = self.client.get(
+                    '/%d/search/names' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content.decode('utf-8'))
+
+        # Short queries only match the beginning of names, exact matches
+        # first.
+        expected_result = [
+                {"id":2345, "name":"t", "class_name":"label", "match":"exact"},
+                {"id":351, "name":"TODO", "class_name":"label", "match":"prefix"},
+                {"id":465, "name":"tubby bye bye", "class_name":"driver_line", "match":"prefix"}]
+        self.assertEqual(expected_result, search({'query': 't'}))
+
+        expected_result = [
+                {"id":235, "name":"skeleton 235", "class_name":"skeleton", "match":"prefix"},
+                {"id":2364, "name":"skeleton 2364", "class_name":"skeleton", "match":"prefix"}]
+        self.assertEqual(expected_result,
+                search({'query': 'Skeleton 23', 'limit': 2}))
+
+        # Longer queries also match within names
+        expected_result = [
+                {"id":374, "name":"downstream-A", "class_name":"neuron", "match":"substring"},
+                {"id":362, "name":"downstream-B", "class_name":"neuron", "match":"substring"}]
+        six.assertCountEqual(self, expected_result, search({'query': 'stream'}))
+        self.assertEqual([], search({'query': 'stream', 'prefix': 'true'}))
+
+        # Type filters
+        expected_result = [
+                {"id":351, "name":"TODO", "class_name":"label", "match":"prefix"}]
+        self.assertEqual(expected_result,
+                search({'query': 'to', 'types[0]': 'label'}))
+
+        # Skeletons can be found by ID
+        expected_result = [
+                {"id":2388, "name":"skeleton 2388", "class_name":"skeleton", "match":"id"}]
+        self.assertEqual(expected_result, search({'query': '2388'}))
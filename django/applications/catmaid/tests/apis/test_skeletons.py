@@ -403,10 +403,35 @@ class SkeletonsApiTests(CatmaidApiTestCase):
                 {'treenode_id': treenode_id, 'distance': 2000, 'size_mode': 1})
         self.assertEqual(response.status_code, 200)
         parsed_response = json.loads(response.content.decode('utf-8'))
-        expected_result = [2462, 2433, 373]
+        # Skeleton 373 is within the L-infinity distance, but not within the
+        # Euclidean distance.
+        expected_result = [2462, 2433]
         six.assertCountEqual(self, expected_result, parsed_response['skeletons'])
 
 
+    def test_skeleton_within_spatial_distance_multiple(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/skeletons/within-spatial-distance/multiple' % (self.test_project_id,),
+                {'treenode_ids': [2419, 2394], 'distance': 2000, 'size_mode': 1})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        six.assertCountEqual(self, ['2419', '2394'], parsed_response['skeletons'].keys())
+        six.assertCountEqual(self, [2462, 2433],
+                parsed_response['skeletons']['2419'])
+        self.assertEqual([], parsed_response['reached_limit'])
+
+        # Each result should match the single treenode lookup
+        response = self.client.post(
+                '/%d/skeletons/within-spatial-distance' % (self.test_project_id,),
+                {'treenode_id': 2394, 'distance': 2000, 'size_mode': 1})
+        self.assertEqual(response.status_code, 200)
+        single_response = json.loads(response.content.decode('utf-8'))
+        six.assertCountEqual(self, single_response['skeletons'],
+                parsed_response['skeletons']['2394'])
+
+
     def test_skeleton_permissions(self):
         skeleton_id = 235
 
@@ -984,6 +1009,53 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.compare_swc_data(response.content.decode('utf-8'), swc_output_for_skeleton_235)
 
 
+    def test_swc_file_streamed(self):
+        self.fake_authentication()
+        url = '/%d/skeleton/235/swc' % (self.test_project_id,)
+        for linearize_ids in ('false', 'true'):
+            response = self.client.get(url, {'linearize_ids': linearize_ids})
+            self.assertEqual(response.status_code, 200)
+            expected_swc_string = response.content.decode('utf-8')
+
+            response = self.client.get(url, {'linearize_ids': linearize_ids,
+                    'stream': 'true'})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            swc_string = b''.join(response.streaming_content).decode('utf-8')
+            self.compare_swc_data(swc_string, expected_swc_string)
+
+
+    def test_measure_skeletons(self):
+        self.fake_authentication()
+        url = '/%d/skeletons/measure' % (self.test_project_id,)
+        skeleton_ids = {'skeleton_ids[0]': 235, 'skeleton_ids[1]': 373}
+        response = self.client.post(url, skeleton_ids)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(sorted(row[0] for row in parsed_response), [235, 373])
+        # Rows are skeleton ID, raw cable, smooth cable, inputs, outputs,
+        # nodes, branches, ends and principal branch cable.
+        measurements = dict((row[0], row) for row in parsed_response)
+        self.assertEqual(measurements[235][5], 28)
+
+        # Streamed results are the same
+        params = dict(skeleton_ids, stream='true')
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        streamed_response = json.loads(b''.join(
+                response.streaming_content).decode('utf-8'))
+        self.assertEqual(sorted(streamed_response), sorted(parsed_response))
+
+        # Missing skeleton IDs are reported before the response is streamed
+        response = self.client.post(url, {'stream': 'true'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.streaming)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(parsed_response['error'],
+                'Must provide the ID of at least one skeleton.')
+
+
     def assert_skeletons_by_node_labels(self, label_ids, expected_response):
         self.fake_authentication()
         url = '/{}/skeletons/node-labels'.format(self.test_project_id)
@@ -10,7 +10,7 @@ from itertools import chain
 
 from django.db import connection
 from django.utils.six import StringIO
-from catmaid.models import Connector
+from catmaid.models import Connector, Treenode
 from catmaid.tests.apis.common import CatmaidApiTestCase
 from catmaid.control import stats
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
@@ -722,6 +722,119 @@ class StatsApiTests(CatmaidApiTestCase):
         parsed_response = json.loads(response.content.decode('utf-8'))
         self.assertEqual(expected_stats, parsed_response)
 
+    def test_stats_summary_checkpoints(self):
+        cursor = connection.cursor()
+        cursor.execute("""TRUNCATE treenode CASCADE""")
+        self.add_test_treenodes()
+        p = self.test_project_id
+
+        stats.populate_stats_summary(p)
+        cursor.execute("SELECT date_trunc('hour', CURRENT_TIMESTAMP)")
+        current_hour = cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT metric, last_update
+            FROM catmaid_stats_summary_checkpoint
+            WHERE project_id = %s
+        """, (p,))
+        self.assertEqual(dict(cursor.fetchall()), dict((metric, current_hour)
+                for metric in stats.STATS_SUMMARY_METRICS))
+
+        # Incremental updates start one hour before the checkpoint
+        start, end = stats.get_stats_summary_range(p, 'n_treenodes')
+        self.assertEqual(start, current_hour - datetime.timedelta(hours=1))
+        self.assertEqual(end, current_hour)
+        start, end = stats.get_stats_summary_range(p, 'n_treenodes',
+                incremental=False)
+        self.assertEqual(start, None)
+
+        # Without start, partitions begin with the first created node
+        partitions = stats.get_stats_summary_partitions(p, 'n_treenodes',
+                None, end, partition_hours=24*30)
+        self.assertEqual(partitions[0][0],
+                datetime.datetime(2017, 6, 1, 7, 0, tzinfo=pytz.utc))
+        self.assertEqual(partitions[-1][1], end)
+        for (start_1, end_1), (start_2, end_2) in zip(partitions, partitions[1:]):
+            self.assertEqual(end_1, start_2)
+            self.assertEqual(end_1 - start_1, datetime.timedelta(hours=24*30))
+
+        # Computing partitions individually gives the same result
+        def node_counts():
+            return set((row[0], row[3], row[10])
+                    for row in self.get_summary_table(cursor) if row[3] > 0)
+        expected_node_counts = node_counts()
+        cursor.execute("TRUNCATE catmaid_stats_summary")
+        for start, end in partitions:
+            stats.populate_nodecount_stats_summary(p, start, end, cursor)
+        self.assertEqual(node_counts(), expected_node_counts)
+
+    def test_parallel_stats_summary_population(self):
+        cursor = connection.cursor()
+        cursor.execute("""TRUNCATE treenode CASCADE""")
+        self.add_test_treenodes()
+        p = self.test_project_id
+
+        stats.populate_stats_summary(p, delete=True, incremental=False)
+        cursor.execute("""
+            SELECT metric, last_update
+            FROM catmaid_stats_summary_checkpoint
+            WHERE project_id = %s
+        """, (p,))
+        expected_checkpoints = dict(cursor.fetchall())
+        expected_summary_table = set(self.get_summary_table(cursor))
+        self.assertTrue(expected_summary_table)
+
+        # Small partitions give the same result as the serial population and
+        # all checkpoints are set.
+        stats.populate_stats_summary_parallel([p], delete=True,
+                incremental=False, jobs=1, partition_hours=24,
+                log=lambda x: None)
+        self.assertEqual(set(self.get_summary_table(cursor)),
+                expected_summary_table)
+        cursor.execute("""
+            SELECT metric, last_update
+            FROM catmaid_stats_summary_checkpoint
+            WHERE project_id = %s
+        """, (p,))
+        self.assertEqual(dict(cursor.fetchall()), expected_checkpoints)
+
+    def test_recent_stats_summary_update(self):
+        cursor = connection.cursor()
+        cursor.execute("""TRUNCATE treenode CASCADE""")
+        self.add_test_treenodes()
+        p = self.test_project_id
+
+        # Without statistics summary, there is nothing to update
+        stats.update_recent_stats_summary([p], log=lambda x: None)
+        self.assert_empty_summary_table(cursor)
+
+        stats.populate_stats_summary(p)
+        summary_table = set(self.get_summary_table(cursor))
+
+        # Add a node along with its transaction in the current hour
+        cursor.execute("""
+            INSERT INTO catmaid_transaction_info (user_id, project_id,
+                change_type, label)
+            VALUES (%(user_id)s, %(project_id)s, 'Backend', 'treenodes.create')
+            RETURNING execution_time, date_trunc('hour', execution_time)
+        """, dict(user_id=self.test_user_id, project_id=p))
+        execution_time, current_hour = cursor.fetchone()
+        skeleton_id = Treenode.objects.filter(project_id=p).first().skeleton_id
+        Treenode.objects.create(project_id=p, skeleton_id=skeleton_id,
+                user_id=self.test_user_id, editor_id=self.test_user_id,
+                location_x=0, location_y=0, location_z=0,
+                creation_time=execution_time)
+
+        stats.update_recent_stats_summary([p], log=lambda x: None)
+        new_rows = set(self.get_summary_table(cursor)) - summary_table
+        self.assertEqual(new_rows, set([
+            (current_hour, 0, 0, 1, 0, 0, 0, 0, 0.0, p, self.test_user_id)
+        ]))
+        cursor.execute("""
+            SELECT last_update FROM catmaid_stats_summary_checkpoint
+            WHERE project_id = %s AND metric = %s
+        """, (p, stats.STATS_SUMMARY_TRANSACTION_LOG))
+        self.assertEqual(cursor.fetchone()[0], execution_time)
+
     def get_summary_table(self, cursor):
         cursor.execute("""
             SELECT
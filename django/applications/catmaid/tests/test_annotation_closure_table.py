@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from catmaid.control.common import get_class_to_id_map, get_relation_to_id_map
+from catmaid.control.neuron_annotations import get_sub_annotation_ids
+from catmaid.models import ClassInstance, ClassInstanceClassInstance
+
+from .common import CatmaidTestCase, init_consistent_data
+
+
+class AnnotationClosureTestMixin(object):
+    """Compare the annotation closure with one computed from all links.
+    """
+
+    def init_annotation_ids(self):
+        self.annotation_class_id = get_class_to_id_map(
+                self.test_project_id)['annotation']
+        self.annotated_with_id = get_relation_to_id_map(
+                self.test_project_id)['annotated_with']
+
+    def get_closure(self):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT ancestor_id, descendant_id, depth
+            FROM catmaid_annotation_closure
+        """)
+        return dict(((row[0], row[1]), row[2]) for row in cursor.fetchall())
+
+    def get_expected_closure(self):
+        """Find the shortest distance from each annotation to all its direct and
+        transitive sub-annotations by a breadth first search.
+        """
+        children = defaultdict(set)
+        for a, b in ClassInstanceClassInstance.objects.filter(
+                relation_id=self.annotated_with_id,
+                class_instance_a__class_column_id=self.annotation_class_id,
+                class_instance_b__class_column_id=self.annotation_class_id) \
+                .values_list('class_instance_a', 'class_instance_b'):
+            children[b].add(a)
+
+        closure = {}
+        for ancestor in list(children.keys()):
+            depth, current = 1, children[ancestor]
+            while current:
+                next_level = set()
+                for descendant in current:
+                    if (ancestor, descendant) not in closure:
+                        closure[(ancestor, descendant)] = depth
+                        next_level.update(children[descendant])
+                depth, current = depth + 1, next_level
+        return closure
+
+    def annotate(self, annotation, meta_annotation):
+        return ClassInstanceClassInstance.objects.create(
+                project_id=self.test_project_id, user=self.user,
+                relation_id=self.annotated_with_id,
+                class_instance_a=annotation, class_instance_b=meta_annotation)
+
+
+class AnnotationClosureTableTests(AnnotationClosureTestMixin, CatmaidTestCase):
+    """Test the trigger based annotation closure update and the sub-annotation
+    lookup based on it.
+    """
+
+    def setUp(self):
+        super(AnnotationClosureTableTests, self).setUp()
+        self.init_annotation_ids()
+
+    def test_closure_update(self):
+        self.assertEqual(self.get_closure(), self.get_expected_closure())
+
+        a, b, c, d, e = [ClassInstance.objects.create(
+                project_id=self.test_project_id, user=self.user,
+                class_column_id=self.annotation_class_id,
+                name='Annotation {}'.format(i)) for i in range(5)]
+
+        # A hierarchy with two paths of different length from a to d
+        self.annotate(b, a)
+        self.annotate(c, b)
+        link_c_d = self.annotate(d, c)
+        self.annotate(d, a)
+        self.assertEqual(self.get_closure(), self.get_expected_closure())
+        self.assertEqual(self.get_closure()[(a.id, d.id)], 1)
+
+        # A cycle
+        self.annotate(a, d)
+        self.assertEqual(self.get_closure(), self.get_expected_closure())
+        self.assertEqual(self.get_closure()[(a.id, a.id)], 2)
+
+        # Move a link
+        ClassInstanceClassInstance.objects.filter(id=link_c_d.id).update(
+                class_instance_a=e)
+        self.assertEqual(self.get_closure(), self.get_expected_closure())
+
+        sub_annotation_ids = get_sub_annotation_ids(self.test_project_id,
+                [frozenset([b.id]), frozenset([c.id, e.id])])
+        self.assertEqual(sorted(sub_annotation_ids[frozenset([b.id])]),
+                sorted([c.id, e.id]))
+        self.assertEqual(sub_annotation_ids[frozenset([c.id, e.id])], [e.id])
+
+        # Delete links and annotations
+        ClassInstanceClassInstance.objects.filter(class_instance_b=a).delete()
+        self.assertEqual(self.get_closure(), self.get_expected_closure())
+
+        b.delete()
+        self.assertEqual(self.get_closure(), self.get_expected_closure())
+
+        ClassInstanceClassInstance.objects.filter(
+                relation_id=self.annotated_with_id).delete()
+        self.assertEqual(self.get_closure(), {})
+
+    def test_closure_update_multiple_links(self):
+        a, b, c, d = [ClassInstance.objects.create(
+                project_id=self.test_project_id, user=self.user,
+                class_column_id=self.annotation_class_id,
+                name='Annotation {}'.format(i)) for i in range(4)]
+        self.annotate(d, c)
+
+        # Paths along multiple links created in one statement, including a
+        # shorter path to an existing sub-annotation.
+        ClassInstanceClassInstance.objects.bulk_create([
+            ClassInstanceClassInstance(project_id=self.test_project_id,
+                    user=self.user, relation_id=self.annotated_with_id,
+                    class_instance_a=child, class_instance_b=parent)
+            for child, parent in ((b, a), (c, b), (d, b), (a, d))])
+        self.assertEqual(self.get_closure(), self.get_expected_closure())
+        self.assertEqual(self.get_closure()[(a.id, d.id)], 2)
+        self.assertEqual(self.get_closure()[(d.id, d.id)], 3)
+
+
+class ConcurrentAnnotationClosureTableTests(AnnotationClosureTestMixin,
+        TransactionTestCase):
+    """Test the annotation closure update with concurrent link changes, which
+    need to be committed in separate transactions.
+    """
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        init_consistent_data()
+        self.test_project_id = 3
+        self.user = User.objects.get(username='test2')
+        self.init_annotation_ids()
+
+    def test_concurrent_link_inserts(self):
+        a, b, c = [ClassInstance.objects.create(
+                project_id=self.test_project_id, user=self.user,
+                class_column_id=self.annotation_class_id,
+                name='Annotation {}'.format(i)) for i in range(3)]
+
+        # The link from b to c is added while the transaction that adds the
+        # link from a to b is still open. Its closure update has to wait for
+        # the first transaction to commit to also add the path from a to c.
+        first_link_added = threading.Event()
+        commit_first_link = threading.Event()
+        errors = []
+
+        def add_first_link():
+            try:
+                with transaction.atomic():
+                    self.annotate(b, a)
+                    first_link_added.set()
+                    commit_first_link.wait(10)
+            except Exception as e:
+                errors.append(e)
+                first_link_added.set()
+            finally:
+                connection.close()
+
+        def add_second_link():
+            try:
+                with transaction.atomic():
+                    self.annotate(c, b)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        first = threading.Thread(target=add_first_link)
+        first.start()
+        first_link_added.wait(10)
+        second = threading.Thread(target=add_second_link)
+        second.start()
+        # Give the second update a chance to finish before the first link is
+        # committed, which it must not do.
+        second.join(1)
+        self.assertTrue(second.is_alive())
+        commit_first_link.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.get_closure(), self.get_expected_closure())
+        self.assertEqual(self.get_closure()[(a.id, c.id)], 2)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from catmaid.control.common import get_class_to_id_map, get_relation_to_id_map
+from catmaid.models import ClassInstance, ClassInstanceClassInstance
+
+from .common import CatmaidTestCase
+
+
+class AnnotationUsageSummaryTableTests(CatmaidTestCase):
+    """Test the trigger based annotation usage summary update.
+    """
+
+    def setUp(self):
+        super(AnnotationUsageSummaryTableTests, self).setUp()
+        classes = get_class_to_id_map(self.test_project_id)
+        self.annotation_class_id = classes['annotation']
+        self.neuron_class_id = classes['neuron']
+        self.annotated_with_id = get_relation_to_id_map(
+                self.test_project_id)['annotated_with']
+
+    def get_summary(self, annotation_ids):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT annotation_id, user_id, num_usage, last_used, last_user_id
+            FROM catmaid_annotation_usage_summary
+            WHERE annotation_id = ANY(%(annotation_ids)s::bigint[])
+        """, {
+            'annotation_ids': annotation_ids
+        })
+        return dict(((row[0], row[1]), (row[2], row[3], row[4]))
+                for row in cursor.fetchall())
+
+    def get_expected_summary(self, annotation_ids):
+        """Summarize all uses of the passed in annotations per user and as
+        union.
+        """
+        uses = defaultdict(list)
+        for link in ClassInstanceClassInstance.objects.filter(
+                relation_id=self.annotated_with_id,
+                class_instance_b__in=annotation_ids):
+            for key in ((link.class_instance_b_id, link.user_id),
+                    (link.class_instance_b_id, None)):
+                uses[key].append((link.creation_time, link.user_id))
+
+        return dict((key, (len(u), max(u)[0], max(u)[1]))
+                for key, u in uses.items())
+
+    def annotate(self, entity, annotation, user, creation_time):
+        return ClassInstanceClassInstance.objects.create(
+                project_id=self.test_project_id, user=user,
+                relation_id=self.annotated_with_id, class_instance_a=entity,
+                class_instance_b=annotation, creation_time=creation_time)
+
+    def test_summary_update(self):
+        now = timezone.now()
+        user_1 = self.user
+        user_2 = User.objects.get(username='test2')
+        neurons = list(ClassInstance.objects.filter(
+                project_id=self.test_project_id,
+                class_column_id=self.neuron_class_id).order_by('id'))
+        a, b = [ClassInstance.objects.create(project_id=self.test_project_id,
+                user=self.user, class_column_id=self.annotation_class_id,
+                name='Annotation {}'.format(i)) for i in range(2)]
+        annotation_ids = [a.id, b.id]
+
+        # Uses of both annotations by two users
+        links = []
+        for i, neuron in enumerate(neurons):
+            links.append(self.annotate(neuron, a, user_1 if i % 2 else user_2,
+                    now - timedelta(hours=i)))
+            if i % 3 == 0:
+                self.annotate(neuron, b, user_2, now - timedelta(days=i))
+        self.assertEqual(self.get_summary(annotation_ids),
+                self.get_expected_summary(annotation_ids))
+
+        # Move the last use of an annotation to another annotation
+        ClassInstanceClassInstance.objects.filter(id=links[0].id).update(
+                class_instance_b=b)
+        self.assertEqual(self.get_summary(annotation_ids),
+                self.get_expected_summary(annotation_ids))
+
+        # Delete uses
+        ClassInstanceClassInstance.objects.filter(id=links[1].id).delete()
+        self.assertEqual(self.get_summary(annotation_ids),
+                self.get_expected_summary(annotation_ids))
+
+        ClassInstanceClassInstance.objects.filter(class_instance_b=a,
+                user=user_1).delete()
+        self.assertEqual(self.get_summary(annotation_ids),
+                self.get_expected_summary(annotation_ids))
+
+        ClassInstanceClassInstance.objects.filter(class_instance_b=b).delete()
+        self.assertEqual(self.get_summary(annotation_ids),
+                self.get_expected_summary(annotation_ids))
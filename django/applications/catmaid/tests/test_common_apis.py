@@ -443,6 +443,55 @@ class ViewPageTests(TestCase):
         self.assertEqual(parsed_response[3], expected_response[3])
         self.assertEqual(parsed_response[4], expected_response[4])
 
+    def test_export_compact_skeleton_many(self):
+        self.fake_authentication()
+
+        skeleton_ids = [235, 361, 373]
+        response = self.client.post(
+                '/%d/skeletons/compact-detail' % self.test_project_id, {
+                    'skeleton_ids': skeleton_ids,
+                    'with_connectors': 'true',
+                    'with_tags': 'true',
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        skeletons = parsed_response['skeletons']
+        six.assertCountEqual(self, skeletons.keys(), [str(s) for s in skeleton_ids])
+
+        # Each result has to match the result of a single skeleton query
+        for skeleton_id in skeleton_ids:
+            response = self.client.post(
+                    '/%d/%d/1/1/compact-skeleton' % (self.test_project_id, skeleton_id))
+            self.assertEqual(response.status_code, 200)
+            expected_response = json.loads(response.content.decode('utf-8'))
+            result = skeletons[str(skeleton_id)]
+            self.assertEqual(len(result), len(expected_response))
+            six.assertCountEqual(self, result[0], expected_response[0])
+            six.assertCountEqual(self, result[1], expected_response[1])
+            self.assertEqual(result[2], expected_response[2])
+            self.assertEqual(result[3], expected_response[3])
+            self.assertEqual(result[4], expected_response[4])
+
+    def test_export_compact_skeleton_many_streamed(self):
+        self.fake_authentication()
+
+        params = {
+            'skeleton_ids': [235, 361, 373],
+            'with_connectors': 'true',
+            'with_tags': 'true',
+        }
+        url = '/%d/skeletons/compact-detail' % self.test_project_id
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        expected_response = json.loads(response.content.decode('utf-8'))
+
+        params['stream'] = 'true'
+        response = self.client.post(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        parsed_response = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(parsed_response, expected_response)
+
     def test_export_compact_arbor(self):
         self.fake_authentication()
 
@@ -572,6 +621,7 @@ class PermissionTests(TestCase):
             '/%(pid)s/node/list' % url_params,
             '/%(pid)s/skeletons/confidence-compartment-subgraph' % url_params,
             '/%(pid)s/graph/circlesofhell' % url_params,
+            '/%(pid)s/graph/shortest-paths' % url_params,
             '/%(pid)s/connector/list/one_to_many' % url_params,
             '/%(pid)s/%(skid)s/1/1/0/compact-arbor' % url_params,
             '/%(pid)s/annotations/forskeletons' % url_params,
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+
+from django.test import TransactionTestCase
+
+from catmaid.control.copyarchive import (export_copy_archive,
+        import_copy_archive, is_copy_archive)
+from catmaid.models import (ClassInstance, Connector, Project, Treenode,
+        TreenodeClassInstance, TreenodeConnector)
+
+from .common import CatmaidTestCase, init_consistent_data
+
+
+class CopyArchiveTestMixin(object):
+    """Compare the tracing data of a source project with an imported copy.
+    """
+
+    def get_skeletons(self, project_id):
+        """Represent each skeleton of a project by its node locations and
+        parent-child edges.
+        """
+        skeletons = {}
+        for t in Treenode.objects.filter(project_id=project_id) \
+                .select_related('parent', 'skeleton'):
+            location = (t.location_x, t.location_y, t.location_z)
+            parent = (t.parent.location_x, t.parent.location_y,
+                    t.parent.location_z) if t.parent else None
+            skeletons.setdefault(t.skeleton.name, set()).add((location, parent))
+        return skeletons
+
+    def get_tags(self, project_id):
+        return sorted((l.class_instance.name, l.treenode.location_x,
+                l.treenode.location_y, l.treenode.location_z)
+                for l in TreenodeClassInstance.objects.filter(
+                    project_id=project_id,
+                    relation__relation_name='labeled_as')
+                .select_related('class_instance', 'treenode'))
+
+    def assertArchiveImported(self, source_project_id, target_project_id):
+        self.assertEqual(self.get_skeletons(source_project_id),
+                self.get_skeletons(target_project_id))
+        self.assertEqual(self.get_tags(source_project_id),
+                self.get_tags(target_project_id))
+        self.assertEqual(
+                Connector.objects.filter(project_id=source_project_id).count(),
+                Connector.objects.filter(project_id=target_project_id).count())
+        self.assertEqual(
+                TreenodeConnector.objects.filter(project_id=source_project_id).count(),
+                TreenodeConnector.objects.filter(project_id=target_project_id).count())
+
+
+class CopyArchiveTests(CopyArchiveTestMixin, CatmaidTestCase):
+    """Test exporting and importing tracing data through copy archives.
+    """
+
+    def setUp(self):
+        super(CopyArchiveTests, self).setUp()
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+    def test_export_import(self):
+        manifest = export_copy_archive(self.test_project_id, self.archive_dir,
+                log=lambda m: None)
+        self.assertTrue(is_copy_archive(self.archive_dir))
+        self.assertEqual(self.test_project_id, manifest['project_id'])
+
+        target = Project.objects.create(title='Copy archive import')
+        import_copy_archive(self.archive_dir, target.id,
+                lambda users: dict((u, u) for u in users), log=lambda m: None)
+
+        self.assertArchiveImported(self.test_project_id, target.id)
+
+        # No imported node should reference data of the source project
+        self.assertFalse(Treenode.objects.filter(project_id=target.id,
+                skeleton__project_id=self.test_project_id).exists())
+
+        # Importing again into the source project creates new neurons and
+        # skeletons, but reuses tags.
+        n_tags = ClassInstance.objects.filter(project_id=self.test_project_id,
+                class_column__class_name='label').count()
+        n_treenodes = Treenode.objects.filter(project_id=self.test_project_id).count()
+        import_copy_archive(self.archive_dir, self.test_project_id,
+                lambda users: dict((u, u) for u in users), log=lambda m: None)
+        self.assertEqual(n_tags, ClassInstance.objects.filter(
+                project_id=self.test_project_id,
+                class_column__class_name='label').count())
+        self.assertEqual(2 * n_treenodes, Treenode.objects.filter(
+                project_id=self.test_project_id).count())
+
+    def test_export_skeletons(self):
+        skeleton_id = Treenode.objects.filter(
+                project_id=self.test_project_id).first().skeleton_id
+        export_copy_archive(self.test_project_id, self.archive_dir,
+                skeleton_ids=[skeleton_id], log=lambda m: None)
+
+        target = Project.objects.create(title='Copy archive import')
+        import_copy_archive(self.archive_dir, target.id,
+                lambda users: dict((u, u) for u in users), log=lambda m: None)
+
+        source_skeletons = self.get_skeletons(self.test_project_id)
+        skeleton_name = ClassInstance.objects.get(id=skeleton_id).name
+        self.assertEqual({skeleton_name: source_skeletons[skeleton_name]},
+                self.get_skeletons(target.id))
+
+    def test_export_shards(self):
+        export_copy_archive(self.test_project_id, self.archive_dir,
+                shard_size=2, log=lambda m: None)
+
+        # Pretend the export was interrupted before the last shard completed
+        shard_records = sorted(f for f in os.listdir(self.archive_dir)
+                if f.startswith('shard-'))
+        self.assertTrue(len(shard_records) > 1)
+        os.remove(os.path.join(self.archive_dir, 'manifest.json'))
+        os.remove(os.path.join(self.archive_dir, shard_records[-1]))
+
+        exported_shards = []
+        export_copy_archive(self.test_project_id, self.archive_dir,
+                shard_size=2, resume=True, log=exported_shards.append)
+        self.assertIn('Exporting 1 of {} shards'.format(len(shard_records)),
+                exported_shards)
+
+        target = Project.objects.create(title='Copy archive import')
+        import_copy_archive(self.archive_dir, target.id,
+                lambda users: dict((u, u) for u in users), log=lambda m: None)
+
+        self.assertArchiveImported(self.test_project_id, target.id)
+
+
+class ParallelCopyArchiveTests(CopyArchiveTestMixin, TransactionTestCase):
+    """Test exporting copy archives with multiple worker processes. The
+    workers share a database snapshot of the exporting transaction, which is
+    only possible outside of the transaction every regular test runs in.
+    """
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        init_consistent_data()
+        self.test_project_id = 3
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+    def test_parallel_export_import(self):
+        log = []
+        export_copy_archive(self.test_project_id, self.archive_dir,
+                shard_size=2, jobs=2, log=log.append)
+        self.assertTrue(is_copy_archive(self.archive_dir))
+
+        # All shards have been exported by the worker processes
+        shard_records = [f for f in os.listdir(self.archive_dir)
+                if f.startswith('shard-')]
+        self.assertTrue(len(shard_records) > 1)
+        self.assertEqual(len(shard_records), len([m for m in log
+                if m.startswith('Exported shard')]))
+
+        target = Project.objects.create(title='Copy archive import')
+        import_copy_archive(self.archive_dir, target.id,
+                lambda users: dict((u, u) for u in users), log=lambda m: None)
+
+        self.assertArchiveImported(self.test_project_id, target.id)
@@ -233,6 +233,12 @@ class HistoryTableTests(TransactionTestCase):
 
         # Regular unversioned CATMAID tables
         'node_query_cache',
+        'node_grid_cache',
+        'node_grid_cache_cell',
+        'node_query_cache_build',
+        'node_query_cache_build_partition',
+        'node_overview_pyramid',
+        'node_overview_tile',
         'log',
         'treenode_edge',
         'catmaid_history_table',
@@ -240,7 +246,12 @@ class HistoryTableTests(TransactionTestCase):
         'connector_geom',
         'catmaid_transaction_info',
         'catmaid_stats_summary',
+        'catmaid_stats_summary_checkpoint',
         'catmaid_skeleton_summary',
+        'catmaid_skeleton_connectivity',
+        'catmaid_skeleton_review_summary',
+        'catmaid_annotation_closure',
+        'catmaid_annotation_usage_summary',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import json
+import msgpack
+import numpy as np
+
+from django.db import connection, transaction
 from django.test import TestCase
 from django.contrib.auth.models import User
 from django.http.request import QueryDict
-from catmaid.control.common import get_request_list
+from catmaid.control.common import (get_request_list, get_relation_to_id_map,
+        relation_map_cache)
 from catmaid.models import Project, Class, Relation, ClassInstance, \
-    ClassInstanceClassInstance
+    ClassInstanceClassInstance, BrokenSlice, ProjectStack, Treenode
+from catmaid.control.analytics import check_broken_section
+from catmaid.control.connectome import ConnectomeGraph
 from catmaid.control.neuron_annotations import delete_annotation_if_unused
+from catmaid.control.skeletonexport import _measure_skeleton_batch
+from catmaid.control.tree_util import Arbor
+from catmaid.control.synapseclustering import tree_arrays, tree_max_density_arrays
+from catmaid.control.nodeoverview import StackTileGeometry, iter_tiles
+from catmaid.control.node import (get_grid_cell_range,
+        merge_node_list_results, add_extra_nodes_to_json_text,
+        add_extra_nodes_to_msgpack, render_nodes_xy)
 from catmaid.tests.common import CatmaidTestCase
 
 
@@ -35,6 +50,168 @@ class InternalApiTestsNoDB(TestCase):
         self.assertEqual(get_request_list(q4, 'a'), [['1', '2', '3']])
         self.assertEqual(get_request_list(q4, 'a', map_fn=int), [[1, 2, 3]])
 
+    def test_grid_cell_range(self):
+        params = {'left': 50, 'right': 250, 'top': -10, 'bottom': 100,
+                  'z1': 80, 'z2': 120}
+        self.assertEqual(get_grid_cell_range(params, 100, 100, 40),
+                (0, 2, -1, 0, 2))
+
+        # Bounding boxes spanning multiple sections aren't supported
+        params['z2'] = 121
+        self.assertEqual(get_grid_cell_range(params, 100, 100, 40), None)
+
+    def test_node_list_result_merge(self):
+        tn1 = [1, None, 10, 10, 0, 5, -1, 7, 0, 3]
+        tn2 = [2, 1, 20, 20, 0, 5, -1, 7, 0, 3]
+        tn3 = [3, 2, 500, 500, 0, 5, -1, 7, 0, 3]
+        c1 = [4, 15, 15, 0, 5, 0, 3, [[1, 8, 5, 0, 9]]]
+        result_a = [[tn1, tn2], [c1], {1: ['a']}, False, {8: 'presynaptic_to'}]
+        result_b = [[tn3, tn2], [c1], {1: ['a', 'b']}, False, {}]
+
+        merged = merge_node_list_results([result_a, result_b])
+        self.assertEqual(merged[0], [tn1, tn2, tn3])
+        self.assertEqual(merged[1], [c1])
+        self.assertEqual(dict(merged[2]), {1: ['a', 'b']})
+        self.assertFalse(merged[3])
+        self.assertEqual(merged[4], {8: 'presynaptic_to'})
+
+        # Nodes inside the bounding box are preferred if the limit is reached
+        params = {'left': 100, 'right': 600, 'top': 100, 'bottom': 600,
+                  'z1': 0, 'z2': 40, 'limit': 1}
+        merged = merge_node_list_results([result_a, result_b], params)
+        self.assertEqual(merged[0], [tn3])
+        self.assertEqual(merged[1], [c1])
+        self.assertTrue(merged[3])
+
+    def test_extra_node_injection(self):
+        result = [[[1, None, 10.0, 20.0, 30.0, 5, -1.0, 2, 0.0, 3]], [], {}, False, {}]
+        extra = [[[4, 1, 10.0, 20.0, 70.0, 5, -1.0, 2, 0.0, 3]], [], {}, False, {}]
+
+        json_text = add_extra_nodes_to_json_text(json.dumps(result), extra)
+        self.assertEqual(json.loads(json_text), result + [[extra]])
+        json_text = add_extra_nodes_to_json_text(json_text, extra)
+        self.assertEqual(json.loads(json_text), result + [[extra, extra]])
+
+        packed = add_extra_nodes_to_msgpack(msgpack.packb(result), extra)
+        self.assertEqual(msgpack.unpackb(packed, raw=False), result + [[extra]])
+        self.assertRaises(ValueError, add_extra_nodes_to_msgpack,
+                msgpack.packb(result[:4]), extra)
+
+    def test_node_rendering(self):
+        params = {'left': 0, 'right': 1000, 'top': 0, 'bottom': 1000,
+                'z1': 40, 'z2': 80}
+        treenodes = [
+            (1, None, 100.0, 100.0, 50.0, 5, -1.0, 1, 0.0, 3),
+            (2, 1, 200.0, 200.0, 50.0, 5, -1.0, 1, 0.0, 3),
+            # Outside of the section, with a virtual node at (300, 445)
+            (3, 2, 300.0, 300.0, 120.0, 5, -1.0, 1, 0.0, 3),
+            (4, 3, 300.0, 500.0, 10.0, 5, -1.0, 1, 0.0, 3),
+        ]
+        connectors = [(5, 600.0, 600.0, 60.0, 5, 0.0, 3, [])]
+        image = render_nodes_xy([treenodes, connectors, {}, False, {}],
+                params, 100, 100, 0, 0, 0.1, 0.1, with_edges=True,
+                with_connectors=True)
+        pixels = image.load()
+        self.assertEqual(pixels[10, 10], (255, 0, 0, 255))
+        self.assertEqual(pixels[20, 20], (255, 0, 255, 255))
+        self.assertEqual(pixels[30, 44], (255, 0, 255, 255))
+        self.assertEqual(pixels[15, 15], (255, 0, 255, 255))
+        self.assertEqual(pixels[60, 60], (0, 128, 255, 255))
+        self.assertEqual(pixels[80, 20], (255, 0, 0, 0))
+
+    def test_node_overview_tile_geometry(self):
+        geometry = StackTileGeometry((100.0, 0.0, 10.0), (4.0, 4.0, 40.0),
+                (2048, 1024, 10), 256)
+        self.assertEqual(geometry.get_grid_size(0), (8, 4, 10))
+        self.assertEqual(geometry.get_grid_size(2), (2, 1, 10))
+        self.assertEqual(geometry.get_tile_params(1, 2, 1, 3), {
+            'left': 6244.0, 'right': 8292.0, 'top': 2048.0, 'bottom': 4096.0,
+            'z1': 90.0, 'z2': 130.0})
+        self.assertEqual(geometry.get_tile_range(1, (6244.0, -50.0, 95.0),
+                (9000.0, 2048.0, 200.0)), ((3, 3), (0, 1), (2, 4)))
+        self.assertEqual(geometry.get_tile_range(1, (0.0, 0.0, 0.0),
+                (50.0, 50.0, 5.0)), None)
+        self.assertEqual(len(list(iter_tiles(1, ((3, 3), (0, 1), (2, 4))))), 6)
+
+    def test_connectome_graph(self):
+        # 1 -> 2 -> 3 -> 4, 1 -> 3 and 5 -> 1 with different synapse counts
+        graph = ConnectomeGraph(1, np.array([1, 2, 3, 1, 5]),
+                np.array([2, 3, 4, 3, 1]), np.array([3, 1, 2, 2, 1]), None)
+        self.assertEqual(sorted(graph.get_circles([1], 1, 1, 1).tolist()), [2, 3, 5])
+        self.assertEqual(sorted(graph.get_circles([1], 2, float('inf'), 2).tolist()), [2, 3, 4])
+        self.assertEqual(graph.get_fronts([4], 3, 1, upstream=True),
+                [{4}, {3}, {1, 2}])
+        self.assertEqual(sorted(graph.get_directed_paths([1], [4], 3, 1)),
+                [[1, 2, 3, 4], [1, 3, 4]])
+        self.assertEqual(graph.get_directed_paths([1], [4], 3, 2), [[1, 3, 4]])
+        self.assertEqual(graph.get_directed_paths([1], [4], 1, 1), [])
+        self.assertEqual(graph.get_shortest_paths([5], [3, 4], 1),
+                [[5, 1, 3], [5, 1, 3, 4]])
+        self.assertEqual(graph.get_shortest_paths([1], [4], 3), [])
+
+    def test_arbor(self):
+        #      1
+        #     / \
+        #    2   5
+        #   / \
+        #  3   4
+        arbor = Arbor([3, 1, 4, 2, 5], [2, None, 2, 1, 1],
+                [(0, 0, 0), (0, 4, 0), (1, 0, 0), (0, 1, 0), (3, 0, 0)])
+        node_ids = arbor.node_ids
+        self.assertEqual(arbor.parents.tolist(), [3, -1, 3, 1, 1])
+        self.assertEqual(arbor.depths().tolist(), [2, 0, 2, 1, 1])
+        self.assertEqual(sorted(node_ids[arbor.end_nodes()].tolist()), [3, 4, 5])
+        self.assertEqual(node_ids[arbor.branch_nodes()].tolist(), [1, 2])
+        self.assertEqual(arbor.subtree_sizes().tolist(), [1, 5, 1, 3, 1])
+        self.assertAlmostEqual(arbor.cable_length(), 9.0 + 2 ** 0.5)
+        self.assertEqual(node_ids[arbor.common_ancestor(arbor.indices([3, 4]))], 2)
+        self.assertEqual(node_ids[arbor.common_ancestor(arbor.indices([3, 5]))], 1)
+        self.assertEqual(sorted(node_ids[arbor.downstream(arbor.index(2))].tolist()), [2, 3, 4])
+        self.assertEqual(sorted(node_ids[s].tolist() for s in arbor.partition()),
+                [[3, 2, 1], [4, 2], [5, 1]])
+
+        arbor.reroot(arbor.index(4))
+        self.assertEqual(arbor.parents.tolist(), [3, 3, -1, 2, 1])
+        self.assertEqual(arbor.depths().tolist(), [2, 2, 0, 1, 3])
+
+        tops = arbor.components(np.isin(node_ids, [1, 3, 5]))
+        self.assertEqual(tops.tolist(), [0, 1, -1, -1, 1])
+
+    def test_skeleton_measurement(self):
+        rows = [(1, None, 10, 0.0, 0.0, 0.0), (2, 1, 10, 3.0, 0.0, 0.0),
+                (3, 2, 10, 3.0, 4.0, 0.0), (4, None, 20, 5.0, 5.0, 5.0)]
+        measurements = dict(_measure_skeleton_batch(rows, {10: 2}, {20: 1}))
+        first, second = measurements[10], measurements[20]
+        self.assertEqual(first.raw_cable, 7.0)
+        # The middle node moves towards its weighted neighbor average
+        smoothed = np.array([3.0, 0.0, 0.0]) * 0.4 + \
+                np.array([12.0 / 7, 16.0 / 7, 0.0]) * 0.6
+        smooth_cable = np.linalg.norm(smoothed) + \
+                np.linalg.norm(np.array([3.0, 4.0, 0.0]) - smoothed)
+        self.assertAlmostEqual(first.smooth_cable, smooth_cable)
+        self.assertAlmostEqual(first.principal_branch_cable, smooth_cable)
+        self.assertEqual((first.n_nodes, first.n_ends, first.n_branch,
+                first.n_pre, first.n_post), (3, 2, 0, 2, 0))
+        self.assertEqual((second.raw_cable, second.smooth_cable, second.n_nodes,
+                second.n_ends, second.n_pre, second.n_post), (0, 0, 1, 0, 0, 1))
+
+    def test_synapse_clustering(self):
+        # A chain of seven nodes with a side branch and synapses close to both ends,
+        # local maxima are pulled slightly towards the other synapses.
+        node_ids = [1, 2, 3, 4, 5, 6, 7, 8]
+        parents, lengths = tree_arrays(node_ids, [None, 1, 2, 3, 4, 5, 6, 4],
+                [(i, 0, 0) for i in range(7)] + [(3, 5, 0)])
+        self.assertEqual(parents.tolist(), [-1, 0, 1, 2, 3, 4, 5, 3])
+        self.assertEqual(lengths.tolist(), [0, 1, 1, 1, 1, 1, 1, 5])
+
+        groups = tree_max_density_arrays(node_ids, parents, lengths,
+                [1, 2, 6, 7, 7], [10, 11, 12, 13, 14], [0, 0, 0, 1, 1], [1.0, 100.0])
+        self.assertEqual(sorted(g.connector_ids for g in groups[1.0].values()),
+                [[10, 11], [12, 13, 14]])
+        self.assertEqual(sorted(g.local_max for g in groups[1.0].values()), [2, 6])
+        self.assertEqual(len(groups[100.0]), 1)
+        self.assertEqual(groups[100.0][0].local_max, 4)
+
 class InternalApiTests(CatmaidTestCase):
     fixtures = ['catmaid_testdata']
 
@@ -103,3 +280,104 @@ class InternalApiTests(CatmaidTestCase):
         self.assertFalse(ClassInstance.objects.filter(id=annotation_a.id).exists())
         self.assertFalse(ClassInstance.objects.filter(id=annotation_b.id).exists())
         self.assertFalse(ClassInstance.objects.filter(id=annotation_c.id).exists())
+
+    def test_relation_map_cache(self):
+        with self.settings(RELATION_CLASS_MAP_CACHE_TIMEOUT=60):
+            relation_map_cache.invalidate()
+            relation_map = get_relation_to_id_map(self.test_project.id)
+            annotated_with = Relation.objects.get(project=self.test_project,
+                                                  relation_name='annotated_with')
+            self.assertEqual(relation_map['annotated_with'], annotated_with.id)
+            self.assertTrue(self.test_project.id in relation_map_cache.entries)
+            self.assertEqual(get_relation_to_id_map(self.test_project.id,
+                    ['annotated_with', 'unknown_relation']),
+                    {'annotated_with': annotated_with.id})
+
+            # Saving a relation through Django invalidates the cache
+            new_relation = Relation.objects.create(project=self.test_project,
+                                                   user=self.test_user,
+                                                   relation_name='new_relation')
+            self.assertFalse(self.test_project.id in relation_map_cache.entries)
+            relation_map = get_relation_to_id_map(self.test_project.id)
+            self.assertEqual(relation_map['new_relation'], new_relation.id)
+            relation_map_cache.invalidate()
+
+    def test_relation_map_cache_rollback(self):
+        with self.settings(RELATION_CLASS_MAP_CACHE_TIMEOUT=60):
+            relation_map_cache.invalidate()
+
+            # A map read after a relation has been created in a transaction
+            # that is rolled back isn't used afterwards.
+            class Rollback(Exception):
+                pass
+            try:
+                with transaction.atomic():
+                    Relation.objects.create(project=self.test_project,
+                            user=self.test_user, relation_name='rolled_back')
+                    relation_map = get_relation_to_id_map(self.test_project.id)
+                    self.assertIn('rolled_back', relation_map)
+                    raise Rollback()
+            except Rollback:
+                pass
+
+            # After the rollback, the map doesn't contain the relation anymore
+            # and is stored again.
+            relation_map = get_relation_to_id_map(self.test_project.id)
+            self.assertNotIn('rolled_back', relation_map)
+            self.assertTrue(self.test_project.id in relation_map_cache.entries)
+            self.assertNotIn('rolled_back',
+                    get_relation_to_id_map(self.test_project.id))
+            relation_map_cache.invalidate()
+
+    def test_relation_map_cache_without_signals(self):
+        with self.settings(RELATION_CLASS_MAP_CACHE_TIMEOUT=60):
+            relation_map_cache.invalidate()
+            get_relation_to_id_map(self.test_project.id)
+            self.assertTrue(self.test_project.id in relation_map_cache.entries)
+
+            # Relations that are added or deleted without Django signals are
+            # found as well.
+            Relation.objects.bulk_create([Relation(project=self.test_project,
+                    user=self.test_user, relation_name='bulk_relation')])
+            relation_map = get_relation_to_id_map(self.test_project.id)
+            self.assertIn('bulk_relation', relation_map)
+
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM relation WHERE id = %s",
+                    (relation_map['bulk_relation'],))
+            self.assertNotIn('bulk_relation',
+                    get_relation_to_id_map(self.test_project.id))
+            relation_map_cache.invalidate()
+
+    def test_broken_section_nodes(self):
+        project_stack = ProjectStack.objects.filter(project=self.test_project,
+                orientation=0).first()
+        translation_z = project_stack.translation.z
+        resolution_z = project_stack.stack.resolution.z
+        treenode = Treenode.objects.filter(project=self.test_project).first()
+
+        # Mark the section of the node and the next one as broken
+        section = int((treenode.location_z - translation_z) // resolution_z)
+        BrokenSlice.objects.create(stack=project_stack.stack, index=section)
+        BrokenSlice.objects.create(stack=project_stack.stack, index=section + 1)
+
+        def expected_nodes(skeleton_ids=None):
+            nodes = Treenode.objects.filter(project=self.test_project)
+            if skeleton_ids:
+                nodes = nodes.filter(skeleton_id__in=skeleton_ids)
+            return sorted(n.id for n in nodes
+                    if translation_z + section * resolution_z <= n.location_z
+                    < translation_z + (section + 2) * resolution_z)
+
+        broken_nodes = check_broken_section(self.test_project.id)
+        self.assertEqual(sorted(r[0] for r in broken_nodes), expected_nodes())
+        self.assertIn(treenode.id, [r[0] for r in broken_nodes])
+        for r in broken_nodes:
+            self.assertEqual(r[1], project_stack.stack.id)
+            self.assertEqual(r[3], 0)
+            self.assertIn(r[4], (section, section + 1))
+
+        broken_nodes = check_broken_section(self.test_project.id,
+                [treenode.skeleton_id])
+        self.assertEqual(sorted(r[0] for r in broken_nodes),
+                expected_nodes([treenode.skeleton_id]))
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import mock
+
+from datetime import timedelta
+from unittest import skipUnless
+
+from django.conf import settings
+from django.db import connection
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from catmaid import history
+from catmaid.control import node
+from catmaid.control.common import get_class_to_id_map
+from catmaid.models import ClassInstance, Treenode, User
+
+from .common import CatmaidTestCase, init_consistent_data
+
+
+def get_cache_sections(project_id, orientation, cursor=None):
+    """Return a dictionary that maps the depth of each node query cache section
+    of the passed in project and orientation to its update time and JSON data.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute("""
+        SELECT depth, update_time, json_data
+        FROM node_query_cache
+        WHERE project_id = %(project_id)s
+        AND orientation = %(orientation)s
+    """, {
+        'project_id': project_id,
+        'orientation': node.ORIENTATIONS[orientation],
+    })
+    return dict((row[0], (row[1], row[2])) for row in cursor.fetchall())
+
+
+def normalize_row(row):
+    """Round floats, JSON decoders can differ in their last digit."""
+    return tuple(round(v, 3) if isinstance(v, float) else v for v in row)
+
+
+def normalize_result(result):
+    """Make node query results comparable, independent of the order of
+    treenodes, connectors and connector links and of the container types.
+    """
+    treenodes = sorted(normalize_row(t) for t in result[0])
+    connectors = sorted(normalize_row(c[:7]) +
+            (tuple(sorted(normalize_row(l) for l in c[7])),)
+            for c in result[1])
+    return treenodes, connectors, bool(result[3])
+
+
+class NodeQueryCacheUpdateTests(TransactionTestCase):
+    """Test incremental node query cache updates. Changes are only recognized
+    if they are made after a section was computed, which is why each change
+    has to be committed individually.
+    """
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        init_consistent_data()
+        self.test_project_id = 3
+        self.user = User.objects.get(username='test2')
+
+    def run(self, *args):
+        """Wrap running of individual tests to make sure history tracking is
+        enabled for each test, deletions can't be found otherwise.
+        """
+        history.enable_history_tracking()
+        return super(NodeQueryCacheUpdateTests, self).run(*args)
+
+    def add_treenode(self, skeleton, x, y, z, parent=None, edition_time=None):
+        return Treenode.objects.create(project_id=self.test_project_id,
+                user=self.user, editor=self.user, skeleton=skeleton,
+                parent=parent, location_x=x, location_y=y, location_z=z,
+                radius=-1, confidence=5,
+                edition_time=edition_time or timezone.now())
+
+    # Without overlap, changes made right before a section update aren't
+    # considered for it.
+    @mock.patch.object(node, 'CHANGE_DETECTION_OVERLAP', timedelta(0))
+    @skipUnless(getattr(settings, 'HISTORY_TRACKING', True),
+            'History tracking is not enabled')
+    def test_incremental_update(self):
+        p, step = self.test_project_id, 9
+        noop = lambda x: None
+        bb = node.get_cache_bounding_box(p, log=noop)
+        depths = node.get_section_depths(bb, 'xy', step)
+        min_depth, max_depth = bb[0][2], bb[1][2]
+
+        # Without a cache, there are no outdated sections
+        self.assertEqual(node.get_outdated_cache_depths(p, 'xy', step,
+                min_depth, max_depth), None)
+
+        # A skeleton that is contained in a single section
+        depth = depths[5]
+        z = depth + step * 0.5
+        skeleton = ClassInstance.objects.create(project_id=p, user=self.user,
+                class_column_id=get_class_to_id_map(p)['skeleton'],
+                name='Single section skeleton')
+        root = self.add_treenode(skeleton, 5000, 4000, z)
+        branch = self.add_treenode(skeleton, 5100, 4000, z, root)
+        leaf = self.add_treenode(skeleton, 5200, 4000, z, branch)
+        other_leaf = self.add_treenode(skeleton, 5000, 4100, z, root)
+
+        node.update_cache(p, 'json', ['xy'], [step], log=noop)
+        sections = get_cache_sections(p, 'xy')
+        self.assertEqual(sorted(sections.keys()), depths)
+        self.assertEqual(node.get_outdated_cache_depths(p, 'xy', step,
+                min_depth, max_depth), [])
+
+        # Change, add and delete nodes
+        Treenode.objects.filter(id=branch.id).update(location_x=5150,
+                edition_time=timezone.now())
+        self.add_treenode(skeleton, 5300, 4000, z, leaf)
+        Treenode.objects.filter(id=other_leaf.id).delete()
+
+        self.assertEqual(node.get_outdated_cache_depths(p, 'xy', step,
+                min_depth, max_depth), [depth])
+
+        # Sections outside of the cached range are added, aligned with the
+        # existing sections.
+        self.assertEqual(node.get_outdated_cache_depths(p, 'xy', step,
+                min_depth - 2 * step, max_depth + 2 * step),
+                [depths[0] - 2 * step, depths[0] - step, depth,
+                 depths[-1] + step, depths[-1] + 2 * step])
+
+        # Only the outdated section is recomputed
+        node.update_cache(p, 'json', ['xy'], [step], log=noop,
+                incremental=True)
+        updated_sections = get_cache_sections(p, 'xy')
+        self.assertEqual(sorted(updated_sections.keys()), depths)
+        for d in depths:
+            if d == depth:
+                self.assertGreater(updated_sections[d][0], sections[d][0])
+            else:
+                self.assertEqual(updated_sections[d], sections[d])
+        self.assertEqual(node.get_outdated_cache_depths(p, 'xy', step,
+                min_depth, max_depth), [])
+
+        # The updated cache is the same as a newly built one
+        node.update_cache(p, 'json', ['xy'], [step], delete=True, log=noop)
+        new_sections = get_cache_sections(p, 'xy')
+        self.assertEqual(sorted(new_sections.keys()), depths)
+        for d in depths:
+            self.assertEqual(normalize_result(updated_sections[d][1]),
+                    normalize_result(new_sections[d][1]))
+
+
+    def test_late_commit_update(self):
+        p, step = self.test_project_id, 9
+        noop = lambda x: None
+        bb = node.get_cache_bounding_box(p, log=noop)
+        depths = node.get_section_depths(bb, 'xy', step)
+        min_depth, max_depth = bb[0][2], bb[1][2]
+        depth = depths[5]
+
+        node.update_cache(p, 'json', ['xy'], [step], log=noop)
+        update_time = get_cache_sections(p, 'xy')[depth][0]
+
+        # A node of a transaction that started before the section was updated,
+        # but was committed only afterwards, has an earlier edition time.
+        skeleton = ClassInstance.objects.create(project_id=p, user=self.user,
+                class_column_id=get_class_to_id_map(p)['skeleton'],
+                name='Late commit skeleton')
+        self.add_treenode(skeleton, 5000, 4000, depth + step * 0.5,
+                edition_time=update_time - timedelta(seconds=10))
+
+        self.assertEqual(node.get_outdated_cache_depths(p, 'xy', step,
+                min_depth, max_depth), [depth])
+
+
+class NodeQueryCacheTests(CatmaidTestCase):
+    """Test the population of the node query cache.
+    """
+
+    # Depth resolutions for which no section boundary coincides with node or
+    # connector locations in a non-Z dimension. Node queries include nodes on
+    # the upper boundary of their XY bounding box, cache sections don't.
+    orientations = ['xy', 'xz', 'zy']
+    steps = [9, 1000.5, 1000.5]
+
+    def get_reference_result(self, bb, orientation, depth, step):
+        """Query the nodes of a cache section with a regular node query.
+        """
+        params = node.get_section_params(bb, orientation, depth, step)
+        # The node query excludes the maximum Z of its bounding box, while
+        # cache sections cover the complete bounding box in all but the depth
+        # dimension.
+        if orientation != 'xy':
+            params['z2'] += 1.0
+        params['project_id'] = self.test_project_id
+        params['limit'] = None
+        return node._node_list_tuples_query(params, self.test_project_id,
+                node.Postgis2dNodeProvider())
+
+    def test_populate_cache(self):
+        p = self.test_project_id
+        noop = lambda x: None
+        bb = node.get_cache_bounding_box(p, log=noop)
+        node.populate_cache(p, ['json'], self.orientations, self.steps, bb,
+                log=noop)
+
+        for orientation, step in zip(self.orientations, self.steps):
+            depths = node.get_section_depths(bb, orientation, step)
+            sections = get_cache_sections(p, orientation)
+            self.assertEqual(sorted(sections.keys()), depths)
+            for depth in depths:
+                self.assertEqual(normalize_result(sections[depth][1]),
+                        normalize_result(self.get_reference_result(bb,
+                            orientation, depth, step)))
+
+        # Edges that cross section borders are part of both sections, along
+        # with both of their nodes.
+        sections = get_cache_sections(p, 'xy')
+        child = Treenode.objects.get(id=11)
+        parent = child.parent
+        self.assertNotEqual(child.location_z, parent.location_z)
+        for depth in (parent.location_z, child.location_z):
+            treenode_ids = set(t[0] for t in sections[depth][1][0])
+            self.assertIn(child.id, treenode_ids)
+            self.assertIn(parent.id, treenode_ids)
+
+    def test_populate_cache_with_node_limit(self):
+        p, node_limit = self.test_project_id, 5
+        noop = lambda x: None
+        bb = node.get_cache_bounding_box(p, log=noop)
+        node.populate_cache(p, ['json'], self.orientations, self.steps, bb,
+                node_limit=node_limit, log=noop)
+
+        n_limited_sections = 0
+        for orientation, step in zip(self.orientations, self.steps):
+            sections = get_cache_sections(p, orientation)
+            for depth in node.get_section_depths(bb, orientation, step):
+                treenodes, connectors, limit_reached = normalize_result(
+                        sections[depth][1])
+                all_treenodes, all_connectors, _ = normalize_result(
+                        self.get_reference_result(bb, orientation, depth, step))
+                self.assertEqual(len(treenodes),
+                        min(node_limit, len(all_treenodes)))
+                self.assertEqual(len(connectors),
+                        min(node_limit, len(all_connectors)))
+                self.assertTrue(set(treenodes).issubset(set(all_treenodes)))
+                self.assertTrue(set(connectors).issubset(set(all_connectors)))
+                self.assertEqual(limit_reached,
+                        len(all_treenodes) >= node_limit)
+                if len(all_treenodes) > node_limit:
+                    n_limited_sections += 1
+
+        # Make sure the limit has been tested
+        self.assertGreater(n_limited_sections, 0)
+
+    def test_partitioned_cache_build(self):
+        p, step = self.test_project_id, 9
+        noop = lambda x: None
+        cursor = connection.cursor()
+
+        def get_completion_time(build_id):
+            cursor.execute("""
+                SELECT completion_time FROM node_query_cache_build
+                WHERE id = %(build_id)s
+            """, {
+                'build_id': build_id
+            })
+            return cursor.fetchone()[0]
+
+        # Populate only some partitions of a new build
+        tasks = node.prepare_cache_builds(p, ['json'], ['xy'], [step],
+                partition_size=5, log=noop)
+        self.assertGreater(len(tasks), 3)
+        build_id = tasks[0][0]
+        self.assertEqual(tasks, [(build_id, i) for i in range(len(tasks))])
+        node.populate_cache_build_partitions(tasks[:3], jobs=1, log=noop)
+        self.assertEqual(node.get_open_cache_build_partitions(build_id),
+                [t[1] for t in tasks[3:]])
+        self.assertIsNone(get_completion_time(build_id))
+        partial_sections = get_cache_sections(p, 'xy')
+        self.assertEqual(len(partial_sections), 3 * 5)
+
+        # Resuming the build only populates open partitions
+        self.assertEqual(node.prepare_cache_builds(p, ['json'], ['xy'],
+                [step], partition_size=5, resume=True, log=noop), tasks[3:])
+        node.update_cache_parallel(p, ['json'], ['xy'], [step], jobs=1,
+                partition_size=5, resume=True, log=noop)
+        self.assertEqual(node.get_open_cache_build_partitions(build_id), [])
+        self.assertIsNotNone(get_completion_time(build_id))
+        self.assertIsNone(node.get_unfinished_cache_build(p, ['json'], 'xy',
+                step))
+
+        sections = get_cache_sections(p, 'xy')
+        bb = node.get_cache_bounding_box(p, log=noop)
+        self.assertEqual(sorted(sections.keys()),
+                node.get_section_depths(bb, 'xy', step))
+        for depth, section in partial_sections.items():
+            self.assertEqual(sections[depth], section)
+
+        # The result is the same as the one of a serial update
+        node.update_cache(p, 'json', ['xy'], [step], delete=True, log=noop)
+        serial_sections = get_cache_sections(p, 'xy')
+        self.assertEqual(sorted(serial_sections.keys()), sorted(sections.keys()))
+        for depth, section in sections.items():
+            self.assertEqual(normalize_result(section[1]),
+                    normalize_result(serial_sections[depth][1]))
+
+    def get_grid_params(self, orientation, depth_index, cell_size,
+            cell_depth, limit=None):
+        """Return node query parameters for a single grid cell of the passed in
+        depth index.
+        """
+        params = {
+            'project_id': self.test_project_id,
+            'orientation': orientation,
+            'limit': limit,
+        }
+        width_dim, height_dim, depth_dim = node.ORIENTATION_DIMENSIONS[orientation]
+        for dim in (width_dim, height_dim):
+            min_param, max_param = node.DIMENSION_PARAMS[dim]
+            params[min_param], params[max_param] = 0.0, cell_size
+        min_param, max_param = node.DIMENSION_PARAMS[depth_dim]
+        params[min_param] = depth_index * cell_depth
+        params[max_param] = (depth_index + 1) * cell_depth
+        return params
+
+    def test_grid_cache_orientations(self):
+        p, cell_size = self.test_project_id, 20000.0
+        noop = lambda x: None
+        for orientation, cell_depth in zip(self.orientations, self.steps):
+            node.update_grid_cache(p, 'json', orientation, cell_size,
+                    cell_size, cell_depth, log=noop)
+            provider = node.GridCachedJsonNodeProvider(cell_width=cell_size,
+                    cell_height=cell_size, cell_depth=cell_depth)
+
+            # A grid cell contains the same nodes as a node query for the
+            # bounding box of the cell.
+            n_compared = 0
+            for depth_index in range(1, 4):
+                params = self.get_grid_params(orientation, depth_index,
+                        cell_size, cell_depth)
+                result, data_type = provider.get_tuples(dict(params), p, [],
+                        [], False, False)
+                self.assertEqual(data_type, 'json')
+                reference = node._node_list_tuples_query(dict(params), p,
+                        node.Postgis2dNodeProvider())
+                if not reference[0]:
+                    continue
+                self.assertEqual(normalize_result(result),
+                        normalize_result(reference))
+                n_compared += 1
+            self.assertGreater(n_compared, 0)
+
+    def test_grid_cache_limit(self):
+        p, cell_size, cell_depth, limit = self.test_project_id, 20000.0, 9, 2
+        noop = lambda x: None
+        node.update_grid_cache(p, 'json_text', 'xy', cell_size, cell_size,
+                cell_depth, log=noop)
+        provider = node.GridCachedJsonTextNodeProvider(cell_width=cell_size,
+                cell_height=cell_size, cell_depth=cell_depth)
+
+        # Without request limit, single cells are returned without decoding
+        params = self.get_grid_params('xy', 0, cell_size, cell_depth)
+        result, data_type = provider.get_tuples(dict(params), p, [], [],
+                False, False)
+        self.assertEqual(data_type, 'json_text')
+        treenodes, connectors, limit_reached = normalize_result(
+                json.loads(result))
+        self.assertGreater(len(treenodes), limit)
+        self.assertFalse(limit_reached)
+
+        # Single cells are clipped to the request limit
+        params['limit'] = limit
+        result, data_type = provider.get_tuples(dict(params), p, [], [],
+                False, False)
+        self.assertEqual(data_type, 'json')
+        self.assertEqual(len(result[0]), limit)
+        self.assertTrue(result[3])
+
+        # Cells populated with a node limit that isn't larger than the request
+        # limit, are returned without decoding them.
+        node.update_grid_cache(p, 'json_text', 'xy', cell_size, cell_size,
+                cell_depth, node_limit=limit, delete=True, log=noop)
+        result, data_type = provider.get_tuples(dict(params), p, [], [],
+                False, False)
+        self.assertEqual(data_type, 'json_text')
+        self.assertEqual(len(json.loads(result)[0]), limit)
+        params['limit'] = limit - 1
+        result, data_type = provider.get_tuples(dict(params), p, [], [],
+                False, False)
+        self.assertEqual(data_type, 'json')
+        self.assertEqual(len(result[0]), limit - 1)
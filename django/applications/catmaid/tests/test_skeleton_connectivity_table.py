@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+from collections import defaultdict
+from itertools import permutations
+
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from catmaid.models import Relation, Treenode, TreenodeConnector
+
+from .common import CatmaidTestCase, init_consistent_data
+
+
+class SkeletonConnectivityTestMixin(object):
+
+    def get_connectivity(self):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT source_skeleton_id, source_relation_id,
+                target_skeleton_id, target_relation_id, confidence_counts
+            FROM catmaid_skeleton_connectivity
+        """)
+        return dict(((row[0], row[1], row[2], row[3]), row[4])
+                for row in cursor.fetchall())
+
+    def get_expected_connectivity(self):
+        """Count all link pairs of the same connector."""
+        links = defaultdict(list)
+        for link in TreenodeConnector.objects.all():
+            links[link.connector_id].append(link)
+
+        connectivity = defaultdict(lambda: [0, 0, 0, 0, 0])
+        for connector_links in links.values():
+            for l1, l2 in permutations(connector_links, 2):
+                key = (l1.skeleton_id, l1.relation_id, l2.skeleton_id, l2.relation_id)
+                connectivity[key][min(l1.confidence, l2.confidence) - 1] += 1
+
+        return dict(connectivity)
+
+
+class SkeletonConnectivityTableTests(SkeletonConnectivityTestMixin,
+        CatmaidTestCase):
+    """Test the trigger based skeleton connectivity table update.
+    """
+
+    def test_connectivity_update(self):
+        self.assertEqual(self.get_connectivity(), self.get_expected_connectivity())
+
+        # Change confidence
+        link = TreenodeConnector.objects.filter(project_id=self.test_project_id,
+                relation__relation_name='postsynaptic_to').first()
+        TreenodeConnector.objects.filter(id=link.id).update(confidence=2)
+        self.assertEqual(self.get_connectivity(), self.get_expected_connectivity())
+
+        # Add a new link to an existing connector
+        presynaptic_to = Relation.objects.get(project_id=self.test_project_id,
+                relation_name='presynaptic_to')
+        TreenodeConnector.objects.create(project_id=self.test_project_id,
+                user_id=link.user_id, relation=presynaptic_to,
+                treenode_id=link.treenode_id, connector_id=link.connector_id,
+                skeleton_id=link.skeleton_id, confidence=3)
+        self.assertEqual(self.get_connectivity(), self.get_expected_connectivity())
+
+        # Delete links
+        TreenodeConnector.objects.filter(id=link.id).delete()
+        self.assertEqual(self.get_connectivity(), self.get_expected_connectivity())
+
+        TreenodeConnector.objects.all().delete()
+        self.assertEqual(self.get_connectivity(), {})
+
+
+class ConcurrentSkeletonConnectivityTableTests(SkeletonConnectivityTestMixin,
+        TransactionTestCase):
+    """Test the skeleton connectivity table update with concurrent link
+    changes, which need to be committed in separate transactions.
+    """
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        init_consistent_data()
+        self.test_project_id = 3
+
+    def test_concurrent_link_inserts(self):
+        link = TreenodeConnector.objects.filter(
+                project_id=self.test_project_id).first()
+        postsynaptic_to = Relation.objects.get(project_id=self.test_project_id,
+                relation_name='postsynaptic_to')
+        treenodes = list(Treenode.objects.filter(
+                project_id=self.test_project_id).exclude(
+                    id=link.treenode_id).order_by('id')[:2])
+
+        def add_link(treenode):
+            TreenodeConnector.objects.create(project_id=self.test_project_id,
+                    user_id=link.user_id, relation=postsynaptic_to,
+                    treenode=treenode, connector_id=link.connector_id,
+                    skeleton_id=treenode.skeleton_id, confidence=5)
+
+        # The second link is added while the transaction of the first one is
+        # still open. Its connectivity update has to wait for the first
+        # transaction to commit to also count the pair of both new links.
+        first_link_added = threading.Event()
+        commit_first_link = threading.Event()
+        errors = []
+
+        def add_first_link():
+            try:
+                with transaction.atomic():
+                    add_link(treenodes[0])
+                    first_link_added.set()
+                    commit_first_link.wait(10)
+            except Exception as e:
+                errors.append(e)
+                first_link_added.set()
+            finally:
+                connection.close()
+
+        def add_second_link():
+            try:
+                with transaction.atomic():
+                    add_link(treenodes[1])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        first = threading.Thread(target=add_first_link)
+        first.start()
+        first_link_added.wait(10)
+        second = threading.Thread(target=add_second_link)
+        second.start()
+        # Give the second update a chance to finish before the first link is
+        # committed, which it must not do.
+        second.join(1)
+        self.assertTrue(second.is_alive())
+        commit_first_link.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.get_connectivity(), self.get_expected_connectivity())
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from catmaid.control.review import get_review_status
+from catmaid.models import Review, ReviewerWhitelist, Treenode
+
+from .common import CatmaidTestCase
+
+
+class SkeletonReviewSummaryTableTests(CatmaidTestCase):
+    """Test the trigger based skeleton review summary update and the review
+    status computation based on it.
+    """
+
+    def get_summary(self):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT skeleton_id, reviewer_id, num_reviewed_nodes,
+                first_review_time, last_review_time
+            FROM catmaid_skeleton_review_summary
+        """)
+        return dict(((row[0], row[1]), (row[2], row[3], row[4]))
+                for row in cursor.fetchall())
+
+    def get_expected_summary(self):
+        """Summarize all reviews per reviewer and as union."""
+        reviewed_nodes = defaultdict(set)
+        review_times = defaultdict(list)
+        for review in Review.objects.all():
+            for key in ((review.skeleton_id, review.reviewer_id),
+                    (review.skeleton_id, None)):
+                reviewed_nodes[key].add(review.treenode_id)
+                review_times[key].append(review.review_time)
+
+        return dict((key, (len(nodes), min(review_times[key]),
+                max(review_times[key]))) for key, nodes in reviewed_nodes.items())
+
+    def get_expected_review_status(self, skeleton_ids, accept=lambda r: True):
+        reviewed_nodes = defaultdict(set)
+        for review in Review.objects.filter(skeleton_id__in=skeleton_ids):
+            if accept(review):
+                reviewed_nodes[review.skeleton_id].add(review.treenode_id)
+        return dict((skeleton_id, len(reviewed_nodes[skeleton_id]))
+                for skeleton_id in skeleton_ids)
+
+    def review(self, reviewer, treenode, review_time):
+        return Review.objects.create(project_id=self.test_project_id,
+                reviewer=reviewer, review_time=review_time,
+                skeleton_id=treenode.skeleton_id, treenode=treenode)
+
+    def test_summary_update(self):
+        self.assertEqual(self.get_summary(), {})
+
+        now = timezone.now()
+        reviewer_1 = self.user
+        reviewer_2 = User.objects.get(username='test2')
+        treenodes = list(Treenode.objects.filter(
+                project_id=self.test_project_id).order_by('id'))
+        skeleton_ids = sorted(set(t.skeleton_id for t in treenodes))
+
+        # Overlapping reviews of two reviewers
+        for i, treenode in enumerate(treenodes):
+            if i % 2 == 0:
+                self.review(reviewer_1, treenode, now - timedelta(days=i))
+            if i % 3 == 0:
+                self.review(reviewer_2, treenode, now - timedelta(hours=i))
+        self.assertEqual(self.get_summary(), self.get_expected_summary())
+
+        # Update review times and move reviews to another skeleton
+        review = Review.objects.filter(reviewer=reviewer_1).first()
+        Review.objects.filter(id=review.id).update(review_time=now)
+        self.assertEqual(self.get_summary(), self.get_expected_summary())
+
+        Review.objects.filter(skeleton_id=skeleton_ids[0]).update(
+                skeleton_id=skeleton_ids[1])
+        self.assertEqual(self.get_summary(), self.get_expected_summary())
+
+        # Check review status with different filters
+        status = get_review_status(skeleton_ids, self.test_project_id)
+        self.assertEqual(dict((k, v[1]) for k, v in status.items()),
+                self.get_expected_review_status(status.keys()))
+
+        status = get_review_status(skeleton_ids, self.test_project_id,
+                user_ids=[reviewer_2.id])
+        self.assertEqual(dict((k, v[1]) for k, v in status.items()),
+                self.get_expected_review_status(status.keys(),
+                    lambda r: r.reviewer_id == reviewer_2.id))
+
+        status = get_review_status(skeleton_ids, self.test_project_id,
+                excluding_user_ids=[reviewer_2.id])
+        self.assertEqual(dict((k, v[1]) for k, v in status.items()),
+                self.get_expected_review_status(status.keys(),
+                    lambda r: r.reviewer_id != reviewer_2.id))
+
+        accept_after = now - timedelta(days=3)
+        ReviewerWhitelist.objects.create(project_id=self.test_project_id,
+                user=reviewer_2, reviewer=reviewer_1, accept_after=accept_after)
+        ReviewerWhitelist.objects.create(project_id=self.test_project_id,
+                user=reviewer_2, reviewer=reviewer_2, accept_after=accept_after)
+        status = get_review_status(skeleton_ids, self.test_project_id,
+                whitelist_id=reviewer_2.id)
+        self.assertEqual(dict((k, v[1]) for k, v in status.items()),
+                self.get_expected_review_status(status.keys(),
+                    lambda r: r.review_time >= accept_after))
+
+        # Delete reviews
+        Review.objects.filter(reviewer=reviewer_1).delete()
+        self.assertEqual(self.get_summary(), self.get_expected_summary())
+
+        Review.objects.all().delete()
+        self.assertEqual(self.get_summary(), {})
@@ -18,7 +18,8 @@ from catmaid.control import (authentication, user, log, message, client, common,
         cropping, data_view, ontology, classification, notifications, roi,
         clustering, volume, flytem, dvid, useranalytics, user_evaluation,
         search, graphexport, transaction, graph2, circles, analytics, review,
-        wiringdiagram, object, sampler, treenodetable, nat, point, landmarks)
+        wiringdiagram, object, sampler, treenodetable, nat, point, landmarks,
+        nodeoverview)
 
 from catmaid.views import CatmaidView
 from catmaid.history import record_request_action as record_view
@@ -106,6 +107,7 @@ urlpatterns += [
 urlpatterns += [
     url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/tile$', tile.get_tile),
     url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/put_tile$', tile.put_tile),
+    url(r'^(?P<project_id>\d+)/stack/(?P<stack_id>\d+)/node-overview/(?P<zoom_level>\d+)/(?P<section>\d+)/(?P<row>\d+)_(?P<col>\d+)\.png$', nodeoverview.node_overview_tile),
 ]
 
 # Tracing general
@@ -219,6 +221,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/nodes/most-recent$', node.most_recent_treenode),
     url(r'^(?P<project_id>\d+)/nodes/location$', node.get_locations),
     url(r'^(?P<project_id>\d+)/node/nearest$', node.node_nearest),
+    url(r'^(?P<project_id>\d+)/nodes/nearest$', node.nodes_nearest),
     url(r'^(?P<project_id>\d+)/node/update$', record_view("nodes.update_location")(node.node_update)),
     url(r'^(?P<project_id>\d+)/node/list$', node.node_list_tuples),
     url(r'^(?P<project_id>\d+)/node/get_location$', node.get_location),
@@ -280,6 +283,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/import$', record_view("skeletons.import")(skeleton.import_skeleton)),
     url(r'^(?P<project_id>\d+)/skeleton/annotationlist$', skeleton.annotation_list),
     url(r'^(?P<project_id>\d+)/skeletons/within-spatial-distance$', skeleton.within_spatial_distance),
+    url(r'^(?P<project_id>\d+)/skeletons/within-spatial-distance/multiple$', skeleton.within_spatial_distance_multiple),
     url(r'^(?P<project_id>\d+)/skeletons/node-labels$', skeleton.skeletons_by_node_labels),
     url(r'^(?P<project_id>\d+)/skeletongroup/adjacency_matrix$', skeleton.adjacency_matrix),
     url(r'^(?P<project_id>\d+)/skeletongroup/skeletonlist_subgraph', skeleton.skeletonlist_subgraph),
@@ -496,6 +500,7 @@ urlpatterns += [
     # Circles
     url(r'^(?P<project_id>\d+)/graph/circlesofhell', circles.circles_of_hell),
     url(r'^(?P<project_id>\d+)/graph/directedpaths', circles.find_directed_paths),
+    url(r'^(?P<project_id>\d+)/graph/shortest-paths$', circles.find_shortest_directed_paths),
     url(r'^(?P<project_id>\d+)/graph/dps', circles.find_directed_path_skeletons),
 
     # Review
@@ -503,6 +508,7 @@ urlpatterns += [
 
     # Search
     url(r'^(?P<project_id>\d+)/search$', search.search),
+    url(r'^(?P<project_id>\d+)/search/names$', search.search_names),
 
     # Wiring diagram export
     url(r'^(?P<project_id>\d+)/wiringdiagram/json$', wiringdiagram.export_wiring_diagram),
@@ -7,4 +7,8 @@ from django.test.runner import DiscoverRunner
 class TestSuiteRunner(DiscoverRunner):
     def __init__(self, *args, **kwargs):
         settings.TESTING_ENVIRONMENT = True
+        # Test transactions are rolled back, which cached relation and class
+        # maps wouldn't notice.
+        settings.RELATION_CLASS_MAP_CACHE_TIMEOUT = 0
+        settings.CONNECTOME_GRAPH_REFRESH_INTERVAL = 0
         super(TestSuiteRunner, self).__init__(*args, **kwargs)
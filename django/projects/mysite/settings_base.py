@@ -187,6 +187,22 @@ NODE_PROVIDERS = [
     'postgis3d'
 ]
 
+# Relation and class name to ID maps of projects are cached in each process for
+# this many seconds. Changes made through the same process are respected
+# immediately, changes made by other processes after the timeout at the latest.
+# A value of 0 disables this cache.
+RELATION_CLASS_MAP_CACHE_TIMEOUT = 60
+
+# Streamed skeleton exports load this many skeletons at once, which limits the
+# memory a single export needs.
+STREAMED_EXPORT_BATCH_SIZE = 50
+
+# Multi-hop connectivity queries use an in-memory graph of each project's
+# synaptic connections, which every process keeps. A graph is updated with
+# changes made in the meantime if it is older than this many seconds when it is
+# used. A value of 0 disables this cache and loads the graph for each request.
+CONNECTOME_GRAPH_REFRESH_INTERVAL = 10
+
 # By default, prepared statements are disabled. If connection pooling is used,
 # this can further improve performance.
 PREPARED_STATEMENTS = False
@@ -28,4 +28,5 @@ CREATE DATABASE "$CATMAID_DATABASE" OWNER "$CATMAID_USER" ENCODING 'UTF8';
 
 \connect $CATMAID_DATABASE
 CREATE EXTENSION postgis;
+CREATE EXTENSION pg_trgm;
 EOSQL
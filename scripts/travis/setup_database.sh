@@ -6,3 +6,4 @@ sudo cp /etc/postgresql/9.5/main/pg_hba.conf /etc/postgresql/9.6/main/pg_hba.con
 sudo /etc/init.d/postgresql restart
 psql -c 'CREATE DATABASE catmaid;' -U postgres
 psql -c 'CREATE EXTENSION postgis;' -U postgres catmaid
+psql -c 'CREATE EXTENSION pg_trgm;' -U postgres catmaid